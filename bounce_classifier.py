@@ -0,0 +1,332 @@
+"""
+Bounce Classifier Module
+
+Single-pass bounce detection and classification for inbound messages.
+
+All indicator phrases (subject, sender and body) are matched in one pass
+over the text with a multi-pattern automaton: pyahocorasick when it is
+installed, otherwise one compiled alternation regex. Indicators are
+weighted - strong phrases ("delivery has failed", "undeliverable") mark a
+bounce on their own, weak tokens ("550", "bounce", "ndr") only count next
+to other evidence, and soft phrases ("will retry", "mailbox full") only
+next to a status code or a bounce-like sender, so ordinary replies
+mentioning them are not treated as bounces. Run the module directly to
+check the sample bounces and replies.
+
+The failed recipient and status code are read deterministically from
+RFC 3464 delivery-status fields (Final-Recipient / Status / Action /
+Diagnostic-Code) or Exchange/Gmail/Postfix NDR text before falling back to
+the first plausible address. Bodies arrive with HTML stripped and
+whitespace collapsed, so every field pattern works on a single line.
+
+This module is imported and used by main.py for bounce handling.
+"""
+
+import re
+import logging
+from dataclasses import dataclass
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import ahocorasick  # pyahocorasick
+    HAS_AHOCORASICK = True
+except ImportError:
+    ahocorasick = None
+    HAS_AHOCORASICK = False
+
+# Indicator weights
+STRONG = 'strong'
+WEAK = 'weak'
+SOFT = 'soft'
+
+SUBJECT_INDICATORS = {
+    STRONG: [
+        "delivery status notification (failure)", "delivery status notification (delay)",
+        "delivery status notification", "mail delivery failed", "mail delivery failure",
+        "undelivered mail returned to sender", "undeliverable:", "undeliverable mail",
+        "message delivery failure", "delivery failure", "returned mail", "mail system error",
+        "delivery error", "non-delivery report", "failure notice", "message not delivered",
+        "delivery has failed", "could not be delivered",
+    ],
+    WEAK: ["delivery report", "ndr", "bounce", "returned"],
+}
+
+SENDER_LOCAL_PARTS = {
+    STRONG: ["mailer-daemon", "postmaster", "microsoftexchange329e71ec88ae4615bbc36ab6ce41109e"],
+    WEAK: ["bounce", "bounces", "delivery", "noreply", "no-reply"],
+}
+
+BODY_INDICATORS = {
+    STRONG: [
+        "message could not be delivered", "delivery has failed", "recipient address rejected",
+        "address not found", "user unknown", "recipient not found", "permanent failure",
+        "your message wasn't delivered", "your message couldn't be delivered",
+        "delivery to the following recipient failed", "delivery to the following recipients failed",
+        "the email account that you tried to reach does not exist", "no such user",
+        "mailbox unavailable", "final-recipient:", "reporting-mta:", "diagnostic-code:",
+        "remote server returned", "undeliverable", "delivery status notification",
+    ],
+    WEAK: ["550", "551", "552", "553", "554", "smtp error", "bounce message", "delivery failure",
+           "message rejected", "ndr"],
+    SOFT: ["mailbox full", "quota exceeded", "over quota", "temporary failure", "temporarily deferred",
+           "try again later", "action: delayed", "delivery delayed", "will retry"],
+}
+
+# Patterns that must not match inside longer words/numbers
+WORD_BOUNDARY_PATTERNS = {"550", "551", "552", "553", "554", "ndr", "bounce", "returned"}
+
+EMAIL_RE = r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}'
+_FINAL_RECIPIENT = re.compile(r'(?:final|original)-recipient:\s*rfc822\s*;\s*<?(' + EMAIL_RE + ')', re.IGNORECASE)
+_STATUS = re.compile(r'\bstatus:\s*([245]\.\d{1,3}\.\d{1,3})', re.IGNORECASE)
+_ACTION = re.compile(r'\baction:\s*(failed|delayed|delivered|relayed|expanded)', re.IGNORECASE)
+_DIAGNOSTIC = re.compile(
+    r'diagnostic-code:\s*(?:smtp|x-[\w-]+)\s*;\s*(.+?)(?=\s+(?:last-attempt-date|final-recipient|original-recipient|'
+    r'action|status|remote-mta|reporting-mta|arrival-date|x-[\w-]+):|$)',
+    re.IGNORECASE
+)
+_NDR_RECIPIENT_PATTERNS = [
+    # Exchange / Outlook
+    re.compile(r"delivery has failed to these recipients or groups:?\s*(?:[^<@]*<)?(" + EMAIL_RE + ")", re.IGNORECASE),
+    re.compile(r"your message to\s*<?(" + EMAIL_RE + r")>?\s*couldn'?t be delivered", re.IGNORECASE),
+    # Gmail
+    re.compile(r"your message wasn'?t delivered to\s*<?(" + EMAIL_RE + ")", re.IGNORECASE),
+    re.compile(r"delivery to the following recipients? failed(?: permanently)?:?\s*<?(" + EMAIL_RE + ")", re.IGNORECASE),
+    # Postfix / generic
+    re.compile(r"<(" + EMAIL_RE + r")>:\s*(?:host|mailbox|user|recipient|said|unknown)", re.IGNORECASE),
+    re.compile(r"(?:original recipient|recipient address|failed recipient)[:\s]+<?(" + EMAIL_RE + ")", re.IGNORECASE),
+]
+_SMTP_REPLY = re.compile(r"\b([245]\d\d)[ -]([245]\.\d{1,3}\.\d{1,3})?", re.IGNORECASE)
+_ENHANCED_STATUS = re.compile(r"\b([45]\.\d{1,3}\.\d{1,3})\b")
+_ANGLE_EMAIL = re.compile(r'<(' + EMAIL_RE + ')>')
+_ANY_EMAIL = re.compile(r'\b(' + EMAIL_RE + r')\b')
+
+# Addresses that appear in bounces but are never the failed recipient
+DAEMON_LOCAL_PARTS = {'mailer-daemon', 'postmaster', 'noreply', 'no-reply'}
+
+# Enhanced status codes that are transient even though they start with 5
+SOFT_PERMANENT_CODES = {'5.2.2', '5.2.0', '5.4.7'}
+
+STATUS_REASONS = {
+    '5.1.1': "Invalid email address",
+    '5.1.0': "Invalid email address",
+    '5.1.10': "Invalid email address",
+    '5.1.2': "Invalid recipient domain",
+    '5.2.1': "Mailbox unavailable",
+    '5.2.2': "Mailbox full",
+    '5.4.1': "Recipient address rejected",
+    '5.7.1': "Delivery not authorized",
+    '4.2.2': "Mailbox full",
+}
+
+
+@dataclass
+class BounceResult:
+    is_bounce: bool
+    bounce_type: Optional[str] = None       # 'hard' | 'soft'
+    recipient: str = ''
+    status: Optional[str] = None            # enhanced status code, e.g. 5.1.1
+    smtp_code: Optional[str] = None         # basic reply code, e.g. 550
+    action: Optional[str] = None            # DSN Action field
+    diagnostic: Optional[str] = None
+    reason: str = ''
+    source: str = ''                        # 'dsn' | 'ndr' | 'text'
+
+
+class _PatternMatcher:
+    """Multi-pattern matcher returning the pattern hits in a single pass."""
+
+    def __init__(self, patterns: Dict[str, Iterable[str]]):
+        self.weights: Dict[str, str] = {}
+        for weight, words in patterns.items():
+            for word in words:
+                self.weights.setdefault(word.lower(), weight)
+        words = sorted(self.weights, key=len, reverse=True)
+        if HAS_AHOCORASICK:
+            self.automaton = ahocorasick.Automaton()
+            for word in words:
+                self.automaton.add_word(word, word)
+            self.automaton.make_automaton()
+            self.regex = None
+        else:
+            self.automaton = None
+            self.regex = re.compile('|'.join(re.escape(w) for w in words))
+
+    def hits(self, text: str) -> Dict[str, Set[str]]:
+        """{weight: {matched patterns}} for lower-cased text."""
+        found: Dict[str, Set[str]] = {}
+        if not text:
+            return found
+        if self.automaton is not None:
+            matches = ((end - len(word) + 1, end + 1, word) for end, word in self.automaton.iter(text))
+        else:
+            matches = ((m.start(), m.end(), m.group(0)) for m in self.regex.finditer(text))
+        for start, end, word in matches:
+            if word in WORD_BOUNDARY_PATTERNS:
+                before = text[start - 1] if start > 0 else ' '
+                after = text[end] if end < len(text) else ' '
+                if before.isalnum() or after.isalnum():
+                    continue
+            found.setdefault(self.weights[word], set()).add(word)
+        return found
+
+
+_subject_matcher = _PatternMatcher(SUBJECT_INDICATORS)
+_body_matcher = _PatternMatcher(BODY_INDICATORS)
+
+
+def _sender_weight(sender_email: str) -> Optional[str]:
+    local = (sender_email or '').strip().lower().split('@')[0].strip('<> ')
+    if local in SENDER_LOCAL_PARTS[STRONG]:
+        return STRONG
+    if local in SENDER_LOCAL_PARTS[WEAK]:
+        return WEAK
+    return None
+
+
+def _is_daemon_address(address: str) -> bool:
+    return address.split('@')[0].lower() in DAEMON_LOCAL_PARTS
+
+
+def extract_failed_recipient(body: str, exclude: Iterable[str] = ()) -> Tuple[str, str]:
+    """
+    Failed recipient of a bounce body and where it was found
+    ('dsn', 'ndr' or 'text'); ('', '') if none.
+    """
+    if not body:
+        return '', ''
+    excluded = {e.lower() for e in exclude if e}
+
+    def usable(address: str) -> bool:
+        address = address.lower()
+        return address not in excluded and not _is_daemon_address(address)
+
+    for m in _FINAL_RECIPIENT.finditer(body):
+        if usable(m.group(1)):
+            return m.group(1).lower(), 'dsn'
+    for pattern in _NDR_RECIPIENT_PATTERNS:
+        for m in pattern.finditer(body):
+            if usable(m.group(1)):
+                return m.group(1).lower(), 'ndr'
+    for pattern in (_ANGLE_EMAIL, _ANY_EMAIL):
+        for m in pattern.finditer(body):
+            if usable(m.group(1)):
+                return m.group(1).lower(), 'text'
+    return '', ''
+
+
+def _classify_type(status: Optional[str], smtp_code: Optional[str], action: Optional[str],
+                   soft_hits: Set[str]) -> str:
+    if action == 'delayed':
+        return 'soft'
+    if status:
+        if status.startswith('4') or status in SOFT_PERMANENT_CODES:
+            return 'soft'
+        return 'hard'
+    if smtp_code:
+        return 'soft' if smtp_code.startswith('4') else 'hard'
+    return 'soft' if soft_hits else 'hard'
+
+
+def _reason(status: Optional[str], bounce_type: str, soft_hits: Set[str], body_lower: str) -> str:
+    if status and status in STATUS_REASONS:
+        return STATUS_REASONS[status]
+    if soft_hits & {"mailbox full", "quota exceeded", "over quota"}:
+        return "Mailbox full"
+    if bounce_type == 'soft':
+        return "Temporary delivery failure"
+    if "user unknown" in body_lower or "address not found" in body_lower or "no such user" in body_lower \
+            or "does not exist" in body_lower or "couldn't be found" in body_lower:
+        return "Invalid email address"
+    if "mailbox unavailable" in body_lower:
+        return "Mailbox unavailable"
+    return "Email delivery failed"
+
+
+def classify_bounce(subject: str, body: str, sender_email: str = '', exclude: Iterable[str] = ()) -> BounceResult:
+    """
+    Decide whether a message is a bounce and, if so, classify it.
+
+    exclude: addresses that are never the failed recipient (e.g. the
+    mailbox that received the bounce).
+    """
+    subject_lower = (subject or '').lower()
+    body = body or ''
+    body_lower = body.lower()
+
+    subject_hits = _subject_matcher.hits(subject_lower)
+    body_hits = _body_matcher.hits(body_lower)
+    sender_weight = _sender_weight(sender_email)
+
+    action_m = _ACTION.search(body)
+    status_m = _STATUS.search(body)
+    action = action_m.group(1).lower() if action_m else None
+    dsn = bool(_FINAL_RECIPIENT.search(body)) and (action in ('failed', 'delayed') or bool(status_m))
+
+    strong = bool(subject_hits.get(STRONG) or body_hits.get(STRONG)) or sender_weight == STRONG or dsn
+    # Soft phrases ("will retry", "try again later") are everyday wording; they
+    # only count once a status code or a bounce-like sender points at a bounce
+    bounce_context = bool(_ENHANCED_STATUS.search(body)) or sender_weight == WEAK
+    weak_signals = (len(subject_hits.get(WEAK, ())) + len(body_hits.get(WEAK, ()))
+                    + (1 if sender_weight == WEAK else 0)
+                    + (1 if body_hits.get(SOFT) and bounce_context else 0))
+    # Weak tokens alone (e.g. "550" or "bounce" in a normal reply) are not enough
+    if not strong and (weak_signals < 2 or not bounce_context):
+        return BounceResult(is_bounce=False)
+
+    status = status_m.group(1) if status_m else None
+    smtp_code = None
+    diagnostic = None
+    diag_m = _DIAGNOSTIC.search(body)
+    if diag_m:
+        diagnostic = diag_m.group(1).strip()[:500]
+    reply_m = _SMTP_REPLY.search(diagnostic or '') or _SMTP_REPLY.search(body)
+    if reply_m:
+        smtp_code = reply_m.group(1)
+        if not status and reply_m.group(2):
+            status = reply_m.group(2)
+    if not status:
+        enhanced = _ENHANCED_STATUS.search(body)
+        status = enhanced.group(1) if enhanced else None
+
+    recipient, source = extract_failed_recipient(body, exclude=list(exclude) + [sender_email or ''])
+    soft_hits = body_hits.get(SOFT, set())
+    bounce_type = _classify_type(status, smtp_code, action, soft_hits)
+
+    return BounceResult(
+        is_bounce=True,
+        bounce_type=bounce_type,
+        recipient=recipient,
+        status=status,
+        smtp_code=smtp_code,
+        action=action,
+        diagnostic=diagnostic,
+        reason=_reason(status, bounce_type, soft_hits, body_lower),
+        source='dsn' if dsn else (source or 'text'),
+    )
+
+
+if __name__ == '__main__':
+    """Check the classifier against sample bounces and human replies"""
+    cases = [
+        # (subject, body, sender, expected is_bounce, expected bounce_type)
+        ("Undeliverable: Invitation", "Delivery has failed to these recipients or groups: jane@acme.com "
+         "The email address you entered couldn't be found.", "postmaster@acme.com", True, 'hard'),
+        ("Delivery Status Notification (Failure)", "Final-Recipient: rfc822; jane@acme.com Action: failed "
+         "Status: 5.1.1 Diagnostic-Code: smtp; 550 5.1.1 user unknown", "mailer-daemon@googlemail.com", True, 'hard'),
+        ("Delivery delayed", "Mailbox full for jane@acme.com, status 4.2.2, will retry", "noreply@acme.com", True, 'soft'),
+        # Human replies using bounce-like wording
+        ("Re: meeting", "The link failed, I will retry and try again later.", "jane@acme.com", False, None),
+        ("Re: booking", "Our mailbox full of requests, we will retry tomorrow. Temporary failure on our side.",
+         "jane@acme.com", False, None),
+        ("Re: rooms", "Room 550 is ready; the bounce house was returned.", "jane@acme.com", False, None),
+    ]
+    failures = 0
+    for subject, body, sender, expected, expected_type in cases:
+        result = classify_bounce(subject, body, sender)
+        ok = result.is_bounce == expected and (not expected or result.bounce_type == expected_type)
+        failures += 0 if ok else 1
+        print(f"{'ok  ' if ok else 'FAIL'} {subject!r}: is_bounce={result.is_bounce} type={result.bounce_type} "
+              f"recipient={result.recipient!r} reason={result.reason!r}")
+    raise SystemExit(1 if failures else 0)
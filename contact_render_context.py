@@ -0,0 +1,277 @@
+"""
+Contact Render Context Module
+
+Derived template fields for a contact (prefix, last_name, greeting_name,
+first_name and the canonical link aliases) are computed once and stored on
+campaign_contacts.render_context, so rendering a batch of messages only
+merges a ready-made dict into the template context.
+
+- Write paths call refresh_render_contexts() for the contacts they touch.
+- A BEFORE UPDATE trigger clears render_context whenever name, prefix or the
+  links change through any other path, and load_render_contexts() fills
+  missing contexts for a whole batch in one UPDATE.
+
+This module is imported and used by main.py for message rendering.
+"""
+
+import re
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Source columns a render context is derived from
+RENDER_SOURCE_FIELDS = ('name', 'prefix', 'payment_link', 'forms_link')
+
+PREFIX_PATTERN = re.compile(r"^(Mr\.|Mr|Ms\.|Ms|Mrs\.|Mrs|Dr\.|Dr|Prof\.|Prof|Sir|Madam|Eng\.|Eng)\b\.?", re.IGNORECASE)
+
+
+def extract_name_parts_with_prefix(full_name: str) -> tuple:
+    """
+    Parses a name string for the email template: 'Dear {{prefix}} {{name}}'
+
+    Logic:
+    1. If a Prefix is found (e.g., Mr., Dr.), returns (Prefix, Last Name).
+    2. If NO Prefix is found, returns (First Name, Last Name).
+       This ensures 'Dear {{prefix}} {{name}}' reads as 'Dear Hatem Ayman'.
+    """
+    if not full_name or not isinstance(full_name, str):
+        return "", ""
+
+    # Clean whitespace
+    full_name = full_name.strip()
+
+    # 1. Common prefixes (Case insensitive) at the start of the string
+    match = PREFIX_PATTERN.match(full_name)
+
+    if match:
+        # --- PATH A: Prefix Found ---
+        # Goal: Return ("Mr.", "Ayman")
+
+        found_prefix = match.group(0).strip()
+        # Remove the prefix from the string to analyze the rest
+        remainder = full_name[match.end():].strip()
+
+        # Split remaining name by comma OR space to find the Last Name
+        if ',' in remainder:
+            parts = remainder.split(',')
+        else:
+            parts = remainder.split()
+
+        # We take the LAST part as the surname
+        last_name = parts[-1].strip() if parts else remainder
+
+        # Ensure prefix has a dot if missing (optional polish)
+        if not found_prefix.endswith('.') and len(found_prefix) <= 3:
+             found_prefix += "."
+
+        return found_prefix.title(), last_name.title()
+
+    else:
+        # --- PATH B: No Prefix Found ---
+        # Goal: Return ("Hatem", "Ayman") so template reads "Dear Hatem Ayman"
+
+        if ',' in full_name:
+
+            parts = full_name.split(',')
+            first_part = parts[0].strip()
+            last_part = parts[-1].strip()
+            return first_part.title(), last_part.title()
+        else:
+            # Handle "Hatem Ayman" (Space separated)
+            parts = full_name.split()
+            if len(parts) >= 2:
+                # First word = Prefix slot, Rest = Name slot
+                return parts[0].title(), " ".join(parts[1:]).title()
+            else:
+                # Single Name (e.g. "Cher")
+                # Return empty prefix, Name in name slot
+                return "", full_name.title()
+
+
+def derive_name_fields(raw_name: Optional[str], db_prefix: Optional[str]) -> Dict[str, str]:
+    """
+    Greeting fields for a contact.
+
+    Path A: a stored prefix (e.g. "prof") is used as-is and the last word of
+    the name (after any comma) becomes last_name -> "Prof. Kim".
+    Path B: without a stored prefix everything is extracted from the name
+    string (see extract_name_parts_with_prefix) -> "Hatem Ayman".
+    """
+    raw_name = (raw_name or '').strip()
+    db_prefix = (db_prefix or '').strip()
+
+    final_prefix = ""
+    final_last_name = raw_name
+
+    if db_prefix:
+        final_prefix = db_prefix
+        # Fix Punctuation (Add dot if missing, skip "Sir")
+        if len(final_prefix) <= 3 and not final_prefix.endswith('.') and final_prefix.lower() not in ["sir", "madam"]:
+            final_prefix += "."
+
+        # Extract "Low" from "test3, low" or "Kim" from "Test4 Kim"
+        if ',' in raw_name:
+            final_last_name = raw_name.split(',')[-1].strip()
+        else:
+            parts = raw_name.split()
+            final_last_name = parts[-1].strip() if parts else raw_name
+    else:
+        try:
+            final_prefix, final_last_name = extract_name_parts_with_prefix(raw_name)
+        except Exception as e:
+            logger.error(f"[RENDER CONTEXT] Name extraction failed for '{raw_name}': {e}")
+            final_prefix = ""
+            final_last_name = raw_name
+
+    final_prefix = final_prefix.title() if final_prefix else ""
+    final_last_name = final_last_name.title()
+    greeting_name = f"{final_prefix} {final_last_name}" if final_prefix else final_last_name
+    first_name = final_prefix if final_prefix else (final_last_name.split()[0] if ' ' in final_last_name else final_last_name)
+
+    return {
+        'prefix': final_prefix,
+        'last_name': final_last_name,
+        'greeting_name': greeting_name,
+        'first_name': first_name,
+        # Templates using {{name}} get the formatted greeting
+        'name': greeting_name,
+    }
+
+
+def build_render_context(contact: Any) -> Dict[str, Any]:
+    """Compute the stored render context for a contact row or dict."""
+    get = contact.get if hasattr(contact, 'get') else (lambda k, d=None: d)
+    context = derive_name_fields(get('name'), get('prefix'))
+
+    # Canonical link fields plus the aliases templates use
+    payment_link = get('payment_link') or get('payments_link')
+    forms_link = get('forms_link') or get('form_link')
+    context['payment_link'] = payment_link
+    context['payments_link'] = payment_link
+    context['forms_link'] = forms_link
+    context['form_link'] = forms_link
+    return context
+
+
+def stored_render_context(contact: Any) -> Optional[Dict[str, Any]]:
+    """Return the render context stored on a fetched contact row, if any."""
+    try:
+        value = contact.get('render_context') if hasattr(contact, 'get') else None
+    except Exception:
+        value = None
+    if not value:
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    return value if isinstance(value, dict) else None
+
+
+async def ensure_render_context_schema(conn):
+    """Add the render_context column and the trigger that invalidates it."""
+    await conn.execute("""
+        ALTER TABLE campaign_contacts ADD COLUMN IF NOT EXISTS render_context JSONB
+    """)
+    # to_jsonb() keeps the trigger valid whether or not optional source
+    # columns such as prefix exist on this database.
+    source_list_new = ', '.join(f"to_jsonb(NEW) ->> '{f}'" for f in RENDER_SOURCE_FIELDS)
+    source_list_old = ', '.join(f"to_jsonb(OLD) ->> '{f}'" for f in RENDER_SOURCE_FIELDS)
+    await conn.execute(f"""
+        CREATE OR REPLACE FUNCTION campaign_contacts_invalidate_render_context()
+        RETURNS trigger AS $$
+        BEGIN
+            IF NEW.render_context IS NOT DISTINCT FROM OLD.render_context
+               AND ROW({source_list_new}) IS DISTINCT FROM ROW({source_list_old}) THEN
+                NEW.render_context := NULL;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("""
+        DROP TRIGGER IF EXISTS trg_campaign_contacts_render_context ON campaign_contacts
+    """)
+    await conn.execute("""
+        CREATE TRIGGER trg_campaign_contacts_render_context
+        BEFORE UPDATE ON campaign_contacts
+        FOR EACH ROW EXECUTE FUNCTION campaign_contacts_invalidate_render_context()
+    """)
+    logger.info("[RENDER CONTEXT] Ensured campaign_contacts.render_context column and trigger")
+
+
+async def _store_render_contexts(conn, contexts: Dict[int, Dict[str, Any]]):
+    if not contexts:
+        return
+    ids = list(contexts.keys())
+    payloads = [json.dumps(contexts[i]) for i in ids]
+    await conn.execute("""
+        UPDATE campaign_contacts cc
+        SET render_context = v.ctx::jsonb
+        FROM unnest($1::int[], $2::text[]) AS v(id, ctx)
+        WHERE cc.id = v.id
+    """, ids, payloads)
+
+
+async def refresh_render_contexts(conn, contact_ids: Optional[Iterable[int]] = None,
+                                  event_id: Optional[int] = None, only_missing: bool = False) -> Dict[int, Dict[str, Any]]:
+    """
+    Recompute and store render contexts.
+
+    Pass contact_ids to refresh specific contacts (e.g. right after a write),
+    or event_id to refresh a whole event (e.g. after an import). With
+    only_missing, contacts that already have a context are left alone.
+    """
+    conditions: List[str] = []
+    args: List[Any] = []
+    if contact_ids is not None:
+        ids = [int(i) for i in contact_ids if i is not None]
+        if not ids:
+            return {}
+        args.append(ids)
+        conditions.append(f"id = ANY(${len(args)}::int[])")
+    if event_id is not None:
+        args.append(int(event_id))
+        conditions.append(f"event_id = ${len(args)}")
+    if only_missing:
+        conditions.append("render_context IS NULL")
+    where = ' AND '.join(conditions) if conditions else 'TRUE'
+
+    rows = await conn.fetch(f"SELECT * FROM campaign_contacts WHERE {where}", *args)
+    contexts = {row['id']: build_render_context(row) for row in rows}
+    try:
+        await _store_render_contexts(conn, contexts)
+    except Exception as e:
+        logger.warning(f"[RENDER CONTEXT] Could not store render contexts: {e}")
+    if contexts:
+        logger.debug(f"[RENDER CONTEXT] Refreshed {len(contexts)} render context(s)")
+    return contexts
+
+
+async def load_render_contexts(conn, contacts: Iterable[Any]) -> Dict[int, Dict[str, Any]]:
+    """
+    Return {contact_id: render_context} for fetched contact rows, using the
+    stored contexts and computing/persisting any missing ones in one batch.
+    """
+    contexts: Dict[int, Dict[str, Any]] = {}
+    missing: Dict[int, Dict[str, Any]] = {}
+    for contact in contacts:
+        contact_id = contact.get('id') if hasattr(contact, 'get') else None
+        if contact_id is None:
+            continue
+        stored = stored_render_context(contact)
+        if stored is not None:
+            contexts[contact_id] = stored
+        else:
+            missing[contact_id] = build_render_context(contact)
+
+    if missing:
+        try:
+            await _store_render_contexts(conn, missing)
+        except Exception as e:
+            logger.warning(f"[RENDER CONTEXT] Could not store {len(missing)} render context(s): {e}")
+        contexts.update(missing)
+    return contexts
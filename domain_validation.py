@@ -0,0 +1,430 @@
+"""
+Domain Validation Module
+
+Domain-level short-circuiting in front of the external email validator.
+
+The validator's expensive step - MX lookup and SMTP probing - is per
+domain, and large uploads are dominated by a few hundred domains. Facts
+about each domain are kept in email_domain_facts (and in memory):
+
+    has_mx        MX lookup (dnspython when installed, otherwise an
+                  address lookup for the implicit MX; without dnspython
+                  a missing address is treated as unknown, not as no MX)
+    disposable    built-in list plus DISPOSABLE_DOMAINS_FILE
+    catch_all     learned from validator answers for the domain
+    unreachable   set after DOMAIN_UNREACHABLE_THRESHOLD answers in a row
+                  where the validator could not reach the mail servers
+
+validate_addresses() groups an upload by domain, answers disposable,
+MX-less, catch-all and recently unreachable domains locally and only
+sends the remaining addresses to the validator: one pilot address per
+domain first, so a catch-all or unreachable domain is detected before
+the rest of its addresses are probed, then the others with at most
+DOMAIN_MAX_PARALLEL calls per domain. Validator answers go through the
+per-address cache (see validation_cache).
+
+This module is imported and used by main.py for email validation.
+"""
+
+import os
+import socket
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, UTC
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from validation_cache import (
+    Result, classify_outcome, normalize_validation_email, prefetch_validations, validate_with_cache,
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import dns.resolver
+    import dns.asyncresolver
+    HAS_DNSPYTHON = True
+except ImportError:
+    dns = None
+    HAS_DNSPYTHON = False
+
+DNS_TIMEOUT = float(os.getenv('EMAIL_DOMAIN_DNS_TIMEOUT', '5'))
+DNS_CONCURRENCY = int(os.getenv('EMAIL_DOMAIN_DNS_CONCURRENCY', '32'))
+TTL_MX = timedelta(hours=float(os.getenv('EMAIL_DOMAIN_MX_TTL_HOURS', '24')))
+TTL_NO_MX = timedelta(hours=float(os.getenv('EMAIL_DOMAIN_NO_MX_TTL_HOURS', '6')))
+TTL_DNS_ERROR = timedelta(minutes=float(os.getenv('EMAIL_DOMAIN_DNS_ERROR_TTL_MINUTES', '15')))
+TTL_CATCH_ALL = timedelta(days=float(os.getenv('EMAIL_DOMAIN_CATCH_ALL_TTL_DAYS', '7')))
+TTL_UNREACHABLE = timedelta(hours=float(os.getenv('EMAIL_DOMAIN_UNREACHABLE_TTL_HOURS', '1')))
+DOMAIN_UNREACHABLE_THRESHOLD = int(os.getenv('DOMAIN_UNREACHABLE_THRESHOLD', '3'))
+DOMAIN_MAX_PARALLEL = int(os.getenv('DOMAIN_MAX_PARALLEL', '4'))
+DOMAIN_CACHE_SIZE = int(os.getenv('EMAIL_DOMAIN_CACHE_SIZE', '20000'))
+
+DISPOSABLE_DOMAINS = {
+    '10minutemail.com', '20minutemail.com', 'discard.email', 'dispostable.com', 'emailondeck.com',
+    'fakeinbox.com', 'getairmail.com', 'getnada.com', 'guerrillamail.com', 'guerrillamail.net',
+    'guerrillamailblock.com', 'maildrop.cc', 'mailinator.com', 'mailnesia.com', 'mintemail.com',
+    'mohmal.com', 'mytemp.email', 'sharklasers.com', 'spamgourmet.com', 'temp-mail.org',
+    'tempmail.com', 'tempmailo.com', 'throwawaymail.com', 'trashmail.com', 'yopmail.com',
+}
+_disposable_file = os.getenv('DISPOSABLE_DOMAINS_FILE')
+if _disposable_file:
+    try:
+        with open(_disposable_file, encoding='utf-8') as fh:
+            DISPOSABLE_DOMAINS.update(
+                line.strip().lower() for line in fh if line.strip() and not line.startswith('#')
+            )
+    except OSError as e:
+        logger.warning(f"[DOMAIN VALIDATION] Could not read DISPOSABLE_DOMAINS_FILE {_disposable_file}: {e}")
+
+# Validator reasons meaning the domain's mail servers could not be reached
+UNREACHABLE_MARKERS = (
+    'could not connect', 'connection refused', 'connection reset', 'connection timed out',
+    'no route to host', 'unreachable', 'smtp timeout', 'timed out',
+)
+CATCH_ALL_MARKERS = ('catch-all', 'catch all', 'catchall', 'accept all', 'accept-all')
+
+
+@dataclass
+class DomainFacts:
+    domain: str
+    has_mx: Optional[bool] = None           # None: unknown (DNS error / no resolver)
+    mx_hosts: List[str] = field(default_factory=list)
+    mx_expires_at: Optional[datetime] = None
+    catch_all: bool = False
+    catch_all_valid: bool = False           # validator verdict for catch-all addresses
+    catch_all_reason: Optional[str] = None
+    catch_all_expires_at: Optional[datetime] = None
+    unreachable_failures: int = 0
+    unreachable_until: Optional[datetime] = None
+    dirty: bool = False
+
+    @property
+    def disposable(self) -> bool:
+        return is_disposable(self.domain)
+
+    def mx_fresh(self, now: datetime) -> bool:
+        return self.mx_expires_at is not None and self.mx_expires_at > now
+
+    def is_catch_all(self, now: datetime) -> bool:
+        return self.catch_all and self.catch_all_expires_at is not None and self.catch_all_expires_at > now
+
+    def is_unreachable(self, now: datetime) -> bool:
+        return self.unreachable_until is not None and self.unreachable_until > now
+
+
+_facts: Dict[str, DomainFacts] = {}
+_dns_semaphore = asyncio.Semaphore(DNS_CONCURRENCY)
+_stats = {'local_verdicts': 0, 'address_checks': 0, 'mx_lookups': 0, 'domains_seen': 0}
+
+
+def email_domain(email: str) -> str:
+    _, _, domain = normalize_validation_email(email).rpartition('@')
+    return domain.rstrip('.')
+
+
+def is_disposable(domain: str) -> bool:
+    """True for a listed disposable domain or any subdomain of one."""
+    parts = domain.split('.')
+    return any('.'.join(parts[i:]) in DISPOSABLE_DOMAINS for i in range(len(parts) - 1))
+
+
+def _remember(facts: DomainFacts):
+    _facts.pop(facts.domain, None)
+    _facts[facts.domain] = facts
+    while len(_facts) > DOMAIN_CACHE_SIZE:
+        _facts.pop(next(iter(_facts)))
+
+
+async def lookup_mx(domain: str) -> Tuple[Optional[bool], List[str]]:
+    """
+    (has_mx, hosts ordered by preference). A null MX ("0 .") or a
+    non-existent domain is False; DNS failures are None.
+    """
+    _stats['mx_lookups'] += 1
+    if HAS_DNSPYTHON:
+        try:
+            answer = await dns.asyncresolver.resolve(domain, 'MX', lifetime=DNS_TIMEOUT)
+            records = sorted(answer, key=lambda r: r.preference)
+            hosts = [r.exchange.to_text().rstrip('.') for r in records]
+            hosts = [h for h in hosts if h]
+            return bool(hosts), hosts
+        except dns.resolver.NXDOMAIN:
+            return False, []
+        except dns.resolver.NoAnswer:
+            pass  # no MX: the domain's own address is the implicit MX
+        except Exception as e:  # timeout, SERVFAIL, no nameservers
+            logger.debug(f"[DOMAIN VALIDATION] MX lookup for {domain} failed: {e}")
+            return None, []
+
+    try:
+        await asyncio.wait_for(
+            asyncio.get_running_loop().getaddrinfo(domain, 25, type=socket.SOCK_STREAM),
+            timeout=DNS_TIMEOUT
+        )
+        return True, [domain]
+    except socket.gaierror as e:
+        # Only conclusive when dnspython already saw the name without MX records
+        if HAS_DNSPYTHON and e.errno == socket.EAI_NONAME:
+            return False, []
+        return None, []
+    except Exception:
+        return None, []
+
+
+async def _refresh_mx(facts: DomainFacts, now: datetime):
+    async with _dns_semaphore:
+        has_mx, hosts = await lookup_mx(facts.domain)
+    facts.has_mx = has_mx
+    facts.mx_hosts = hosts[:10]
+    facts.mx_expires_at = now + (TTL_MX if has_mx else TTL_NO_MX if has_mx is False else TTL_DNS_ERROR)
+    facts.dirty = True
+
+
+async def ensure_email_domain_facts_table(conn):
+    """Create email_domain_facts."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_domain_facts (
+            domain TEXT PRIMARY KEY,
+            has_mx BOOLEAN,
+            mx_hosts TEXT[],
+            mx_expires_at TIMESTAMP,
+            catch_all BOOLEAN NOT NULL DEFAULT FALSE,
+            catch_all_valid BOOLEAN NOT NULL DEFAULT FALSE,
+            catch_all_reason TEXT,
+            catch_all_expires_at TIMESTAMP,
+            unreachable_failures INTEGER NOT NULL DEFAULT 0,
+            unreachable_until TIMESTAMP,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("[DOMAIN VALIDATION] Ensured email_domain_facts table")
+
+
+def _aware(value: Optional[datetime]) -> Optional[datetime]:
+    return value.replace(tzinfo=UTC) if value is not None else None
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    return value.replace(tzinfo=None) if value is not None else None
+
+
+async def load_domain_facts(pool, domains: Iterable[str]) -> Dict[str, DomainFacts]:
+    """
+    Facts for every domain: from memory, then one query for the rest, then
+    MX lookups (DNS_CONCURRENCY at a time) for domains whose MX fact expired.
+    """
+    now = datetime.now(UTC)
+    wanted = sorted({d for d in domains if d})
+    found: Dict[str, DomainFacts] = {d: _facts[d] for d in wanted if d in _facts}
+    missing = [d for d in wanted if d not in found]
+    if missing and pool is not None:
+        try:
+            async with pool.acquire() as conn:
+                rows = await conn.fetch("SELECT * FROM email_domain_facts WHERE domain = ANY($1::text[])", missing)
+            for row in rows:
+                found[row['domain']] = DomainFacts(
+                    domain=row['domain'],
+                    has_mx=row['has_mx'],
+                    mx_hosts=list(row['mx_hosts'] or []),
+                    mx_expires_at=_aware(row['mx_expires_at']),
+                    catch_all=row['catch_all'],
+                    catch_all_valid=row['catch_all_valid'],
+                    catch_all_reason=row['catch_all_reason'],
+                    catch_all_expires_at=_aware(row['catch_all_expires_at']),
+                    unreachable_failures=row['unreachable_failures'],
+                    unreachable_until=_aware(row['unreachable_until']),
+                )
+        except Exception as e:
+            logger.warning(f"[DOMAIN VALIDATION] Could not load domain facts: {e}")
+    for domain in wanted:
+        if domain not in found:
+            found[domain] = DomainFacts(domain=domain)
+            _stats['domains_seen'] += 1
+        _remember(found[domain])
+
+    stale = [f for f in found.values() if not f.disposable and not f.mx_fresh(now)]
+    if stale:
+        await asyncio.gather(*(_refresh_mx(f, now) for f in stale))
+        logger.info(f"[DOMAIN VALIDATION] Looked up MX for {len(stale)} domain(s)")
+    return found
+
+
+async def save_domain_facts(pool, facts: Iterable[DomainFacts]):
+    """Upsert the facts that changed since they were loaded."""
+    dirty = [f for f in facts if f.dirty]
+    if not dirty or pool is None:
+        return
+    try:
+        async with pool.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO email_domain_facts
+                    (domain, has_mx, mx_hosts, mx_expires_at, catch_all, catch_all_valid, catch_all_reason,
+                     catch_all_expires_at, unreachable_failures, unreachable_until, updated_at)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, CURRENT_TIMESTAMP)
+                ON CONFLICT (domain) DO UPDATE
+                SET has_mx = EXCLUDED.has_mx,
+                    mx_hosts = EXCLUDED.mx_hosts,
+                    mx_expires_at = EXCLUDED.mx_expires_at,
+                    catch_all = EXCLUDED.catch_all,
+                    catch_all_valid = EXCLUDED.catch_all_valid,
+                    catch_all_reason = EXCLUDED.catch_all_reason,
+                    catch_all_expires_at = EXCLUDED.catch_all_expires_at,
+                    unreachable_failures = EXCLUDED.unreachable_failures,
+                    unreachable_until = EXCLUDED.unreachable_until,
+                    updated_at = CURRENT_TIMESTAMP
+            """, [
+                (f.domain, f.has_mx, f.mx_hosts, _naive(f.mx_expires_at), f.catch_all, f.catch_all_valid,
+                 f.catch_all_reason, _naive(f.catch_all_expires_at), f.unreachable_failures,
+                 _naive(f.unreachable_until))
+                for f in dirty
+            ])
+        for f in dirty:
+            f.dirty = False
+    except Exception as e:
+        logger.warning(f"[DOMAIN VALIDATION] Could not save domain facts: {e}")
+
+
+def _local_result(facts: DomainFacts, valid: bool, reason: str, verdict: str) -> Result:
+    return {
+        'code': 200,
+        'valid': valid,
+        'validation_result': {'valid': valid, 'reason': reason, 'domain': facts.domain,
+                              'domain_verdict': verdict, 'mx_hosts': facts.mx_hosts},
+        'reason': reason,
+        'raw': None,
+        'domain_verdict': verdict,
+    }
+
+
+def local_verdict(facts: Optional[DomainFacts]) -> Optional[Result]:
+    """Result decided by the domain alone, or None if the address needs the validator."""
+    if facts is None:
+        return None
+    now = datetime.now(UTC)
+    if facts.disposable:
+        return _local_result(facts, False, 'Disposable email domain', 'disposable')
+    if facts.has_mx is False:
+        return _local_result(facts, False, 'Invalid domain: no MX record', 'no_mx')
+    if facts.is_catch_all(now):
+        return _local_result(facts, facts.catch_all_valid,
+                             facts.catch_all_reason or 'Catch-all domain', 'catch_all')
+    if facts.is_unreachable(now):
+        return _local_result(facts, False, 'Unknown: domain mail servers unreachable', 'unreachable')
+    return None
+
+
+def observe(facts: Optional[DomainFacts], result: Optional[Result], error: Optional[BaseException] = None):
+    """Learn catch-all / unreachable facts from a validator answer for an address of the domain."""
+    # Exceptions mean the validator itself failed, which says nothing about the domain
+    if facts is None or error is not None or not result:
+        return
+    if classify_outcome(result) == 'error':
+        return
+    now = datetime.now(UTC)
+    reason = str(result.get('reason') or '').lower()
+    if any(marker in reason for marker in CATCH_ALL_MARKERS):
+        facts.catch_all = True
+        facts.catch_all_valid = bool(result.get('valid'))
+        facts.catch_all_reason = str(result.get('reason'))[:500]
+        facts.catch_all_expires_at = now + TTL_CATCH_ALL
+        facts.dirty = True
+    elif any(marker in reason for marker in UNREACHABLE_MARKERS):
+        facts.unreachable_failures += 1
+        if facts.unreachable_failures >= DOMAIN_UNREACHABLE_THRESHOLD:
+            facts.unreachable_until = now + TTL_UNREACHABLE
+            logger.info(f"[DOMAIN VALIDATION] {facts.domain} marked unreachable until {facts.unreachable_until}")
+        facts.dirty = True
+    elif facts.unreachable_failures or facts.unreachable_until:
+        facts.unreachable_failures = 0
+        facts.unreachable_until = None
+        facts.dirty = True
+
+
+async def validate_addresses(pool, emails: Iterable[str], validator: Callable[[str], Awaitable[Result]],
+                             log_level: int = logging.INFO) -> Dict[str, Union[Result, Exception]]:
+    """
+    Result (or the validator's exception) for every distinct normalized
+    address. Cached addresses and domain verdicts are answered without the
+    validator; the rest are validated domain by domain. The summary line
+    is logged at log_level.
+    """
+    keys = list(dict.fromkeys(normalize_validation_email(e) for e in emails if e))
+    keys = [k for k in keys if k]
+    results: Dict[str, Union[Result, Exception]] = {}
+    if not keys:
+        return results
+    try:
+        await prefetch_validations(pool, keys)
+    except Exception as e:
+        logger.warning(f"[DOMAIN VALIDATION] Could not prefetch cached validations: {e}")
+
+    async def run(email: str, facts: Optional[DomainFacts]):
+        _stats['address_checks'] += 1
+        try:
+            result = await validate_with_cache(pool, email, validator, check_db=False)
+        except Exception as e:
+            observe(facts, None, e)
+            results[email] = e
+            return
+        observe(facts, result)
+        results[email] = result
+
+    by_domain: Dict[str, List[str]] = {}
+    for key in keys:
+        by_domain.setdefault(email_domain(key), []).append(key)
+    facts = await load_domain_facts(pool, [d for d in by_domain if d])
+
+    async def run_domain(domain: str, addresses: List[str]):
+        domain_facts = facts.get(domain)
+        pilot, rest = addresses[0], addresses[1:]
+        verdict = local_verdict(domain_facts)
+        if verdict is None:
+            await run(pilot, domain_facts)
+            verdict = local_verdict(domain_facts)
+        else:
+            rest = addresses
+        if verdict is not None:
+            # Addresses answered by the validator before keep their own result
+            for email in rest:
+                if email not in results:
+                    results[email] = verdict
+                    _stats['local_verdicts'] += 1
+            return
+        limit = asyncio.Semaphore(DOMAIN_MAX_PARALLEL)
+
+        async def bounded(email: str):
+            async with limit:
+                late_verdict = local_verdict(domain_facts)
+                if late_verdict is not None:
+                    results[email] = late_verdict
+                    _stats['local_verdicts'] += 1
+                    return
+                await run(email, domain_facts)
+
+        await asyncio.gather(*(bounded(email) for email in rest))
+
+    await asyncio.gather(*(run_domain(d, addrs) for d, addrs in by_domain.items()))
+    await save_domain_facts(pool, facts.values())
+    local = sum(1 for r in results.values() if isinstance(r, dict) and r.get('domain_verdict'))
+    logger.log(
+        log_level,
+        f"[DOMAIN VALIDATION] {len(keys)} address(es) over {len(by_domain)} domain(s); "
+        f"{local} answered from domain facts"
+    )
+    return results
+
+
+async def validate_address(pool, email: str, validator: Callable[[str], Awaitable[Result]]) -> Result:
+    """validate_addresses() for one address; raises the validator's exception."""
+    key = normalize_validation_email(email)
+    # Per-row callers would log one summary per address; keep those at debug
+    result = (await validate_addresses(pool, [key], validator, log_level=logging.DEBUG)).get(key)
+    if result is None:
+        return await validator(email)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def domain_stats() -> Dict[str, Any]:
+    return dict(_stats, domains_cached=len(_facts), dnspython=HAS_DNSPYTHON)
@@ -0,0 +1,152 @@
+"""
+Email Queue Bulk Enqueue Module
+
+Inserts many email_queue rows in a single round trip and lets the database
+enforce duplicate suppression.
+
+A unique partial index on (contact_id, last_message_type) for rows that are
+'pending' or 'sent' guarantees that a contact never gets the same message
+type queued twice, so callers no longer need a SELECT-before-INSERT per
+contact. Rows are shipped as typed arrays and expanded with unnest(), and
+conflicting rows are dropped with ON CONFLICT DO NOTHING.
+
+This module is imported and used by main.py for message queueing.
+"""
+
+import logging
+from typing import Any, Dict, List, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEDUPE_INDEX_NAME = 'uniq_email_queue_contact_message_type_active'
+
+# (column, postgres array type) in insert order. Keys missing from a message
+# dict are inserted as NULL, except the defaults below.
+QUEUE_COLUMNS = (
+    ('contact_id', 'int'),
+    ('event_id', 'int'),
+    ('sender_email', 'text'),
+    ('recipient_email', 'text'),
+    ('cc_recipients', 'text'),
+    ('subject', 'text'),
+    ('message', 'text'),
+    ('type', 'text'),
+    ('status', 'text'),
+    ('message_type', 'text'),
+    ('last_message_type', 'text'),
+    ('campaign_stage', 'text'),
+    ('created_at', 'timestamp'),
+    ('due_at', 'timestamp'),
+    ('scheduled_at', 'timestamp'),
+    ('forms_link', 'text'),
+    ('payment_link', 'text'),
+    ('conversation_id', 'text'),
+    ('in_reply_to', 'text'),
+    ('message_id', 'text'),
+    ('attachment', 'bytea'),
+    ('attachment_filename', 'text'),
+    ('attachment_mimetype', 'text'),
+    ('payload', 'jsonb'),
+    ('payload_hash', 'text'),
+    ('payload_rendered_at', 'timestamp'),
+)
+
+QUEUE_DEFAULTS = {
+    'type': 'campaign',
+    'status': 'pending',
+}
+
+
+def _build_insert_sql() -> str:
+    columns = ', '.join(name for name, _ in QUEUE_COLUMNS)
+    params = ', '.join(f'${i}::{pg_type}[]' for i, (_, pg_type) in enumerate(QUEUE_COLUMNS, start=1))
+    # NOT EXISTS keeps the insert correct even before the unique index exists
+    # (e.g. while legacy duplicates block its creation); the index makes it
+    # race-free once present.
+    return f"""
+        INSERT INTO email_queue ({columns})
+        SELECT {columns}
+        FROM unnest({params}) AS v({columns})
+        WHERE v.contact_id IS NULL
+           OR v.last_message_type IS NULL
+           OR NOT EXISTS (
+                SELECT 1 FROM email_queue q
+                WHERE q.contact_id = v.contact_id
+                  AND q.last_message_type = v.last_message_type
+                  AND q.status IN ('pending', 'sent')
+           )
+        ON CONFLICT DO NOTHING
+        RETURNING id, contact_id, last_message_type
+    """
+
+
+INSERT_SQL = _build_insert_sql()
+
+
+async def ensure_email_queue_dedupe_index(conn) -> bool:
+    """
+    Create the unique partial index used for duplicate suppression.
+
+    Pending rows that already duplicate another pending/sent row of the same
+    contact and message type are marked 'skipped' first (the oldest row is
+    kept). Historical sent duplicates cannot be resolved automatically; if
+    they exist the index is not created and a warning is logged.
+    """
+    try:
+        skipped = await conn.execute("""
+            UPDATE email_queue SET status = 'skipped',
+                   error_message = 'Duplicate message type for contact'
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, status,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY contact_id, last_message_type
+                               ORDER BY (status = 'sent') DESC, id
+                           ) AS rn
+                    FROM email_queue
+                    WHERE status IN ('pending', 'sent')
+                      AND contact_id IS NOT NULL
+                      AND last_message_type IS NOT NULL
+                ) d
+                WHERE d.rn > 1 AND d.status = 'pending'
+            )
+        """)
+        if skipped and skipped != 'UPDATE 0':
+            logger.info(f"[ENQUEUE] Resolved duplicate pending rows before indexing: {skipped}")
+
+        await conn.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {DEDUPE_INDEX_NAME}
+            ON email_queue (contact_id, last_message_type)
+            WHERE status IN ('pending', 'sent')
+        """)
+        logger.info(f"[ENQUEUE] Ensured unique index {DEDUPE_INDEX_NAME}")
+        return True
+    except Exception as e:
+        logger.warning(f"[ENQUEUE] Could not create unique index {DEDUPE_INDEX_NAME}: {e}")
+        return False
+
+
+async def enqueue_messages(conn, messages: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Insert queue rows in one statement, skipping duplicates.
+
+    Each message is a dict keyed by email_queue column name (see
+    QUEUE_COLUMNS). Returns the inserted rows as dicts with id, contact_id
+    and last_message_type; messages suppressed as duplicates are absent.
+    """
+    if not messages:
+        return []
+
+    columns = [[] for _ in QUEUE_COLUMNS]
+    for message in messages:
+        for i, (name, _) in enumerate(QUEUE_COLUMNS):
+            value = message.get(name)
+            if value is None:
+                value = QUEUE_DEFAULTS.get(name)
+            columns[i].append(value)
+
+    rows = await conn.fetch(INSERT_SQL, *columns)
+    inserted = [dict(r) for r in rows]
+    if len(inserted) < len(messages):
+        logger.info(f"[ENQUEUE] Suppressed {len(messages) - len(inserted)} duplicate message(s) of {len(messages)}")
+    return inserted
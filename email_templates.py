@@ -0,0 +1,303 @@
+"""
+Email Template Registry Module
+
+Keeps the campaign email templates parsed in memory so the send/queue hot
+path does no disk reads, lookup-table construction or regex scanning per
+message.
+
+- TEMPLATE_FILES maps (template_type, part, reminder_type, stage) to a file.
+- Each file is compiled once into literal segments plus the set of variable
+  names it needs, and recompiled only when its mtime changes (checked at most
+  every TEMPLATE_MTIME_CHECK_SECONDS).
+- Arbitrary template strings (custom messages, bulk campaign bodies) are
+  compiled through a bounded LRU cache keyed by the text itself.
+
+This module is imported and used by main.py for template loading/rendering.
+"""
+
+import os
+import re
+import time
+import logging
+import threading
+from functools import lru_cache
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.getenv('EMAIL_TEMPLATE_DIR', 'public/templates/emails')
+TEMPLATE_MTIME_CHECK_SECONDS = float(os.getenv('TEMPLATE_MTIME_CHECK_SECONDS', '5'))
+
+TEMPLATE_VAR_PATTERN = re.compile(r'{{\s*(.*?)\s*}}')
+
+# Template file mappings with fallback hierarchy (see resolve_template_file)
+TEMPLATE_FILES: Dict[Tuple[Optional[str], ...], str] = {
+    # Initial campaign message (first email)
+    ('campaign', 'subject', None, 'initial'): 'campaign_default_subject.txt',
+    ('campaign', 'body', None, 'initial'): 'campaign_default_body.txt',
+
+    # First reminder (reminder1)
+    ('reminder', 'subject', 'reminder1', None): 'reminder_default_subject.txt',
+    ('reminder', 'body', 'reminder1', None): 'reminder_default_body.txt',
+
+    # Second reminder (reminder2)
+    ('reminder', 'subject', 'reminder2', None): 'reminder2_default_subject.txt',
+    ('reminder', 'body', 'reminder2', None): 'reminder2_default_body.txt',
+
+    # Forms stage initial message
+    ('forms', 'subject', None, 'initial'): 'forms_main_subject.txt',
+    ('forms', 'body', None, 'initial'): 'forms_main_body.txt',
+
+    # Forms stage reminders
+    ('forms', 'subject', 'reminder1', None): 'forms_reminder1_subject.txt',
+    ('forms', 'body', 'reminder1', None): 'forms_reminder1_body.txt',
+    ('forms', 'subject', 'reminder2', None): 'forms_reminder2_subject.txt',
+    ('forms', 'body', 'reminder2', None): 'forms_reminder2_body.txt',
+    ('forms', 'subject', 'reminder3', None): 'forms_reminder3_subject.txt',
+    ('forms', 'body', 'reminder3', None): 'forms_reminder3_body.txt',
+
+    # Payments stage initial message
+    ('payments', 'subject', None, 'initial'): 'payments_main_subject.txt',
+    ('payments', 'body', None, 'initial'): 'payments_main_body.txt',
+
+    # Payments stage reminders (up to 6 reminders)
+    ('payments', 'subject', 'reminder1', None): 'payments_reminder1_subject.txt',
+    ('payments', 'body', 'reminder1', None): 'payments_reminder1_body.txt',
+    ('payments', 'subject', 'reminder2', None): 'payments_reminder2_subject.txt',
+    ('payments', 'body', 'reminder2', None): 'payments_reminder2_body.txt',
+    ('payments', 'subject', 'reminder3', None): 'payments_reminder3_subject.txt',
+    ('payments', 'body', 'reminder3', None): 'payments_reminder3_body.txt',
+    ('payments', 'subject', 'reminder4', None): 'payments_reminder4_subject.txt',
+    ('payments', 'body', 'reminder4', None): 'payments_reminder4_body.txt',
+    ('payments', 'subject', 'reminder5', None): 'payments_reminder5_subject.txt',
+    ('payments', 'body', 'reminder5', None): 'payments_reminder5_body.txt',
+    ('payments', 'subject', 'reminder6', None): 'payments_reminder6_subject.txt',
+    ('payments', 'body', 'reminder6', None): 'payments_reminder6_body.txt',
+
+    # SEPA bank transfer payment stage (payment_sepa templates)
+    ('sepa', 'subject', None, 'initial'): 'payment_sepa_subject.txt',
+    ('sepa', 'body', None, 'initial'): 'payment_sepa_body.txt',
+
+    # SEPA reminders 1..3 use SEPA-specific templates
+    ('sepa', 'subject', 'reminder1', None): 'payment_sepa_reminder1_subject.txt',
+    ('sepa', 'body', 'reminder1', None): 'payment_sepa_reminder1_body.txt',
+    ('sepa', 'subject', 'reminder2', None): 'payment_sepa_reminder2_subject.txt',
+    ('sepa', 'body', 'reminder2', None): 'payment_sepa_reminder2_body.txt',
+    ('sepa', 'subject', 'reminder3', None): 'payment_sepa_reminder3_subject.txt',
+    ('sepa', 'body', 'reminder3', None): 'payment_sepa_reminder3_body.txt',
+
+    # SEPA reminders 4..6 reuse the payments reminder templates (same copy)
+    ('sepa', 'subject', 'reminder4', None): 'payments_reminder4_subject.txt',
+    ('sepa', 'body', 'reminder4', None): 'payments_reminder4_body.txt',
+    ('sepa', 'subject', 'reminder5', None): 'payments_reminder5_subject.txt',
+    ('sepa', 'body', 'reminder5', None): 'payments_reminder5_body.txt',
+    ('sepa', 'subject', 'reminder6', None): 'payments_reminder6_subject.txt',
+    ('sepa', 'body', 'reminder6', None): 'payments_reminder6_body.txt',
+
+    # RH bank transfer payment stage (payment_rh templates)
+    ('rh', 'subject', None, 'initial'): 'payment_rh_subject.txt',
+    ('rh', 'body', None, 'initial'): 'payment_rh_body.txt',
+
+    # RH reminders 1..3 use RH-specific templates
+    ('rh', 'subject', 'reminder1', None): 'payment_rh_reminder1_subject.txt',
+    ('rh', 'body', 'reminder1', None): 'payment_rh_reminder1_body.txt',
+    ('rh', 'subject', 'reminder2', None): 'payment_rh_reminder2_subject.txt',
+    ('rh', 'body', 'reminder2', None): 'payment_rh_reminder2_body.txt',
+    ('rh', 'subject', 'reminder3', None): 'payment_rh_reminder3_subject.txt',
+    ('rh', 'body', 'reminder3', None): 'payment_rh_reminder3_body.txt',
+
+    # RH reminders 4..6 reuse the payments reminder templates (same copy)
+    ('rh', 'subject', 'reminder4', None): 'payments_reminder4_subject.txt',
+    ('rh', 'body', 'reminder4', None): 'payments_reminder4_body.txt',
+    ('rh', 'subject', 'reminder5', None): 'payments_reminder5_subject.txt',
+    ('rh', 'body', 'reminder5', None): 'payments_reminder5_body.txt',
+    ('rh', 'subject', 'reminder6', None): 'payments_reminder6_subject.txt',
+    ('rh', 'body', 'reminder6', None): 'payments_reminder6_body.txt',
+
+    # Fallback for any other reminder types
+    ('reminder', 'subject', None, None): 'reminder_default_subject.txt',
+    ('reminder', 'body', None, None): 'reminder_default_body.txt',
+}
+
+
+class CompiledTemplate:
+    """A template split into literal segments and variable names"""
+
+    __slots__ = ('text', 'segments', 'variables')
+
+    def __init__(self, text: str):
+        self.text = text
+        # re.split with one capture group alternates literal, name, literal, ...
+        parts = TEMPLATE_VAR_PATTERN.split(text)
+        self.segments: Tuple[str, ...] = tuple(
+            part.strip() if i % 2 else part for i, part in enumerate(parts)
+        )
+        self.variables: FrozenSet[str] = frozenset(self.segments[1::2])
+
+    def substitute(self, values: Dict[str, Any]) -> str:
+        """Join literals with str() of each variable value (None renders as '')."""
+        out: List[str] = []
+        for i, part in enumerate(self.segments):
+            if i % 2:
+                value = values.get(part)
+                out.append('' if value is None else str(value))
+            else:
+                out.append(part)
+        return ''.join(out)
+
+
+@lru_cache(maxsize=int(os.getenv('TEMPLATE_COMPILE_CACHE_SIZE', '512')))
+def compile_template(text: str) -> CompiledTemplate:
+    """Compile a template string (cached by content)."""
+    return CompiledTemplate(text)
+
+
+def _normalize_lookup(template_type, part, reminder_type, stage):
+    template_type = template_type.lower() if template_type else None
+    part = part.lower() if part else None
+    stage = stage.lower() if stage else None
+    reminder_type = str(reminder_type).lower() if reminder_type else None
+
+    # Backwards-compatibility: callers sometimes pass the reminder stage in the
+    # `stage` parameter (e.g. 'reminder2') instead of `reminder_type`.
+    if not reminder_type and stage and stage.startswith('reminder'):
+        reminder_type = stage
+        stage = None
+    return template_type, part, reminder_type, stage
+
+
+@lru_cache(maxsize=1024)
+def resolve_template_file(template_type: Optional[str], part: Optional[str],
+                          reminder_type: Optional[str] = None, stage: Optional[str] = None) -> Tuple[Tuple, str]:
+    """
+    Resolve a template request to (matched_key, file path) using the
+    fallback hierarchy. Raises RuntimeError when nothing matches.
+    """
+    template_type, part, reminder_type, stage = _normalize_lookup(template_type, part, reminder_type, stage)
+
+    lookup_keys = []
+
+    # 0. Handle backward compatibility and special cases
+    if template_type == 'campaign':
+        # For initial campaign message (stage='default' or None)
+        if not stage or stage == 'default':
+            lookup_keys.append(('campaign', part, None, 'initial'))
+        # For campaign with specific stage (e.g., 'forms', 'payments')
+        elif stage in ['forms', 'payments']:
+            lookup_keys.append((stage, part, reminder_type, 'initial'))
+            lookup_keys.append((stage, part, None, 'initial'))
+
+    # 1. Exact match with both stage and reminder_type
+    if stage and reminder_type:
+        lookup_keys.append((template_type, part, reminder_type, stage))
+
+    # 2. Match with stage only (for initial messages)
+    if stage:
+        lookup_keys.append((template_type, part, None, stage))
+
+    # 3. Match with reminder_type only (for default stage)
+    if reminder_type:
+        lookup_keys.append((template_type, part, reminder_type, None))
+
+    # 4. Most generic fallback (no stage or reminder_type)
+    lookup_keys.append((template_type, part, None, None))
+
+    for key in lookup_keys:
+        if key in TEMPLATE_FILES:
+            return key, os.path.join(TEMPLATE_DIR, TEMPLATE_FILES[key])
+
+    raise RuntimeError(f"No template found for type: {template_type}, part: {part}, "
+                       f"reminder_type: {reminder_type}, stage: {stage}")
+
+
+class TemplateRegistry:
+    """Process-wide cache of compiled template files with mtime invalidation"""
+
+    def __init__(self, check_interval: float = TEMPLATE_MTIME_CHECK_SECONDS):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        # path -> (mtime, last_checked_monotonic, CompiledTemplate)
+        self._entries: Dict[str, Tuple[float, float, CompiledTemplate]] = {}
+
+    def _load(self, path: str) -> CompiledTemplate:
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            logger.error(f"[TEMPLATE] Template file not found: {path}")
+            raise RuntimeError(f"Could not load template file: {path}")
+        except Exception as e:
+            raise RuntimeError(f"Error reading template file {path}: {e}")
+
+        if not content:
+            raise RuntimeError(f"Error reading template file {path}: Template file is empty: {path}")
+
+        compiled = compile_template(content)
+        with self._lock:
+            self._entries[path] = (mtime, time.monotonic(), compiled)
+        logger.debug(f"[TEMPLATE] Compiled {path} ({len(compiled.variables)} variables)")
+        return compiled
+
+    def get(self, path: str) -> CompiledTemplate:
+        """Return the compiled template for a file, reloading it if it changed on disk."""
+        entry = self._entries.get(path)
+        if entry is None:
+            return self._load(path)
+
+        mtime, checked_at, compiled = entry
+        now = time.monotonic()
+        if now - checked_at < self.check_interval:
+            return compiled
+
+        try:
+            current_mtime = os.path.getmtime(path)
+        except OSError:
+            current_mtime = None
+        if current_mtime != mtime:
+            logger.info(f"[TEMPLATE] Template changed on disk, reloading: {path}")
+            return self._load(path)
+
+        with self._lock:
+            self._entries[path] = (mtime, now, compiled)
+        return compiled
+
+    def invalidate(self, path: Optional[str] = None):
+        """Drop one cached file (or all of them) so the next access re-reads it."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def reload(self) -> Dict[str, Any]:
+        """Re-read and recompile every mapped template file."""
+        self.invalidate()
+        loaded, errors = [], {}
+        for filename in sorted(set(TEMPLATE_FILES.values())):
+            path = os.path.join(TEMPLATE_DIR, filename)
+            try:
+                self._load(path)
+                loaded.append(filename)
+            except RuntimeError as e:
+                errors[filename] = str(e)
+        logger.info(f"[TEMPLATE] Reloaded {len(loaded)} templates ({len(errors)} errors)")
+        return {'loaded': loaded, 'errors': errors}
+
+    def stats(self) -> Dict[str, Any]:
+        info = compile_template.cache_info()
+        return {
+            'cached_files': len(self._entries),
+            'compile_cache_hits': info.hits,
+            'compile_cache_misses': info.misses,
+            'compile_cache_size': info.currsize,
+        }
+
+
+template_registry = TemplateRegistry()
+
+
+def get_compiled_template(template_type: str, part: str, reminder_type: str = None, stage: str = None) -> CompiledTemplate:
+    """Resolve and return the compiled template for a campaign message part."""
+    _, path = resolve_template_file(template_type, part, reminder_type, stage)
+    return template_registry.get(path)
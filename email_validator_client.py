@@ -0,0 +1,432 @@
+"""
+Email Validator Client Module
+
+Calls to the external email validator behind an adaptive concurrency
+limit and a circuit breaker, plus a queue that re-validates deferred
+addresses in the background.
+
+Concurrency starts at VALIDATOR_CONCURRENCY and adapts to observed
+latency: it grows by one per window of calls answered within
+VALIDATOR_LATENCY_TOLERANCE times the baseline (lowest recent) latency
+and shrinks by a quarter when calls get slower or time out, between
+VALIDATOR_MIN_CONCURRENCY and VALIDATOR_MAX_CONCURRENCY.
+
+The breaker opens after VALIDATOR_BREAKER_CONSECUTIVE failures in a row
+or a failure rate of VALIDATOR_BREAKER_FAILURE_RATE over the last
+VALIDATOR_BREAKER_WINDOW calls (timeouts, connection errors, 5xx/429 and
+calls slower than VALIDATOR_SLOW_CALL_SECONDS). While it is open every
+call - including ones already waiting for a slot - fails at once with
+ValidationDeferred; after the cooldown (doubling on repeated trips) one
+probe call decides whether it closes again. Read timeouts are not
+retried, so a sick validator costs an upload at most one timeout per
+in-flight call instead of rows x timeout x retries.
+
+Deferred addresses are queued in validation_retry_queue; the
+revalidation worker validates them once the breaker is closed and fills
+in campaign_contacts.validation_result for contacts stored with the
+VALIDATION_DEFERRED placeholder.
+
+This module is imported and used by main.py for email validation.
+"""
+
+import os
+import time
+import asyncio
+import inspect
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+
+import httpx
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from http_clients import validator_client, VALIDATOR_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+VALIDATOR_URL = os.getenv('VALIDATOR_URL', 'https://62.171.152.239:5000/validate')
+VALIDATOR_CONCURRENCY = int(os.getenv('VALIDATOR_CONCURRENCY', '8'))
+VALIDATOR_MIN_CONCURRENCY = int(os.getenv('VALIDATOR_MIN_CONCURRENCY', '1'))
+VALIDATOR_MAX_CONCURRENCY = int(os.getenv('VALIDATOR_MAX_CONCURRENCY', '16'))
+VALIDATOR_LATENCY_TOLERANCE = float(os.getenv('VALIDATOR_LATENCY_TOLERANCE', '2.0'))
+VALIDATOR_MAX_RETRIES = int(os.getenv('VALIDATOR_MAX_RETRIES', '3'))
+VALIDATOR_BACKOFF_BASE = float(os.getenv('VALIDATOR_BACKOFF_BASE', '1.0'))
+# Calls slower than this count as failures for the breaker
+VALIDATOR_SLOW_CALL_SECONDS = float(os.getenv('VALIDATOR_SLOW_CALL_SECONDS', '30'))
+
+VALIDATOR_BREAKER_WINDOW = int(os.getenv('VALIDATOR_BREAKER_WINDOW', '20'))
+VALIDATOR_BREAKER_MIN_CALLS = int(os.getenv('VALIDATOR_BREAKER_MIN_CALLS', '10'))
+VALIDATOR_BREAKER_FAILURE_RATE = float(os.getenv('VALIDATOR_BREAKER_FAILURE_RATE', '0.5'))
+VALIDATOR_BREAKER_CONSECUTIVE = int(os.getenv('VALIDATOR_BREAKER_CONSECUTIVE', '5'))
+VALIDATOR_BREAKER_COOLDOWN = float(os.getenv('VALIDATOR_BREAKER_COOLDOWN_SECONDS', '30'))
+VALIDATOR_BREAKER_MAX_COOLDOWN = float(os.getenv('VALIDATOR_BREAKER_MAX_COOLDOWN_SECONDS', '300'))
+
+REVALIDATE_INTERVAL = int(os.getenv('VALIDATOR_REVALIDATE_INTERVAL_SECONDS', '30'))
+REVALIDATE_BATCH = int(os.getenv('VALIDATOR_REVALIDATE_BATCH', '200'))
+REVALIDATE_MAX_ATTEMPTS = int(os.getenv('VALIDATOR_REVALIDATE_MAX_ATTEMPTS', '10'))
+
+# campaign_contacts.validation_result of contacts waiting for the revalidation worker
+VALIDATION_DEFERRED = 'Validation deferred'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ValidationDeferred(Exception):
+    """The validator is unavailable; the address has been queued for revalidation."""
+
+    deferred = True
+
+    def __init__(self, detail: str):
+        super().__init__(f"{VALIDATION_DEFERRED}: {detail}")
+
+
+def validation_text(result: Dict[str, Any]) -> str:
+    """campaign_contacts.validation_result text for a validator result."""
+    text = result.get('reason') or result.get('validation_result') or ("Valid" if result.get('valid') else "Invalid")
+    return str(text)
+
+
+class ValidatorClient:
+    """Adaptive-concurrency, circuit-broken access to the validator."""
+
+    def __init__(self):
+        self.limit = float(max(VALIDATOR_MIN_CONCURRENCY, min(VALIDATOR_CONCURRENCY, VALIDATOR_MAX_CONCURRENCY)))
+        self.in_flight = 0
+        self._cond: Optional[asyncio.Condition] = None
+        self.baseline: Optional[float] = None
+        self.latency_ewma: Optional[float] = None
+        self._last_decrease = 0.0
+
+        self.state = CLOSED
+        self.opened_until = 0.0
+        self.cooldown = VALIDATOR_BREAKER_COOLDOWN
+        self._window: Deque[bool] = deque(maxlen=VALIDATOR_BREAKER_WINDOW)
+        self._consecutive_failures = 0
+        self._probe_in_flight = False
+
+        self.pending: Set[str] = set()
+        self.counters = {'calls': 0, 'failures': 0, 'deferred': 0, 'trips': 0, 'retries': 0}
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    # ---- circuit breaker -------------------------------------------------
+
+    def available(self) -> bool:
+        """False while the breaker is open (calls would be deferred)."""
+        if self.state == OPEN and time.monotonic() >= self.opened_until:
+            self.state = HALF_OPEN
+            logger.info("[VALIDATOR] Circuit half-open, probing validator")
+        return self.state != OPEN
+
+    def _trip(self, reason: str):
+        if self.state != OPEN:
+            self.counters['trips'] += 1
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, VALIDATOR_BREAKER_MAX_COOLDOWN)
+        self.state = OPEN
+        self.opened_until = time.monotonic() + self.cooldown
+        self._window.clear()
+        self._consecutive_failures = 0
+        logger.warning(f"[VALIDATOR] Circuit open for {self.cooldown:.0f}s: {reason}")
+
+    def _record(self, ok: bool, latency: Optional[float]):
+        if self.state == OPEN:
+            # Calls started before the trip; the cooldown stands either way
+            self._adapt(ok, latency)
+            return
+        self._window.append(ok)
+        if ok:
+            self._consecutive_failures = 0
+            if self.state == HALF_OPEN:
+                self.state = CLOSED
+                self.cooldown = VALIDATOR_BREAKER_COOLDOWN
+                logger.info("[VALIDATOR] Circuit closed, validator answering again")
+        else:
+            self.counters['failures'] += 1
+            self._consecutive_failures += 1
+            failures = self._window.count(False)
+            if self.state == HALF_OPEN:
+                self._trip("probe call failed")
+            elif self._consecutive_failures >= VALIDATOR_BREAKER_CONSECUTIVE:
+                self._trip(f"{self._consecutive_failures} failures in a row")
+            elif (len(self._window) >= VALIDATOR_BREAKER_MIN_CALLS
+                  and failures / len(self._window) >= VALIDATOR_BREAKER_FAILURE_RATE):
+                self._trip(f"{failures} of the last {len(self._window)} calls failed")
+        self._adapt(ok, latency)
+
+    # ---- adaptive concurrency --------------------------------------------
+
+    def _adapt(self, ok: bool, latency: Optional[float]):
+        now = time.monotonic()
+        if latency is not None:
+            self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+            # Baseline follows the fastest recent calls and slowly forgets them
+            self.baseline = latency if self.baseline is None else min(latency, self.baseline * 1.01)
+        slow = latency is None or (self.baseline is not None and latency > self.baseline * VALIDATOR_LATENCY_TOLERANCE)
+        if ok and not slow:
+            self.limit = min(float(VALIDATOR_MAX_CONCURRENCY), self.limit + 1.0 / self.limit)
+        elif now - self._last_decrease >= (self.latency_ewma or 1.0):
+            # At most one decrease per round trip, so one slow batch does not collapse the window
+            self.limit = max(float(VALIDATOR_MIN_CONCURRENCY), self.limit * 0.75)
+            self._last_decrease = now
+
+    async def _acquire(self, email: str):
+        cond = self._condition()
+        async with cond:
+            while True:
+                if not self.available():
+                    raise ValidationDeferred("validator circuit open")
+                if self.state == HALF_OPEN:
+                    # One probe at a time; everyone else is deferred until it succeeds
+                    if self._probe_in_flight:
+                        raise ValidationDeferred("validator circuit half-open")
+                    if self.in_flight == 0:
+                        self._probe_in_flight = True
+                        break
+                elif self.in_flight < int(self.limit):
+                    break
+                # Woken by a finished call or by the breaker opening
+                try:
+                    await asyncio.wait_for(cond.wait(), timeout=max(1.0, self.opened_until - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+            self.in_flight += 1
+
+    async def _release(self):
+        cond = self._condition()
+        async with cond:
+            self.in_flight -= 1
+            self._probe_in_flight = False
+            cond.notify_all()
+
+    # ---- calls -------------------------------------------------------------
+
+    def defer(self, email: str, detail: str) -> ValidationDeferred:
+        self.counters['deferred'] += 1
+        self.pending.add(email.strip().lower())
+        return ValidationDeferred(detail)
+
+    async def validate(self, email: str) -> Dict[str, Any]:
+        """
+        Structured validator result for the address. Raises
+        ValidationDeferred (and queues the address) when the validator is
+        unavailable; other exceptions are per-address failures.
+        """
+        last_detail = 'validator unavailable'
+        for attempt in range(1, VALIDATOR_MAX_RETRIES + 1):
+            try:
+                await self._acquire(email)
+            except ValidationDeferred as e:
+                raise self.defer(email, str(e).split(': ', 1)[-1])
+            retry = False
+            try:
+                self.counters['calls'] += 1
+                client = validator_client()
+                timeout = httpx.Timeout(self.call_timeout(), connect=min(10.0, self.call_timeout()))
+                logger.debug(f"Calling validator (attempt {attempt}) for {email} -> {VALIDATOR_URL}")
+                started = time.monotonic()
+                resp = await client.post(VALIDATOR_URL, json={"email": email}, timeout=timeout)
+                elapsed = time.monotonic() - started
+                logger.debug(f"Validator response for {email} received in {elapsed:.2f}s (status={resp.status_code})")
+
+                if resp.status_code >= 500 or resp.status_code == 429:
+                    self._record(False, elapsed)
+                    last_detail = f"validator returned {resp.status_code}"
+                    retry = True
+                else:
+                    self._record(elapsed <= VALIDATOR_SLOW_CALL_SECONDS, elapsed)
+                    try:
+                        data = resp.json()
+                    except Exception:
+                        data = {}
+                    return {
+                        'code': resp.status_code,
+                        'valid': data.get('valid', False),
+                        'validation_result': data,
+                        'reason': data.get('reason'),
+                        'raw': resp.text
+                    }
+            except httpx.TimeoutException as e:
+                # Not retried: a slow validator would only get slower
+                self._record(False, None)
+                logger.warning(f"Validator timeout on attempt {attempt} for {email}: {e!r}")
+                raise self.defer(email, f"validator timed out ({e.__class__.__name__})")
+            except httpx.TransportError as e:
+                self._record(False, None)
+                last_detail = f"validator connection failed ({e.__class__.__name__})"
+                logger.warning(f"Validator call exception on attempt {attempt} for {email}: {e!r}")
+                retry = True
+            finally:
+                await self._release()
+
+            if retry and attempt < VALIDATOR_MAX_RETRIES and self.available():
+                self.counters['retries'] += 1
+                await asyncio.sleep(VALIDATOR_BACKOFF_BASE * (2 ** (attempt - 1)))
+                continue
+            break
+        raise self.defer(email, last_detail)
+
+    def call_timeout(self) -> float:
+        """Read timeout: a generous multiple of the observed latency, capped by VALIDATOR_HTTP_TIMEOUT."""
+        if self.latency_ewma is None:
+            return VALIDATOR_TIMEOUT
+        return min(VALIDATOR_TIMEOUT, max(VALIDATOR_SLOW_CALL_SECONDS, self.latency_ewma * 10))
+
+    def metrics(self) -> Dict[str, Any]:
+        self.available()
+        return {
+            'state': self.state,
+            'open_for_seconds': round(max(0.0, self.opened_until - time.monotonic()), 1) if self.state == OPEN else 0,
+            'concurrency_limit': round(self.limit, 2),
+            'in_flight': self.in_flight,
+            'latency_ewma_seconds': round(self.latency_ewma, 3) if self.latency_ewma is not None else None,
+            'latency_baseline_seconds': round(self.baseline, 3) if self.baseline is not None else None,
+            'call_timeout_seconds': round(self.call_timeout(), 1),
+            'recent_failure_rate': round(self._window.count(False) / len(self._window), 2) if self._window else 0.0,
+            'pending_revalidation': len(self.pending),
+            **self.counters,
+        }
+
+
+email_validator = ValidatorClient()
+
+
+async def ensure_validation_retry_queue_table(conn):
+    """Create validation_retry_queue."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS validation_retry_queue (
+            email TEXT PRIMARY KEY,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_validation_retry_queue_next ON validation_retry_queue (next_attempt_at)"
+    )
+    logger.info("[VALIDATOR] Ensured validation_retry_queue table")
+
+
+async def _flush_pending(pool):
+    if not email_validator.pending:
+        return
+    emails = sorted(email_validator.pending)
+    email_validator.pending.difference_update(emails)
+    try:
+        async with pool.acquire() as conn:
+            await conn.executemany("""
+                INSERT INTO validation_retry_queue (email) VALUES ($1)
+                ON CONFLICT (email) DO NOTHING
+            """, [(e,) for e in emails])
+    except Exception:
+        email_validator.pending.update(emails)
+        raise
+
+
+async def _fill_contacts(conn, email: str, text: str) -> str:
+    return await conn.execute("""
+        UPDATE campaign_contacts SET validation_result = $2
+        WHERE LOWER(TRIM(split_part(email, ',', 1))) = $1
+          AND validation_result LIKE $3
+    """, email, text, f"{VALIDATION_DEFERRED}%")
+
+
+async def _postpone(pool, email: str, attempts: int, error: Exception):
+    delay = min(6 * 3600, REVALIDATE_INTERVAL * 2 ** min(attempts, 10))
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            UPDATE validation_retry_queue
+            SET attempts = attempts + 1,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => $2),
+                last_error = $3
+            WHERE email = $1
+        """, email, float(delay), str(error))
+
+
+async def revalidate_due(pool, validate: Callable[[str], Awaitable[Dict[str, Any]]]) -> int:
+    """Re-validate due queued addresses while the validator is available; returns how many were settled."""
+    await _flush_pending(pool)
+    if not email_validator.available():
+        return 0
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT email, attempts FROM validation_retry_queue
+            WHERE next_attempt_at <= CURRENT_TIMESTAMP
+            ORDER BY next_attempt_at
+            LIMIT $1
+        """, REVALIDATE_BATCH)
+    settled = 0
+    for row in rows:
+        email = row['email']
+        try:
+            text = validation_text(await validate(email))
+        except ValidationDeferred as e:
+            # Still unavailable: try again next round
+            email_validator.pending.discard(email)
+            await _postpone(pool, email, row['attempts'], e)
+            break
+        except Exception as e:
+            if row['attempts'] + 1 < REVALIDATE_MAX_ATTEMPTS:
+                await _postpone(pool, email, row['attempts'], e)
+                continue
+            text = f"Validation error: {e}"
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                updated = await _fill_contacts(conn, email, text)
+                await conn.execute("DELETE FROM validation_retry_queue WHERE email = $1", email)
+        settled += 1
+        logger.debug(f"[VALIDATOR] Revalidated {email} ({updated})")
+    if settled:
+        logger.info(f"[VALIDATOR] Revalidated {settled} deferred address(es)")
+    return settled
+
+
+async def revalidation_worker(pool, validate: Callable[[str], Awaitable[Dict[str, Any]]]):
+    """Fill in deferred validation results once the validator is back."""
+    while True:
+        await asyncio.sleep(REVALIDATE_INTERVAL)
+        try:
+            await revalidate_due(pool, validate)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[VALIDATOR] Revalidation run failed: {e}")
+
+
+def create_validator_client_router():
+    """Factory function to create the validator client status router"""
+    router = APIRouter()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    @router.get("/admin/validator")
+    async def get_validator_status(current_user: dict = Depends(get_current_user)):
+        """Breaker state, concurrency window and revalidation queue size."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        import main
+        status = email_validator.metrics()
+        try:
+            async with main.db_pool.acquire() as conn:
+                status['queued_for_revalidation'] = await conn.fetchval("SELECT COUNT(*) FROM validation_retry_queue")
+        except Exception as e:
+            logger.warning(f"[VALIDATOR] Could not count validation_retry_queue: {e}")
+        return status
+
+    return router
+
+
+router = create_validator_client_router()
@@ -0,0 +1,187 @@
+"""
+Graph Attachments Module
+
+Attachment handling for send_graph_email.
+
+Graph accepts file attachments inline (base64 in the sendMail JSON) only
+up to roughly 3-4 MB per request. Attachments up to INLINE_ATTACHMENT_LIMIT
+in total keep using the inline payload; anything larger is sent through a
+draft:
+
+    1. POST /users/{sender}/messages            create the draft (small
+                                                attachments inline)
+    2. POST .../attachments/createUploadSession one per large attachment
+    3. PUT  <uploadUrl>                         UPLOAD_CHUNK_SIZE chunks
+    4. POST .../messages/{id}/send
+
+An attachment is a dict with 'filename', optional 'mimetype' and one of
+'content' (bytes / memoryview), 'path' (file on disk) or 'reader' plus
+'size' (reader(offset, length) -> bytes, e.g. a database substring read).
+Large attachments are read one chunk at a time, so peak memory per send
+is bounded by the chunk size rather than the attachment size.
+
+This module is imported and used by graph_email.py.
+"""
+
+import os
+import base64
+import logging
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Total raw attachment bytes still sent inline; base64 grows them by a
+# third and the whole sendMail request must stay under 4 MB
+INLINE_ATTACHMENT_LIMIT = int(os.getenv('GRAPH_INLINE_ATTACHMENT_LIMIT', str(int(2.5 * 1024 * 1024))))
+# Upload session chunks must be a multiple of 320 KiB
+_CHUNK_UNIT = 320 * 1024
+UPLOAD_CHUNK_SIZE = max(_CHUNK_UNIT, int(os.getenv('GRAPH_UPLOAD_CHUNK_SIZE', str(12 * _CHUNK_UNIT))) // _CHUNK_UNIT * _CHUNK_UNIT)
+UPLOAD_TIMEOUT = int(os.getenv('GRAPH_UPLOAD_TIMEOUT', '120'))
+
+
+class AttachmentUploadError(Exception):
+    """A draft, upload session or send step was rejected by Graph."""
+
+    def __init__(self, message: str, status_code: int = 0):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_valid_attachment(att: Any) -> bool:
+    return isinstance(att, dict) and 'filename' in att and (
+        'content' in att or 'path' in att or ('reader' in att and 'size' in att)
+    )
+
+
+def attachment_size(att: Dict[str, Any]) -> int:
+    if att.get('content') is not None:
+        return len(att['content'])
+    if att.get('path'):
+        return os.path.getsize(att['path'])
+    return int(att.get('size') or 0)
+
+
+def read_attachment(att: Dict[str, Any]) -> bytes:
+    """Whole attachment content (only used for inline-sized attachments)."""
+    if att.get('content') is not None:
+        return bytes(att['content'])
+    return b''.join(iter_attachment_chunks(att, UPLOAD_CHUNK_SIZE))
+
+
+def iter_attachment_chunks(att: Dict[str, Any], chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield the attachment content chunk by chunk without loading it whole."""
+    if att.get('content') is not None:
+        view = memoryview(att['content'])
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size].tobytes()
+        return
+    if att.get('path'):
+        with open(att['path'], 'rb') as fh:
+            while True:
+                chunk = fh.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+    reader: Callable[[int, int], bytes] = att['reader']
+    size = int(att['size'])
+    offset = 0
+    while offset < size:
+        chunk = reader(offset, min(chunk_size, size - offset))
+        if not chunk:
+            raise AttachmentUploadError(f"Attachment '{att['filename']}' ended at byte {offset} of {size}")
+        yield chunk
+        offset += len(chunk)
+
+
+def inline_attachment(att: Dict[str, Any]) -> Dict[str, Any]:
+    """fileAttachment JSON for the sendMail / draft payload."""
+    return {
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": att['filename'],
+        "contentType": att.get('mimetype') or 'application/octet-stream',
+        "contentBytes": base64.b64encode(read_attachment(att)).decode('ascii'),
+    }
+
+
+def split_attachments(attachments: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    (inline, upload): the smallest attachments go inline while the running
+    total stays within INLINE_ATTACHMENT_LIMIT; the rest need upload sessions.
+    """
+    inline, upload = [], []
+    total = 0
+    for att in sorted(attachments, key=attachment_size):
+        size = attachment_size(att)
+        if total + size <= INLINE_ATTACHMENT_LIMIT:
+            inline.append(att)
+            total += size
+        else:
+            upload.append(att)
+    return inline, upload
+
+
+def _check(response, expected, step: str):
+    if response.status_code not in expected:
+        try:
+            error = response.json().get('error', {})
+            detail = f"{error.get('code', 'UNKNOWN')}: {error.get('message', response.text)}"
+        except Exception:
+            detail = response.text[:500]
+        raise AttachmentUploadError(f"{step} failed ({response.status_code}): {detail}", response.status_code)
+
+
+def _upload(session, api_base: str, sender_email: str, draft_id: str, headers: Dict[str, str], att: Dict[str, Any]):
+    size = attachment_size(att)
+    response = session.post(
+        f"{api_base}/users/{sender_email}/messages/{draft_id}/attachments/createUploadSession",
+        headers=headers,
+        json={"AttachmentItem": {
+            "attachmentType": "file",
+            "name": att['filename'],
+            "size": size,
+            "contentType": att.get('mimetype') or 'application/octet-stream',
+        }},
+        timeout=30
+    )
+    _check(response, (200, 201), f"createUploadSession for '{att['filename']}'")
+    upload_url = response.json()['uploadUrl']
+
+    offset = 0
+    for chunk in iter_attachment_chunks(att):
+        end = offset + len(chunk) - 1
+        # The upload URL is pre-authorized; it must not carry the bearer token
+        response = session.put(
+            upload_url,
+            headers={"Content-Length": str(len(chunk)), "Content-Range": f"bytes {offset}-{end}/{size}"},
+            data=chunk,
+            timeout=UPLOAD_TIMEOUT
+        )
+        _check(response, (200, 201), f"Uploading '{att['filename']}' bytes {offset}-{end}")
+        offset = end + 1
+    logger.info(f"[SEND_EMAIL] Uploaded attachment {att['filename']} ({size} bytes) via upload session")
+
+
+def send_via_draft(session, api_base: str, sender_email: str, access_token: str,
+                   message: Dict[str, Any], upload: List[Dict[str, Any]]) -> Optional[str]:
+    """
+    Create a draft from message (which may already carry inline
+    attachments), attach the upload list through upload sessions and send
+    it. Returns the draft id; raises AttachmentUploadError on failure after
+    deleting the draft.
+    """
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    response = session.post(f"{api_base}/users/{sender_email}/messages", headers=headers, json=message, timeout=60)
+    _check(response, (201,), "Creating draft")
+    draft_id = response.json()['id']
+    try:
+        for att in upload:
+            _upload(session, api_base, sender_email, draft_id, headers, att)
+        response = session.post(f"{api_base}/users/{sender_email}/messages/{draft_id}/send", headers=headers, timeout=60)
+        _check(response, (202, 204), "Sending draft")
+    except Exception:
+        try:
+            session.delete(f"{api_base}/users/{sender_email}/messages/{draft_id}", headers=headers, timeout=30)
+        except Exception as e:
+            logger.warning(f"[SEND_EMAIL] Could not delete failed draft {draft_id}: {e}")
+        raise
+    return draft_id
@@ -0,0 +1,215 @@
+"""
+Graph Auth Module
+
+Shared app-only token manager for Microsoft Graph credentials.
+
+One MSAL ConfidentialClientApplication is kept per (tenant, client) and
+the access token it issues is cached until REFRESH_MARGIN_SECONDS before
+it expires, so sending or verifying an email normally reads a cached
+token instead of calling MSAL. token_refresh_worker renews tokens that
+are about to lapse in the background, which keeps acquisition off the
+per-message path altogether.
+
+Tokens are handed out from worker threads (graph_email runs under
+asyncio.to_thread) as well as the event loop, so all state is guarded by
+locks; concurrent callers of one credential wait for a single refresh.
+
+This module is imported and used by graph_email.py and main.py.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from msal import ConfidentialClientApplication
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AUTHORITY_HOST = 'https://login.microsoftonline.com'
+# Point at graph_simulator (e.g. http://127.0.0.1:8900) for offline runs
+AUTHORITY_HOST = os.getenv('GRAPH_AUTHORITY_HOST', DEFAULT_AUTHORITY_HOST).rstrip('/')
+GRAPH_SCOPE = ['https://graph.microsoft.com/.default']
+
+# A cached token is only handed out while it has at least this long to live
+REFRESH_MARGIN_SECONDS = int(os.getenv('GRAPH_TOKEN_REFRESH_MARGIN_SECONDS', '300'))
+# The background refresh renews tokens expiring within this window
+PROACTIVE_REFRESH_SECONDS = int(os.getenv('GRAPH_TOKEN_PROACTIVE_REFRESH_SECONDS', '900'))
+REFRESH_CHECK_SECONDS = int(os.getenv('GRAPH_TOKEN_REFRESH_CHECK_SECONDS', '60'))
+
+CredentialKey = Tuple[str, str]
+
+
+@dataclass
+class _Credential:
+    tenant_id: str
+    client_id: str
+    client_secret: str
+    app: Any = None
+    access_token: Optional[str] = None
+    expires_at: float = 0.0
+    refreshed_at: float = 0.0
+    refresh_count: int = 0
+    last_error: Optional[str] = None
+
+
+class TokenManager:
+    """Caches MSAL apps and client-credential tokens per (tenant, client)."""
+
+    def __init__(self, authority_host: str = AUTHORITY_HOST, scopes: Optional[List[str]] = None):
+        self.authority_host = authority_host.rstrip('/')
+        self.scopes = list(scopes or GRAPH_SCOPE)
+        self._credentials: Dict[CredentialKey, _Credential] = {}
+        self._locks: Dict[CredentialKey, threading.Lock] = {}
+        self._registry_lock = threading.Lock()
+
+    def _entry(self, tenant_id: str, client_id: str, client_secret: str) -> Tuple[_Credential, threading.Lock]:
+        key = (tenant_id.lower(), client_id.lower())
+        with self._registry_lock:
+            entry = self._credentials.get(key)
+            if entry is None or entry.client_secret != client_secret:
+                entry = self._credentials[key] = _Credential(tenant_id, client_id, client_secret)
+            lock = self._locks.setdefault(key, threading.Lock())
+        return entry, lock
+
+    def _app(self, entry: _Credential):
+        if entry.app is None:
+            entry.app = ConfidentialClientApplication(
+                entry.client_id,
+                authority=f"{self.authority_host}/{entry.tenant_id}",
+                client_credential=entry.client_secret,
+                # Custom hosts (a simulator) are not in Azure's authority list
+                validate_authority=self.authority_host == DEFAULT_AUTHORITY_HOST
+            )
+        return entry.app
+
+    def _request_token(self, entry: _Credential) -> Dict[str, Any]:
+        """
+        Plain client-credentials request; used for http:// authority hosts
+        (a local simulator), which MSAL refuses.
+        """
+        from http_clients import graph_session
+        response = graph_session().post(
+            f"{self.authority_host}/{entry.tenant_id}/oauth2/v2.0/token",
+            data={
+                'grant_type': 'client_credentials',
+                'client_id': entry.client_id,
+                'client_secret': entry.client_secret,
+                'scope': ' '.join(self.scopes),
+            },
+            timeout=30
+        )
+        try:
+            return response.json()
+        except ValueError:
+            return {'error': f"HTTP {response.status_code}", 'error_description': response.text[:500]}
+
+    def _acquire(self, entry: _Credential) -> str:
+        """Request a token from MSAL; caller holds the credential lock."""
+        if self.authority_host.startswith('http://'):
+            result = self._request_token(entry)
+        else:
+            result = self._app(entry).acquire_token_for_client(scopes=self.scopes)
+        if 'access_token' not in result:
+            entry.last_error = f"{result.get('error')}: {result.get('error_description')}"
+            raise RuntimeError(f"Could not obtain access token for client {entry.client_id}: {result}")
+        now = time.time()
+        entry.access_token = result['access_token']
+        entry.expires_at = now + int(result.get('expires_in') or 3600)
+        entry.refreshed_at = now
+        entry.refresh_count += 1
+        entry.last_error = None
+        logger.debug(f"[GRAPH AUTH] Token for client {entry.client_id} refreshed, valid {int(entry.expires_at - now)}s")
+        return entry.access_token
+
+    def get_token(self, tenant_id: str, client_id: str, client_secret: str) -> str:
+        """Cached access token for the credential, refreshed when close to expiry."""
+        entry, lock = self._entry(tenant_id, client_id, client_secret)
+        token = entry.access_token
+        if token and entry.expires_at - time.time() > REFRESH_MARGIN_SECONDS:
+            return token
+        with lock:
+            # Another thread may have refreshed while we waited
+            if entry.access_token and entry.expires_at - time.time() > REFRESH_MARGIN_SECONDS:
+                return entry.access_token
+            return self._acquire(entry)
+
+    def msal_app(self, tenant_id: str, client_id: str, client_secret: str):
+        """The shared MSAL application of a credential."""
+        entry, lock = self._entry(tenant_id, client_id, client_secret)
+        with lock:
+            return self._app(entry)
+
+    def invalidate(self, tenant_id: str, client_id: str):
+        """Drop a cached token (e.g. after Graph rejected it with 401)."""
+        key = (tenant_id.lower(), client_id.lower())
+        with self._registry_lock:
+            entry = self._credentials.get(key)
+        if entry is not None:
+            entry.access_token = None
+            entry.expires_at = 0.0
+
+    def refresh_expiring(self, within_seconds: int = PROACTIVE_REFRESH_SECONDS) -> int:
+        """Renew every cached token expiring within the window; returns the number renewed."""
+        with self._registry_lock:
+            items = [(key, entry, self._locks[key]) for key, entry in self._credentials.items()]
+        renewed = 0
+        for key, entry, lock in items:
+            if entry.expires_at - time.time() > within_seconds:
+                continue
+            with lock:
+                if entry.expires_at - time.time() > within_seconds:
+                    continue
+                try:
+                    self._acquire(entry)
+                    renewed += 1
+                except Exception as e:
+                    logger.error(f"[GRAPH AUTH] Background refresh failed for client {key[1]}: {e}")
+        return renewed
+
+    def status(self) -> List[Dict[str, Any]]:
+        now = time.time()
+        with self._registry_lock:
+            entries = list(self._credentials.values())
+        return [
+            {
+                'tenant_id': e.tenant_id,
+                'client_id': e.client_id,
+                'has_token': bool(e.access_token),
+                'expires_in_seconds': max(0, int(e.expires_at - now)) if e.access_token else 0,
+                'refresh_count': e.refresh_count,
+                'last_error': e.last_error,
+            }
+            for e in entries
+        ]
+
+
+token_manager = TokenManager()
+
+
+async def token_refresh_worker(credentials_fn=None):
+    """
+    Keep cached tokens fresh in the background.
+
+    credentials_fn() returns (tenant_id, client_id, client_secret) tuples to
+    warm up once at start, so the first send does not pay for acquisition.
+    """
+    if credentials_fn is not None:
+        for tenant_id, client_id, client_secret in credentials_fn():
+            try:
+                await asyncio.to_thread(token_manager.get_token, tenant_id, client_id, client_secret)
+            except Exception as e:
+                logger.error(f"[GRAPH AUTH] Could not pre-fetch token for client {client_id}: {e}")
+    while True:
+        try:
+            renewed = await asyncio.to_thread(token_manager.refresh_expiring)
+            if renewed:
+                logger.info(f"[GRAPH AUTH] Refreshed {renewed} token(s) ahead of expiry")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[GRAPH AUTH] Token refresh worker error: {e}", exc_info=True)
+        await asyncio.sleep(REFRESH_CHECK_SECONDS)
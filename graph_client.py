@@ -0,0 +1,603 @@
+"""
+Graph Client Module
+
+Throttling-aware front for every Microsoft Graph request.
+
+Exchange Online limits each app to a few concurrent requests and a
+request budget per mailbox, and answers excess requests with 429 (or
+503) and a Retry-After header. GraphClient.request():
+
+- waits for a slot in the mailbox's concurrency window; the window is
+  adapted AIMD-style - it grows by one slot per window of successful
+  requests and halves on every 429/503, between MIN_CONCURRENCY and the
+  mailbox's cap (sender registry max_concurrency or
+  GRAPH_MAILBOX_CONCURRENCY);
+- draws from token-bucket budgets per (app, mailbox) and per app;
+- on 429/503/504 honours Retry-After (exponential backoff without it),
+  pauses the whole mailbox for that long and retries up to MAX_RETRIES
+  times. Non-idempotent requests are only retried on 429, which Graph
+  guarantees was not processed;
+- stops growing the window while x-ms-throttle-limit-percentage reports
+  the mailbox close to its limit.
+
+GraphBatcher coalesces GETs issued within a short window into $batch
+calls of up to 20 requests (identical requests share one item), so bulk
+Sent Items checks and message reads cost one round trip instead of many.
+
+Per-mailbox, per-app and batching counters are kept in memory and
+served at /admin/graph-throttling.
+
+graph_email runs in worker threads, so the client is synchronous and all
+state is guarded by locks. This module is imported and used by
+graph_email.py and main.py.
+"""
+
+import os
+import json
+import time
+import random
+import inspect
+import logging
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import quote, urlencode
+
+from requests.structures import CaseInsensitiveDict
+from requests.utils import requote_uri
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from http_clients import graph_session
+
+logger = logging.getLogger(__name__)
+
+# Outlook allows 4 concurrent requests per app and mailbox
+MAILBOX_CONCURRENCY = int(os.getenv('GRAPH_MAILBOX_CONCURRENCY', '4'))
+MIN_CONCURRENCY = 1
+# ... and 10,000 requests per 10 minutes per app and mailbox
+MAILBOX_REQUESTS_PER_10_MIN = int(os.getenv('GRAPH_MAILBOX_REQUESTS_PER_10_MIN', '10000'))
+MAILBOX_BURST = int(os.getenv('GRAPH_MAILBOX_BURST', '50'))
+# Budget across all mailboxes of one app registration; 0 disables it
+APP_REQUESTS_PER_SECOND = float(os.getenv('GRAPH_APP_REQUESTS_PER_SECOND', '1000'))
+APP_BURST = int(os.getenv('GRAPH_APP_BURST', '1000'))
+
+MAX_RETRIES = int(os.getenv('GRAPH_THROTTLE_MAX_RETRIES', '3'))
+# Throttled requests asking for a longer wait are handed back to the caller
+MAX_RETRY_AFTER_SECONDS = float(os.getenv('GRAPH_MAX_RETRY_AFTER_SECONDS', '60'))
+DEFAULT_BACKOFF_SECONDS = 2.0
+# x-ms-throttle-limit-percentage at which the window stops growing
+NEAR_LIMIT_PERCENTAGE = float(os.getenv('GRAPH_THROTTLE_NEAR_LIMIT', '0.8'))
+
+# $batch coalescing window for GETs; 0 sends every request on its own
+BATCH_WINDOW_MS = float(os.getenv('GRAPH_BATCH_WINDOW_MS', '50'))
+BATCH_MAX_REQUESTS = int(os.getenv('GRAPH_BATCH_MAX_REQUESTS', '20'))
+
+THROTTLE_STATUSES = (429, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+
+def retry_after_seconds(response, default: Optional[float] = None) -> Optional[float]:
+    """Seconds from a Retry-After header (delta-seconds or HTTP date)."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token; returns how long the caller must wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+@dataclass
+class _MailboxState:
+    cap: int
+    limit: float
+    in_flight: int = 0
+    blocked_until: float = 0.0
+    near_limit: bool = False
+    requests: int = 0
+    throttled: int = 0
+    server_busy: int = 0
+    retries: int = 0
+    given_up: int = 0
+    wait_seconds: float = 0.0
+    last_retry_after: Optional[float] = None
+    last_throttled_at: Optional[float] = None
+    throttle_percentage: Optional[float] = None
+    throttle_scope: Optional[str] = None
+    cond: threading.Condition = field(default_factory=threading.Condition)
+
+
+class GraphClient:
+    """Routes Graph requests through per-mailbox windows and budgets."""
+
+    def __init__(self):
+        self._mailboxes: Dict[str, _MailboxState] = {}
+        self._mailbox_budgets: Dict[tuple, _TokenBucket] = {}
+        self._app_budgets: Dict[str, _TokenBucket] = {}
+        self._app_requests: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _mailbox(self, mailbox: str, cap: Optional[int]) -> _MailboxState:
+        cap = max(MIN_CONCURRENCY, cap or MAILBOX_CONCURRENCY)
+        with self._lock:
+            state = self._mailboxes.get(mailbox)
+            if state is None:
+                state = self._mailboxes[mailbox] = _MailboxState(cap=cap, limit=float(cap))
+        if state.cap != cap:
+            # The sender registry changed the mailbox's cap
+            with state.cond:
+                state.cap = cap
+                state.limit = min(state.limit, float(cap))
+                state.cond.notify_all()
+        return state
+
+    def _budget_wait(self, app_id: Optional[str], mailbox: Optional[str]) -> float:
+        wait = 0.0
+        with self._lock:
+            if app_id and APP_REQUESTS_PER_SECOND > 0:
+                bucket = self._app_budgets.get(app_id)
+                if bucket is None:
+                    bucket = self._app_budgets[app_id] = _TokenBucket(APP_REQUESTS_PER_SECOND, APP_BURST)
+                self._app_requests[app_id] = self._app_requests.get(app_id, 0) + 1
+            else:
+                bucket = None
+            mailbox_bucket = None
+            if mailbox and MAILBOX_REQUESTS_PER_10_MIN > 0:
+                key = (app_id, mailbox)
+                mailbox_bucket = self._mailbox_budgets.get(key)
+                if mailbox_bucket is None:
+                    mailbox_bucket = self._mailbox_budgets[key] = _TokenBucket(
+                        MAILBOX_REQUESTS_PER_10_MIN / 600.0, MAILBOX_BURST)
+        if bucket is not None:
+            wait = bucket.reserve()
+        if mailbox_bucket is not None:
+            wait = max(wait, mailbox_bucket.reserve())
+        return wait
+
+    def _acquire(self, state: _MailboxState) -> float:
+        """Wait for a free slot in the mailbox window; returns the time waited."""
+        started = time.monotonic()
+        with state.cond:
+            while True:
+                pause = state.blocked_until - time.monotonic()
+                if pause <= 0 and state.in_flight < max(MIN_CONCURRENCY, int(state.limit)):
+                    break
+                state.cond.wait(timeout=pause if pause > 0 else 1.0)
+            state.in_flight += 1
+            state.requests += 1
+        return time.monotonic() - started
+
+    def _release(self, state: _MailboxState, response, waited: float):
+        with state.cond:
+            state.in_flight -= 1
+            state.wait_seconds += waited
+            if response is not None:
+                self._observe(state, response)
+            state.cond.notify_all()
+
+    def _observe(self, state: _MailboxState, response):
+        """Adapt the window to the response; caller holds state.cond."""
+        headers = response.headers
+        percentage = headers.get('x-ms-throttle-limit-percentage')
+        if percentage:
+            try:
+                state.throttle_percentage = float(percentage)
+            except ValueError:
+                pass
+            state.near_limit = (state.throttle_percentage or 0) >= NEAR_LIMIT_PERCENTAGE
+        elif response.status_code < 400:
+            state.near_limit = False
+        if headers.get('x-ms-throttle-scope'):
+            state.throttle_scope = headers.get('x-ms-throttle-scope')
+
+        if response.status_code in THROTTLE_STATUSES:
+            if response.status_code == 429:
+                state.throttled += 1
+            else:
+                state.server_busy += 1
+            state.limit = max(float(MIN_CONCURRENCY), state.limit / 2)
+            state.last_throttled_at = time.time()
+        elif response.status_code < 400 and not state.near_limit and state.limit < state.cap:
+            # Additive increase: one slot per window of successful requests
+            state.limit = min(float(state.cap), state.limit + 1.0 / state.limit)
+
+    def _pause(self, state: _MailboxState, seconds: float):
+        with state.cond:
+            state.last_retry_after = seconds
+            state.blocked_until = max(state.blocked_until, time.monotonic() + seconds)
+
+    def window(self, mailbox: str, max_concurrency: Optional[int] = None) -> int:
+        """Current number of concurrent requests allowed for the mailbox."""
+        return max(MIN_CONCURRENCY, int(self._mailbox(mailbox.lower(), max_concurrency).limit))
+
+    def record(self, mailbox: str, response, max_concurrency: Optional[int] = None):
+        """Account for a response that did not go through request() (a $batch item)."""
+        state = self._mailbox(mailbox.lower(), max_concurrency)
+        with state.cond:
+            state.requests += 1
+            self._observe(state, response)
+            state.cond.notify_all()
+        if response.status_code in THROTTLE_STATUSES:
+            delay = retry_after_seconds(response)
+            if delay is not None:
+                self._pause(state, min(delay, MAX_RETRY_AFTER_SECONDS))
+
+    def request(self, method: str, url: str, mailbox: Optional[str] = None, app_id: Optional[str] = None,
+                max_concurrency: Optional[int] = None, **kwargs):
+        """
+        Send a request through the shared Graph session. Throttled responses
+        are retried after Retry-After; the last response is returned either
+        way, so callers keep their own status handling.
+        """
+        method = method.upper()
+        state = self._mailbox(mailbox.lower(), max_concurrency) if mailbox else None
+        attempt = 0
+        while True:
+            waited = 0.0
+            budget_wait = self._budget_wait(app_id, mailbox.lower() if mailbox else None)
+            if budget_wait > 0:
+                time.sleep(budget_wait)
+                waited += budget_wait
+            if state is not None:
+                waited += self._acquire(state)
+            response = None
+            try:
+                response = graph_session().request(method, url, **kwargs)
+            finally:
+                if state is not None:
+                    self._release(state, response, waited)
+
+            status = response.status_code
+            if status not in THROTTLE_STATUSES:
+                return response
+            if status != 429 and method not in IDEMPOTENT_METHODS:
+                return response
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = DEFAULT_BACKOFF_SECONDS * (2 ** attempt) + random.uniform(0, 1)
+            if attempt >= MAX_RETRIES or delay > MAX_RETRY_AFTER_SECONDS:
+                if state is not None:
+                    state.given_up += 1
+                logger.warning(
+                    f"[GRAPH THROTTLE] {method} for {mailbox or 'app'} still {status} after {attempt} retr"
+                    f"{'y' if attempt == 1 else 'ies'} (Retry-After {delay:.1f}s)"
+                )
+                return response
+            attempt += 1
+            if state is not None:
+                state.retries += 1
+                self._pause(state, delay)
+            else:
+                time.sleep(delay)
+            logger.info(f"[GRAPH THROTTLE] {status} for {mailbox or 'app'}, retrying in {delay:.1f}s ({attempt}/{MAX_RETRIES})")
+
+    def bind(self, mailbox: Optional[str] = None, app_id: Optional[str] = None,
+             max_concurrency: Optional[int] = None) -> 'BoundGraphClient':
+        return BoundGraphClient(self, mailbox, app_id, max_concurrency)
+
+    def metrics(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            mailboxes = dict(self._mailboxes)
+            app_requests = dict(self._app_requests)
+        return {
+            'mailboxes': {
+                mailbox: {
+                    'concurrency_limit': round(s.limit, 2),
+                    'concurrency_cap': s.cap,
+                    'in_flight': s.in_flight,
+                    'paused_for_seconds': round(max(0.0, s.blocked_until - now), 1),
+                    'requests': s.requests,
+                    'throttled': s.throttled,
+                    'server_busy': s.server_busy,
+                    'retries': s.retries,
+                    'given_up': s.given_up,
+                    'wait_seconds': round(s.wait_seconds, 1),
+                    'last_retry_after': s.last_retry_after,
+                    'last_throttled_at': (
+                        datetime.fromtimestamp(s.last_throttled_at, timezone.utc).isoformat()
+                        if s.last_throttled_at else None
+                    ),
+                    'throttle_limit_percentage': s.throttle_percentage,
+                    'throttle_scope': s.throttle_scope,
+                }
+                for mailbox, s in sorted(mailboxes.items())
+            },
+            'apps': {app_id: {'requests': count} for app_id, count in sorted(app_requests.items())},
+        }
+
+
+class BoundGraphClient:
+    """Session-like view (get/post/put/patch/delete) bound to one mailbox."""
+
+    def __init__(self, client: GraphClient, mailbox: Optional[str], app_id: Optional[str],
+                 max_concurrency: Optional[int]):
+        self.client = client
+        self.mailbox = mailbox
+        self.app_id = app_id
+        self.max_concurrency = max_concurrency
+
+    def request(self, method: str, url: str, **kwargs):
+        return self.client.request(method, url, mailbox=self.mailbox, app_id=self.app_id,
+                                   max_concurrency=self.max_concurrency, **kwargs)
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url: str, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url: str, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url: str, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+class BatchItemResponse:
+    """One $batch response item with the parts of requests.Response callers use."""
+
+    def __init__(self, status_code: int, headers: Optional[Dict[str, str]] = None, body: Any = None):
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers or {})
+        self._body = body
+
+    def json(self):
+        if isinstance(self._body, (dict, list)):
+            return self._body
+        return json.loads(self._body or 'null')
+
+    @property
+    def text(self) -> str:
+        if isinstance(self._body, str):
+            return self._body
+        return json.dumps(self._body) if self._body is not None else ''
+
+
+@dataclass
+class _BatchItem:
+    method: str
+    url: str
+    mailbox: Optional[str]
+    futures: List[Future] = field(default_factory=list)
+    attempts: int = 0
+
+
+@dataclass
+class _BatchGroup:
+    api_base: str
+    access_token: str
+    app_id: Optional[str]
+    max_concurrency: Optional[int]
+    items: Dict[Tuple[str, str], _BatchItem] = field(default_factory=dict)
+
+
+class GraphBatcher:
+    """
+    Coalesces GET requests into Graph $batch calls.
+
+    Requests submitted with the same access token within BATCH_WINDOW_MS
+    are sent together, up to BATCH_MAX_REQUESTS per call; identical
+    requests in one window (e.g. several Sent Items checks of a mailbox)
+    share a single batch item. Items of one mailbox are chained with
+    dependsOn to stay within its concurrency window. Throttled items are
+    resubmitted after their Retry-After, and every item response is
+    recorded against its mailbox's window in the GraphClient.
+    """
+
+    def __init__(self, client: GraphClient, window_ms: float = BATCH_WINDOW_MS,
+                 max_requests: int = BATCH_MAX_REQUESTS):
+        self.client = client
+        self.window = window_ms / 1000.0
+        self.max_requests = max(1, min(20, max_requests))
+        self._groups: Dict[Tuple[str, str], _BatchGroup] = {}
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.coalesced = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def submit(self, api_base: str, access_token: str, url: str, app_id: Optional[str] = None,
+               max_concurrency: Optional[int] = None) -> Future:
+        """Queue a GET of url (absolute, under api_base); the future yields a BatchItemResponse."""
+        future: Future = Future()
+        relative = requote_uri(url[len(api_base):] if url.startswith(api_base) else url)
+        item = _BatchItem('GET', relative, _mailbox_from_path(relative), [future])
+        self._enqueue(api_base, access_token, app_id, max_concurrency, item)
+        return future
+
+    def get(self, api_base: str, access_token: str, url: str, params: Optional[Dict[str, Any]] = None,
+            app_id: Optional[str] = None, max_concurrency: Optional[int] = None, timeout: float = 60):
+        """Blocking GET through the batcher (or directly when batching is off)."""
+        if params:
+            url = f"{url}{'&' if '?' in url else '?'}{urlencode(params, quote_via=quote, safe='$,()')}"
+        if not self.enabled or not url.startswith(api_base):
+            mailbox = _mailbox_from_path(url[len(api_base):]) if url.startswith(api_base) else None
+            return self.client.request('GET', url, mailbox=mailbox,
+                                       app_id=app_id, max_concurrency=max_concurrency,
+                                       headers={"Authorization": f"Bearer {access_token}"}, timeout=timeout)
+        return self.submit(api_base, access_token, url, app_id, max_concurrency).result(timeout=timeout)
+
+    def _enqueue(self, api_base: str, access_token: str, app_id: Optional[str],
+                 max_concurrency: Optional[int], item: _BatchItem):
+        key = (api_base, access_token)
+        full = None
+        with self._lock:
+            group = self._groups.get(key)
+            if group is None:
+                group = self._groups[key] = _BatchGroup(api_base, access_token, app_id, max_concurrency)
+                timer = threading.Timer(self.window, self._flush, args=(key, group))
+                timer.daemon = True
+                timer.start()
+            existing = group.items.get((item.method, item.url))
+            if existing is not None:
+                existing.futures.extend(item.futures)
+                self.coalesced += len(item.futures)
+            else:
+                group.items[(item.method, item.url)] = item
+                if len(group.items) >= self.max_requests:
+                    full = self._groups.pop(key)
+        if full is not None:
+            threading.Thread(target=self._send, args=(full,), daemon=True).start()
+
+    def _flush(self, key: Tuple[str, str], group: _BatchGroup):
+        with self._lock:
+            if self._groups.get(key) is not group:
+                return  # already sent because it filled up
+            del self._groups[key]
+        self._send(group)
+
+    def _send(self, group: _BatchGroup):
+        items = list(group.items.values())
+        mailboxes = {item.mailbox for item in items}
+        # Graph checks every batch item against its mailbox's concurrency
+        # limit; chain a mailbox's items with dependsOn so no more than its
+        # current window run at once
+        requests_payload = []
+        by_mailbox: Dict[Optional[str], List[int]] = {}
+        for index, item in enumerate(items):
+            entry = {"id": str(index), "method": item.method, "url": item.url}
+            if item.mailbox:
+                previous = by_mailbox.setdefault(item.mailbox, [])
+                lanes = self.client.window(item.mailbox, group.max_concurrency)
+                if len(previous) >= lanes:
+                    entry["dependsOn"] = [str(previous[-lanes])]
+                previous.append(index)
+            requests_payload.append(entry)
+        try:
+            response = self.client.request(
+                'POST', f"{group.api_base}/$batch",
+                # A batch for one mailbox occupies one of its request slots
+                mailbox=next(iter(mailboxes)) if len(mailboxes) == 1 else None,
+                app_id=group.app_id, max_concurrency=group.max_concurrency,
+                headers={"Authorization": f"Bearer {group.access_token}", "Content-Type": "application/json"},
+                json={"requests": requests_payload},
+                timeout=60
+            )
+        except Exception as e:
+            for item in items:
+                _resolve(item, exception=e)
+            return
+        self.batches += 1
+        self.items += len(items)
+        if response.status_code != 200:
+            failed = BatchItemResponse(response.status_code, dict(response.headers), response.text)
+            for item in items:
+                _resolve(item, failed)
+            return
+
+        answers = {r.get('id'): r for r in response.json().get('responses', [])}
+        for index, item in enumerate(items):
+            answer = answers.get(str(index))
+            if answer is None:
+                _resolve(item, BatchItemResponse(500, {}, {"error": {"code": "MissingBatchResponse"}}))
+                continue
+            result = BatchItemResponse(int(answer.get('status', 500)), answer.get('headers'), answer.get('body'))
+            if result.status_code == 424 and item.attempts < MAX_RETRIES:
+                # Only its dependsOn predecessor failed; send it again
+                item.attempts += 1
+                self._enqueue(group.api_base, group.access_token, group.app_id, group.max_concurrency, item)
+                continue
+            if item.mailbox:
+                self.client.record(item.mailbox, result, group.max_concurrency)
+            if result.status_code in THROTTLE_STATUSES and item.attempts < MAX_RETRIES:
+                delay = retry_after_seconds(result, DEFAULT_BACKOFF_SECONDS * (2 ** item.attempts))
+                if delay <= MAX_RETRY_AFTER_SECONDS:
+                    item.attempts += 1
+                    timer = threading.Timer(delay, self._enqueue, args=(
+                        group.api_base, group.access_token, group.app_id, group.max_concurrency, item))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+            _resolve(item, result)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'window_ms': self.window * 1000,
+            'batches': self.batches,
+            'items': self.items,
+            'coalesced_duplicates': self.coalesced,
+            'avg_items_per_batch': round(self.items / self.batches, 1) if self.batches else 0,
+        }
+
+
+def _mailbox_from_path(path: str) -> Optional[str]:
+    parts = path.lstrip('/').split('/')
+    if len(parts) > 1 and parts[0].lower() == 'users':
+        return parts[1].split('?')[0].lower()
+    return None
+
+
+def _resolve(item: _BatchItem, response=None, exception: Optional[Exception] = None):
+    for future in item.futures:
+        if future.done():
+            continue
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+
+graph_client = GraphClient()
+graph_batcher = GraphBatcher(graph_client)
+
+
+def create_graph_client_router():
+    """Factory function to create the Graph throttling metrics router"""
+    router = APIRouter()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    @router.get("/admin/graph-throttling")
+    async def get_graph_throttling(current_user: dict = Depends(get_current_user)):
+        """Per-mailbox concurrency windows and throttling counters since start."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return {**graph_client.metrics(), 'batching': graph_batcher.metrics()}
+
+    return router
+
+
+router = create_graph_client_router()
@@ -1,10 +1,21 @@
 import os
+import re
 import logging
 import requests
-from msal import ConfidentialClientApplication
+from urllib.parse import quote, urlencode
 from dotenv import load_dotenv
+
+from graph_auth import token_manager
+from http_clients import GRAPH_TIMEOUT
+from graph_client import graph_client, graph_batcher, retry_after_seconds, MAX_RETRY_AFTER_SECONDS
+from graph_attachments import (
+    AttachmentUploadError, attachment_size, inline_attachment, is_valid_attachment, send_via_draft, split_attachments,
+)
 load_dotenv()
 
+# Reads the sender environment variables, so it is imported after load_dotenv()
+from sender_registry import sender_registry
+
 # Setup logging to both file and console with detailed output
 try:
     from logging.handlers import RotatingFileHandler
@@ -21,77 +32,65 @@ logger.setLevel(logging.DEBUG)
 logger.addHandler(log_handler)
 logger.addHandler(console_handler)
 
-# Read up to 3 sets of credentials from environment variables
-SENDERS = []
-for i in range(1, 4):
-    client_id = os.getenv(f'AZURE_CLIENT_ID_{i}')
-    client_secret = os.getenv(f'AZURE_CLIENT_SECRET_{i}')
-    tenant_id = os.getenv(f'AZURE_TENANT_ID_{i}')
-    sender_email = os.getenv(f'GRAPH_SENDER_EMAIL_{i}')
-    if client_id and client_secret and tenant_id and sender_email:
-        SENDERS.append({
-            'client_id': client_id,
-            'client_secret': client_secret,
-            'tenant_id': tenant_id,
-            'sender_email': sender_email.lower(),
-            'msal_app': None
-        })
-# Fallback/default sender
-DEFAULT_CLIENT_ID = os.getenv('AZURE_CLIENT_ID')
-DEFAULT_CLIENT_SECRET = os.getenv('AZURE_CLIENT_SECRET')
-DEFAULT_TENANT_ID = os.getenv('AZURE_TENANT_ID')
-DEFAULT_SENDER_EMAIL = os.getenv('GRAPH_SENDER_EMAIL')
-DEFAULT_SENDER = {
-    'client_id': DEFAULT_CLIENT_ID,
-    'client_secret': DEFAULT_CLIENT_SECRET,
-    'tenant_id': DEFAULT_TENANT_ID,
-    'sender_email': DEFAULT_SENDER_EMAIL.lower() if DEFAULT_SENDER_EMAIL else None,
-    'msal_app': None
-}
-
-GRAPH_API_BASE = 'https://graph.microsoft.com/v1.0'
+# Point at graph_simulator (e.g. http://127.0.0.1:8900/v1.0) for offline runs
+GRAPH_API_BASE = os.getenv('GRAPH_API_BASE', 'https://graph.microsoft.com/v1.0').rstrip('/')
 SCOPE = ['https://graph.microsoft.com/.default']
 
 def get_sender_config(sender_email):
-    if not sender_email:
-        raise Exception("No sender_email provided to get_sender_config")
-    sender_email = sender_email.lower()
-    # Debug logging for sender matching
-    loaded_senders = [s['sender_email'] for s in SENDERS]
-    logger.debug(f"get_sender_config: requested sender_email={sender_email}")
-    logger.debug(f"get_sender_config: loaded SENDERS={loaded_senders}")
-    logger.debug(f"get_sender_config: DEFAULT_SENDER={DEFAULT_SENDER['sender_email']}")
-    for sender in SENDERS:
-        if sender['sender_email'] == sender_email:
-            # Ensure all required fields are present
-            if not sender['tenant_id'] or sender['tenant_id'].lower() == 'none':
-                raise Exception(f"Missing or invalid tenant_id for sender {sender_email}")
-            return sender
-    # fallback
-    if DEFAULT_SENDER['sender_email'] == sender_email:
-        if not DEFAULT_SENDER['tenant_id'] or DEFAULT_SENDER['tenant_id'].lower() == 'none':
-            raise Exception(f"Missing or invalid tenant_id for default sender {sender_email}")
-        return DEFAULT_SENDER
-    raise Exception(f"No Azure config found for sender {sender_email}")
+    """Credentials and limits of a sender from the sender registry."""
+    return sender_registry.get_sender_config(sender_email)
 
 def get_msal_app(sender_config):
     if sender_config['msal_app'] is None:
-        sender_config['msal_app'] = ConfidentialClientApplication(
-            sender_config['client_id'],
-            authority=f"https://login.microsoftonline.com/{sender_config['tenant_id']}",
-            client_credential=sender_config['client_secret']
+        sender_config['msal_app'] = token_manager.msal_app(
+            sender_config['tenant_id'], sender_config['client_id'], sender_config['client_secret']
         )
     return sender_config['msal_app']
 
 def get_access_token(sender_email):
+    """Cached app-only token for the sender's credentials (see graph_auth)."""
     sender_config = get_sender_config(sender_email)
-    app = get_msal_app(sender_config)
-    result = app.acquire_token_for_client(scopes=SCOPE)
-    if 'access_token' in result:
-        return result['access_token']
-    else:
-        logger.error(f"MSAL token error for {sender_email}: {result.get('error')}, {result.get('error_description')}")
-        raise RuntimeError(f"Could not obtain access token for {sender_email}: {result}")
+    try:
+        return token_manager.get_token(
+            sender_config['tenant_id'], sender_config['client_id'], sender_config['client_secret']
+        )
+    except Exception as e:
+        logger.error(f"MSAL token error for {sender_email}: {e}")
+        raise
+
+def invalidate_access_token(sender_email):
+    """Forget the cached token of a sender, e.g. after Graph answered 401."""
+    try:
+        sender_config = get_sender_config(sender_email)
+    except Exception:
+        return
+    token_manager.invalidate(sender_config['tenant_id'], sender_config['client_id'])
+
+def graph_for(sender_email, mailbox_scoped=True):
+    """
+    Throttling-aware Graph client bound to the sender's app and, unless the
+    resource is app-wide (subscriptions), its mailbox (see graph_client).
+    """
+    sender = sender_registry.get(sender_email) or {}
+    return graph_client.bind(
+        sender_email.lower() if mailbox_scoped and sender_email else None,
+        sender.get('client_id'),
+        sender.get('max_concurrency')
+    )
+
+def graph_get(sender_email, access_token, url, params=None, timeout=30):
+    """
+    GET that may be coalesced with other reads into a Graph $batch call
+    (see graph_client.GraphBatcher); returns a response-like object.
+    """
+    sender = sender_registry.get(sender_email) or {}
+    return graph_batcher.get(GRAPH_API_BASE, access_token, url, params,
+                             app_id=sender.get('client_id'), max_concurrency=sender.get('max_concurrency'),
+                             timeout=timeout)
+
+def configured_credentials():
+    """(tenant_id, client_id, client_secret) of every configured sender."""
+    return sender_registry.credentials()
 
 def send_graph_email(
     sender_email,
@@ -123,7 +122,9 @@ def send_graph_email(
         body (str): Email body (plain text or HTML based on content_type).
         content_type (str): "HTML" or "TEXT" (default: "HTML").
         cc_emails (str or list, optional): CC recipient(s).
-        attachments (list, optional): List of dicts with 'filename', 'content' (bytes), 'mimetype'.
+        attachments (list, optional): List of dicts with 'filename', 'mimetype' and 'content' (bytes),
+            'path' (file on disk) or 'reader' + 'size' (see graph_attachments). Attachments
+            beyond the inline limit are streamed through Graph upload sessions.
         in_reply_to (str, optional): Message-ID to reply to.
         references (str, optional): Message-ID references for threading.
         test_mode (bool): If True, logs payload without sending.
@@ -145,9 +146,6 @@ def send_graph_email(
             "code": <HTTP status code>
         }
     """
-    import time
-    import base64
-    
     # ============================================================================
     # 1. VALIDATION
     # ============================================================================
@@ -248,37 +246,32 @@ def send_graph_email(
                     "value": references
                 })
         
-        # Handle attachments
+        # Handle attachments: small ones inline, large ones via upload sessions
+        upload_attachments = []
         if attachments and isinstance(attachments, list):
-            payload["message"]["attachments"] = []
+            valid = []
             for att in attachments:
-                if not isinstance(att, dict) or 'filename' not in att or 'content' not in att:
+                if not is_valid_attachment(att):
                     logger.warning("[SEND_EMAIL] Skipping invalid attachment format")
                     continue
-                
-                try:
-                    filename = att['filename']
-                    content_bytes = att['content']
-                    mimetype = att.get('mimetype', 'application/octet-stream')
-                    
-                    # Encode to base64
-                    content_b64 = base64.b64encode(content_bytes).decode('ascii')
-                    
-                    file_att = {
-                        "@odata.type": "#microsoft.graph.fileAttachment",
-                        "name": filename,
-                        "contentType": mimetype,
-                        "contentBytes": content_b64
-                    }
-                    payload["message"]["attachments"].append(file_att)
-                    logger.info(f"[SEND_EMAIL] Attached file: {filename} ({len(content_bytes)} bytes)")
-                except Exception as e:
-                    logger.error(f"[SEND_EMAIL] Failed to process attachment '{att.get('filename')}': {e}")
-                    return {
-                        "status": "failed",
-                        "error_message": f"Attachment processing failed: {str(e)}",
-                        "code": 400
-                    }
+                valid.append(att)
+
+            try:
+                inline_attachments, upload_attachments = split_attachments(valid)
+                if inline_attachments:
+                    payload["message"]["attachments"] = []
+                for att in inline_attachments:
+                    payload["message"]["attachments"].append(inline_attachment(att))
+                    logger.info(f"[SEND_EMAIL] Attached file: {att['filename']} ({attachment_size(att)} bytes)")
+                for att in upload_attachments:
+                    logger.info(f"[SEND_EMAIL] Attachment {att['filename']} ({attachment_size(att)} bytes) will use an upload session")
+            except Exception as e:
+                logger.error(f"[SEND_EMAIL] Failed to process attachments: {e}")
+                return {
+                    "status": "failed",
+                    "error_message": f"Attachment processing failed: {str(e)}",
+                    "code": 400
+                }
         
     except Exception as e:
         logger.error(f"[SEND_EMAIL] Failed to build payload: {e}")
@@ -324,10 +317,26 @@ def send_graph_email(
     
     try:
         logger.info(f"[SEND_EMAIL] Sending to {','.join(to_recipients)} from {sender_email}")
-        response = requests.post(url, headers=headers, json=payload, timeout=30)
+        if upload_attachments:
+            # Too large for an inline payload: draft + upload sessions + send
+            try:
+                send_via_draft(graph_for(sender_email), GRAPH_API_BASE, sender_email, access_token,
+                               payload["message"], upload_attachments)
+            except AttachmentUploadError as e:
+                logger.error(f"[SEND_EMAIL] {e}")
+                if e.status_code == 401:
+                    invalidate_access_token(sender_email)
+                return {
+                    "status": "failed",
+                    "error_message": str(e),
+                    "code": e.status_code
+                }
+            response = None
+        else:
+            response = graph_for(sender_email).post(url, headers=headers, json=payload, timeout=30)
         
         # Check for success response codes
-        if response.status_code not in [202, 204]:
+        if response is not None and response.status_code not in [202, 204]:
             # Extract error details from Graph response
             try:
                 error_data = response.json()
@@ -341,6 +350,8 @@ def send_graph_email(
                 f"[SEND_EMAIL] Graph API returned {response.status_code}: "
                 f"code={error_code}, message={error_message}"
             )
+            if response.status_code == 401:
+                invalidate_access_token(sender_email)
             
             return {
                 "status": "failed",
@@ -348,7 +359,7 @@ def send_graph_email(
                 "code": response.status_code
             }
         
-        logger.info(f"[SEND_EMAIL] Graph API accepted email (HTTP {response.status_code})")
+        logger.info(f"[SEND_EMAIL] Graph API accepted email (HTTP {response.status_code if response is not None else 202})")
         
     except requests.exceptions.Timeout:
         error_msg = "Graph API request timed out (30 seconds)"
@@ -432,10 +443,6 @@ def _verify_email_in_sent_items(sender_email, subject, recipient_email, max_retr
         return None
     
     url = f"{GRAPH_API_BASE}/users/{sender_email}/mailFolders/SentItems/messages"
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
     
     # Query parameters: get recent messages, sorted by most recent first
     params = {
@@ -451,7 +458,8 @@ def _verify_email_in_sent_items(sender_email, subject, recipient_email, max_retr
                 f"for subject='{subject}', to='{recipient_email}'"
             )
             
-            response = requests.get(url, headers=headers, params=params, timeout=10)
+            # Concurrent checks of this mailbox share one $batch item
+            response = graph_get(sender_email, access_token, url, params, timeout=10)
             
             if response.status_code != 200:
                 logger.warning(
@@ -459,7 +467,11 @@ def _verify_email_in_sent_items(sender_email, subject, recipient_email, max_retr
                     f"when checking Sent Items: {response.text}"
                 )
                 if attempt < max_retries:
-                    time.sleep(retry_delay_sec)
+                    # Throttled: wait as long as Graph asked instead of the fixed delay
+                    delay = retry_delay_sec
+                    if response.status_code in (429, 503):
+                        delay = min(retry_after_seconds(response, retry_delay_sec), MAX_RETRY_AFTER_SECONDS)
+                    time.sleep(delay)
                 continue
             
             messages = response.json().get('value', [])
@@ -521,95 +533,182 @@ def _verify_email_in_sent_items(sender_email, subject, recipient_email, max_retr
     return None
 
 
-def fetch_all_inbox_messages(sender_email, max_messages=500):
+def strip_html(html_content):
+    """Simple HTML to text conversion"""
+    if not html_content:
+        return ''
+    # Remove style and script tags and their contents
+    html_content = re.sub(r'<style.*?</style>', '', html_content, flags=re.DOTALL)
+    html_content = re.sub(r'<script.*?</script>', '', html_content, flags=re.DOTALL)
+    # Replace <br> and </p> with newlines
+    html_content = re.sub(r'<br\s*/?>|</p>', '\n', html_content)
+    # Remove all other HTML tags
+    html_content = re.sub(r'<[^>]+>', '', html_content)
+    # Fix whitespace
+    html_content = re.sub(r'\s+', ' ', html_content)
+    return html_content.strip()
+
+
+# Lightweight listing fields; bodies are loaded on demand (load_message_body)
+LIGHT_SELECT_FIELDS = "id,subject,from,toRecipients,ccRecipients,conversationId,receivedDateTime,bodyPreview"
+BODY_SELECT_FIELDS = "body,uniqueBody"
+# MAPI PidTagInReplyToId, expanded instead of selecting all internetMessageHeaders
+IN_REPLY_TO_PROPERTY = "String 0x1042"
+IN_REPLY_TO_EXPAND = f"singleValueExtendedProperties($filter=id eq '{IN_REPLY_TO_PROPERTY}')"
+
+
+def _apply_processed_body(msg):
+    """Set processed_body from the best available body (uniqueBody, body, bodyPreview)."""
+    # Extract message body from different possible sources
+    body_content = ''
+    if msg.get('body'):
+        body_content = msg['body'].get('content', '') or ''
+        content_type = (msg['body'].get('contentType', '') or '').lower()
+        if content_type == 'html':
+            try:
+                body_content = strip_html(body_content)
+            except Exception as e:
+                logger.error(f"[GRAPH] Failed to parse HTML body: {e}")
+
+    # Use uniqueBody if available (strips out quoted text)
+    unique_body = (msg.get('uniqueBody') or {}).get('content', '') or ''
+    if unique_body:
+        try:
+            unique_body = strip_html(unique_body)
+        except Exception as e:
+            logger.error(f"[GRAPH] Failed to parse unique body: {e}")
+
+    # Fall back to bodyPreview if needed
+    preview = msg.get('bodyPreview', '') or ''
+
+    # Use the best available content
+    final_body = unique_body or body_content or preview
+    msg['processed_body'] = final_body.strip()
+
+    logger.debug(f"[GRAPH] Message {msg.get('id', 'unknown')}: has body={bool(body_content)}, "
+                 f"has unique body={bool(unique_body)}, final body length={len(final_body)}")
+    return msg
+
+
+def _process_inbox_batch(batch):
+    """
+    Add inReplyTo and processed_body to each message of a Graph result page.
+
+    inReplyTo comes from the expanded PidTagInReplyToId property or, when
+    present, internetMessageHeaders. Messages listed without body fields
+    get bodyPreview as processed_body and body_loaded=False; call
+    load_message_body() for the ones that are actually stored.
+    """
+    for msg in batch:
+        for prop in msg.get('singleValueExtendedProperties') or []:
+            if (prop.get('id') or '').lower() == IN_REPLY_TO_PROPERTY.lower() and prop.get('value'):
+                msg['inReplyTo'] = prop['value']
+                break
+        if not msg.get('inReplyTo'):
+            msg_headers = msg.get('internetMessageHeaders', []) or []
+            # Extract inReplyTo from headers if available
+            for h in msg_headers:
+                if h.get('name', '').lower() in ('in-reply-to', 'x-in-reply-to'):
+                    msg['inReplyTo'] = h.get('value', '')
+                    break
+
+        msg['body_loaded'] = 'body' in msg or 'uniqueBody' in msg
+        if msg['body_loaded']:
+            _apply_processed_body(msg)
+        else:
+            msg['processed_body'] = (msg.get('bodyPreview') or '').strip()
+    return batch
+
+
+def load_message_body(sender_email, msg):
+    """
+    Fetch body/uniqueBody for one listed message and set its processed_body
+    (HTML stripped). No-op if the body was already loaded.
+    """
+    if msg.get('body_loaded') or not msg.get('id'):
+        return msg
+    access_token = get_access_token(sender_email)
+    response = graph_get(
+        sender_email, access_token,
+        f"{GRAPH_API_BASE}/users/{sender_email}/messages/{msg['id']}",
+        {"$select": BODY_SELECT_FIELDS}
+    )
+    return _apply_body_response(sender_email, msg, response)
+
+
+def _apply_body_response(sender_email, msg, response):
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"Fetching body of {msg['id']} for {sender_email} failed: {response.status_code} {response.text[:500]}"
+        )
+    data = response.json()
+    msg['body'] = data.get('body')
+    msg['uniqueBody'] = data.get('uniqueBody')
+    msg['body_loaded'] = True
+    return _apply_processed_body(msg)
+
+
+def load_message_bodies(sender_email, messages):
+    """
+    load_message_body for several messages at once; the reads are issued
+    together so they travel in shared $batch calls. Messages whose body
+    could not be loaded keep their preview; returns the number loaded.
+    """
+    pending = [m for m in messages if not m.get('body_loaded') and m.get('id')]
+    if not pending:
+        return 0
+    access_token = get_access_token(sender_email)
+    futures = [
+        _submit_get(sender_email, access_token,
+                    f"{GRAPH_API_BASE}/users/{sender_email}/messages/{m['id']}", {"$select": BODY_SELECT_FIELDS})
+        for m in pending
+    ]
+    loaded = 0
+    for msg, future in zip(pending, futures):
+        try:
+            _apply_body_response(sender_email, msg, future())
+            loaded += 1
+        except Exception as e:
+            logger.warning(f"[GRAPH] Could not load body of {msg['id']}, using preview: {e}")
+    return loaded
+
+
+def _submit_get(sender_email, access_token, url, params=None, timeout=60):
+    """Start a (possibly batched) GET; returns a callable that waits for the response."""
+    if not graph_batcher.enabled:
+        return lambda: graph_get(sender_email, access_token, url, params, timeout)
+    sender = sender_registry.get(sender_email) or {}
+    future = graph_batcher.submit(
+        GRAPH_API_BASE, access_token,
+        f"{url}?{urlencode(params, quote_via=quote, safe='$,()')}" if params else url,
+        app_id=sender.get('client_id'), max_concurrency=sender.get('max_concurrency')
+    )
+    return lambda: future.result(timeout=timeout)
+
+
+def fetch_all_inbox_messages(sender_email, max_messages=500, include_body=False):
     """
     Fetch all messages from the inbox for the given sender using Microsoft Graph API (with paging).
-    Returns a list of message dicts with internetMessageHeaders and inReplyTo fields.
+    Returns a list of message dicts with inReplyTo fields. Bodies are only
+    requested with include_body; otherwise use load_message_body() per message.
     """
     access_token = get_access_token(sender_email)
-    # Request all necessary fields including the message body
-    select_fields = "id,subject,from,receivedDateTime,internetMessageHeaders,body,bodyPreview,uniqueBody"
+    select_fields = LIGHT_SELECT_FIELDS + (f",{BODY_SELECT_FIELDS}" if include_body else "")
     url = f"{GRAPH_API_BASE}/users/{sender_email}/mailFolders/inbox/messages"
-    url += f"?$select={select_fields}&$orderby=receivedDateTime desc&$top=50"
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
+    url += f"?$select={select_fields}&$expand={IN_REPLY_TO_EXPAND}&$orderby=receivedDateTime desc&$top=50"
     
     messages = []
     fetched = 0
     
     try:
         while url and fetched < max_messages:
-            response = requests.get(url, headers=headers)
+            response = graph_get(sender_email, access_token, url, timeout=GRAPH_TIMEOUT)
             if response.status_code != 200:
                 logger.error(f"Failed to fetch inbox messages for {sender_email}: {response.status_code} {response.text}")
                 break
                 
             data = response.json()
-            batch = data.get('value', [])
-            
-            # Process each message to extract inReplyTo from headers
-            for msg in batch:
-                msg_headers = msg.get('internetMessageHeaders', [])
-                # Extract inReplyTo from headers if available
-                for h in msg_headers:
-                    if h.get('name', '').lower() in ('in-reply-to', 'x-in-reply-to'):
-                        msg['inReplyTo'] = h.get('value', '')
-                        break
-                
-            # Process and log debug info for each message
-            import re
-            def strip_html(html_content):
-                """Simple HTML to text conversion"""
-                if not html_content:
-                    return ''
-                # Remove style and script tags and their contents
-                html_content = re.sub(r'<style.*?</style>', '', html_content, flags=re.DOTALL)
-                html_content = re.sub(r'<script.*?</script>', '', html_content, flags=re.DOTALL)
-                # Replace <br> and </p> with newlines
-                html_content = re.sub(r'<br\s*/?>|</p>', '\n', html_content)
-                # Remove all other HTML tags
-                html_content = re.sub(r'<[^>]+>', '', html_content)
-                # Fix whitespace
-                html_content = re.sub(r'\s+', ' ', html_content)
-                return html_content.strip()
-
-            for msg in batch:
-                # Extract message body from different possible sources
-                body_content = ''
-                if 'body' in msg:
-                    body_content = msg['body'].get('content', '')
-                    content_type = msg['body'].get('contentType', '').lower()
-                    if content_type == 'html':
-                        try:
-                            body_content = strip_html(body_content)
-                        except Exception as e:
-                            logger.error(f"[GRAPH] Failed to parse HTML body: {e}")
-                
-                # Use uniqueBody if available (strips out quoted text)
-                unique_body = msg.get('uniqueBody', {}).get('content', '')
-                if unique_body:
-                    try:
-                        unique_body = strip_html(unique_body)
-                    except Exception as e:
-                        logger.error(f"[GRAPH] Failed to parse unique body: {e}")
-                
-                # Fall back to bodyPreview if needed
-                preview = msg.get('bodyPreview', '')
-                
-                # Use the best available content
-                final_body = unique_body or body_content or preview
-                msg['processed_body'] = final_body.strip()
-                
-                logger.debug(f"[GRAPH] Message {msg.get('id', 'unknown')}:")
-                logger.debug(f"[GRAPH] - Subject: {msg.get('subject', '')}")
-                logger.debug(f"[GRAPH] - Content Type: {msg.get('body', {}).get('contentType', 'unknown')}")
-                logger.debug(f"[GRAPH] - Has body: {bool(body_content)}")
-                logger.debug(f"[GRAPH] - Has unique body: {bool(unique_body)}")
-                logger.debug(f"[GRAPH] - Final body length: {len(final_body)}")
-                if final_body:
-                    logger.debug(f"[GRAPH] - Preview: {final_body[:100]}...")
+            batch = _process_inbox_batch(data.get('value', []))
             
             messages.extend(batch)
             fetched += len(batch)
@@ -619,4 +718,179 @@ def fetch_all_inbox_messages(sender_email, max_messages=500):
         logger.error(f"Error fetching messages: {str(e)}", exc_info=True)
         
     logger.debug(f"[GRAPH] Fetched {len(messages)} messages with headers")
-    return messages[:max_messages]
\ No newline at end of file
+    return messages[:max_messages]
+
+
+class DeltaTokenExpired(Exception):
+    """The stored delta/next link is no longer valid (HTTP 410); a full resync is required."""
+
+
+# Delta queries do not support $expand, so In-Reply-To comes from the headers
+DELTA_SELECT_FIELDS = LIGHT_SELECT_FIELDS + ",internetMessageId,sentDateTime,internetMessageHeaders"
+DELTA_PAGE_SIZE = 50
+
+
+def fetch_inbox_delta(sender_email, delta_link=None, since=None, max_messages=1000):
+    """Incremental inbox sync; see fetch_folder_delta."""
+    return fetch_folder_delta(sender_email, 'inbox', delta_link, since, max_messages)
+
+
+def fetch_folder_delta(sender_email, folder='inbox', delta_link=None, since=None, max_messages=1000):
+    """
+    Incrementally fetch new/changed messages of a mail folder (well-known
+    name such as 'inbox' or 'sentitems') with the Graph delta query.
+
+    Without delta_link a new delta round is started (optionally limited to
+    messages received at or after `since`, a UTC datetime). With delta_link
+    (a previously returned @odata.deltaLink or @odata.nextLink) only changes
+    since that point are returned.
+
+    Returns (messages, link, complete):
+        messages: processed message dicts (removed items are skipped)
+        link: the link to resume from next time - the deltaLink when the
+              round finished, or the nextLink when max_messages was reached
+        complete: True if the round reached its deltaLink
+
+    Raises DeltaTokenExpired when Graph reports the link as expired (410)
+    and RuntimeError on other Graph errors, so callers never advance their
+    stored link past messages they did not receive.
+    """
+    access_token = get_access_token(sender_email)
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Prefer": f"odata.maxpagesize={DELTA_PAGE_SIZE}"
+    }
+
+    if delta_link:
+        url = delta_link
+        params = None
+    else:
+        url = f"{GRAPH_API_BASE}/users/{sender_email}/mailFolders/{folder}/messages/delta"
+        params = {"$select": DELTA_SELECT_FIELDS}
+        if since is not None:
+            params["$filter"] = f"receivedDateTime ge {since.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+
+    messages = []
+    removed = 0
+    while url:
+        response = graph_for(sender_email).get(url, headers=headers, params=params, timeout=30)
+        params = None  # next/delta links already carry the query
+        if response.status_code == 410:
+            raise DeltaTokenExpired(f"Delta link expired for {sender_email}/{folder}")
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"Delta query failed for {sender_email}/{folder}: {response.status_code} {response.text[:500]}"
+            )
+
+        data = response.json()
+        batch = []
+        for msg in data.get('value', []):
+            if '@removed' in msg:
+                removed += 1
+                continue
+            batch.append(msg)
+        messages.extend(_process_inbox_batch(batch))
+
+        next_link = data.get('@odata.nextLink')
+        if not next_link:
+            delta = data.get('@odata.deltaLink')
+            logger.debug(f"[GRAPH] Delta round complete for {sender_email}/{folder}: {len(messages)} changed, {removed} removed")
+            return messages, delta, True
+        if len(messages) >= max_messages:
+            logger.info(f"[GRAPH] Delta page limit reached for {sender_email}/{folder} ({len(messages)} messages); resuming next cycle")
+            return messages, next_link, False
+        url = next_link
+
+    return messages, None, False
+
+
+def fetch_inbox_message(sender_email, message_id):
+    """
+    Fetch a single message by Graph id with the same fields and
+    post-processing as the inbox listing. Returns None if it no longer exists.
+    """
+    return fetch_inbox_messages(sender_email, [message_id]).get(message_id)
+
+
+def fetch_inbox_messages(sender_email, message_ids):
+    """
+    fetch_inbox_message for several ids, read in shared $batch calls.
+    Returns {message_id: message} without the ids that no longer exist;
+    raises RuntimeError if any other read failed.
+    """
+    access_token = get_access_token(sender_email)
+    params = {"$select": LIGHT_SELECT_FIELDS, "$expand": IN_REPLY_TO_EXPAND}
+    futures = [
+        (message_id, _submit_get(sender_email, access_token,
+                                 f"{GRAPH_API_BASE}/users/{sender_email}/messages/{message_id}", params))
+        for message_id in message_ids
+    ]
+    messages, errors = {}, []
+    for message_id, future in futures:
+        response = future()
+        if response.status_code == 404:
+            continue
+        if response.status_code != 200:
+            errors.append(f"{message_id}: {response.status_code} {response.text[:200]}")
+            continue
+        messages[message_id] = _process_inbox_batch([response.json()])[0]
+    if errors:
+        raise RuntimeError(f"Fetching messages for {sender_email} failed: {'; '.join(errors)}")
+    return messages
+
+
+def create_inbox_subscription(sender_email, notification_url, client_state, expiration, lifecycle_url=None):
+    """
+    Subscribe to new inbox messages of a mailbox (Graph change notifications).
+    `expiration` is a UTC datetime; returns the subscription resource dict.
+    """
+    access_token = get_access_token(sender_email)
+    payload = {
+        "changeType": "created",
+        "notificationUrl": notification_url,
+        "resource": f"users/{sender_email}/mailFolders('inbox')/messages",
+        "expirationDateTime": expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z'),
+        "clientState": client_state,
+    }
+    if lifecycle_url:
+        payload["lifecycleNotificationUrl"] = lifecycle_url
+    response = graph_for(sender_email, mailbox_scoped=False).post(
+        f"{GRAPH_API_BASE}/subscriptions",
+        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        json=payload,
+        timeout=30
+    )
+    if response.status_code not in (200, 201):
+        raise RuntimeError(
+            f"Creating subscription for {sender_email} failed: {response.status_code} {response.text[:500]}"
+        )
+    logger.info(f"[GRAPH] Created inbox subscription for {sender_email}")
+    return response.json()
+
+
+def renew_subscription(sender_email, subscription_id, expiration):
+    """Extend a subscription; returns the updated resource, or None if Graph no longer knows it."""
+    access_token = get_access_token(sender_email)
+    response = graph_for(sender_email, mailbox_scoped=False).patch(
+        f"{GRAPH_API_BASE}/subscriptions/{subscription_id}",
+        headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        json={"expirationDateTime": expiration.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')},
+        timeout=30
+    )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"Renewing subscription {subscription_id} for {sender_email} failed: {response.status_code} {response.text[:500]}"
+        )
+    return response.json()
+
+
+def delete_subscription(sender_email, subscription_id):
+    access_token = get_access_token(sender_email)
+    response = graph_for(sender_email, mailbox_scoped=False).delete(
+        f"{GRAPH_API_BASE}/subscriptions/{subscription_id}",
+        headers={"Authorization": f"Bearer {access_token}"},
+        timeout=30
+    )
+    return response.status_code in (204, 404)
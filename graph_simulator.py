@@ -0,0 +1,740 @@
+"""
+Graph Simulator Module
+
+Local stand-in for the Microsoft identity platform and the parts of
+Microsoft Graph this project uses, so graph_email, the send worker and
+the reply checker can be exercised without Azure tenants:
+
+- POST /{tenant}/oauth2/v2.0/token         client-credentials tokens
+- POST /v1.0/users/{m}/sendMail             inline sends (4 MB request limit)
+- POST /v1.0/users/{m}/messages             drafts; .../attachments/
+                                            createUploadSession, PUT upload
+                                            URLs and .../send
+- GET  /v1.0/users/{m}/mailFolders/{f}/messages        paged listings
+- GET  /v1.0/users/{m}/mailFolders/{f}/messages/delta  delta rounds
+- GET  /v1.0/users/{m}/messages/{id}
+- POST /v1.0/$batch                         JSON batches of up to 20 requests
+- POST/PATCH/DELETE /v1.0/subscriptions     with the validationToken
+                                            handshake and "created"
+                                            notifications for new inbox mail
+
+Behaviour is set with SIM_* environment variables or PUT /_sim/config:
+latency and jitter, a per-mailbox concurrency limit answered with 429
+and Retry-After, random throttling and 503 failure rates, the delay
+before a sent message appears in Sent Items, and automatic replies to a
+share of the sent messages. Inbound mail can be injected with
+POST /_sim/mailboxes/{m}/inbox; /_sim/stats reports request counts and
+latencies per endpoint.
+
+Run it with
+
+    python graph_simulator.py --port 8900
+
+and point the backend at it:
+
+    GRAPH_API_BASE=http://127.0.0.1:8900/v1.0
+    GRAPH_AUTHORITY_HOST=http://127.0.0.1:8900
+
+State is in memory and lost on restart (or POST /_sim/reset).
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import logging
+from collections import defaultdict
+from dataclasses import asdict, dataclass, fields
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+SENT_ITEMS = 'sentitems'
+INBOX = 'inbox'
+DRAFTS = 'drafts'
+FOLDER_ALIASES = {'sentitems': SENT_ITEMS, 'inbox': INBOX, 'drafts': DRAFTS}
+IN_REPLY_TO_PROPERTY = 'String 0x1042'
+MAX_REQUEST_BYTES = 4 * 1024 * 1024
+MAX_BATCH_REQUESTS = 20
+DEFAULT_PAGE_SIZE = 10
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.getenv(name, str(default)))
+
+
+@dataclass
+class SimulatorConfig:
+    latency_ms: float = _env_float('SIM_LATENCY_MS', 30)
+    latency_jitter_ms: float = _env_float('SIM_LATENCY_JITTER_MS', 20)
+    # Concurrent requests per mailbox before 429 MailboxConcurrency; 0 = unlimited
+    mailbox_concurrency: int = int(os.getenv('SIM_MAILBOX_CONCURRENCY', '4'))
+    throttle_rate: float = _env_float('SIM_THROTTLE_RATE', 0.0)
+    retry_after_seconds: float = _env_float('SIM_RETRY_AFTER_SECONDS', 1)
+    failure_rate: float = _env_float('SIM_FAILURE_RATE', 0.0)
+    token_failure_rate: float = _env_float('SIM_TOKEN_FAILURE_RATE', 0.0)
+    token_lifetime_seconds: int = int(os.getenv('SIM_TOKEN_LIFETIME_SECONDS', '3600'))
+    sent_items_delay_seconds: float = _env_float('SIM_SENT_ITEMS_DELAY_SECONDS', 2)
+    auto_reply_rate: float = _env_float('SIM_AUTO_REPLY_RATE', 0.0)
+    auto_reply_delay_seconds: float = _env_float('SIM_AUTO_REPLY_DELAY_SECONDS', 30)
+    validate_subscriptions: bool = os.getenv('SIM_VALIDATE_SUBSCRIPTIONS', 'true').lower() in ('1', 'true', 'yes')
+
+
+def _now() -> datetime:
+    return datetime.now(UTC)
+
+
+def _iso(value: datetime) -> str:
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _error(status: int, code: str, message: str, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    return JSONResponse({'error': {'code': code, 'message': message}}, status_code=status, headers=headers)
+
+
+def _recipients(addresses: List[str]) -> List[Dict[str, Any]]:
+    return [{'emailAddress': {'address': a, 'name': a}} for a in addresses]
+
+
+def _addresses(recipients: Optional[List[Dict[str, Any]]]) -> List[str]:
+    return [((r or {}).get('emailAddress') or {}).get('address', '') for r in recipients or []]
+
+
+class SimulatedGraph:
+    """In-memory mailboxes, tokens, upload sessions and subscriptions."""
+
+    def __init__(self, config: Optional[SimulatorConfig] = None):
+        self.config = config or SimulatorConfig()
+        self.reset()
+
+    def reset(self):
+        self.folders: Dict[Tuple[str, str], Dict[str, Dict[str, Any]]] = defaultdict(dict)
+        self.seq = 0
+        self.tokens: Dict[str, float] = {}
+        self.uploads: Dict[str, Dict[str, Any]] = {}
+        self.subscriptions: Dict[str, Dict[str, Any]] = {}
+        self.in_flight: Dict[str, int] = defaultdict(int)
+        self.stats: Dict[str, Dict[str, Any]] = defaultdict(lambda: {'count': 0, 'statuses': defaultdict(int), 'total_ms': 0.0, 'max_ms': 0.0})
+        self.throttled: Dict[str, int] = defaultdict(int)
+        self.batch_items = 0
+
+    # -- messages ------------------------------------------------------------
+
+    def store(self, mailbox: str, folder: str, message: Dict[str, Any]) -> Dict[str, Any]:
+        self.seq += 1
+        message['_seq'] = self.seq
+        self.folders[(mailbox, folder)][message['id']] = message
+        return message
+
+    def find(self, mailbox: str, message_id: str) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        for folder in (INBOX, SENT_ITEMS, DRAFTS):
+            message = self.folders[(mailbox, folder)].get(message_id)
+            if message is not None:
+                return folder, message
+        return None, None
+
+    def new_message(self, mailbox: str, payload: Dict[str, Any], sender: Optional[str] = None,
+                    in_reply_to: Optional[str] = None, conversation_id: Optional[str] = None) -> Dict[str, Any]:
+        now = _iso(_now())
+        body = payload.get('body') or {'contentType': 'Text', 'content': ''}
+        content = body.get('content') or ''
+        sender_address = sender or mailbox
+        return {
+            'id': f"AAMk{uuid.uuid4().hex}",
+            'internetMessageId': f"<{uuid.uuid4().hex}@graph-simulator.local>",
+            'conversationId': conversation_id or f"AAQk{uuid.uuid4().hex}",
+            'subject': payload.get('subject') or '',
+            'body': body,
+            'uniqueBody': body,
+            'bodyPreview': content[:255],
+            'from': {'emailAddress': {'address': sender_address, 'name': sender_address}},
+            'sender': {'emailAddress': {'address': sender_address, 'name': sender_address}},
+            'toRecipients': payload.get('toRecipients') or [],
+            'ccRecipients': payload.get('ccRecipients') or [],
+            'receivedDateTime': now,
+            'sentDateTime': now,
+            'isRead': False,
+            'hasAttachments': bool(payload.get('attachments')),
+            'attachments': [
+                {'name': a.get('name'), 'size': len(a.get('contentBytes') or '') * 3 // 4}
+                for a in payload.get('attachments') or []
+            ],
+            'internetMessageHeaders': (
+                [{'name': 'In-Reply-To', 'value': in_reply_to}] if in_reply_to else []
+            ),
+            '_in_reply_to': in_reply_to,
+        }
+
+    def project(self, message: Dict[str, Any], select: Optional[str], expand: Optional[str]) -> Dict[str, Any]:
+        if select:
+            wanted = {f.strip() for f in select.split(',') if f.strip()} | {'id'}
+            result = {k: v for k, v in message.items() if k in wanted}
+        else:
+            result = {k: v for k, v in message.items() if not k.startswith('_') and k != 'internetMessageHeaders'}
+        if expand and 'singleValueExtendedProperties' in expand and message.get('_in_reply_to'):
+            result['singleValueExtendedProperties'] = [{'id': IN_REPLY_TO_PROPERTY, 'value': message['_in_reply_to']}]
+        return result
+
+    def listing(self, mailbox: str, folder: str) -> List[Dict[str, Any]]:
+        messages = list(self.folders[(mailbox, folder)].values())
+        messages.sort(key=lambda m: (m['receivedDateTime'], m['_seq']), reverse=True)
+        return messages
+
+    # -- auth ----------------------------------------------------------------
+
+    def issue_token(self) -> str:
+        token = f"sim.{uuid.uuid4().hex}"
+        self.tokens[token] = time.time() + self.config.token_lifetime_seconds
+        return token
+
+    def token_valid(self, authorization: Optional[str]) -> bool:
+        if not authorization or not authorization.lower().startswith('bearer '):
+            return False
+        expires = self.tokens.get(authorization[7:].strip())
+        return expires is not None and expires > time.time()
+
+
+sim = SimulatedGraph()
+app = FastAPI(title="Graph Simulator")
+
+
+async def _deliver_later(delay: float, mailbox: str, folder: str, message: Dict[str, Any]):
+    if delay > 0:
+        await asyncio.sleep(delay)
+    sim.store(mailbox, folder, message)
+    if folder == INBOX:
+        await _notify(mailbox, message)
+
+
+async def _notify(mailbox: str, message: Dict[str, Any]):
+    """Post a "created" change notification to matching inbox subscriptions."""
+    expected = f"users/{mailbox}/mailfolders('inbox')/messages"
+    for subscription in list(sim.subscriptions.values()):
+        if subscription['resource'].lower() != expected:
+            continue
+        notification = {'value': [{
+            'subscriptionId': subscription['id'],
+            'clientState': subscription.get('clientState'),
+            'changeType': 'created',
+            'resource': f"Users/{mailbox}/Messages/{message['id']}",
+            'resourceData': {'@odata.type': '#Microsoft.Graph.Message', 'id': message['id']},
+            'tenantId': subscription.get('_tenant'),
+        }]}
+        try:
+            async with httpx.AsyncClient(timeout=10) as client:
+                await client.post(subscription['notificationUrl'], json=notification)
+        except Exception as e:
+            logger.warning(f"[SIMULATOR] Notification to {subscription['notificationUrl']} failed: {e}")
+
+
+def _schedule(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+_background: set = set()
+
+
+def _mailbox_of(path: str) -> Optional[str]:
+    parts = path.split('/')
+    if len(parts) > 3 and parts[1] == 'v1.0' and parts[2].lower() == 'users':
+        return parts[3].lower()
+    return None
+
+
+@app.middleware("http")
+async def simulate_conditions(request: Request, call_next):
+    """Latency, auth, concurrency limits, throttling and failure injection."""
+    path = request.url.path
+    if path.startswith('/_sim/'):
+        return await call_next(request)
+
+    started = time.perf_counter()
+    config = sim.config
+    mailbox = _mailbox_of(path)
+    endpoint = f"{request.method} {_endpoint_name(path)}"
+    response = None
+    counted = False
+    try:
+        delay = max(0.0, config.latency_ms + random.uniform(-1, 1) * config.latency_jitter_ms) / 1000
+        is_graph = path.startswith('/v1.0/')
+        if is_graph and not sim.token_valid(request.headers.get('authorization')):
+            response = _error(401, 'InvalidAuthenticationToken', 'Access token is empty or invalid.')
+        elif is_graph and mailbox and config.mailbox_concurrency and sim.in_flight[mailbox] >= config.mailbox_concurrency:
+            response = _throttled(mailbox, 'MailboxConcurrency')
+        elif is_graph and random.random() < config.throttle_rate:
+            response = _throttled(mailbox, 'ApplicationThrottled')
+        elif random.random() < config.failure_rate:
+            response = _error(503, 'ServiceUnavailable', 'Simulated service failure.',
+                              {'Retry-After': str(int(config.retry_after_seconds))})
+        if response is not None:
+            await asyncio.sleep(delay)
+            return response
+
+        if mailbox:
+            sim.in_flight[mailbox] += 1
+            counted = True
+        await asyncio.sleep(delay)
+        response = await call_next(request)
+        if mailbox and config.mailbox_concurrency:
+            response.headers['x-ms-throttle-limit-percentage'] = (
+                f"{sim.in_flight[mailbox] / config.mailbox_concurrency:.2f}"
+            )
+        return response
+    finally:
+        if counted:
+            sim.in_flight[mailbox] -= 1
+        elapsed = (time.perf_counter() - started) * 1000
+        stat = sim.stats[endpoint]
+        stat['count'] += 1
+        stat['statuses'][response.status_code if response is not None else 500] += 1
+        stat['total_ms'] += elapsed
+        stat['max_ms'] = max(stat['max_ms'], elapsed)
+
+
+def _throttled(mailbox: Optional[str], reason: str) -> JSONResponse:
+    sim.throttled[mailbox or 'app'] += 1
+    return _error(
+        429, 'ApplicationThrottled', f"Application is over its {reason} limit.",
+        {
+            'Retry-After': str(max(1, int(round(sim.config.retry_after_seconds)))),
+            'x-ms-throttle-scope': f"Mailbox/Application/{mailbox}" if mailbox else 'Application',
+            'x-ms-throttle-information': reason,
+            'x-ms-throttle-limit-percentage': '1.00',
+        }
+    )
+
+
+def _endpoint_name(path: str) -> str:
+    parts = path.split('/')
+    if len(parts) > 3 and parts[2].lower() == 'users':
+        parts[3] = '{mailbox}'
+    for i, part in enumerate(parts):
+        if i > 0 and parts[i - 1] in ('messages', 'subscriptions', 'upload') and part not in ('delta',):
+            parts[i] = '{id}'
+    if len(parts) > 2 and parts[2] == 'oauth2':
+        parts[1] = '{tenant}'
+    return '/'.join(parts)
+
+
+# -- identity platform -------------------------------------------------------
+
+@app.get("/{tenant}/v2.0/.well-known/openid-configuration")
+async def openid_configuration(tenant: str, request: Request):
+    base = str(request.base_url).rstrip('/')
+    return {
+        'token_endpoint': f"{base}/{tenant}/oauth2/v2.0/token",
+        'authorization_endpoint': f"{base}/{tenant}/oauth2/v2.0/authorize",
+        'issuer': f"{base}/{tenant}/v2.0",
+    }
+
+
+@app.post("/{tenant}/oauth2/v2.0/token")
+async def token(tenant: str, request: Request):
+    form = {k: v[0] for k, v in parse_qs((await request.body()).decode()).items()}
+    if form.get('grant_type') != 'client_credentials':
+        return JSONResponse({'error': 'unsupported_grant_type', 'error_description': 'Only client_credentials is simulated.'}, status_code=400)
+    if not form.get('client_id') or not form.get('client_secret'):
+        return JSONResponse({'error': 'invalid_client', 'error_description': 'Missing client credentials.'}, status_code=401)
+    if random.random() < sim.config.token_failure_rate:
+        return JSONResponse({'error': 'temporarily_unavailable', 'error_description': 'Simulated token failure.'}, status_code=503)
+    return {
+        'token_type': 'Bearer',
+        'expires_in': sim.config.token_lifetime_seconds,
+        'ext_expires_in': sim.config.token_lifetime_seconds,
+        'access_token': sim.issue_token(),
+    }
+
+
+# -- sending -----------------------------------------------------------------
+
+def _queue_sent(mailbox: str, message: Dict[str, Any]):
+    _schedule(_deliver_later(sim.config.sent_items_delay_seconds, mailbox, SENT_ITEMS, message))
+    if sim.config.auto_reply_rate and random.random() < sim.config.auto_reply_rate:
+        to = _addresses(message['toRecipients'])
+        if to:
+            reply = sim.new_message(
+                mailbox,
+                {'subject': f"RE: {message['subject']}", 'toRecipients': _recipients([mailbox]),
+                 'body': {'contentType': 'Text', 'content': 'Thanks, simulated reply.'}},
+                sender=to[0], in_reply_to=message['internetMessageId'], conversation_id=message['conversationId']
+            )
+            _schedule(_deliver_later(sim.config.auto_reply_delay_seconds, mailbox, INBOX, reply))
+
+
+@app.post("/v1.0/users/{mailbox}/sendMail")
+async def send_mail(mailbox: str, request: Request):
+    raw = await request.body()
+    if len(raw) > MAX_REQUEST_BYTES:
+        return _error(413, 'RequestBodyTooLarge', 'The maximum request length supported is 4MB.')
+    try:
+        payload = json.loads(raw)
+    except ValueError:
+        return _error(400, 'BadRequest', 'Invalid JSON body.')
+    message_payload = payload.get('message') or {}
+    if not message_payload.get('toRecipients'):
+        return _error(400, 'ErrorInvalidRecipients', 'At least one recipient is required.')
+    message = sim.new_message(mailbox.lower(), message_payload)
+    if payload.get('saveToSentItems', True):
+        _queue_sent(mailbox.lower(), message)
+    return Response(status_code=202)
+
+
+@app.post("/v1.0/users/{mailbox}/messages")
+async def create_draft(mailbox: str, request: Request):
+    raw = await request.body()
+    if len(raw) > MAX_REQUEST_BYTES:
+        return _error(413, 'RequestBodyTooLarge', 'The maximum request length supported is 4MB.')
+    message = sim.new_message(mailbox.lower(), json.loads(raw or b'{}'))
+    sim.store(mailbox.lower(), DRAFTS, message)
+    return JSONResponse(sim.project(message, None, None), status_code=201)
+
+
+@app.post("/v1.0/users/{mailbox}/messages/{message_id}/attachments/createUploadSession")
+async def create_upload_session(mailbox: str, message_id: str, request: Request):
+    folder, message = sim.find(mailbox.lower(), message_id)
+    if folder != DRAFTS:
+        return _error(404, 'ErrorItemNotFound', 'The specified draft was not found.')
+    item = (await request.json()).get('AttachmentItem') or {}
+    session_id = uuid.uuid4().hex
+    sim.uploads[session_id] = {'message': message, 'name': item.get('name'), 'size': int(item.get('size') or 0), 'received': 0}
+    expires = _iso(_now() + timedelta(hours=1))
+    return JSONResponse({
+        'uploadUrl': f"{str(request.base_url).rstrip('/')}/_sim/upload/{session_id}",
+        'expirationDateTime': expires,
+        'nextExpectedRanges': ['0-'],
+    }, status_code=201)
+
+
+@app.put("/_sim/upload/{session_id}")
+async def upload_chunk(session_id: str, request: Request):
+    session = sim.uploads.get(session_id)
+    if session is None:
+        return _error(404, 'ItemNotFound', 'Upload session not found or expired.')
+    if request.headers.get('authorization'):
+        return _error(401, 'InvalidAuthenticationToken', 'Upload URLs must not carry an Authorization header.')
+    chunk = await request.body()
+    try:
+        unit, _, spec = request.headers.get('content-range', '').partition(' ')
+        span, _, total = spec.partition('/')
+        start, _, end = span.partition('-')
+        start, end, total = int(start), int(end), int(total)
+    except ValueError:
+        return _error(400, 'InvalidRange', 'Content-Range header is missing or invalid.')
+    if start != session['received'] or total != session['size'] or end - start + 1 != len(chunk):
+        return _error(416, 'InvalidRange', f"Expected range starting at {session['received']}.")
+    session['received'] = end + 1
+    if session['received'] < session['size']:
+        return JSONResponse({'nextExpectedRanges': [f"{session['received']}-"]}, status_code=200)
+    session['message']['attachments'].append({'name': session['name'], 'size': session['size']})
+    session['message']['hasAttachments'] = True
+    del sim.uploads[session_id]
+    return JSONResponse({'name': session['name'], 'size': session['size']}, status_code=201)
+
+
+@app.post("/v1.0/users/{mailbox}/messages/{message_id}/send")
+async def send_draft(mailbox: str, message_id: str):
+    mailbox = mailbox.lower()
+    message = sim.folders[(mailbox, DRAFTS)].pop(message_id, None)
+    if message is None:
+        return _error(404, 'ErrorItemNotFound', 'The specified draft was not found.')
+    _queue_sent(mailbox, message)
+    return Response(status_code=202)
+
+
+@app.delete("/v1.0/users/{mailbox}/messages/{message_id}")
+async def delete_message(mailbox: str, message_id: str):
+    folder, _ = sim.find(mailbox.lower(), message_id)
+    if folder is None:
+        return _error(404, 'ErrorItemNotFound', 'The specified object was not found in the store.')
+    del sim.folders[(mailbox.lower(), folder)][message_id]
+    return Response(status_code=204)
+
+
+# -- reading -----------------------------------------------------------------
+
+def _page_size(request: Request, default: int = DEFAULT_PAGE_SIZE) -> int:
+    prefer = request.headers.get('prefer') or ''
+    if 'odata.maxpagesize=' in prefer:
+        try:
+            return max(1, int(prefer.split('odata.maxpagesize=')[1].split(',')[0]))
+        except ValueError:
+            pass
+    try:
+        return max(1, min(1000, int(request.query_params.get('$top', default))))
+    except ValueError:
+        return default
+
+
+@app.get("/v1.0/users/{mailbox}/mailFolders/{folder}/messages")
+async def list_messages(mailbox: str, folder: str, request: Request):
+    folder_key = FOLDER_ALIASES.get(folder.lower())
+    if folder_key is None:
+        return _error(404, 'ErrorInvalidIdMalformed', f"Unknown folder {folder}.")
+    params = request.query_params
+    top = _page_size(request)
+    skip = int(params.get('$skip', 0))
+    messages = sim.listing(mailbox.lower(), folder_key)
+    page = messages[skip:skip + top]
+    result: Dict[str, Any] = {
+        'value': [sim.project(m, params.get('$select'), params.get('$expand')) for m in page]
+    }
+    if skip + top < len(messages):
+        query = {k: v for k, v in params.items() if k != '$skip'}
+        query['$skip'] = str(skip + top)
+        result['@odata.nextLink'] = str(request.url.include_query_params(**query))
+    return result
+
+
+@app.get("/v1.0/users/{mailbox}/mailFolders/{folder}/messages/delta")
+async def delta_messages(mailbox: str, folder: str, request: Request):
+    """
+    Delta round over messages stored after a sequence number. Tokens are
+    "after.upto.since" (skip) or "upto" (delta); anything else is a 410.
+    """
+    folder_key = FOLDER_ALIASES.get(folder.lower())
+    if folder_key is None:
+        return _error(404, 'ErrorInvalidIdMalformed', f"Unknown folder {folder}.")
+    params = request.query_params
+    since = ''
+    try:
+        if '$skiptoken' in params:
+            after, upto, since = params['$skiptoken'].split('.', 2)
+            after, upto = int(after), int(upto)
+        elif '$deltatoken' in params:
+            after, upto = int(params['$deltatoken']), sim.seq
+        else:
+            after, upto = 0, sim.seq
+            filter_ = params.get('$filter') or ''
+            if 'receivedDateTime ge ' in filter_:
+                since = filter_.split('receivedDateTime ge ', 1)[1].strip()
+    except ValueError:
+        return _error(410, 'SyncStateNotFound', 'The sync state generation is invalid.')
+    if after > sim.seq:
+        return _error(410, 'SyncStateNotFound', 'The sync state generation is invalid.')
+
+    changed = sorted(
+        (m for m in sim.folders[(mailbox.lower(), folder_key)].values()
+         if after < m['_seq'] <= upto and (not since or m['receivedDateTime'] >= since)),
+        key=lambda m: m['_seq']
+    )
+    page = changed[:_page_size(request)]
+    result: Dict[str, Any] = {'value': [sim.project(m, params.get('$select'), None) for m in page]}
+    base = str(request.url.remove_query_params(['$skiptoken', '$deltatoken', '$filter']))
+    separator = '&' if '?' in base else '?'
+    if len(changed) > len(page):
+        result['@odata.nextLink'] = f"{base}{separator}$skiptoken={page[-1]['_seq']}.{upto}.{since}"
+    else:
+        result['@odata.deltaLink'] = f"{base}{separator}$deltatoken={upto}"
+    return result
+
+
+@app.get("/v1.0/users/{mailbox}/messages/{message_id}")
+async def get_message(mailbox: str, message_id: str, request: Request):
+    _, message = sim.find(mailbox.lower(), message_id)
+    if message is None:
+        return _error(404, 'ErrorItemNotFound', 'The specified object was not found in the store.')
+    return sim.project(message, request.query_params.get('$select'), request.query_params.get('$expand'))
+
+
+# -- JSON batching -----------------------------------------------------------
+
+@app.post("/v1.0/$batch")
+async def batch(request: Request):
+    """
+    Run up to 20 sub-requests against this app (through the same latency,
+    concurrency and throttling simulation) and return their responses.
+    """
+    payload = await request.json()
+    sub_requests = payload.get('requests') or []
+    if not sub_requests or len(sub_requests) > MAX_BATCH_REQUESTS:
+        return _error(400, 'BadRequest', f"A batch must contain 1 to {MAX_BATCH_REQUESTS} requests.")
+    authorization = request.headers.get('authorization', '')
+
+    done: Dict[str, asyncio.Future] = {
+        str(sub.get('id')): asyncio.get_running_loop().create_future() for sub in sub_requests
+    }
+
+    async def run(sub: Dict[str, Any]) -> Dict[str, Any]:
+        result = await execute(sub)
+        done[str(sub.get('id'))].set_result(result['status'])
+        return result
+
+    async def execute(sub: Dict[str, Any]) -> Dict[str, Any]:
+        for dependency in sub.get('dependsOn') or []:
+            if dependency not in done:
+                return {'id': sub.get('id'), 'status': 400, 'headers': {},
+                        'body': {'error': {'code': 'BadRequest', 'message': f"Unknown dependsOn id {dependency}."}}}
+            if await done[dependency] >= 400:
+                return {'id': sub.get('id'), 'status': 424, 'headers': {},
+                        'body': {'error': {'code': 'FailedDependency', 'message': f"Request {dependency} failed."}}}
+        headers = dict(sub.get('headers') or {})
+        headers['Authorization'] = authorization
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url=str(request.base_url).rstrip('/')) as client:
+            response = await client.request(
+                sub.get('method', 'GET'), f"/v1.0/{sub.get('url', '').lstrip('/')}",
+                headers=headers, json=sub.get('body')
+            )
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text or None
+        kept = {k: v for k, v in response.headers.items()
+                if k.lower() in ('retry-after', 'content-type') or k.lower().startswith('x-ms-throttle')}
+        return {'id': sub.get('id'), 'status': response.status_code, 'headers': kept, 'body': body}
+
+    responses = await asyncio.gather(*(run(sub) for sub in sub_requests))
+    sim.batch_items += len(sub_requests)
+    return {'responses': list(responses)}
+
+
+# -- subscriptions -----------------------------------------------------------
+
+async def _validate_endpoint(url: str) -> bool:
+    token = uuid.uuid4().hex
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            response = await client.post(url, params={'validationToken': token})
+        return response.status_code == 200 and response.text == token
+    except Exception as e:
+        logger.warning(f"[SIMULATOR] Validation of {url} failed: {e}")
+        return False
+
+
+@app.post("/v1.0/subscriptions")
+async def create_subscription(request: Request):
+    payload = await request.json()
+    for url in filter(None, (payload.get('notificationUrl'), payload.get('lifecycleNotificationUrl'))):
+        if sim.config.validate_subscriptions and not await _validate_endpoint(url):
+            return _error(400, 'ValidationError', f"Subscription validation request failed for {url}.")
+    subscription = {
+        'id': str(uuid.uuid4()),
+        'resource': payload.get('resource', ''),
+        'changeType': payload.get('changeType', 'created'),
+        'clientState': payload.get('clientState'),
+        'notificationUrl': payload.get('notificationUrl'),
+        'lifecycleNotificationUrl': payload.get('lifecycleNotificationUrl'),
+        'expirationDateTime': payload.get('expirationDateTime'),
+    }
+    sim.subscriptions[subscription['id']] = subscription
+    return JSONResponse(subscription, status_code=201)
+
+
+@app.patch("/v1.0/subscriptions/{subscription_id}")
+async def renew_subscription(subscription_id: str, request: Request):
+    subscription = sim.subscriptions.get(subscription_id)
+    if subscription is None:
+        return _error(404, 'ResourceNotFound', 'The object was not found.')
+    subscription['expirationDateTime'] = (await request.json()).get('expirationDateTime')
+    return subscription
+
+
+@app.delete("/v1.0/subscriptions/{subscription_id}")
+async def delete_subscription(subscription_id: str):
+    if sim.subscriptions.pop(subscription_id, None) is None:
+        return _error(404, 'ResourceNotFound', 'The object was not found.')
+    return Response(status_code=204)
+
+
+# -- simulator control -------------------------------------------------------
+
+@app.get("/_sim/config")
+async def get_config():
+    return asdict(sim.config)
+
+
+@app.put("/_sim/config")
+async def put_config(request: Request):
+    """Change simulated conditions at runtime (unknown keys are rejected)."""
+    updates = await request.json()
+    known = {f.name: f.type for f in fields(SimulatorConfig)}
+    unknown = sorted(set(updates) - set(known))
+    if unknown:
+        return JSONResponse({'detail': f"Unknown settings: {', '.join(unknown)}"}, status_code=400)
+    for key, value in updates.items():
+        current = getattr(sim.config, key)
+        setattr(sim.config, key, type(current)(value))
+    return asdict(sim.config)
+
+
+@app.post("/_sim/reset")
+async def reset():
+    sim.reset()
+    return {'reset': True}
+
+
+@app.post("/_sim/mailboxes/{mailbox}/inbox")
+async def inject_inbound(mailbox: str, request: Request):
+    """
+    Deliver an inbound message: {"from", "subject", "body", "to", "in_reply_to"}.
+    in_reply_to may be the internetMessageId of a sent message, whose
+    conversation the reply then joins.
+    """
+    mailbox = mailbox.lower()
+    payload = await request.json()
+    in_reply_to = payload.get('in_reply_to')
+    conversation_id = None
+    subject = payload.get('subject') or ''
+    if in_reply_to:
+        for message in sim.folders[(mailbox, SENT_ITEMS)].values():
+            if message['internetMessageId'] == in_reply_to:
+                conversation_id = message['conversationId']
+                subject = subject or f"RE: {message['subject']}"
+                break
+    message = sim.new_message(
+        mailbox,
+        {'subject': subject, 'toRecipients': _recipients(payload.get('to') or [mailbox]),
+         'body': {'contentType': payload.get('content_type', 'Text'), 'content': payload.get('body') or ''}},
+        sender=payload.get('from') or 'contact@example.com', in_reply_to=in_reply_to, conversation_id=conversation_id
+    )
+    await _deliver_later(0, mailbox, INBOX, message)
+    return JSONResponse({'id': message['id'], 'internetMessageId': message['internetMessageId']}, status_code=201)
+
+
+@app.get("/_sim/mailboxes/{mailbox}/{folder}")
+async def dump_folder(mailbox: str, folder: str):
+    folder_key = FOLDER_ALIASES.get(folder.lower(), folder.lower())
+    return {'value': [sim.project(m, None, None) for m in sim.listing(mailbox.lower(), folder_key)]}
+
+
+@app.get("/_sim/stats")
+async def stats():
+    return {
+        'endpoints': {
+            name: {
+                'count': s['count'],
+                'statuses': dict(s['statuses']),
+                'avg_ms': round(s['total_ms'] / s['count'], 1) if s['count'] else 0,
+                'max_ms': round(s['max_ms'], 1),
+            }
+            for name, s in sorted(sim.stats.items())
+        },
+        'throttled': dict(sim.throttled),
+        'batch_items': sim.batch_items,
+        'messages': {f"{m}/{f}": len(items) for (m, f), items in sim.folders.items() if items},
+        'subscriptions': len(sim.subscriptions),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the local Microsoft Graph simulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f"[SIMULATOR] GRAPH_API_BASE=http://{args.host}:{args.port}/v1.0 "
+                f"GRAPH_AUTHORITY_HOST=http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,436 @@
+"""
+Graph Webhooks Module
+
+Optional push-based reply detection with Microsoft Graph change
+notifications. Enabled by setting GRAPH_WEBHOOK_URL to the public URL of
+POST /graph/notifications.
+
+- The subscription worker keeps one "created" subscription per sender inbox
+  in graph_subscriptions, creating and renewing them before they expire.
+- The notification endpoint answers Graph's validationToken handshake,
+  checks each notification's clientState against the stored subscription
+  and queues the message id; it returns 202 immediately.
+- The notification worker fetches the queued messages by id (coalescing a
+  short burst per mailbox) and hands them to the reply matcher, so replies
+  are detected within seconds.
+
+Polling stays as the fallback: while every mailbox has a live subscription
+the reply checker polls at REPLY_CHECKER_WEBHOOK_POLL_SECONDS instead of
+every 5 minutes, and Graph "missed" lifecycle events trigger an immediate
+poll.
+
+Run this module directly to post synthetic notifications to a local
+instance (see --help).
+"""
+
+import os
+import asyncio
+import inspect
+import logging
+import secrets
+from datetime import datetime, timedelta, UTC
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import PlainTextResponse, JSONResponse
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+import graph_email
+
+logger = logging.getLogger(__name__)
+
+GRAPH_WEBHOOK_URL = os.getenv('GRAPH_WEBHOOK_URL')
+GRAPH_WEBHOOK_LIFECYCLE_URL = os.getenv('GRAPH_WEBHOOK_LIFECYCLE_URL')
+# Graph allows at most 4230 minutes for message subscriptions
+SUBSCRIPTION_LIFETIME_MINUTES = int(os.getenv('GRAPH_SUBSCRIPTION_LIFETIME_MINUTES', '4200'))
+RENEW_BEFORE_MINUTES = int(os.getenv('GRAPH_SUBSCRIPTION_RENEW_BEFORE_MINUTES', '720'))
+SUBSCRIPTION_CHECK_SECONDS = int(os.getenv('GRAPH_SUBSCRIPTION_CHECK_SECONDS', '600'))
+# Reply checker poll interval while all subscriptions are healthy
+WEBHOOK_POLL_SECONDS = int(os.getenv('REPLY_CHECKER_WEBHOOK_POLL_SECONDS', '1800'))
+DEFAULT_POLL_SECONDS = 300
+# Notifications arriving within this window are fetched together
+NOTIFICATION_COALESCE_SECONDS = float(os.getenv('GRAPH_NOTIFICATION_COALESCE_SECONDS', '2'))
+
+SUBSCRIPTION_LOCK_KEY = 90004  # Advisory lock for the subscription worker
+
+# subscription_id -> {'mailbox', 'client_state', 'expires_at'}
+_subscriptions: Dict[str, Dict[str, Any]] = {}
+# Mailboxes whose subscription Graph asked us to reauthorize or recreate
+_needs_renewal: Set[str] = set()
+_notification_queue: Optional[asyncio.Queue] = None
+_poll_requested: Optional[asyncio.Event] = None
+
+
+def webhooks_enabled() -> bool:
+    return bool(GRAPH_WEBHOOK_URL)
+
+
+def _queue() -> asyncio.Queue:
+    global _notification_queue
+    if _notification_queue is None:
+        _notification_queue = asyncio.Queue()
+    return _notification_queue
+
+
+def _poll_event() -> asyncio.Event:
+    global _poll_requested
+    if _poll_requested is None:
+        _poll_requested = asyncio.Event()
+    return _poll_requested
+
+
+# --- Subscription state ---
+
+async def ensure_graph_subscriptions_table(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS graph_subscriptions (
+            mailbox TEXT PRIMARY KEY,
+            subscription_id TEXT UNIQUE,
+            client_state TEXT NOT NULL,
+            resource TEXT,
+            expires_at TIMESTAMP,
+            last_notification_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("[WEBHOOK] Ensured graph_subscriptions table")
+
+
+async def load_subscriptions(conn) -> Dict[str, Dict[str, Any]]:
+    """Refresh the in-memory subscription map used to validate notifications."""
+    rows = await conn.fetch("""
+        SELECT mailbox, subscription_id, client_state, expires_at
+        FROM graph_subscriptions WHERE subscription_id IS NOT NULL
+    """)
+    _subscriptions.clear()
+    for row in rows:
+        _subscriptions[row['subscription_id']] = {
+            'mailbox': row['mailbox'],
+            'client_state': row['client_state'],
+            'expires_at': row['expires_at'],
+        }
+    return dict(_subscriptions)
+
+
+async def subscription_mailboxes(conn) -> List[str]:
+    """Sender mailboxes used by events that have Graph credentials configured."""
+    rows = await conn.fetch("""
+        SELECT DISTINCT LOWER(sender_email) AS mailbox FROM event
+        WHERE sender_email IS NOT NULL AND sender_email <> ''
+    """)
+    mailboxes = []
+    for row in rows:
+        try:
+            graph_email.get_sender_config(row['mailbox'])
+            mailboxes.append(row['mailbox'])
+        except Exception:
+            continue
+    return mailboxes
+
+
+def subscriptions_healthy(mailboxes: List[str]) -> bool:
+    """True if every mailbox has a subscription that is not about to expire."""
+    now = datetime.now(UTC).replace(tzinfo=None)
+    live = {
+        s['mailbox'] for s in _subscriptions.values()
+        if s.get('expires_at') and s['expires_at'] > now + timedelta(minutes=5)
+    }
+    return bool(mailboxes) and all(m in live for m in mailboxes)
+
+
+async def ensure_subscription(conn, mailbox: str, force_renew: bool = False) -> Optional[Dict[str, Any]]:
+    """Create the mailbox subscription, or renew it when it is close to expiry (or force_renew)."""
+    mailbox = mailbox.lower()
+    now = datetime.now(UTC)
+    expiration = now + timedelta(minutes=SUBSCRIPTION_LIFETIME_MINUTES)
+    row = await conn.fetchrow("SELECT * FROM graph_subscriptions WHERE mailbox = $1", mailbox)
+
+    if row and row['subscription_id'] and row['expires_at']:
+        if not force_renew and row['expires_at'] > now.replace(tzinfo=None) + timedelta(minutes=RENEW_BEFORE_MINUTES):
+            return dict(row)
+        renewed = await asyncio.to_thread(graph_email.renew_subscription, mailbox, row['subscription_id'], expiration)
+        if renewed:
+            await conn.execute("""
+                UPDATE graph_subscriptions
+                SET expires_at = $2, last_error = NULL, updated_at = CURRENT_TIMESTAMP
+                WHERE mailbox = $1
+            """, mailbox, expiration.replace(tzinfo=None))
+            logger.info(f"[WEBHOOK] Renewed subscription for {mailbox} until {expiration.isoformat()}")
+            return dict(await conn.fetchrow("SELECT * FROM graph_subscriptions WHERE mailbox = $1", mailbox))
+        logger.warning(f"[WEBHOOK] Subscription for {mailbox} no longer exists; recreating")
+
+    client_state = secrets.token_urlsafe(32)
+    created = await asyncio.to_thread(
+        graph_email.create_inbox_subscription, mailbox, GRAPH_WEBHOOK_URL, client_state, expiration,
+        GRAPH_WEBHOOK_LIFECYCLE_URL or GRAPH_WEBHOOK_URL
+    )
+    await conn.execute("""
+        INSERT INTO graph_subscriptions (mailbox, subscription_id, client_state, resource, expires_at, updated_at)
+        VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+        ON CONFLICT (mailbox) DO UPDATE
+        SET subscription_id = EXCLUDED.subscription_id,
+            client_state = EXCLUDED.client_state,
+            resource = EXCLUDED.resource,
+            expires_at = EXCLUDED.expires_at,
+            last_error = NULL,
+            updated_at = EXCLUDED.updated_at
+    """, mailbox, created.get('id'), client_state, created.get('resource'), expiration.replace(tzinfo=None))
+    # Ask for one poll so nothing that arrived before the subscription is missed
+    request_poll()
+    return dict(await conn.fetchrow("SELECT * FROM graph_subscriptions WHERE mailbox = $1", mailbox))
+
+
+# --- Notifications ---
+
+def request_poll():
+    """Wake the polling reply checker (e.g. after missed notifications)."""
+    try:
+        _poll_event().set()
+    except Exception:
+        pass
+
+
+async def wait_for_next_poll(mailboxes: Optional[List[str]] = None):
+    """Sleep until the next reply-checker poll is due or explicitly requested."""
+    interval = DEFAULT_POLL_SECONDS
+    if webhooks_enabled() and subscriptions_healthy(mailboxes if mailboxes is not None else
+                                                    sorted({s['mailbox'] for s in _subscriptions.values()})):
+        interval = WEBHOOK_POLL_SECONDS
+    event = _poll_event()
+    try:
+        await asyncio.wait_for(event.wait(), timeout=interval)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+
+async def accept_notifications(payload: Dict[str, Any], pool=None) -> Tuple[int, int]:
+    """
+    Validate a Graph notification payload and queue its message ids.
+    Unknown subscription ids (e.g. one just created by another instance)
+    reload graph_subscriptions from pool once before they are rejected.
+    Returns (accepted, rejected).
+    """
+    notes = payload.get('value') or []
+    if pool is not None and any((note.get('subscriptionId') or '') not in _subscriptions for note in notes):
+        try:
+            async with pool.acquire() as conn:
+                await load_subscriptions(conn)
+        except Exception as e:
+            logger.warning(f"[WEBHOOK] Could not reload subscriptions: {e}")
+
+    accepted = rejected = 0
+    for note in notes:
+        subscription = _subscriptions.get(note.get('subscriptionId') or '')
+        if not subscription or not secrets.compare_digest(
+                str(note.get('clientState') or ''), str(subscription['client_state'])):
+            rejected += 1
+            continue
+
+        lifecycle = note.get('lifecycleEvent')
+        if lifecycle:
+            logger.info(f"[WEBHOOK] Lifecycle event '{lifecycle}' for {subscription['mailbox']}")
+            if lifecycle in ('reauthorizationRequired', 'subscriptionRemoved'):
+                # Renewed (or recreated) on the next subscription check
+                _needs_renewal.add(subscription['mailbox'])
+            request_poll()
+            accepted += 1
+            continue
+
+        message_id = (note.get('resourceData') or {}).get('id')
+        if not message_id:
+            rejected += 1
+            continue
+        _queue().put_nowait((subscription['mailbox'], message_id))
+        accepted += 1
+    if rejected:
+        logger.warning(f"[WEBHOOK] Rejected {rejected} notification(s) with unknown subscription or clientState")
+    return accepted, rejected
+
+
+async def notification_worker(pool, process_messages: Callable[..., Awaitable[Any]]):
+    """
+    Fetch notified messages and pass them to process_messages(conn, mailbox, messages).
+    """
+    from mailbox_sync import mailbox_semaphore
+
+    queue = _queue()
+    while True:
+        try:
+            mailbox, message_id = await queue.get()
+            pending: Dict[str, Set[str]] = {mailbox: {message_id}}
+            await asyncio.sleep(NOTIFICATION_COALESCE_SECONDS)
+            while not queue.empty():
+                mailbox, message_id = queue.get_nowait()
+                pending.setdefault(mailbox, set()).add(message_id)
+
+            for mailbox, ids in pending.items():
+                async with mailbox_semaphore(mailbox):
+                    # One call per mailbox; the reads share $batch requests
+                    try:
+                        fetched = await asyncio.to_thread(graph_email.fetch_inbox_messages, mailbox, list(ids))
+                    except Exception as e:
+                        logger.error(f"[WEBHOOK] Failed to fetch notified messages for {mailbox}: {e}")
+                        request_poll()
+                        continue
+                messages = list(fetched.values())
+                if not messages:
+                    continue
+                async with pool.acquire() as conn:
+                    recorded = await process_messages(conn, mailbox, messages)
+                    await conn.execute(
+                        "UPDATE graph_subscriptions SET last_notification_at = CURRENT_TIMESTAMP WHERE mailbox = $1",
+                        mailbox
+                    )
+                logger.info(f"[WEBHOOK] Processed {len(messages)} notified message(s) for {mailbox}; replies recorded: {recorded}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[WEBHOOK] Notification worker error: {e}", exc_info=True)
+            await asyncio.sleep(5)
+
+
+async def subscription_worker(pool):
+    """Create/renew subscriptions for all sender mailboxes periodically."""
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                if await conn.fetchval(f"SELECT pg_try_advisory_lock({SUBSCRIPTION_LOCK_KEY})"):
+                    try:
+                        for mailbox in await subscription_mailboxes(conn):
+                            try:
+                                force = mailbox in _needs_renewal
+                                _needs_renewal.discard(mailbox)
+                                await ensure_subscription(conn, mailbox, force_renew=force)
+                                # Accept notifications for a new or recreated subscription right away
+                                await load_subscriptions(conn)
+                            except Exception as e:
+                                logger.error(f"[WEBHOOK] Could not ensure subscription for {mailbox}: {e}")
+                                await conn.execute("""
+                                    INSERT INTO graph_subscriptions (mailbox, client_state, last_error, updated_at)
+                                    VALUES ($1, '', $2, CURRENT_TIMESTAMP)
+                                    ON CONFLICT (mailbox) DO UPDATE
+                                    SET last_error = EXCLUDED.last_error, updated_at = EXCLUDED.updated_at
+                                """, mailbox, str(e)[:2000])
+                    finally:
+                        await conn.execute(f"SELECT pg_advisory_unlock({SUBSCRIPTION_LOCK_KEY})")
+                # Every instance validates notifications against the stored subscriptions
+                await load_subscriptions(conn)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[WEBHOOK] Subscription worker error: {e}", exc_info=True)
+        await asyncio.sleep(SUBSCRIPTION_CHECK_SECONDS)
+
+
+# --- Router ---
+
+def create_graph_webhooks_router():
+    """Factory function to create the Graph notification router"""
+    router = APIRouter()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    async def _receive(request: Request):
+        # Subscription validation handshake: echo the token as text/plain
+        token = request.query_params.get('validationToken')
+        if token is not None:
+            return PlainTextResponse(token, status_code=200)
+        try:
+            payload = await request.json()
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid notification payload")
+        import main
+        accepted, rejected = await accept_notifications(payload, main.get_db_pool())
+        return JSONResponse({'accepted': accepted, 'rejected': rejected}, status_code=202)
+
+    @router.post("/graph/notifications")
+    async def graph_notifications(request: Request):
+        """Receives Graph change notifications for sender inboxes."""
+        return await _receive(request)
+
+    @router.post("/graph/lifecycle")
+    async def graph_lifecycle(request: Request):
+        """Receives Graph lifecycle notifications (reauthorization, missed, removed)."""
+        return await _receive(request)
+
+    @router.get("/admin/graph-subscriptions")
+    async def get_graph_subscriptions(current_user: dict = Depends(get_current_user)):
+        """Webhook mode status and the stored subscription per mailbox."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        import main
+        pool = main.get_db_pool()
+        if not pool:
+            raise HTTPException(status_code=503, detail="Database pool not available")
+        async with pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT mailbox, subscription_id, expires_at, last_notification_at, last_error, updated_at
+                FROM graph_subscriptions ORDER BY mailbox
+            """)
+        return {
+            'enabled': webhooks_enabled(),
+            'notification_url': GRAPH_WEBHOOK_URL,
+            'queued_notifications': _queue().qsize(),
+            'subscriptions': [dict(r) for r in rows],
+        }
+
+    return router
+
+
+router = create_graph_webhooks_router()
+
+
+if __name__ == '__main__':
+    # Local stand-in for Graph: post a validation request or synthetic
+    # "created" notifications to a running instance.
+    import argparse
+    import requests
+
+    parser = argparse.ArgumentParser(description="Post synthetic Graph change notifications")
+    parser.add_argument('--url', default='http://localhost:8000/graph/notifications')
+    parser.add_argument('--validate', action='store_true', help="send a validationToken handshake only")
+    parser.add_argument('--subscription-id', help="subscription id stored in graph_subscriptions")
+    parser.add_argument('--client-state', help="client state stored for the subscription")
+    parser.add_argument('--mailbox', default='mailbox@example.com')
+    parser.add_argument('--message-id', action='append', default=[], help="Graph message id (repeatable)")
+    parser.add_argument('--lifecycle', help="send a lifecycle event instead (e.g. missed)")
+    args = parser.parse_args()
+
+    if args.validate:
+        token = secrets.token_urlsafe(16)
+        resp = requests.post(args.url, params={'validationToken': token}, timeout=10)
+        ok = resp.status_code == 200 and resp.text == token
+        print(f"validation: HTTP {resp.status_code}, echoed={'yes' if ok else 'no'}")
+        raise SystemExit(0 if ok else 1)
+
+    if not args.subscription_id or not args.client_state:
+        parser.error("--subscription-id and --client-state are required for notifications")
+
+    if args.lifecycle:
+        value = [{
+            'subscriptionId': args.subscription_id,
+            'clientState': args.client_state,
+            'lifecycleEvent': args.lifecycle,
+        }]
+    else:
+        value = [{
+            'subscriptionId': args.subscription_id,
+            'clientState': args.client_state,
+            'changeType': 'created',
+            'resource': f"Users/{args.mailbox}/Messages/{mid}",
+            'resourceData': {'@odata.type': '#Microsoft.Graph.Message', 'id': mid},
+            'subscriptionExpirationDateTime': (datetime.now(UTC) + timedelta(days=1)).isoformat(),
+        } for mid in args.message_id]
+
+    resp = requests.post(args.url, json={'value': value}, timeout=10)
+    print(f"HTTP {resp.status_code}: {resp.text}")
+    raise SystemExit(0 if resp.status_code == 202 else 1)
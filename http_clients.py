@@ -0,0 +1,110 @@
+"""
+HTTP Clients Module
+
+Long-lived, pooled HTTP clients for the upstreams the backend talks to:
+
+- Microsoft Graph: one requests.Session with a sized connection pool.
+  graph_email is synchronous and runs in worker threads, so it keeps
+  using requests (and its exception types); the session reuses TCP/TLS
+  connections across sends, Sent Items checks and inbox syncs.
+- Email validator: one httpx.AsyncClient with keep-alive limits, using
+  HTTP/2 when the h2 package is installed.
+
+Pool sizes and timeouts are configured per upstream through environment
+variables. The app lifespan calls startup() and shutdown(); clients are
+also created lazily so scripts and workers outside the app keep working.
+
+This module is imported and used by graph_email.py and main.py.
+"""
+
+import os
+import logging
+import threading
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Microsoft Graph
+GRAPH_POOL_CONNECTIONS = int(os.getenv('GRAPH_HTTP_POOL_CONNECTIONS', '4'))
+GRAPH_POOL_MAXSIZE = int(os.getenv('GRAPH_HTTP_POOL_MAXSIZE', '32'))
+GRAPH_TIMEOUT = float(os.getenv('GRAPH_HTTP_TIMEOUT', '30'))
+
+# Email validator
+VALIDATOR_MAX_CONNECTIONS = int(os.getenv('VALIDATOR_HTTP_MAX_CONNECTIONS', '16'))
+VALIDATOR_MAX_KEEPALIVE = int(os.getenv('VALIDATOR_HTTP_MAX_KEEPALIVE', '8'))
+VALIDATOR_KEEPALIVE_EXPIRY = float(os.getenv('VALIDATOR_HTTP_KEEPALIVE_EXPIRY', '60'))
+VALIDATOR_TIMEOUT = float(os.getenv('VALIDATOR_HTTP_TIMEOUT', '120'))
+VALIDATOR_CONNECT_TIMEOUT = float(os.getenv('VALIDATOR_HTTP_CONNECT_TIMEOUT', '10'))
+VALIDATOR_HTTP2 = os.getenv('VALIDATOR_HTTP2', 'true').lower() in ('1', 'true', 'yes')
+
+_graph_session: Optional[requests.Session] = None
+_graph_lock = threading.Lock()
+_validator_client: Optional[httpx.AsyncClient] = None
+
+
+def graph_session() -> requests.Session:
+    """The shared, pooled session for Graph requests (thread-safe creation)."""
+    global _graph_session
+    session = _graph_session
+    if session is None:
+        with _graph_lock:
+            if _graph_session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=GRAPH_POOL_CONNECTIONS, pool_maxsize=GRAPH_POOL_MAXSIZE)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _graph_session = session
+                logger.info(f"[HTTP] Graph session created (pool {GRAPH_POOL_MAXSIZE} per host)")
+            session = _graph_session
+    return session
+
+
+def validator_client() -> httpx.AsyncClient:
+    """The shared async client for the email validator."""
+    global _validator_client
+    if _validator_client is None or _validator_client.is_closed:
+        http2 = VALIDATOR_HTTP2 and HTTP2_AVAILABLE
+        _validator_client = httpx.AsyncClient(
+            verify=False,
+            http2=http2,
+            timeout=httpx.Timeout(VALIDATOR_TIMEOUT, connect=VALIDATOR_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=VALIDATOR_MAX_CONNECTIONS,
+                max_keepalive_connections=VALIDATOR_MAX_KEEPALIVE,
+                keepalive_expiry=VALIDATOR_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info(f"[HTTP] Validator client created (max {VALIDATOR_MAX_CONNECTIONS} connections, http2={http2})")
+    return _validator_client
+
+
+async def startup():
+    """Create the shared clients up front (called from the app lifespan)."""
+    graph_session()
+    validator_client()
+
+
+async def shutdown():
+    """Close the shared clients and their pooled connections."""
+    global _graph_session, _validator_client
+    if _validator_client is not None:
+        try:
+            await _validator_client.aclose()
+        except Exception as e:
+            logger.warning(f"[HTTP] Error closing validator client: {e}")
+        _validator_client = None
+    with _graph_lock:
+        if _graph_session is not None:
+            _graph_session.close()
+            _graph_session = None
+    logger.info("[HTTP] Shared HTTP clients closed")
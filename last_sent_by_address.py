@@ -0,0 +1,125 @@
+"""
+Last Sent By Address Module
+
+Keeps, per normalized email address, the most recent sent message that was
+addressed to it as the main recipient or in CC (message_id,
+conversation_id, sent_at, main recipient).
+
+The table is maintained by an AFTER INSERT/UPDATE trigger on messages, so
+every path that records a sent message keeps it current, and it is
+backfilled from the existing messages once. The reply checker resolves its
+fallback threading info for a batch of contact addresses with a single
+primary-key lookup instead of scanning recent sent messages.
+
+This module is imported and used by main.py for reply checking.
+"""
+
+import logging
+from typing import Any, Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = 'last_sent_by_address'
+
+# Mirrors main.normalize_email: strip brackets/whitespace, keep the part in
+# the last <...> of a "Name <address>" value, lower-case.
+NORMALIZE_FUNCTION_SQL = r"""
+    CREATE OR REPLACE FUNCTION normalize_email_address(addr TEXT)
+    RETURNS TEXT AS $$
+        SELECT CASE
+            WHEN a LIKE '%<%' AND a LIKE '%>%'
+                THEN lower(btrim(split_part((regexp_match(a, '.*<(.*)$'))[1], '>', 1)))
+            ELSE lower(a)
+        END
+        FROM (SELECT btrim(addr, E'<> \t\n\r') AS a) s
+    $$ LANGUAGE sql IMMUTABLE
+"""
+
+# Addresses of one messages row ({row} is NEW in the trigger, m in the
+# backfill): the main recipient plus every CC entry.
+ADDRESSES_SQL = r"""
+    SELECT normalize_email_address({row}.recipient_email) AS address
+    WHERE COALESCE(btrim({row}.recipient_email), '') <> ''
+    UNION
+    SELECT normalize_email_address(cc) AS address
+    FROM regexp_split_to_table(COALESCE({row}.cc_recipients, ''), '[;,\s]+') AS cc
+    WHERE btrim(cc) <> ''
+"""
+
+
+async def ensure_last_sent_by_address(conn):
+    """Create the table, the maintenance trigger, and backfill it once."""
+    await conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+            address TEXT PRIMARY KEY,
+            message_id TEXT NOT NULL,
+            conversation_id TEXT,
+            sent_at TIMESTAMP,
+            recipient_email TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute(NORMALIZE_FUNCTION_SQL)
+    await conn.execute(f"""
+        CREATE OR REPLACE FUNCTION messages_track_last_sent_by_address()
+        RETURNS trigger AS $$
+        BEGIN
+            IF NEW.direction = 'sent' AND NEW.message_id IS NOT NULL THEN
+                INSERT INTO {TABLE_NAME} AS l (address, message_id, conversation_id, sent_at, recipient_email, updated_at)
+                SELECT a.address, NEW.message_id, NEW.conversation_id, NEW.sent_at, NEW.recipient_email, CURRENT_TIMESTAMP
+                FROM ({ADDRESSES_SQL.format(row='NEW')}
+                ) a
+                WHERE a.address <> ''
+                ON CONFLICT (address) DO UPDATE
+                SET message_id = EXCLUDED.message_id,
+                    conversation_id = EXCLUDED.conversation_id,
+                    sent_at = EXCLUDED.sent_at,
+                    recipient_email = EXCLUDED.recipient_email,
+                    updated_at = EXCLUDED.updated_at
+                WHERE l.sent_at IS NULL OR EXCLUDED.sent_at >= l.sent_at;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_messages_last_sent_by_address ON messages")
+    await conn.execute("""
+        CREATE TRIGGER trg_messages_last_sent_by_address
+        AFTER INSERT OR UPDATE OF message_id, conversation_id, sent_at, recipient_email, cc_recipients ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_track_last_sent_by_address()
+    """)
+
+    if not await conn.fetchval(f"SELECT EXISTS (SELECT 1 FROM {TABLE_NAME})"):
+        result = await conn.execute(f"""
+            INSERT INTO {TABLE_NAME} (address, message_id, conversation_id, sent_at, recipient_email)
+            SELECT DISTINCT ON (a.address)
+                   a.address, m.message_id, m.conversation_id, m.sent_at, m.recipient_email
+            FROM messages m
+            CROSS JOIN LATERAL ({ADDRESSES_SQL.format(row='m')}) a
+            WHERE m.direction = 'sent' AND m.message_id IS NOT NULL AND a.address <> ''
+            ORDER BY a.address, m.sent_at DESC NULLS LAST, m.id DESC
+            ON CONFLICT (address) DO NOTHING
+        """)
+        logger.info(f"[LAST SENT] Backfilled {TABLE_NAME}: {result}")
+    logger.info(f"[LAST SENT] Ensured {TABLE_NAME} table and trigger")
+
+
+async def fetch_last_sent_by_address(conn, addresses: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """{normalized address: last sent info} for the given normalized addresses."""
+    keys = sorted({a for a in addresses if a})
+    if not keys:
+        return {}
+    rows = await conn.fetch(f"""
+        SELECT address, message_id, conversation_id, sent_at, recipient_email
+        FROM {TABLE_NAME}
+        WHERE address = ANY($1::text[])
+    """, keys)
+    return {
+        row['address']: {
+            'message_id': row['message_id'],
+            'conversation_id': row['conversation_id'],
+            'sent_at': row['sent_at'],
+            'recipient_email': row['recipient_email'],
+        }
+        for row in rows
+    }
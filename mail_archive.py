@@ -0,0 +1,346 @@
+"""
+Mail Archive Module
+
+Local mirror of the sender mailboxes: every inbound (Inbox) and sent
+(Sent Items) Graph message is stored once in mail_archive with normalized
+headers - Internet Message-ID, In-Reply-To, conversation, sender and
+To/Cc address arrays, normalized subject and timestamps.
+
+Inbox messages are archived by the reply checker from the delta sync it
+already runs; Sent Items are mirrored by mail_archive_worker with its own
+delta links (mail_archive_sync_state). Threading questions - which contact
+a reply answers, which sent messages were replied to - are then indexed
+SQL joins on local data, and Graph is only needed for the sync itself.
+
+This module is imported and used by main.py for reply checking and
+reporting.
+"""
+
+import os
+import asyncio
+import inspect
+import logging
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+from mailbox_sync import fetch_mailbox_changes
+from reply_matcher import normalize_email, normalize_subject, strip_message_id
+
+logger = logging.getLogger(__name__)
+
+# Graph well-known folder -> archive direction
+ARCHIVE_FOLDERS = {
+    'inbox': 'received',
+    'sentitems': 'sent',
+}
+
+# Interval of the Sent Items mirror; 0 disables it
+SENT_SYNC_SECONDS = int(os.getenv('MAIL_ARCHIVE_SENT_SYNC_SECONDS', '600'))
+ARCHIVE_LOCK_KEY = 90006  # Advisory lock for the Sent Items mirror
+
+UPSERT_SQL = """
+    INSERT INTO mail_archive (
+        mailbox, graph_id, folder, direction, internet_message_id, in_reply_to, conversation_id,
+        from_address, to_addresses, cc_addresses, subject, subject_normalized,
+        sent_at, received_at, body_preview, archived_at, updated_at
+    ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9::text[], $10::text[], $11, $12, $13, $14, $15,
+              CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT (mailbox, graph_id) DO UPDATE
+    SET folder = EXCLUDED.folder,
+        direction = EXCLUDED.direction,
+        internet_message_id = COALESCE(EXCLUDED.internet_message_id, mail_archive.internet_message_id),
+        in_reply_to = COALESCE(EXCLUDED.in_reply_to, mail_archive.in_reply_to),
+        conversation_id = EXCLUDED.conversation_id,
+        subject = EXCLUDED.subject,
+        subject_normalized = EXCLUDED.subject_normalized,
+        body_preview = EXCLUDED.body_preview,
+        updated_at = EXCLUDED.updated_at
+"""
+
+
+async def ensure_mail_archive_tables(conn):
+    """Create mail_archive, its lookup indexes and the sync state table."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS mail_archive (
+            id BIGSERIAL PRIMARY KEY,
+            mailbox TEXT NOT NULL,
+            graph_id TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            internet_message_id TEXT,
+            in_reply_to TEXT,
+            conversation_id TEXT,
+            from_address TEXT,
+            to_addresses TEXT[] NOT NULL DEFAULT '{}',
+            cc_addresses TEXT[] NOT NULL DEFAULT '{}',
+            subject TEXT,
+            subject_normalized TEXT,
+            sent_at TIMESTAMP,
+            received_at TIMESTAMP,
+            body_preview TEXT,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (mailbox, graph_id)
+        )
+    """)
+    for name, definition in (
+        ('idx_mail_archive_internet_message_id', '(internet_message_id) WHERE internet_message_id IS NOT NULL'),
+        ('idx_mail_archive_in_reply_to', '(in_reply_to) WHERE in_reply_to IS NOT NULL'),
+        ('idx_mail_archive_conversation', '(conversation_id)'),
+        ('idx_mail_archive_from', '(from_address, received_at)'),
+        ('idx_mail_archive_mailbox_time', '(mailbox, direction, received_at)'),
+        ('idx_mail_archive_to', 'USING GIN (to_addresses)'),
+        ('idx_mail_archive_cc', 'USING GIN (cc_addresses)'),
+    ):
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON mail_archive {definition}")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS mail_archive_sync_state (
+            mailbox TEXT NOT NULL,
+            folder TEXT NOT NULL,
+            delta_link TEXT,
+            round_complete BOOLEAN NOT NULL DEFAULT FALSE,
+            last_synced_at TIMESTAMP,
+            last_message_count INTEGER DEFAULT 0,
+            last_error TEXT,
+            last_error_at TIMESTAMP,
+            PRIMARY KEY (mailbox, folder)
+        )
+    """)
+    logger.info("[MAIL ARCHIVE] Ensured mail_archive tables")
+
+
+def _parse_time(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(UTC).replace(tzinfo=None)
+    return parsed
+
+
+def _addresses(recipients: Optional[List[Dict[str, Any]]]) -> List[str]:
+    found = (normalize_email((r.get('emailAddress') or {}).get('address')) for r in (recipients or []))
+    return list(dict.fromkeys(a for a in found if a))
+
+
+def _header(msg: Dict[str, Any], name: str) -> Optional[str]:
+    for h in msg.get('internetMessageHeaders') or []:
+        if (h.get('name') or '').lower() == name:
+            return h.get('value')
+    return None
+
+
+def archive_row(mailbox: str, folder: str, msg: Dict[str, Any]) -> tuple:
+    """UPSERT_SQL parameters for one Graph message."""
+    subject = msg.get('subject') or ''
+    internet_message_id = strip_message_id(msg.get('internetMessageId') or _header(msg, 'message-id')) or None
+    return (
+        mailbox.lower(),
+        msg['id'],
+        folder,
+        ARCHIVE_FOLDERS.get(folder, folder),
+        internet_message_id,
+        strip_message_id(msg.get('inReplyTo')) or None,
+        msg.get('conversationId'),
+        normalize_email(((msg.get('from') or {}).get('emailAddress') or {}).get('address')) or None,
+        _addresses(msg.get('toRecipients')),
+        _addresses(msg.get('ccRecipients')),
+        subject,
+        normalize_subject(subject),
+        _parse_time(msg.get('sentDateTime')),
+        _parse_time(msg.get('receivedDateTime')),
+        (msg.get('bodyPreview') or '')[:1000],
+    )
+
+
+async def archive_messages(conn, mailbox: str, folder: str, messages: Iterable[Dict[str, Any]]) -> int:
+    """Upsert a batch of Graph messages of one folder; returns the batch size."""
+    rows = [archive_row(mailbox, folder, m) for m in messages if m.get('id')]
+    if rows:
+        await conn.executemany(UPSERT_SQL, rows)
+    return len(rows)
+
+
+async def resolve_reply_recipients(conn, in_reply_to_ids: Iterable[str]) -> Dict[str, Set[str]]:
+    """
+    {Message-ID: To/Cc addresses} of the archived sent messages the given
+    In-Reply-To ids point at.
+    """
+    ids = sorted({strip_message_id(i) for i in in_reply_to_ids} - {''})
+    if not ids:
+        return {}
+    rows = await conn.fetch("""
+        SELECT internet_message_id, to_addresses, cc_addresses
+        FROM mail_archive
+        WHERE direction = 'sent' AND internet_message_id = ANY($1::text[])
+    """, ids)
+    recipients: Dict[str, Set[str]] = {}
+    for row in rows:
+        recipients.setdefault(row['internet_message_id'], set()).update(
+            list(row['to_addresses'] or []) + list(row['cc_addresses'] or [])
+        )
+    return recipients
+
+
+async def sync_sent_items(pool, mailbox: str) -> int:
+    """Mirror new/changed Sent Items of one mailbox; returns the number archived."""
+    folder = 'sentitems'
+    mailbox = mailbox.lower()
+    async with pool.acquire() as conn:
+        delta_link = await conn.fetchval(
+            "SELECT delta_link FROM mail_archive_sync_state WHERE mailbox = $1 AND folder = $2", mailbox, folder
+        )
+    try:
+        messages, link, complete = await fetch_mailbox_changes(mailbox, delta_link, folder=folder)
+    except Exception as e:
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO mail_archive_sync_state (mailbox, folder, last_error, last_error_at)
+                VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                ON CONFLICT (mailbox, folder) DO UPDATE
+                SET last_error = EXCLUDED.last_error, last_error_at = EXCLUDED.last_error_at
+            """, mailbox, folder, str(e)[:2000])
+        raise
+
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            archived = await archive_messages(conn, mailbox, folder, messages)
+            if link:
+                await conn.execute("""
+                    INSERT INTO mail_archive_sync_state (mailbox, folder, delta_link, round_complete,
+                                                         last_synced_at, last_message_count)
+                    VALUES ($1, $2, $3, $4, CURRENT_TIMESTAMP, $5)
+                    ON CONFLICT (mailbox, folder) DO UPDATE
+                    SET delta_link = EXCLUDED.delta_link,
+                        round_complete = EXCLUDED.round_complete,
+                        last_synced_at = EXCLUDED.last_synced_at,
+                        last_message_count = EXCLUDED.last_message_count,
+                        last_error = NULL
+                """, mailbox, folder, link, complete, archived)
+    return archived
+
+
+async def mail_archive_worker(pool, mailboxes_fn):
+    """
+    Periodically mirror Sent Items of every sender mailbox.
+
+    mailboxes_fn(conn) returns the mailboxes to sync.
+    """
+    while True:
+        try:
+            async with pool.acquire() as lock_conn:
+                if await lock_conn.fetchval(f"SELECT pg_try_advisory_lock({ARCHIVE_LOCK_KEY})"):
+                    try:
+                        mailboxes = mailboxes_fn(lock_conn)
+                        if inspect.isawaitable(mailboxes):
+                            mailboxes = await mailboxes
+                        for mailbox in mailboxes:
+                            try:
+                                archived = await sync_sent_items(pool, mailbox)
+                                if archived:
+                                    logger.info(f"[MAIL ARCHIVE] Archived {archived} sent message(s) of {mailbox}")
+                            except Exception as e:
+                                logger.error(f"[MAIL ARCHIVE] Sent Items sync failed for {mailbox}: {e}")
+                    finally:
+                        await lock_conn.execute(f"SELECT pg_advisory_unlock({ARCHIVE_LOCK_KEY})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[MAIL ARCHIVE] Worker error: {e}", exc_info=True)
+        await asyncio.sleep(SENT_SYNC_SECONDS)
+
+
+async def archive_summary(conn) -> List[Dict[str, Any]]:
+    """Per-mailbox message counts and replied sent messages, from local data only."""
+    rows = await conn.fetch("""
+        WITH counts AS (
+            SELECT mailbox,
+                   COUNT(*) FILTER (WHERE direction = 'sent') AS sent,
+                   COUNT(*) FILTER (WHERE direction = 'received') AS received,
+                   MAX(received_at) FILTER (WHERE direction = 'received') AS last_received_at,
+                   MAX(sent_at) FILTER (WHERE direction = 'sent') AS last_sent_at
+            FROM mail_archive
+            GROUP BY mailbox
+        ),
+        replied AS (
+            SELECT s.mailbox, COUNT(DISTINCT s.id) AS replied_sent
+            FROM mail_archive s
+            JOIN mail_archive r
+              ON r.in_reply_to = s.internet_message_id AND r.direction = 'received'
+            WHERE s.direction = 'sent'
+            GROUP BY s.mailbox
+        )
+        SELECT c.*, COALESCE(rp.replied_sent, 0) AS replied_sent,
+               st.last_synced_at AS sent_items_synced_at, st.last_error AS sent_items_error
+        FROM counts c
+        LEFT JOIN replied rp ON rp.mailbox = c.mailbox
+        LEFT JOIN mail_archive_sync_state st ON st.mailbox = c.mailbox AND st.folder = 'sentitems'
+        ORDER BY c.mailbox
+    """)
+    return [dict(r) for r in rows]
+
+
+async def archived_thread(conn, address: str, limit: int = 200) -> List[Dict[str, Any]]:
+    """Archived messages exchanged with one address, newest first."""
+    rows = await conn.fetch("""
+        SELECT id, mailbox, direction, internet_message_id, in_reply_to, conversation_id,
+               from_address, to_addresses, cc_addresses, subject, sent_at, received_at, body_preview
+        FROM mail_archive
+        WHERE from_address = $1 OR to_addresses @> ARRAY[$1]::text[] OR cc_addresses @> ARRAY[$1]::text[]
+        ORDER BY COALESCE(received_at, sent_at) DESC NULLS LAST
+        LIMIT $2
+    """, normalize_email(address), limit)
+    return [dict(r) for r in rows]
+
+
+# --- Router ---
+
+def create_mail_archive_router():
+    """Factory function to create the mail archive router"""
+    router = APIRouter()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    def _pool():
+        import main
+        pool = main.get_db_pool()
+        if not pool:
+            raise HTTPException(status_code=503, detail="Database pool not available")
+        return pool
+
+    @router.get("/admin/mail-archive")
+    async def get_mail_archive_summary(current_user: dict = Depends(get_current_user)):
+        """Archived message counts, replied sent messages and sync state per mailbox."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        async with _pool().acquire() as conn:
+            return {'mailboxes': await archive_summary(conn)}
+
+    @router.get("/admin/mail-archive/thread")
+    async def get_mail_archive_thread(
+        address: str = Query(..., description="Contact email address"),
+        limit: int = Query(200, ge=1, le=1000),
+        current_user: dict = Depends(get_current_user)
+    ):
+        """Archived messages to/from one address, newest first."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        async with _pool().acquire() as conn:
+            return {'address': normalize_email(address), 'messages': await archived_thread(conn, address, limit)}
+
+    return router
+
+
+router = create_mail_archive_router()
@@ -0,0 +1,153 @@
+"""
+Mailbox Sync Module
+
+Incremental inbox sync per mailbox using Microsoft Graph delta queries.
+
+The link to resume from (the @odata.deltaLink of the last completed round,
+or the @odata.nextLink of a round that is still being paged through) is
+stored per mailbox in mailbox_sync_state. Each sync therefore returns only
+messages that are new or changed since the previous one, however many
+arrived in between.
+
+Callers process the returned messages first and only then call
+commit_mailbox_sync(), so a failure while processing makes the next cycle
+fetch the same changes again instead of skipping them.
+
+Mailboxes can be fetched concurrently; each fetch is bounded by a
+per-mailbox semaphore and a global limit on parallel fetches.
+
+This module is imported and used by main.py for reply checking.
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, List, Optional, Tuple
+
+import graph_email
+# Worker threads per mailbox; graph_client adapts the request window below this
+from graph_client import MAILBOX_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+# How far back the first sync of a mailbox (or a resync after the delta
+# link expired) looks for messages.
+INITIAL_SYNC_DAYS = int(os.getenv('MAILBOX_SYNC_INITIAL_DAYS', '30'))
+# Maximum messages taken from Graph per mailbox per cycle; the rest of the
+# round is resumed on the next cycle.
+MAX_MESSAGES_PER_SYNC = int(os.getenv('MAILBOX_SYNC_MAX_MESSAGES', '1000'))
+# Mailboxes fetched at the same time (each fetch occupies a worker thread).
+MAX_PARALLEL_MAILBOXES = int(os.getenv('MAILBOX_SYNC_PARALLELISM', '8'))
+
+_mailbox_semaphores: Dict[str, asyncio.Semaphore] = {}
+_fetch_semaphore: Optional[asyncio.Semaphore] = None
+
+
+async def ensure_mailbox_sync_state_table(conn):
+    """Create the mailbox_sync_state table if it does not exist."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS mailbox_sync_state (
+            mailbox TEXT PRIMARY KEY,
+            delta_link TEXT,
+            round_complete BOOLEAN NOT NULL DEFAULT FALSE,
+            last_synced_at TIMESTAMP,
+            last_message_count INTEGER DEFAULT 0,
+            last_error TEXT,
+            last_error_at TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    logger.info("[MAILBOX SYNC] Ensured mailbox_sync_state table")
+
+
+async def get_sync_state(conn, mailbox: str) -> Optional[Dict[str, Any]]:
+    row = await conn.fetchrow(
+        "SELECT * FROM mailbox_sync_state WHERE mailbox = $1", mailbox.lower()
+    )
+    return dict(row) if row else None
+
+
+async def reset_sync_state(conn, mailbox: str):
+    """Forget the stored link so the next sync starts a fresh delta round."""
+    await conn.execute("""
+        UPDATE mailbox_sync_state
+        SET delta_link = NULL, round_complete = FALSE, updated_at = CURRENT_TIMESTAMP
+        WHERE mailbox = $1
+    """, mailbox.lower())
+
+
+async def record_sync_error(conn, mailbox: str, error: str):
+    await conn.execute("""
+        INSERT INTO mailbox_sync_state (mailbox, last_error, last_error_at, updated_at)
+        VALUES ($1, $2, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+        ON CONFLICT (mailbox) DO UPDATE
+        SET last_error = EXCLUDED.last_error,
+            last_error_at = EXCLUDED.last_error_at,
+            updated_at = EXCLUDED.updated_at
+    """, mailbox.lower(), str(error)[:2000])
+
+
+async def commit_mailbox_sync(conn, mailbox: str, link: Optional[str], complete: bool, message_count: int):
+    """Persist the link to resume from once the fetched messages were processed."""
+    if not link:
+        return
+    await conn.execute("""
+        INSERT INTO mailbox_sync_state (mailbox, delta_link, round_complete, last_synced_at,
+                                        last_message_count, last_error, updated_at)
+        VALUES ($1, $2, $3, CURRENT_TIMESTAMP, $4, NULL, CURRENT_TIMESTAMP)
+        ON CONFLICT (mailbox) DO UPDATE
+        SET delta_link = EXCLUDED.delta_link,
+            round_complete = EXCLUDED.round_complete,
+            last_synced_at = EXCLUDED.last_synced_at,
+            last_message_count = EXCLUDED.last_message_count,
+            last_error = NULL,
+            updated_at = EXCLUDED.updated_at
+    """, mailbox.lower(), link, complete, message_count)
+
+
+def mailbox_semaphore(mailbox: str) -> asyncio.Semaphore:
+    """Per-mailbox cap on concurrent Graph requests issued by this process."""
+    mailbox = mailbox.lower()
+    sem = _mailbox_semaphores.get(mailbox)
+    if sem is None:
+        sem = _mailbox_semaphores[mailbox] = asyncio.Semaphore(MAILBOX_CONCURRENCY)
+    return sem
+
+
+def _fetch_slots() -> asyncio.Semaphore:
+    global _fetch_semaphore
+    if _fetch_semaphore is None:
+        _fetch_semaphore = asyncio.Semaphore(MAX_PARALLEL_MAILBOXES)
+    return _fetch_semaphore
+
+
+async def fetch_mailbox_changes(mailbox: str, delta_link: Optional[str],
+                                folder: str = 'inbox') -> Tuple[List[Dict[str, Any]], Optional[str], bool]:
+    """
+    Fetch new/changed messages of a mailbox folder (the inbox by default)
+    since delta_link (the stored link from get_sync_state(), or None for a
+    first sync).
+
+    Returns (messages, link, complete); pass link and complete to
+    commit_mailbox_sync() after the messages were processed. An expired
+    link is dropped and a fresh round limited to INITIAL_SYNC_DAYS is
+    started in the same call.
+
+    No database connection is held while Graph is being queried, and the
+    request runs under both the per-mailbox and the global fetch limits.
+    """
+    mailbox = mailbox.lower()
+    since = datetime.now(UTC) - timedelta(days=INITIAL_SYNC_DAYS)
+
+    async with _fetch_slots(), mailbox_semaphore(mailbox):
+        try:
+            return await asyncio.to_thread(
+                graph_email.fetch_folder_delta, mailbox, folder, delta_link, since, MAX_MESSAGES_PER_SYNC
+            )
+        except graph_email.DeltaTokenExpired:
+            # The stored link is simply overwritten by the next commit
+            logger.warning(f"[MAILBOX SYNC] Delta link for {mailbox}/{folder} expired; starting a full resync")
+            return await asyncio.to_thread(
+                graph_email.fetch_folder_delta, mailbox, folder, None, since, MAX_MESSAGES_PER_SYNC
+            )
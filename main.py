@@ -38,16 +38,69 @@ import logging
 from logging.handlers import RotatingFileHandler
 import graph_email
 from dotenv import load_dotenv
-import requests
-from msal import ConfidentialClientApplication
+from graph_auth import token_manager, token_refresh_worker
 import asyncpg
-import httpx
-from asyncio import Semaphore
+import http_clients
+from http_clients import GRAPH_TIMEOUT
+from graph_client import graph_client
 import subprocess
 from starlette.responses import Response
 from monitoring import init_monitoring_service, update_worker_heartbeat
 from monitoring_api import router as monitoring_router
 from business_hours import next_allowed_uk_business_time, is_business_hours
+from email_enqueue import enqueue_messages, ensure_email_queue_dedupe_index
+from reply_matcher import ReplyMatcher
+from mail_archive import (
+    ensure_mail_archive_tables, archive_messages, resolve_reply_recipients, mail_archive_worker,
+    SENT_SYNC_SECONDS as MAIL_ARCHIVE_SENT_SYNC_SECONDS,
+)
+from sender_registry import (
+    sender_registry, assignable_senders, ensure_sender_registry_table, load_sender_registry,
+    sender_registry_worker, DEFAULT_CAPACITY_PER_EVENT, RELOAD_SECONDS as SENDER_REGISTRY_RELOAD_SECONDS,
+)
+from validation_cache import ensure_email_validation_cache_table
+from domain_validation import ensure_email_domain_facts_table, validate_address, validate_addresses
+from email_validator_client import (
+    email_validator, ensure_validation_retry_queue_table, revalidation_worker, ValidationDeferred,
+    REVALIDATE_INTERVAL as VALIDATOR_REVALIDATE_INTERVAL,
+)
+from bounce_classifier import BounceResult, classify_bounce, extract_failed_recipient
+from message_store import (
+    ensure_messages_message_id_index, filter_unseen_message_ids, insert_received_message,
+    ensure_messages_content_hash, find_content_duplicate, duplicate_cleanup_worker, DEDUPE_INTERVAL_SECONDS,
+)
+import message_store
+from last_sent_by_address import ensure_last_sent_by_address, fetch_last_sent_by_address
+from graph_webhooks import (
+    ensure_graph_subscriptions_table,
+    webhooks_enabled,
+    notification_worker,
+    subscription_worker,
+    subscription_mailboxes,
+    wait_for_next_poll,
+)
+from mailbox_sync import (
+    ensure_mailbox_sync_state_table,
+    get_sync_state,
+    fetch_mailbox_changes,
+    commit_mailbox_sync,
+    record_sync_error,
+)
+from email_templates import compile_template, get_compiled_template, template_registry
+from message_snapshot import (
+    append_quoted_history,
+    build_payload,
+    clean_subject,
+    ensure_queue_payload_columns,
+    fetch_history,
+    payload_hash,
+    read_payload
+)
+from contact_render_context import (
+    ensure_render_context_schema,
+    load_render_contexts,
+    refresh_render_contexts
+)
 from contact_messages import (
     get_contact_message_flows, 
     save_contact_custom_message, 
@@ -93,64 +146,19 @@ LOCAL_DB_PATH = os.getenv('LOCAL_DB_PATH', './crm_database')
 OUTLOOK_EMAIL = os.getenv('OUTLOOK_EMAIL')
 OUTLOOK_PASSWORD = os.getenv('OUTLOOK_PASSWORD')
 
-# External validator service URL
-VALIDATOR_URL = os.getenv('VALIDATOR_URL', 'https://62.171.152.239:5000/validate')
-# Concurrency limit for validation requests
-VALIDATOR_CONCURRENCY = int(os.getenv('VALIDATOR_CONCURRENCY', '8'))
-_validator_semaphore = Semaphore(VALIDATOR_CONCURRENCY)
-VALIDATOR_MAX_RETRIES = int(os.getenv('VALIDATOR_MAX_RETRIES', '3'))
-VALIDATOR_BACKOFF_BASE = float(os.getenv('VALIDATOR_BACKOFF_BASE', '1.0'))
-
-
 async def call_validator(email: str) -> Dict[str, Any]:
-    """Call external validator with retry/backoff and return structured result."""
-    last_exc = None
-    for attempt in range(1, VALIDATOR_MAX_RETRIES + 1):
-        try:
-            async with _validator_semaphore:
-                timeout = httpx.Timeout(120.0, connect=10.0)
-                async with httpx.AsyncClient(verify=False, timeout=timeout) as client:
-                    logger.debug(f"Calling validator (attempt {attempt}) for {email} -> {VALIDATOR_URL}")
-                    
-                    start_ts = datetime.utcnow()
-                    resp = await client.post(VALIDATOR_URL, json={"email": email})
-                    elapsed = (datetime.utcnow() - start_ts).total_seconds()
-                    
-                    logger.debug(f"Validator response for {email} received in {elapsed:.2f}s (status={resp.status_code})")
-
-                    # === FIX: Return the actual result directly ===
-                    try:
-                        data = resp.json()
-                    except Exception:
-                        data = {}
-
-                    return {
-                        'code': resp.status_code,
-                        'valid': data.get('valid', False),
-                        'validation_result': data,
-                        'reason': data.get('reason'),
-                        'raw': resp.text
-                    }
-
-        except httpx.ReadTimeout as e:
-            last_exc = e
-            logger.warning(f"Validator read timeout on attempt {attempt} for {email}: {e}")
-            if attempt < VALIDATOR_MAX_RETRIES:
-                backoff = VALIDATOR_BACKOFF_BASE * (2 ** (attempt - 1))
-                await asyncio.sleep(backoff)
-                continue
-            raise last_exc
-        except Exception as e:
-            last_exc = e
-            logger.warning(f"Validator call exception on attempt {attempt} for {email}: {e}")
-            if attempt < VALIDATOR_MAX_RETRIES:
-                backoff = VALIDATOR_BACKOFF_BASE * (2 ** (attempt - 1))
-                await asyncio.sleep(backoff)
-                continue
-            raise last_exc
+    """
+    Validation result for an address: answered from its domain's facts
+    (see domain_validation) or the validation cache, and only sent to the
+    external validator when neither decides it. Raises ValidationDeferred
+    when the validator is unavailable (the address is then re-validated in
+    the background, see email_validator_client).
+    """
+    return await validate_address(db_pool, email, email_validator.validate)
 
 import math
 
+# Rotation used to seed sender_registry and until it has been loaded
 ALLOWED_SENDERS = [
     'accommodations@converiatravel.com',
     'coordination@converiatravel.com',
@@ -159,13 +167,15 @@ ALLOWED_SENDERS = [
     'reservations@converiatravels.com',
     'lodgings@converiatravels.com',
 ]
+sender_registry.set_default_assignable(ALLOWED_SENDERS)
 
 DEFAULT_SENDER_EMAIL = 'accommodations@converiatravel.com'
 
 async def get_auto_assigned_sender(conn, event_size: int = 0) -> str:
-    # Batch size config
-    CAPACITY_PER_SENDER = 50
-    
+    senders = assignable_senders()
+    if not senders:
+        return DEFAULT_SENDER_EMAIL
+
     # 1. Query Total Load
     rows = await conn.fetch(
         """
@@ -176,23 +186,23 @@ async def get_auto_assigned_sender(conn, event_size: int = 0) -> str:
         WHERE sender_email = ANY($1::text[])
         GROUP BY sender_email
         """,
-        ALLOWED_SENDERS
+        senders
     )
     
     # 2. Map results
     current_loads = {row['sender_email']: row['total_load'] for row in rows}
     
     # 3. Fill missing senders with 0
-    for sender in ALLOWED_SENDERS:
+    for sender in senders:
         if sender not in current_loads:
             current_loads[sender] = 0
 
     # 4. Calculate Batch Tiers
     sender_tiers = {}
     print("\n--- SENDER ROTATION DEBUG ---")
-    for sender in ALLOWED_SENDERS:
+    for sender in senders:
         load = current_loads[sender]
-        tier = load // CAPACITY_PER_SENDER
+        tier = load // sender_registry.capacity_per_event(sender)
         sender_tiers[sender] = tier
         print(f"Sender: {sender:<35} | Load: {load:<5} | Tier: {tier}")
 
@@ -201,12 +211,12 @@ async def get_auto_assigned_sender(conn, event_size: int = 0) -> str:
     print(f"TARGET TIER: {min_tier}")
 
     # 6. Select first sender in lowest tier
-    for sender in ALLOWED_SENDERS:
+    for sender in senders:
         if sender_tiers[sender] == min_tier:
             print(f"✅ ASSIGNING: {sender}\n")
             return sender
 
-    return ALLOWED_SENDERS[0]
+    return senders[0]
 
 
 # Define allowed origins for CORS
@@ -230,6 +240,9 @@ def load_template(template_type: str, part: str, reminder_type: str = None, stag
     """
     Load email templates based on type, part, and stage.
 
+    Templates are served from the in-memory registry in email_templates,
+    which re-reads a file only when its mtime changes.
+
     Args:
         template_type: 'campaign', 'reminder', 'forms', or 'payments'
         part: 'subject' or 'body'
@@ -239,183 +252,7 @@ def load_template(template_type: str, part: str, reminder_type: str = None, stag
     Returns:
         str: The template content
     """
-    # Normalize inputs
-    template_type = template_type.lower() if template_type else None
-    part = part.lower() if part else None
-    stage = stage.lower() if stage else None
-    reminder_type = str(reminder_type).lower() if reminder_type else None
-
-    # Backwards-compatibility: callers sometimes pass the reminder stage in the
-    # `stage` parameter (e.g. 'reminder2') instead of the `reminder_type`
-    # parameter. If we detect that `stage` looks like a reminder name and
-    # `reminder_type` isn't provided, treat `stage` as the `reminder_type` and
-    # clear `stage` so lookups match the template_files keys.
-    if not reminder_type and stage and stage.startswith('reminder'):
-        reminder_type = stage
-        stage = None
-        logger.debug(f"[TEMPLATE] Interpreting stage '{reminder_type}' as reminder_type for lookup")
-
-    # Define template file mappings with fallback hierarchy
-    template_files = {
-        # Initial campaign message (first email)
-        ('campaign', 'subject', None, 'initial'): 'public/templates/emails/campaign_default_subject.txt',
-        ('campaign', 'body', None, 'initial'): 'public/templates/emails/campaign_default_body.txt',
-
-        # First reminder (reminder1)
-        ('reminder', 'subject', 'reminder1', None): 'public/templates/emails/reminder_default_subject.txt',
-        ('reminder', 'body', 'reminder1', None): 'public/templates/emails/reminder_default_body.txt',
-
-        # Second reminder (reminder2)
-        ('reminder', 'subject', 'reminder2', None): 'public/templates/emails/reminder2_default_subject.txt',
-        ('reminder', 'body', 'reminder2', None): 'public/templates/emails/reminder2_default_body.txt',
-
-        # Forms stage initial message
-        ('forms', 'subject', None, 'initial'): 'public/templates/emails/forms_main_subject.txt',
-        ('forms', 'body', None, 'initial'): 'public/templates/emails/forms_main_body.txt',
-
-        # Forms stage reminders
-        ('forms', 'subject', 'reminder1', None): 'public/templates/emails/forms_reminder1_subject.txt',
-        ('forms', 'body', 'reminder1', None): 'public/templates/emails/forms_reminder1_body.txt',
-        ('forms', 'subject', 'reminder2', None): 'public/templates/emails/forms_reminder2_subject.txt',
-        ('forms', 'body', 'reminder2', None): 'public/templates/emails/forms_reminder2_body.txt',
-        ('forms', 'subject', 'reminder3', None): 'public/templates/emails/forms_reminder3_subject.txt',
-        ('forms', 'body', 'reminder3', None): 'public/templates/emails/forms_reminder3_body.txt',
-
-        # Payments stage initial message
-        ('payments', 'subject', None, 'initial'): 'public/templates/emails/payments_main_subject.txt',
-        ('payments', 'body', None, 'initial'): 'public/templates/emails/payments_main_body.txt',
-
-        # Payments stage reminders (up to 6 reminders)
-        ('payments', 'subject', 'reminder1', None): 'public/templates/emails/payments_reminder1_subject.txt',
-        ('payments', 'body', 'reminder1', None): 'public/templates/emails/payments_reminder1_body.txt',
-        ('payments', 'subject', 'reminder2', None): 'public/templates/emails/payments_reminder2_subject.txt',
-        ('payments', 'body', 'reminder2', None): 'public/templates/emails/payments_reminder2_body.txt',
-        ('payments', 'subject', 'reminder3', None): 'public/templates/emails/payments_reminder3_subject.txt',
-        ('payments', 'body', 'reminder3', None): 'public/templates/emails/payments_reminder3_body.txt',
-        ('payments', 'subject', 'reminder4', None): 'public/templates/emails/payments_reminder4_subject.txt',
-        ('payments', 'body', 'reminder4', None): 'public/templates/emails/payments_reminder4_body.txt',
-        ('payments', 'subject', 'reminder5', None): 'public/templates/emails/payments_reminder5_subject.txt',
-        ('payments', 'body', 'reminder5', None): 'public/templates/emails/payments_reminder5_body.txt',
-        ('payments', 'subject', 'reminder6', None): 'public/templates/emails/payments_reminder6_subject.txt',
-        ('payments', 'body', 'reminder6', None): 'public/templates/emails/payments_reminder6_body.txt',
-
-    # SEPA bank transfer payment stage (payment_sepa templates)
-    ('sepa', 'subject', None, 'initial'): 'public/templates/emails/payment_sepa_subject.txt',
-    ('sepa', 'body', None, 'initial'): 'public/templates/emails/payment_sepa_body.txt',
-
-    # SEPA reminders 1..3 use SEPA-specific templates
-    ('sepa', 'subject', 'reminder1', None): 'public/templates/emails/payment_sepa_reminder1_subject.txt',
-    ('sepa', 'body', 'reminder1', None): 'public/templates/emails/payment_sepa_reminder1_body.txt',
-    ('sepa', 'subject', 'reminder2', None): 'public/templates/emails/payment_sepa_reminder2_subject.txt',
-    ('sepa', 'body', 'reminder2', None): 'public/templates/emails/payment_sepa_reminder2_body.txt',
-    ('sepa', 'subject', 'reminder3', None): 'public/templates/emails/payment_sepa_reminder3_subject.txt',
-    ('sepa', 'body', 'reminder3', None): 'public/templates/emails/payment_sepa_reminder3_body.txt',
-
-    # SEPA reminders 4..6 reuse the payments reminder templates (same copy)
-    ('sepa', 'subject', 'reminder4', None): 'public/templates/emails/payments_reminder4_subject.txt',
-    ('sepa', 'body', 'reminder4', None): 'public/templates/emails/payments_reminder4_body.txt',
-    ('sepa', 'subject', 'reminder5', None): 'public/templates/emails/payments_reminder5_subject.txt',
-    ('sepa', 'body', 'reminder5', None): 'public/templates/emails/payments_reminder5_body.txt',
-    ('sepa', 'subject', 'reminder6', None): 'public/templates/emails/payments_reminder6_subject.txt',
-    ('sepa', 'body', 'reminder6', None): 'public/templates/emails/payments_reminder6_body.txt',
-
-    # RH bank transfer payment stage (payment_rh templates)
-    ('rh', 'subject', None, 'initial'): 'public/templates/emails/payment_rh_subject.txt',
-    ('rh', 'body', None, 'initial'): 'public/templates/emails/payment_rh_body.txt',
-
-    # RH reminders 1..3 use RH-specific templates
-    ('rh', 'subject', 'reminder1', None): 'public/templates/emails/payment_rh_reminder1_subject.txt',
-    ('rh', 'body', 'reminder1', None): 'public/templates/emails/payment_rh_reminder1_body.txt',
-    ('rh', 'subject', 'reminder2', None): 'public/templates/emails/payment_rh_reminder2_subject.txt',
-    ('rh', 'body', 'reminder2', None): 'public/templates/emails/payment_rh_reminder2_body.txt',
-    ('rh', 'subject', 'reminder3', None): 'public/templates/emails/payment_rh_reminder3_subject.txt',
-    ('rh', 'body', 'reminder3', None): 'public/templates/emails/payment_rh_reminder3_body.txt',
-
-    # RH reminders 4..6 reuse the payments reminder templates (same copy)
-    ('rh', 'subject', 'reminder4', None): 'public/templates/emails/payments_reminder4_subject.txt',
-    ('rh', 'body', 'reminder4', None): 'public/templates/emails/payments_reminder4_body.txt',
-    ('rh', 'subject', 'reminder5', None): 'public/templates/emails/payments_reminder5_subject.txt',
-    ('rh', 'body', 'reminder5', None): 'public/templates/emails/payments_reminder5_body.txt',
-    ('rh', 'subject', 'reminder6', None): 'public/templates/emails/payments_reminder6_subject.txt',
-    ('rh', 'body', 'reminder6', None): 'public/templates/emails/payments_reminder6_body.txt',
-
-        # Fallback for any other reminder types
-        ('reminder', 'subject', None, None): 'public/templates/emails/reminder_default_subject.txt',
-        ('reminder', 'body', None, None): 'public/templates/emails/reminder_default_body.txt',
-    }
-
-    # Define the fallback hierarchy for template lookup
-    lookup_keys = []
-
-    # 0. Handle backward compatibility and special cases
-    if template_type == 'campaign':
-        # For initial campaign message (stage='default' or None)
-        if not stage or stage == 'default':
-            lookup_keys.append(('campaign', part, None, 'initial'))
-        # For campaign with specific stage (e.g., 'forms', 'payments')
-        elif stage in ['forms', 'payments']:
-            lookup_keys.append((stage, part, reminder_type, 'initial'))
-            lookup_keys.append((stage, part, None, 'initial'))
-
-    # 1. Exact match with both stage and reminder_type
-    if stage and reminder_type:
-        lookup_keys.append((template_type, part, reminder_type, stage))
-
-    # 2. Match with stage only (for initial messages)
-    if stage:
-        lookup_keys.append((template_type, part, None, stage))
-
-    # 3. Match with reminder_type only (for default stage)
-    if reminder_type:
-        lookup_keys.append((template_type, part, reminder_type, None))
-
-    # 4. Most generic fallback (no stage or reminder_type)
-    lookup_keys.append((template_type, part, None, None))
-
-    # Try each key in order until we find a match
-    template_file = None
-    matched_key = None
-    for key in lookup_keys:
-        if key in template_files:
-            template_file = template_files[key]
-            matched_key = key
-            break
-
-    if not template_file:
-        raise RuntimeError(f"No template found for type: {template_type}, part: {part}, "
-                         f"reminder_type: {reminder_type}, stage: {stage}")
-
-    # Try to load the template file
-    try:
-        with open(template_file, 'r', encoding='utf-8') as f:
-            content = f.read().strip()
-            if not content:
-                raise ValueError(f"Template file is empty: {template_file}")
-
-            logger.info(f"Successfully loaded template: {template_file}")
-            if matched_key:
-                # Log at INFO so it appears in normal logs and include a short preview
-                preview = (content[:120] + '...') if len(content) > 120 else content
-                logger.info(f"[TEMPLATE-LOOKUP] matched_key={matched_key} -> file={template_file} preview={preview!r}")
-            return content
-
-    except FileNotFoundError:
-        logger.error(f"Template file not found: {template_file}")
-        # If this was a specific template, try the next fallback in hierarchy
-        if len(lookup_keys) > 1:
-            fallback_key = (template_type, part, None)
-            fallback_file = template_files.get(fallback_key)
-            if fallback_file and fallback_file != template_file:
-                try:
-                    with open(fallback_file, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                        logger.warning(f"Using fallback template: {fallback_file} instead of {template_file}")
-                        return content
-                except FileNotFoundError:
-                    pass
-        raise RuntimeError(f"Could not load template file: {template_file}")
-    except Exception as e:
-        raise RuntimeError(f"Error reading template file {template_file}: {e}")
+    return get_compiled_template(template_type, part, reminder_type, stage).text
 
 def render_template_strict(template: str, customer: dict) -> str:
     """
@@ -455,8 +292,9 @@ def render_template_strict(template: str, customer: dict) -> str:
     except Exception:
         pass
 
-    # Extract all required variables from the template
-    required_vars = set(re.findall(r'{{\s*(.*?)\s*}}', template))
+    # Parsed segments and variable names are cached per template text
+    compiled = compile_template(template)
+    required_vars = compiled.variables
     if not required_vars:
         logger.debug("No template variables found in template")
         return template
@@ -473,23 +311,16 @@ def render_template_strict(template: str, customer: dict) -> str:
         raise ValueError(error_msg)
 
     # All variables are present, perform the substitution
-    def replacer(match):
-        key = match.group(1).strip()
-        value = customer.get(key, '')
-        if value is None:
-            logger.warning(f"Variable '{key}' is None for customer ID {customer.get('id', 'unknown')}")
-            return ''
-        return str(value)
-
     try:
-        result = re.sub(r'{{\s*(.*?)\s*}}', replacer, template)
+        result = compiled.substitute(customer)
         if not result or not result.strip():
             raise ValueError(f"Rendered template is empty for customer ID {customer.get('id', 'unknown')}")
 
-        # Verify no template variables remain unsubstituted
-        remaining_vars = set(re.findall(r'{{\s*(.*?)\s*}}', result))
-        if remaining_vars:
-            raise ValueError(f"Failed to substitute all template variables. Remaining: {', '.join(remaining_vars)}")
+        # Verify no template variables remain unsubstituted (only possible if a value contains one)
+        if '{{' in result:
+            remaining_vars = set(re.findall(r'{{\s*(.*?)\s*}}', result))
+            if remaining_vars:
+                raise ValueError(f"Failed to substitute all template variables. Remaining: {', '.join(remaining_vars)}")
 
         return result
 
@@ -499,72 +330,6 @@ def render_template_strict(template: str, customer: dict) -> str:
 
 import re
 
-def extract_name_parts_with_prefix(full_name: str) -> tuple:
-    """
-    Parses a name string for the email template: 'Dear {{prefix}} {{name}}'
-    
-    Logic:
-    1. If a Prefix is found (e.g., Mr., Dr.), returns (Prefix, Last Name).
-    2. If NO Prefix is found, returns (First Name, Last Name).
-       This ensures 'Dear {{prefix}} {{name}}' reads as 'Dear Hatem Ayman'.
-    """
-    if not full_name or not isinstance(full_name, str):
-        return "", ""
-    
-    # Clean whitespace
-    full_name = full_name.strip()
-    
-    # 1. Define common prefixes (Case insensitive)
-    # Checks for "Mr.", "Mr", "Dr.", "Dr", etc. at the start of the string
-    prefix_pattern = r"^(Mr\.|Mr|Ms\.|Ms|Mrs\.|Mrs|Dr\.|Dr|Prof\.|Prof|Sir|Madam|Eng\.|Eng)\b\.?"
-    
-    match = re.match(prefix_pattern, full_name, re.IGNORECASE)
-    
-    if match:
-        # --- PATH A: Prefix Found ---
-        # Goal: Return ("Mr.", "Ayman")
-        
-        found_prefix = match.group(0).strip()
-        # Remove the prefix from the string to analyze the rest
-        remainder = full_name[match.end():].strip()
-        
-        # Split remaining name by comma OR space to find the Last Name
-        if ',' in remainder:
-            parts = remainder.split(',')
-        else:
-            parts = remainder.split()
-            
-        # We take the LAST part as the surname
-        last_name = parts[-1].strip() if parts else remainder
-        
-        # Ensure prefix has a dot if missing (optional polish)
-        if not found_prefix.endswith('.') and len(found_prefix) <= 3:
-             found_prefix += "."
-             
-        return found_prefix.title(), last_name.title()
-
-    else:
-        # --- PATH B: No Prefix Found ---
-        # Goal: Return ("Hatem", "Ayman") so template reads "Dear Hatem Ayman"
-        
-        if ',' in full_name:
-            
-            parts = full_name.split(',')
-            first_part = parts[0].strip()
-            last_part = parts[-1].strip()
-            return first_part.title(), last_part.title()
-        else:
-            # Handle "Hatem Ayman" (Space separated)
-            parts = full_name.split()
-            if len(parts) >= 2:
-                # First word = Prefix slot, Rest = Name slot
-                return parts[0].title(), " ".join(parts[1:]).title()
-            else:
-                # Single Name (e.g. "Cher")
-                # Return empty prefix, Name in name slot
-                return "", full_name.title()
-
-
 # In main.py, add this helper function before generate_quoted_block
 def build_outgoing_body(contact: dict, new_body: str) -> str:
     """
@@ -620,70 +385,12 @@ def is_bounce_email(subject: str, body: str, sender_email: str) -> bool:
     """
     Detect if an email is a delivery failure bounce.
     """
-    # Normalize inputs for checking
-    subject_lower = subject.lower() if subject else ""
-    body_lower = body.lower() if body else ""
-    sender_lower = sender_email.lower() if sender_email else ""
-
-    # Common bounce indicators in subject
-    bounce_subjects = [
-        "delivery status notification", "mail delivery failed", "delivery failure",
-        "undelivered mail returned to sender", "message delivery failure", "returned mail",
-        "mail system error", "delivery error", "postmaster@", "mailer-daemon@",
-        "delivery report", "non-delivery report", "ndr", "bounce", "failure notice"
-    ]
-
-    # Common bounce senders
-    bounce_senders = [
-        "postmaster@", "mailer-daemon@", "noreply@", "no-reply@", "bounce@", "bounces@", "delivery@"
-    ]
-
-    # Common bounce body indicators
-    bounce_body_indicators = [
-        "message could not be delivered", "delivery has failed", "recipient address rejected",
-        "mailbox unavailable", "address not found", "user unknown", "mailbox full",
-        "quota exceeded", "message rejected", "recipient not found", "smtp error",
-        "550", "554", "permanent failure", "bounce message", "delivery failure"
-    ]
-
-    # Check subject for bounce indicators
-    for indicator in bounce_subjects:
-        if indicator in subject_lower:
-            return True
-
-    # Check sender for bounce indicators
-    for indicator in bounce_senders:
-        if indicator in sender_lower:
-            return True
-
-    # Check body for bounce indicators
-    for indicator in bounce_body_indicators:
-        if indicator in body_lower:
-            return True
-
-    return False
+    return classify_bounce(subject, body, sender_email).is_bounce
 
 def extract_bounced_email(body: str) -> str:
     """Extract the original recipient email address from a bounce message."""
-    import re
-
-    if not body:
-        return ""
-
-    # Common patterns for finding bounced email addresses
-    patterns = [
-        r'(?:original recipient|recipient address|failed recipient)[:\s]+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})',
-        r'(?:delivery to the following recipient failed)[:\s]+([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})',
-        r'<([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})>',  # Email in angle brackets
-        r'\b([a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,})\b'  # Any email pattern
-    ]
-
-    for pattern in patterns:
-        matches = re.findall(pattern, body, re.IGNORECASE)
-        if matches:
-            return normalize_email(matches[0])
-
-    return ""
+    recipient, _ = extract_failed_recipient(body)
+    return normalize_email(recipient)
 
 def serialize_for_json(obj):
     """Helper function to serialize objects for JSON storage, handling datetime objects"""
@@ -757,30 +464,57 @@ async def log_user_activity(conn, user_info: dict, action_type: str, action_desc
         if new_values:
             logger.error(f"[ACTIVITY] new_values keys: {list(new_values.keys()) if isinstance(new_values, dict) else 'not a dict'}")
 
-async def handle_bounce_email(conn, subject: str, body: str, sender_email: str):
+async def log_user_activities(conn, user_info: dict, action_type: str, entries: List[Dict[str, Any]]):
+    """Log one audit row per entry in a single round trip (bulk variant of log_user_activity).
+
+    Each entry holds action_description and optionally target_type, target_id,
+    target_name, old_values and new_values.
+    """
+    if not entries:
+        return
+    try:
+        username_to_log = (user_info.get('username') if user_info else None) or 'system'
+        user_id = user_info.get('id') if user_info else None
+        timestamp = datetime.now()
+        rows = []
+        for entry in entries:
+            serialized_old_values = serialize_for_json(entry.get('old_values'))
+            serialized_new_values = serialize_for_json(entry.get('new_values'))
+            rows.append((
+                user_id, username_to_log, action_type, entry['action_description'],
+                entry.get('target_type'), entry.get('target_id'), entry.get('target_name'),
+                json.dumps(serialized_old_values) if serialized_old_values else None,
+                json.dumps(serialized_new_values) if serialized_new_values else None,
+                None, None, timestamp
+            ))
+        await conn.executemany('''
+            INSERT INTO user_activity_logs (
+                user_id, username, action_type, action_description,
+                target_type, target_id, target_name, old_values, new_values,
+                ip_address, user_agent, timestamp
+            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+        ''', rows)
+        logger.debug(f"[ACTIVITY] Logged {len(rows)} x {action_type} by {username_to_log}")
+    except Exception as e:
+        logger.error(f"[ACTIVITY] Failed to log {action_type} activities: {e}")
+
+async def handle_bounce_email(conn, subject: str, body: str, sender_email: str,
+                              bounce: Optional[BounceResult] = None):
     """Handle a detected bounce email by marking the email as bounced."""
-    bounced_email = extract_bounced_email(body)
+    if bounce is None:
+        bounce = classify_bounce(subject, body, sender_email)
+    bounced_email = normalize_email(bounce.recipient)
 
     if not bounced_email:
         logger.warning(f"[BOUNCE] Could not extract bounced email from bounce message")
         return
 
-    logger.info(f"[BOUNCE] Detected bounce for email: {bounced_email}")
+    logger.info(f"[BOUNCE] Detected bounce for email: {bounced_email} "
+                f"(type={bounce.bounce_type} status={bounce.status} source={bounce.source})")
 
-    # Determine bounce type and reason
-    bounce_type = "hard"
-    bounce_reason = "Email delivery failed"
-
-    if "mailbox full" in body.lower() or "quota exceeded" in body.lower():
-        bounce_type = "soft"
-        bounce_reason = "Mailbox full"
-    elif "temporary failure" in body.lower():
-        bounce_type = "soft"
-        bounce_reason = "Temporary delivery failure"
-    elif "user unknown" in body.lower() or "address not found" in body.lower():
-        bounce_reason = "Invalid email address"
-    elif "mailbox unavailable" in body.lower():
-        bounce_reason = "Mailbox unavailable"
+    # Type and reason come from the DSN/NDR status code when present
+    bounce_type = bounce.bounce_type or "hard"
+    bounce_reason = bounce.reason or "Email delivery failed"
 
     now = datetime.now()
 
@@ -955,18 +689,12 @@ def is_duplicate_trigger(trigger: str) -> bool:
 
 # Graph API functions
 def get_graph_token(client_id, client_secret, tenant_id):
-    authority = f"https://login.microsoftonline.com/{tenant_id}"
-    app = ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret)
-    scopes = ["https://graph.microsoft.com/.default"]
-    result = app.acquire_token_silent(scopes, account=None)
-    if not result:
-        result = app.acquire_token_for_client(scopes=scopes)
-    return result["access_token"]
+    return token_manager.get_token(tenant_id, client_id, client_secret)
 
 def fetch_recent_messages(token, mailbox):
-    url = f"https://graph.microsoft.com/v1.0/users/{mailbox}/mailFolders/inbox/messages?$top=50"
+    url = f"{graph_email.GRAPH_API_BASE}/users/{mailbox}/mailFolders/inbox/messages?$top=50"
     headers = {"Authorization": f"Bearer {token}"}
-    response = requests.get(url, headers=headers)
+    response = graph_client.request('GET', url, mailbox=mailbox, headers=headers, timeout=GRAPH_TIMEOUT)
     response.raise_for_status()
     return response.json()["value"]
 
@@ -1009,6 +737,84 @@ async def init_db() -> bool:
                 await create_contact_messages_table(conn)
             except Exception as e:
                 logger.warning(f"[DB] Could not create contact_messages table: {e}")
+
+            # Stored per-contact render context (derived name/link fields)
+            try:
+                await ensure_render_context_schema(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure campaign_contacts.render_context: {e}")
+
+            # Pre-rendered send payload columns on email_queue
+            try:
+                await ensure_queue_payload_columns(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure email_queue payload columns: {e}")
+
+            # Unique messages.message_id used for processed-message detection
+            try:
+                await ensure_messages_message_id_index(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure messages.message_id index: {e}")
+
+            # Local mirror of inbox/sent Graph messages
+            try:
+                await ensure_mail_archive_tables(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create mail_archive tables: {e}")
+
+            # Content fingerprint used for duplicate detection and cleanup
+            try:
+                await ensure_messages_content_hash(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure messages.content_hash: {e}")
+
+            # Last sent message per recipient/CC address (reply checker fallback)
+            try:
+                await ensure_last_sent_by_address(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure last_sent_by_address table: {e}")
+
+            # Graph change notification subscriptions (webhook reply detection)
+            try:
+                await ensure_graph_subscriptions_table(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create graph_subscriptions table: {e}")
+
+            # Per-mailbox Graph delta links for incremental inbox sync
+            try:
+                await ensure_mailbox_sync_state_table(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create mailbox_sync_state table: {e}")
+
+            # Cached external validator results per address
+            try:
+                await ensure_email_validation_cache_table(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create email_validation_cache table: {e}")
+
+            # MX / disposable / catch-all facts per recipient domain
+            try:
+                await ensure_email_domain_facts_table(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create email_domain_facts table: {e}")
+
+            # Addresses deferred while the validator was unavailable
+            try:
+                await ensure_validation_retry_queue_table(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create validation_retry_queue table: {e}")
+
+            # Sender mailboxes, credentials references and limits
+            try:
+                await ensure_sender_registry_table(conn, ALLOWED_SENDERS)
+            except Exception as e:
+                logger.warning(f"[DB] Could not create sender_registry table: {e}")
+
+            # Unique (contact_id, last_message_type) index used for queue dedupe
+            try:
+                await ensure_email_queue_dedupe_index(conn)
+            except Exception as e:
+                logger.warning(f"[DB] Could not ensure email_queue dedupe index: {e}")
             
             return True
         finally:
@@ -1057,10 +863,34 @@ async def lifespan(app: FastAPI):
         await init_monitoring_service(db_pool)
         print("ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¾ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¦ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â¦ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¦ Monitoring service initialized")
 
+        # Sender registry (hot-reloaded from the sender_registry table)
+        try:
+            async with db_pool.acquire() as conn:
+                await load_sender_registry(conn)
+        except Exception as e:
+            logger.warning(f"[SENDERS] Using environment senders, registry load failed: {e}")
+
+        # Long-lived HTTP clients shared by all workers and requests
+        await http_clients.startup()
+
         # Start background workers
         asyncio.create_task(send_email_worker())
         asyncio.create_task(campaign_worker())
         asyncio.create_task(reply_checker_worker())
+        asyncio.create_task(token_refresh_worker(graph_email.configured_credentials))
+        if webhooks_enabled():
+            # Push-based reply detection; polling above remains the fallback
+            asyncio.create_task(subscription_worker(db_pool))
+            asyncio.create_task(notification_worker(db_pool, process_notified_messages))
+            logger.info("[WEBHOOK] Graph change notification workers started")
+        if MAIL_ARCHIVE_SENT_SYNC_SECONDS > 0:
+            asyncio.create_task(mail_archive_worker(db_pool, subscription_mailboxes))
+        if DEDUPE_INTERVAL_SECONDS > 0:
+            asyncio.create_task(duplicate_cleanup_worker(db_pool))
+        if SENDER_REGISTRY_RELOAD_SECONDS > 0:
+            asyncio.create_task(sender_registry_worker(db_pool))
+        if VALIDATOR_REVALIDATE_INTERVAL > 0:
+            asyncio.create_task(revalidation_worker(db_pool, call_validator))
         print("ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¾ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¦ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¾Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€šÃ‚Â¦ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬ÃƒÂ¢Ã¢â‚¬Å¾Ã‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã‚Â¦ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã¢â‚¬Â ÃƒÂ¢Ã¢â€šÂ¬Ã¢â€žÂ¢ÃƒÆ’Ã†â€™Ãƒâ€šÃ‚Â¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡Ãƒâ€šÃ‚Â¬ÃƒÆ’Ã¢â‚¬Â¦Ãƒâ€šÃ‚Â¡ÃƒÆ’Ã†â€™Ãƒâ€ Ã¢â‚¬â„¢ÃƒÆ’Ã‚Â¢ÃƒÂ¢Ã¢â‚¬Å¡Ã‚Â¬Ãƒâ€¦Ã‚Â¡ÃƒÆ’Ã†â€™ÃƒÂ¢Ã¢â€šÂ¬Ã…Â¡ÃƒÆ’Ã¢â‚¬Å¡Ãƒâ€šÃ‚Â¦ Background workers started")
 
         # Expose pool on app.state for other modules / tests that look there
@@ -1090,6 +920,11 @@ async def lifespan(app: FastAPI):
 
         yield
     finally:
+        # Close pooled HTTP clients (Graph session, validator client)
+        try:
+            await http_clients.shutdown()
+        except Exception as e:
+            logger.warning(f"[HTTP] Error closing shared clients: {e}")
         if db_pool:
             try:
                 await db_pool.close()
@@ -1207,6 +1042,48 @@ except Exception as e:
 
 # 6. Organizations router
 
+# 7. Send volume forecast router
+try:
+    from send_forecast import router as send_forecast_router
+    routers_to_register.append(("send_forecast", send_forecast_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import send_forecast router: {e}")
+
+# 8. Graph change notification router (webhook reply detection)
+try:
+    from graph_webhooks import router as graph_webhooks_router
+    routers_to_register.append(("graph_webhooks", graph_webhooks_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import graph_webhooks router: {e}")
+
+# 9. Local mail archive router (archived message summary / threads)
+try:
+    from mail_archive import router as mail_archive_router
+    routers_to_register.append(("mail_archive", mail_archive_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import mail_archive router: {e}")
+
+# 10. Sender registry router
+try:
+    from sender_registry import router as sender_registry_router
+    routers_to_register.append(("sender_registry", sender_registry_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import sender_registry router: {e}")
+
+# 11. Graph throttling metrics router
+try:
+    from graph_client import router as graph_client_router
+    routers_to_register.append(("graph_client", graph_client_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import graph_client router: {e}")
+
+# 12. Validator client status router
+try:
+    from email_validator_client import router as email_validator_client_router
+    routers_to_register.append(("email_validator_client", email_validator_client_router))
+except Exception as e:
+    logger.warning(f"[MAIN] Failed to import email_validator_client router: {e}")
+
 # Register all routers and log their routes
 for router_name, router in routers_to_register:
     try:
@@ -1268,6 +1145,7 @@ async def _process_upload_job(job_id: str, file_bytes: bytes, filename: str, use
         # call existing upload-excel logic by invoking function internals
         # For simplicity, re-implement lightweight per-row validation+save here
         results = []
+        inserted_contact_ids = []
         
         # Get database pool properly
         pool = get_db_pool()
@@ -1301,15 +1179,19 @@ async def _process_upload_job(job_id: str, file_bytes: bytes, filename: str, use
                     emails_list = process_emails(str(raw_email), validate=True)
                     if emails_list:
                         primary_email = emails_list[0].lower()
-                        if primary_email not in validation_cache:
+                        if primary_email not in emails_to_validate:
                             emails_to_validate.append(primary_email)
             
-            # Validate all unique emails in parallel (leverages semaphore)
+            # Validate all unique emails grouped by domain (leverages semaphore);
+            # cached addresses and domains decided locally skip the validator
             if emails_to_validate:
-                validation_tasks = [call_validator(email) for email in emails_to_validate]
-                validation_results = await asyncio.gather(*validation_tasks, return_exceptions=True)
-                for email, result in zip(emails_to_validate, validation_results):
-                    if isinstance(result, Exception):
+                validation_results = await validate_addresses(pool, emails_to_validate, email_validator.validate)
+                for email in emails_to_validate:
+                    result = validation_results.get(email, RuntimeError('Not validated'))
+                    if isinstance(result, ValidationDeferred):
+                        # Stored as the placeholder; the revalidation worker fills it in
+                        validation_cache[email] = {'code': 0, 'reason': str(result), 'validation_result': None, 'valid': False, 'raw': None}
+                    elif isinstance(result, Exception):
                         validation_cache[email] = {'code': 0, 'reason': f"Validation error: {str(result)}", 'validation_result': None, 'valid': False, 'raw': None}
                     else:
                         validation_cache[email] = result
@@ -1393,7 +1275,9 @@ async def _process_upload_job(job_id: str, file_bytes: bytes, filename: str, use
                         placeholders = ', '.join([f'${i+1}' for i in range(len(dynamic_values))])
                         fields_str = ', '.join(dynamic_fields)
                         insert_sql = f"INSERT INTO campaign_contacts ({fields_str}) VALUES ({placeholders}) RETURNING id"
-                        await conn.fetchrow(insert_sql, *dynamic_values)
+                        inserted_row = await conn.fetchrow(insert_sql, *dynamic_values)
+                        if inserted_row:
+                            inserted_contact_ids.append(inserted_row['id'])
 
                         result_row = {'row': idx+2, 'name': row.get('name'), 'email': primary_email, 'status': 'added', 'validation_result': validation_result_text, 'validator_code': validator_info.get('code'), 'matches': json.dumps(matches_list) if matches_list else None}
                         results.append(result_row)
@@ -1418,6 +1302,9 @@ async def _process_upload_job(job_id: str, file_bytes: bytes, filename: str, use
             async with pool.acquire() as conn:
                 await conn.execute("UPDATE upload_jobs SET status=$1, finished_at=$2, processed_rows=$3 WHERE id=$4",
                                    'finished', datetime.now().strftime('%Y-%m-%d %H:%M:%S'), processed, job_id)
+                # Materialize render contexts for the imported contacts in one batch
+                if inserted_contact_ids:
+                    await refresh_render_contexts(conn, inserted_contact_ids)
             logger.info(f"[UPLOAD] Job {job_id} completed. {processed} rows processed. Excel generation skipped.")
         except Exception as e:
             logger.error(f"Error updating job status for {job_id}: {e}")
@@ -1492,7 +1379,7 @@ async def get_sender_capacities():
         print("[DEBUG] Fetching sender capacities (Public Access)...")
         
         async with db_pool.acquire() as conn:
-            CAPACITY_PER_SENDER = 50
+            senders = assignable_senders()
             
             # 1. Query: Sum of ONLY expected_contact_count
             rows = await conn.fetch(
@@ -1504,29 +1391,30 @@ async def get_sender_capacities():
                 WHERE sender_email = ANY($1::text[])
                 GROUP BY sender_email
                 """,
-                ALLOWED_SENDERS
+                senders
             )
             
             # 2. Map DB results
             current_loads = {row['sender_email']: row['total_load'] for row in rows}
             
             # 3. Ensure all senders exist
-            for sender in ALLOWED_SENDERS:
+            for sender in senders:
                 if sender not in current_loads:
                     current_loads[sender] = 0
             
             # 4. Calculate Active Batch
-            sender_tiers = {email: load // CAPACITY_PER_SENDER for email, load in current_loads.items()}
+            sender_tiers = {email: load // sender_registry.capacity_per_event(email) for email, load in current_loads.items()}
             min_tier = min(sender_tiers.values()) if sender_tiers else 0
 
             # 5. Build response
             senders_data = []
-            for sender in ALLOWED_SENDERS:
+            for sender in senders:
                 load = current_loads[sender]
                 tier = sender_tiers[sender]
+                capacity = sender_registry.capacity_per_event(sender)
                 
-                load_in_current_batch = load % CAPACITY_PER_SENDER
-                capacity_remaining = CAPACITY_PER_SENDER - load_in_current_batch
+                load_in_current_batch = load % capacity
+                capacity_remaining = capacity - load_in_current_batch
                 is_active_turn = (tier == min_tier)
                 
                 senders_data.append({
@@ -1534,7 +1422,7 @@ async def get_sender_capacities():
                     "total_load": load,
                     "current_batch_number": tier + 1,
                     "load_in_current_batch": load_in_current_batch,
-                    "capacity_per_sender": CAPACITY_PER_SENDER,
+                    "capacity_per_sender": capacity,
                     "capacity_remaining": capacity_remaining,
                     "is_active_turn": is_active_turn,
                     "status": "Active" if is_active_turn else "Waiting"
@@ -1542,8 +1430,8 @@ async def get_sender_capacities():
             
             return {
                 "senders": senders_data,
-                "total_senders": len(ALLOWED_SENDERS),
-                "capacity_per_sender": CAPACITY_PER_SENDER,
+                "total_senders": len(senders),
+                "capacity_per_sender": DEFAULT_CAPACITY_PER_EVENT,
                 "current_active_batch": min_tier + 1
             }
     
@@ -2325,6 +2213,14 @@ async def validate_excel(file: UploadFile = File(...), current_user: dict = Depe
                     if nl and nl not in names:
                         names.append(nl)
 
+            # Validate the sheet's primary addresses grouped by domain up front;
+            # the per-row call_validator() calls below are then cache hits
+            try:
+                primaries = [p[0] for p in (process_emails(e, validate=True) for e in emails) if p]
+                await validate_addresses(pool, primaries, email_validator.validate)
+            except Exception as e:
+                logger.warning(f"[EXCEL VALIDATE] Batch pre-validation failed, validating per row: {e}")
+
             email_eq_array = emails if emails else ['']
             email_like_array = [f'%{e}%' for e in emails] if emails else ['']
             name_eq_array = names if names else ['']
@@ -4381,7 +4277,7 @@ async def delete_dynamic_column(
 async def get_sender_capacities():
     try:
         async with db_pool.acquire() as conn:
-            CAPACITY_PER_SENDER = 50
+            senders = assignable_senders()
             
             # 1. Query: Sum of ONLY expected_contact_count
             rows = await conn.fetch(
@@ -4393,29 +4289,30 @@ async def get_sender_capacities():
                 WHERE sender_email = ANY($1::text[])
                 GROUP BY sender_email
                 """,
-                ALLOWED_SENDERS
+                senders
             )
             
             # 2. Map DB results
             current_loads = {row['sender_email']: row['total_load'] for row in rows}
             
             # 3. Ensure all senders exist
-            for sender in ALLOWED_SENDERS:
+            for sender in senders:
                 if sender not in current_loads:
                     current_loads[sender] = 0
             
             # 4. Calculate Active Batch
-            sender_tiers = {email: load // CAPACITY_PER_SENDER for email, load in current_loads.items()}
+            sender_tiers = {email: load // sender_registry.capacity_per_event(email) for email, load in current_loads.items()}
             min_tier = min(sender_tiers.values()) if sender_tiers else 0
 
             # 5. Build response
             senders_data = []
-            for sender in ALLOWED_SENDERS:
+            for sender in senders:
                 load = current_loads[sender]
                 tier = sender_tiers[sender]
+                capacity = sender_registry.capacity_per_event(sender)
                 
-                load_in_current_batch = load % CAPACITY_PER_SENDER
-                capacity_remaining = CAPACITY_PER_SENDER - load_in_current_batch
+                load_in_current_batch = load % capacity
+                capacity_remaining = capacity - load_in_current_batch
                 is_active_turn = (tier == min_tier)
                 
                 senders_data.append({
@@ -4423,7 +4320,7 @@ async def get_sender_capacities():
                     "total_load": load,
                     "current_batch_number": tier + 1,
                     "load_in_current_batch": load_in_current_batch,
-                    "capacity_per_sender": CAPACITY_PER_SENDER,
+                    "capacity_per_sender": capacity,
                     "capacity_remaining": capacity_remaining,
                     "is_active_turn": is_active_turn,
                     "status": "Active" if is_active_turn else "Waiting"
@@ -4431,8 +4328,8 @@ async def get_sender_capacities():
             
             return {
                 "senders": senders_data,
-                "total_senders": len(ALLOWED_SENDERS),
-                "capacity_per_sender": CAPACITY_PER_SENDER,
+                "total_senders": len(senders),
+                "capacity_per_sender": DEFAULT_CAPACITY_PER_EVENT,
                 "current_active_batch": min_tier + 1
             }
     
@@ -5404,6 +5301,48 @@ async def prepare_email_body(conn, contact_id: int, new_body: str) -> str:
     
     return await build_outgoing_body(contact_dict, new_body)
 
+async def snapshot_queue_messages(conn, messages: List[dict]) -> List[dict]:
+    """
+    Attach the final send payload (subject, quoted plain-text body, To, CC)
+    and its hash to queue message dicts before they are inserted.
+    History for all contacts in the batch is loaded with one query.
+    """
+    histories = await fetch_history(conn, [m.get('contact_id') for m in messages])
+    rendered_at = datetime.now(UTC).replace(tzinfo=None)
+    for msg in messages:
+        try:
+            history = histories.get(msg.get('contact_id'))
+            subject = clean_subject(msg.get('subject'), history.get('event_name') if history else None)
+            message_body = to_plain_text(msg.get('message') or msg.get('body') or '')
+            message_body = append_quoted_history(message_body, history, msg.get('sender_email'))
+
+            recipient = (msg.get('recipient_email') or '').strip()
+            contact_email_field = history['email'] if history and history.get('email') else recipient
+            cc_raw = msg.get('cc_recipients')
+            cc_emails = [e.strip() for e in re.split(r'[;,\s]+', cc_raw) if e.strip()] if cc_raw else None
+            parsed = process_emails(contact_email_field or recipient, validate=True)
+            if cc_emails:
+                main_recipient = parsed[0] if parsed else recipient
+            else:
+                # Legacy behavior - additional addresses embedded in the contact email field
+                main_recipient = parsed[0] if parsed else recipient
+                cc_emails = parsed[1:] if len(parsed) > 1 else None
+            if not main_recipient:
+                continue
+
+            payload = build_payload(subject, message_body, main_recipient, cc_emails)
+            msg['payload'] = json.dumps(payload)
+            msg['payload_hash'] = payload_hash(payload)
+            msg['payload_rendered_at'] = rendered_at
+        except Exception as e:
+            # The send worker assembles rows without a snapshot itself
+            logger.warning(f"[SNAPSHOT] Could not snapshot message for contact {msg.get('contact_id')}: {e}")
+    return messages
+
+async def enqueue_with_snapshot(conn, messages: List[dict]) -> List[dict]:
+    """Snapshot and insert queue messages (see email_enqueue.enqueue_messages)."""
+    return await enqueue_messages(conn, await snapshot_queue_messages(conn, messages))
+
 async def send_email_worker():
     """Background worker that processes the email queue and sends emails."""
     SAFE_TIMEOUT = 300  # 5 minutes max for pending messages
@@ -5554,8 +5493,11 @@ async def send_email_worker():
                     #  2 = forms (initial + all form reminders)
                     #  3 = first message and its reminders (campaign_main, reminder1, reminder2)
                     #  4 = everything else
+                    # Only the columns needed to order and dispatch the batch; the full
+                    # row (message body, attachment bytes) is loaded per email under
+                    # its row lock below, so at most one attachment is held at a time.
                     rows = await fetch_conn.fetch("""
-                        SELECT * FROM email_queue
+                        SELECT id, contact_id, last_message_type FROM email_queue
                         WHERE status = 'pending'
                         AND (scheduled_at IS NULL OR scheduled_at <= NOW())
                         ORDER BY
@@ -5727,8 +5669,12 @@ async def send_email_worker():
                         except Exception as e:
                             logger.error(f"[ATTACHMENT NORMALIZE] Unexpected error while normalizing attachment for queue_id={queue_id}: {e}")
 
+                        # Rows queued with a pre-rendered snapshot carry the final
+                        # subject/body/recipients; use them as-is.
+                        payload = read_payload(email_data)
+
                         # ALWAYS ensure non-empty subject
-                        subject = email_data['subject']
+                        subject = payload['subject'] if payload else email_data['subject']
                         if not subject or not subject.strip():
                             # Only fallback if truly empty
                             event = await conn.fetchrow(
@@ -5760,7 +5706,7 @@ async def send_email_worker():
 
                         # Get event name separately if needed
                         event_name = None
-                        if contact and contact['event_id']:
+                        if not payload and contact and contact['event_id']:
                             event_row = await conn.fetchrow(
                                 'SELECT event_name FROM event WHERE id = $1',
                                 contact['event_id']
@@ -6078,24 +6024,16 @@ async def send_email_worker():
                                 # Skip all conversation history and quoted block generation
                                 logger.debug(f"[INDIVIDUAL] Sending individual email with no conversation history")
 
-                                # Format message with proper line breaks - INDIVIDUAL EMAIL (NO QUOTES)
-                                # Convert HTML or text into normalized plain-text suitable for email
-                                message_body = to_plain_text(message)
-                                # Force plain text content type
-                                content_type = "Text"
-
-                                # Send the email WITHOUT threading - individual email with unique subject
-                                # IMPORTANT: Do NOT use the `cc_store` column for sending. cc_store is persistent
-                                # storage only. When composing recipients, derive them from the contact's
-                                # `email` field (legacy comma-separated behavior) or from the queued
-                                # recipient value. This ensures cc_store is never used in campaign sends.
                                 # Fetch contact including any stored attachment metadata so we can
                                 # fallback to a contact-level attachment if the queued row lacks one.
-                                contact_row = await conn.fetchrow(
-                                    'SELECT email, event_id, attachment, attachment_filename, attachment_mimetype FROM campaign_contacts WHERE id = $1',
-                                    contact_id
-                                )
-                                contact_email_field = contact_row['email'] if contact_row and contact_row.get('email') else recipient
+                                # Snapshots carry no attachments, so this applies to both send paths;
+                                # snapshot sends only need the lookup when the queued row has none.
+                                contact_row = None
+                                if not payload or not email_data.get('attachment'):
+                                    contact_row = await conn.fetchrow(
+                                        'SELECT email, event_id, attachment, attachment_filename, attachment_mimetype FROM campaign_contacts WHERE id = $1',
+                                        contact_id
+                                    )
 
                                 # If the queued email has no attachment but the contact has one,
                                 # attach it now to avoid missing files due to race conditions
@@ -6116,42 +6054,63 @@ async def send_email_worker():
                                 except Exception as e:
                                     logger.error(f"[ATTACHMENT FALLBACK] Error while applying contact-level attachment for queue_id={queue_id}: {e}")
 
-                                # Prefer cc_recipients stored on the queued row (this may be populated from cc_store at queue time)
-                                cc_raw = email_data.get('cc_recipients') if email_data and email_data.get('cc_recipients') else None
-                                cc_emails = None
-                                if cc_raw:
-                                    # cc_recipients stored as semicolon-separated string - normalize to list
-                                    cc_emails = [e.strip() for e in re.split(r'[;,\s]+', cc_raw) if e.strip()]
-
-                                # Fallback: legacy behavior - parse additional addresses embedded in the contact email field
-                                if not cc_emails:
-                                    contact_emails = process_emails(contact_email_field or recipient, validate=True)
-                                    if contact_emails:
-                                        main_recipient = contact_emails[0]
-                                        cc_emails = contact_emails[1:] if len(contact_emails) > 1 else None
-                                    else:
-                                        main_recipient = recipient
-                                        cc_emails = None
+                                if payload:
+                                    # Pre-rendered snapshot: no rendering or history lookups
+                                    message_body = payload['body']
+                                    content_type = payload.get('content_type') or "Text"
+                                    main_recipient = payload['to']
+                                    cc_emails = payload.get('cc') or None
+                                    logger.debug(f"[SNAPSHOT] Sending queue_id={queue_id} from snapshot hash={email_data.get('payload_hash')}")
                                 else:
-                                    # If cc_recipients was present, ensure main_recipient comes from the queued recipient (parsed)
-                                    parsed_main = process_emails(contact_email_field or recipient, validate=True)
-                                    main_recipient = parsed_main[0] if parsed_main else recipient
-
-                                # Debug: log resolved recipient and CCs to help diagnose missing CC issues
-                                logger.debug(f"[SEND DEBUG] queue_id={queue_id}, sender={sender}, recipient_raw={recipient_raw}, contact_email_field={contact_email_field}, main_recipient={main_recipient}, cc_emails={cc_emails}")
-
-                                # Send using the resolved main_recipient and cc_emails (from queue or legacy parsing)
-                                # Prepare message with history
-                                queue_item = {
-                                    'contact_id': contact_id,
-                                    'sender_email': sender,
-                                    'message': message_body,
-                                    'campaign_stage': message_type,
-                                    'type': message_type
-                                }
-                                prepared_message = await prepare_message_for_sending(conn, queue_item)
-                                # Use the prepared message body for sending
-                                message_body = prepared_message
+                                    # Format message with proper line breaks - INDIVIDUAL EMAIL (NO QUOTES)
+                                    # Convert HTML or text into normalized plain-text suitable for email
+                                    message_body = to_plain_text(message)
+                                    # Force plain text content type
+                                    content_type = "Text"
+
+                                    # Send the email WITHOUT threading - individual email with unique subject
+                                    # IMPORTANT: Do NOT use the `cc_store` column for sending. cc_store is persistent
+                                    # storage only. When composing recipients, derive them from the contact's
+                                    # `email` field (legacy comma-separated behavior) or from the queued
+                                    # recipient value. This ensures cc_store is never used in campaign sends.
+                                    contact_email_field = contact_row['email'] if contact_row and contact_row.get('email') else recipient
+
+                                    # Prefer cc_recipients stored on the queued row (this may be populated from cc_store at queue time)
+                                    cc_raw = email_data.get('cc_recipients') if email_data and email_data.get('cc_recipients') else None
+                                    cc_emails = None
+                                    if cc_raw:
+                                        # cc_recipients stored as semicolon-separated string - normalize to list
+                                        cc_emails = [e.strip() for e in re.split(r'[;,\s]+', cc_raw) if e.strip()]
+
+                                    # Fallback: legacy behavior - parse additional addresses embedded in the contact email field
+                                    if not cc_emails:
+                                        contact_emails = process_emails(contact_email_field or recipient, validate=True)
+                                        if contact_emails:
+                                            main_recipient = contact_emails[0]
+                                            cc_emails = contact_emails[1:] if len(contact_emails) > 1 else None
+                                        else:
+                                            main_recipient = recipient
+                                            cc_emails = None
+                                    else:
+                                        # If cc_recipients was present, ensure main_recipient comes from the queued recipient (parsed)
+                                        parsed_main = process_emails(contact_email_field or recipient, validate=True)
+                                        main_recipient = parsed_main[0] if parsed_main else recipient
+
+                                    # Debug: log resolved recipient and CCs to help diagnose missing CC issues
+                                    logger.debug(f"[SEND DEBUG] queue_id={queue_id}, sender={sender}, recipient_raw={recipient_raw}, contact_email_field={contact_email_field}, main_recipient={main_recipient}, cc_emails={cc_emails}")
+
+                                    # Send using the resolved main_recipient and cc_emails (from queue or legacy parsing)
+                                    # Prepare message with history
+                                    queue_item = {
+                                        'contact_id': contact_id,
+                                        'sender_email': sender,
+                                        'message': message_body,
+                                        'campaign_stage': message_type,
+                                        'type': message_type
+                                    }
+                                    prepared_message = await prepare_message_for_sending(conn, queue_item)
+                                    # Use the prepared message body for sending
+                                    message_body = prepared_message
 
                                 # Send email
                                 # Debug: log attachment presence before sending
@@ -7463,28 +7422,8 @@ async def send_campaign_message(conn, contact, action_type, template_type, templ
         logger.error(f"[VALIDATION] Missing required fields {missing_fields} for contact {contact_id}")
         return False
 
-    # 2. Check for duplicate message with stronger consistency and broader message type matching
-    duplicate = await conn.fetchrow("""
-        SELECT id, status
-        FROM email_queue
-        WHERE contact_id = $1
-        AND last_message_type = $2  
-        AND status IN ('pending', 'sent')
-        ORDER BY created_at DESC
-        LIMIT 1
-        FOR UPDATE OF email_queue SKIP LOCKED
-    """, contact_id, action_type)
-
-    if duplicate:
-        logger.warning(f"[DUPLICATE] Skipping {action_type} for contact {contact_id} - found existing {action_type} with status: {duplicate['status']}")
-        if duplicate['status'] == 'pending':
-            await conn.execute(
-                "UPDATE email_queue SET status = 'skipped', "
-                "error_message = 'Duplicate message detected' "
-                "WHERE id = $1",
-                duplicate['id']
-            )
-        return False
+    # 2. Duplicate suppression is enforced by the unique (contact_id, last_message_type)
+    # index on email_queue; the insert below reports a duplicate as no row inserted.
 
     # 3. Get threading information from the first message in the conversation
     thread_info = await conn.fetchrow('''
@@ -7547,74 +7486,10 @@ async def send_campaign_message(conn, contact, action_type, template_type, templ
         except Exception:
             pass
 
-        # Add name parts for templates with prefix awareness
-        # Path A: If prefix exists (Mr., Dr.) -> returns ("Mr.", "Ayman")
-        #         Template: "Dear {{prefix}} {{last_name}}" → "Dear Prof. Ayman"
-        # Path B: If no prefix -> returns ("Hatem", "Ayman")
-        #         Template: "Dear {{greeting_name}}" → "Dear Hatem Ayman"
-        raw_name = contact.get('name', '').strip()
-        # CRITICAL: Capture the DB prefix safely
-        db_prefix = contact.get('prefix', '').strip() if contact.get('prefix') else ""
-
-        # 2. Initialize defaults
-        final_prefix = ""
-        final_last_name = raw_name
-
-        # 3. Decision Logic
-        if db_prefix:
-            # --- CASE A: Database Prefix Exists (e.g. "Dr", "Prof") ---
-            # Use the DB prefix, and split the name to get the valid Last Name
-            final_prefix = db_prefix
-            
-            # Fix Punctuation (Add dot if missing, skip "Sir")
-            if len(final_prefix) <= 3 and not final_prefix.endswith('.') and final_prefix.lower() not in ["sir", "madam"]:
-                    final_prefix += "."
-
-            # Extract "Low" from "test3, low" or "Kim" from "Test4 Kim"
-            if ',' in raw_name:
-                final_last_name = raw_name.split(',')[-1].strip()
-            else:
-                parts = raw_name.split()
-                final_last_name = parts[-1].strip() if parts else raw_name
-        else:
-            # --- CASE B: No Database Prefix ---
-            # Auto-extract everything from the name string
-            try:
-                final_prefix, final_last_name = extract_name_parts_with_prefix(raw_name)
-            except Exception as e:
-                logger.error(f"Extraction error for contact {contact_id}: {e}")
-                final_prefix = ""
-                final_last_name = raw_name
-
-        # 4. Capitalize and Format
-        final_prefix = final_prefix.title() if final_prefix else ""
-        final_last_name = final_last_name.title()
-
-        # 5. Construct Greeting Name
-        if final_prefix:
-            # Result: "Prof. Kim"
-            greeting_name = f"{final_prefix} {final_last_name}"
-        else:
-            # Result: "Hatem Ayman"
-            greeting_name = final_last_name
-
-        # 6. Update Context (Overwrite with corrected values)
-        context['prefix'] = final_prefix
-        context['last_name'] = final_last_name
-        context['greeting_name'] = greeting_name
-        
-        # For templates that use {{name}}, set it to greeting_name
-        context['name'] = greeting_name 
-        
-        # For legacy support
-        context['first_name'] = final_prefix if final_prefix else (final_last_name.split()[0] if ' ' in final_last_name else final_last_name)
-
-        # Log the name extraction for debugging
-        logger.info(f"[NAME EXTRACTION] Contact {contact_id}: raw_name='{raw_name}' -> prefix='{final_prefix}', last_name='{final_last_name}', greeting_name='{greeting_name}'")
-        logger.debug(f"[CONTEXT VALUES] greeting_name='{context.get('greeting_name')}', last_name='{context.get('last_name')}', first_name='{context.get('first_name')}'")
-
-        # Log the name extraction for debugging
-        logger.info(f"[NAME EXTRACTION] Contact {contact_id}: raw_name='{contact.get('name')}' -> prefix='{prefix}', last_name='{last_name}', greeting_name='{context['greeting_name']}'")
+        # Add name parts and link aliases from the stored render context
+        # (prefix, last_name, greeting_name, first_name, name, links)
+        render_contexts = await load_render_contexts(conn, [contact])
+        context.update(render_contexts.get(contact_id) or {})
         logger.debug(f"[CONTEXT VALUES] greeting_name='{context.get('greeting_name')}', last_name='{context.get('last_name')}', first_name='{context.get('first_name')}'")
 
         # Render templates with strict validation
@@ -7764,26 +7639,33 @@ async def send_campaign_message(conn, contact, action_type, template_type, templ
                 logger.warning(f"[BUSINESS_HOURS] Error calculating business hours for contact {contact_id}: {e}. Using due_time as fallback.")
                 scheduled_at = due_time
 
-            queue_result = await conn.fetchval("""
-                INSERT INTO email_queue (
-                    contact_id, sender_email, recipient_email, cc_recipients, subject, message,
-                    last_message_type, status, created_at, due_at, scheduled_at, type,
-                    conversation_id, in_reply_to,
-                    forms_link, payment_link, message_type, attachment, attachment_filename, attachment_mimetype
-                ) VALUES ($1, $2, $3, $4, $5, $6, $7, 'pending', $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
-                RETURNING id
-            """,
-                contact_id, sender_email, recipient_email, cc_recipients, subject, body,
-                action_type, now, due_time, scheduled_at, action_type, conversation_id, in_reply_to,
-                contact.get('forms_link'), contact.get('payment_link'), action_type,
-                # Attach only for payments or payment reminders
-                (contact.get('attachment') if ((template_type == 'payments') or (template_stage and template_stage.startswith('reminder') and template_type == 'payments') or (action_type and action_type.startswith('reminder') and template_type == 'payments')) else None),
-                (contact.get('attachment_filename') if ((template_type == 'payments') or (template_stage and template_stage.startswith('reminder') and template_type == 'payments') or (action_type and action_type.startswith('reminder') and template_type == 'payments')) else None),
-                (contact.get('attachment_mimetype') if ((template_type == 'payments') or (template_stage and template_stage.startswith('reminder') and template_type == 'payments') or (action_type and action_type.startswith('reminder') and template_type == 'payments')) else None)
-            )
-
-            if not queue_result:
-                raise Exception("Failed to insert into email_queue")
+            # Attach only for payments or payment reminders
+            include_attachment = ((template_type == 'payments') or (template_stage and template_stage.startswith('reminder') and template_type == 'payments') or (action_type and action_type.startswith('reminder') and template_type == 'payments'))
+            inserted = await enqueue_with_snapshot(conn, [{
+                'contact_id': contact_id,
+                'sender_email': sender_email,
+                'recipient_email': recipient_email,
+                'cc_recipients': cc_recipients,
+                'subject': subject,
+                'message': body,
+                'last_message_type': action_type,
+                'created_at': now,
+                'due_at': due_time,
+                'scheduled_at': scheduled_at,
+                'type': action_type,
+                'conversation_id': conversation_id,
+                'in_reply_to': in_reply_to,
+                'forms_link': contact.get('forms_link'),
+                'payment_link': contact.get('payment_link'),
+                'message_type': action_type,
+                'attachment': contact.get('attachment') if include_attachment else None,
+                'attachment_filename': contact.get('attachment_filename') if include_attachment else None,
+                'attachment_mimetype': contact.get('attachment_mimetype') if include_attachment else None,
+            }])
+
+            if not inserted:
+                logger.warning(f"[DUPLICATE] Skipping {action_type} for contact {contact_id} - already pending or sent")
+                return False
 
             # Update contact status and tracking with only existing columns
             update_result = await conn.execute("""
@@ -8024,65 +7906,11 @@ async def process_single_contact_campaign(contact_id: int):
                     except Exception:
                         pass
 
-                    # Extract name parts with prefix awareness (CRITICAL for proper greeting)
-                    # Path A: With prefix -> ("Prof.", "Ayman")
-                    # Path B: Without prefix -> ("Hatem", "Ayman")
-                    raw_name = contact.get('name', '').strip()
-                    # CRITICAL: Capture the DB prefix safely
-                    db_prefix = contact.get('prefix', '').strip() if contact.get('prefix') else ""
-
-                    # 2. Initialize defaults
-                    final_prefix = ""
-                    final_last_name = raw_name
-
-                    # 3. Decision Logic
-                    if db_prefix:
-                        # --- CASE A: Database Prefix Exists (e.g. "Dr") ---
-                        # We use the DB prefix, and split the name to get the Last Name
-                        final_prefix = db_prefix
-                        
-                        # Fix Punctuation (Add dot if missing, skip "Sir")
-                        if len(final_prefix) <= 3 and not final_prefix.endswith('.') and final_prefix.lower() not in ["sir", "madam"]:
-                             final_prefix += "."
-
-                        # Extract "Low" from "test3, low"
-                        if ',' in raw_name:
-                            final_last_name = raw_name.split(',')[-1].strip()
-                        else:
-                            parts = raw_name.split()
-                            final_last_name = parts[-1].strip() if parts else raw_name
-                    else:
-                        # --- CASE B: No Database Prefix ---
-                        # Auto-extract everything from the name string
-                        try:
-                            final_prefix, final_last_name = extract_name_parts_with_prefix(raw_name)
-                        except Exception as e:
-                            logger.error(f"Extraction error: {e}")
-                            final_prefix = ""
-                            final_last_name = raw_name
-
-                    # 4. Capitalize and Format
-                    final_prefix = final_prefix.title() if final_prefix else ""
-                    final_last_name = final_last_name.title()
-
-                    # 5. Construct Greeting Name (e.g. "Dr. Low")
-                    if final_prefix:
-                        greeting_name = f"{final_prefix} {final_last_name}"
-                    else:
-                        greeting_name = final_last_name
-
-                    # 6. Update Context (Overwrite with corrected values)
-                    context['prefix'] = final_prefix
-                    context['last_name'] = final_last_name
-                    context['greeting_name'] = greeting_name
-                    
-                    # Ensure 'name' matches greeting_name for templates using {{name}}
-                    context['name'] = greeting_name 
-                    
-                    # Legacy support
-                    context['first_name'] = final_prefix if final_prefix else (final_last_name.split()[0] if ' ' in final_last_name else final_last_name)
-
-                    logger.info(f"[SINGLE CONTACT] Name extraction: raw='{raw_name}' -> prefix='{final_prefix}', last_name='{final_last_name}', greeting_name='{greeting_name}'")
+                    # Name parts (prefix awareness) and link aliases come from the
+                    # stored render context; only missing contexts are computed.
+                    render_contexts = await load_render_contexts(conn, [contact])
+                    context.update(render_contexts.get(contact_id) or {})
+                    logger.debug(f"[SINGLE CONTACT] Render context: prefix='{context.get('prefix')}', last_name='{context.get('last_name')}', greeting_name='{context.get('greeting_name')}'")
 
                     # Log the full context for debugging
                     logger.info(f"[SINGLE CONTACT] Raw contact data: {contact}")
@@ -8140,16 +7968,6 @@ async def process_single_contact_campaign(contact_id: int):
                         ''', f'Template rendering failed: {str(ve)}', contact_id)
                         return  # Don't raise, just return to prevent cascade
 
-                    # Check for duplicatess
-                    existing = await conn.fetchval('''
-                        SELECT 1 FROM email_queue
-                        WHERE contact_id = $1 AND last_message_type = $2 AND status = 'pending'
-                    ''', contact_id, next_type)
-
-                    if existing:
-                        logger.warning(f"[SINGLE CONTACT] Duplicate prevention: Skipping {next_type} for contact_id={contact_id} (already queued)")
-                        return
-
                     # Queue the email (include CCs from cc_store or legacy email extras)
                     logger.info(f"[SINGLE CONTACT] Queuing email: {next_type} for contact {contact_id}")
                     cc_recipients = None
@@ -8182,11 +8000,25 @@ async def process_single_contact_campaign(contact_id: int):
                     if queue_type == 'payment_main':
                         queue_type = 'payments_initial'
 
-                    await conn.execute('''
-                          INSERT INTO email_queue (
-                                 contact_id, sender_email, recipient_email, cc_recipients, subject, message, last_message_type, status, created_at, due_at, type, attachment, attachment_filename, attachment_mimetype
-                                     ) VALUES ($1, $2, $3, $4, $5, $6, $7, 'pending', $8, $9, $10, $11, $12, $13)
-                        ''', contact_id, sender_email, contact['email'], cc_recipients, subject, body, queue_type, now, now, queue_type, attach_bytes, attach_filename, attach_mimetype)
+                    # Duplicate prevention is enforced by the email_queue unique index
+                    inserted = await enqueue_with_snapshot(conn, [{
+                        'contact_id': contact_id,
+                        'sender_email': sender_email,
+                        'recipient_email': contact['email'],
+                        'cc_recipients': cc_recipients,
+                        'subject': subject,
+                        'message': body,
+                        'last_message_type': queue_type,
+                        'created_at': now,
+                        'due_at': now,
+                        'type': queue_type,
+                        'attachment': attach_bytes,
+                        'attachment_filename': attach_filename,
+                        'attachment_mimetype': attach_mimetype,
+                    }])
+                    if not inserted:
+                        logger.warning(f"[SINGLE CONTACT] Duplicate prevention: Skipping {queue_type} for contact_id={contact_id} (already queued)")
+                        return
 
                     # Update contact trigger info and canonicalize stored tokens
                     contact_token = queue_type
@@ -8213,16 +8045,238 @@ async def process_single_contact_campaign(contact_id: int):
 
 # In main.py, replace the entire reply_checker_worker function with this one.
 
+async def load_reply_check_context(conn, sender_email: Optional[str] = None):
+    """
+    Lookup data for reply matching: active contacts grouped by the sender
+    mailbox of their event, plus last sent threading info per contact and
+    per address. Pass sender_email to load a single mailbox only.
+
+    Returns (contacts_by_sender, last_sent_lookup, last_sent_by_email).
+    """
+    from collections import defaultdict
+
+    # 1. Get all active contacts that are expecting replies.
+    if sender_email:
+        active_contacts = await conn.fetch('''
+            SELECT c.id, c.email, c.status, c.stage, c.event_id
+            FROM campaign_contacts c
+            JOIN event e ON e.id = c.event_id
+            WHERE c.campaign_paused = FALSE AND c.status NOT IN ('completed', 'cancelled', 'Replied')
+              AND LOWER(e.sender_email) = $1
+        ''', sender_email.lower())
+    else:
+        active_contacts = await conn.fetch('''
+            SELECT id, email, status, stage, event_id
+            FROM campaign_contacts
+            WHERE campaign_paused = FALSE AND status NOT IN ('completed', 'cancelled', 'Replied')
+        ''')
+
+    if not active_contacts:
+        return {}, {}, {}
+
+    contact_ids = [c['id'] for c in active_contacts]
+    contacts_by_id = {c['id']: dict(c) for c in active_contacts}
+
+    # 2. NEW: Create a lookup dictionary with the correct threading info for each contact.
+    # Primary source: last sent entry from email_queue (one row per contact_id).
+    # Fallback source: messages table (checks recipient_email and cc_recipients) so
+    # contacts who were only CC'd are also tracked for reply detection.
+    last_sent_lookup = {}
+    if contact_ids:
+        last_sent_emails = await conn.fetch('''
+            WITH ranked_emails AS (
+                SELECT
+                    contact_id, subject, sent_at, message_id, conversation_id,
+                    ROW_NUMBER() OVER(PARTITION BY contact_id ORDER BY sent_at DESC) as rn
+                FROM email_queue
+                WHERE status = 'sent' AND contact_id = ANY($1::int[]) AND message_id IS NOT NULL
+            )
+            SELECT contact_id, subject, sent_at, message_id, conversation_id
+            FROM ranked_emails
+            WHERE rn = 1
+        ''', contact_ids)
+
+        for row in last_sent_emails:
+            last_sent_lookup[row['contact_id']] = dict(row)
+
+    # Fallback mapping from normalized recipient email -> last sent message info.
+    # This lets us detect replies when the contact was included as CC (stored in
+    # cc_recipients); last_sent_by_address is kept current by a trigger on messages.
+    contact_emails = [normalize_email(c['email']) for c in active_contacts if c.get('email')]
+    last_sent_by_email = await fetch_last_sent_by_address(conn, contact_emails)
+
+    # 3. Group contacts by the sender email account we need to check.
+    event_ids = [c['event_id'] for c in active_contacts]
+    sender_map_rows = await conn.fetch('SELECT id, sender_email FROM event WHERE id = ANY($1::int[])', event_ids)
+    sender_map = {row['id']: row['sender_email'] for row in sender_map_rows}
+
+    contacts_by_sender = defaultdict(list)
+    for contact_id in contact_ids:
+        contact = contacts_by_id[contact_id]
+        event_id = contact['event_id']
+        contact_sender = sender_map.get(event_id)
+        if contact_sender:
+            contacts_by_sender[contact_sender.lower()].append(contact)
+
+    return contacts_by_sender, last_sent_lookup, last_sent_by_email
+
+async def process_inbox_messages(conn, sender_email: str, inbox_messages: List[dict], contacts_to_check: List[dict],
+                                 last_sent_lookup: dict, last_sent_by_email: dict) -> int:
+    """
+    Match inbox messages of one sender mailbox against its active contacts,
+    handle bounces and record replies. Returns the number of replies recorded.
+    Used by the polling reply checker and the Graph notification worker.
+    """
+    from dateutil.parser import parse as parse_dt
+
+    replies_recorded = 0
+
+    # Skip messages we have already processed (one indexed lookup for the batch)
+    unseen_ids = set(await filter_unseen_message_ids(conn, [m.get('id') for m in inbox_messages]))
+    new_messages = [m for m in inbox_messages if m.get('id') in unseen_ids]
+    if len(new_messages) < len(inbox_messages):
+        logger.debug(f"[REPLY CHECKER] {len(inbox_messages) - len(new_messages)} already processed message(s) skipped for {sender_email}")
+
+    # Mirror the batch into the local mail archive before matching
+    try:
+        await archive_messages(conn, sender_email, 'inbox', inbox_messages)
+    except Exception as e:
+        logger.warning(f"[MAIL ARCHIVE] Could not archive inbox batch of {sender_email}: {e}")
+
+    matcher = await ReplyMatcher.build(conn, contacts_to_check, last_sent_lookup, last_sent_by_email)
+    await matcher.prefetch_message_map(conn, new_messages)
+    try:
+        matcher.add_reply_recipients(
+            await resolve_reply_recipients(conn, [m.get('inReplyTo') for m in new_messages])
+        )
+    except Exception as e:
+        logger.warning(f"[MAIL ARCHIVE] Could not resolve archived reply recipients: {e}")
+    logger.debug(f"[REPLY CHECKER] Matcher for {sender_email}: {matcher.stats()}")
+
+    # Resolve candidate contacts through the matcher indexes (no per-pair queries)
+    matched = [(msg, matcher.match(msg)) for msg in new_messages]
+    matched = [(msg, candidates) for msg, candidates in matched if candidates]
+
+    # Listing carries only light fields; load the bodies of matched messages
+    # only, in one go so the reads share Graph $batch calls
+    try:
+        await asyncio.to_thread(graph_email.load_message_bodies, sender_email, [msg for msg, _ in matched])
+    except Exception as e:
+        logger.warning(f"[REPLY CHECKER] Could not load message bodies for {sender_email}, using previews: {e}")
+
+    for msg, candidates in matched:
+        graph_message_id = msg.get('id')
+
+        # Bounces are classified once per message, not per candidate contact
+        sender_address_raw = ((msg.get('from') or {}).get('emailAddress') or {}).get('address', '') or ''
+        bounce = classify_bounce(msg.get('subject', ''), msg.get('processed_body', ''), sender_address_raw,
+                                 exclude=[sender_email])
+        if bounce.is_bounce:
+            logger.info(f"[BOUNCE DETECTED IN INBOX] Message {graph_message_id} looks like a bounce; handling.")
+            try:
+                await handle_bounce_email(conn, msg.get('subject', ''), msg.get('processed_body', ''),
+                                          sender_address_raw, bounce=bounce)
+            except Exception as e:
+                logger.error(f"[BOUNCE] Error handling bounce from inbox message {graph_message_id}: {e}")
+            # Skip treating this message as a contact reply
+            continue
+
+        for contact in candidates:
+            last_sent_info = matcher.last_sent.get(contact['id']) or {}
+            logger.debug(f"[REPLY CHECKER] Candidate match: msg_id={graph_message_id} contact={contact['id']} inReplyTo={msg.get('inReplyTo')} conv={msg.get('conversationId')} sender={msg.get('from')} to={[(r.get('emailAddress',{}).get('address')) for r in (msg.get('toRecipients') or [])]} cc={[(r.get('emailAddress',{}).get('address')) for r in (msg.get('ccRecipients') or [])]} subject='{msg.get('subject','')}' last_msg_id='{last_sent_info.get('message_id')}' last_subj='{last_sent_info.get('subject')}'")
+            # Final verification: Did the reply come from the correct person OR include contact as recipient?
+            sender_of_reply = normalize_email(sender_address_raw)
+            
+            # Parse contact email field (may contain comma-separated multiple emails)
+            contact_email_raw = (contact.get('email') or '')
+            contact_emails = [normalize_email(e.strip()) for e in contact_email_raw.split(',') if e.strip()]
+            
+            # Check if contact is in To or CC recipients (for CC'd reply detection)
+            to_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('toRecipients') or [])]
+            cc_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('ccRecipients') or [])]
+            all_recipients = set([r for r in to_list + cc_list if r])
+            
+            # Check if sender is any of the contact emails OR contact is in recipients
+            is_direct_sender = sender_of_reply in contact_emails
+            is_cc_recipient = any(email in all_recipients for email in contact_emails)
+            
+            if not is_direct_sender and not is_cc_recipient:
+                logger.debug(f"[REPLY CHECKER] Rejected: sender={sender_of_reply} not in contact_emails={contact_emails} and contact not in recipients. to={to_list} cc={cc_list}")
+                continue # Not a reply from our target contact or their thread
+
+            logger.info(f"[REPLY DETECTED] New reply for contact {contact['id']} (Message ID: {graph_message_id}) sender={sender_of_reply} contact_emails={contact_emails} is_direct={is_direct_sender} is_cc={is_cc_recipient}")
+
+            # Use a transaction to safely update the database
+            async with conn.transaction():
+                msg_time = parse_dt(msg['receivedDateTime']).astimezone(UTC).replace(tzinfo=None)
+
+                # Update contact status to 'Replied' and pause the campaign
+                await conn.execute("""
+                    UPDATE campaign_contacts
+                    SET status = 'Replied', campaign_paused = TRUE, last_triggered_at = $2,
+                        trigger = COALESCE(trigger || E'\n', '') || $3
+                    WHERE id = $1
+                """, contact['id'], msg_time, f"Reply detected at {msg_time}")
+
+                # Insert the new, unique reply into our messages table for history
+                # Extract cc recipients from the incoming message headers if present
+                cc_field = ''
+                try:
+                    # msg may include an 'ccRecipients' or internetMessageHeaders with Cc
+                    cc_field = msg.get('ccRecipients') or ''
+                    if isinstance(cc_field, list):
+                        # Graph recipient objects -> "a@x.com; b@y.com"
+                        cc_field = '; '.join(
+                            (r.get('emailAddress') or {}).get('address', '') for r in cc_field
+                            if (r.get('emailAddress') or {}).get('address')
+                        )
+                    if not cc_field:
+                        # Try headers
+                        headers = msg.get('internetMessageHeaders') or []
+                        for h in headers:
+                            if h.get('name', '').lower() == 'cc':
+                                cc_field = h.get('value') or ''
+                                break
+                except Exception:
+                    cc_field = ''
+
+                await insert_received_message(conn, {
+                    'contact_id': contact['id'],
+                    'sender_email': sender_of_reply,
+                    'recipient_email': sender_email,
+                    'cc_recipients': cc_field,
+                    'subject': msg.get('subject', ''),
+                    'body': msg.get('processed_body', ''),
+                    'received_at': msg_time,
+                    'stage': contact['stage'],
+                    'message_id': graph_message_id,
+                    'in_reply_to': msg.get('inReplyTo'),
+                })
+
+            replies_recorded += 1
+            break # Match found, move to the next inbox message
+
+    return replies_recorded
+
+async def process_notified_messages(conn, sender_email: str, messages: List[dict]) -> int:
+    """Match messages delivered by Graph change notifications for one mailbox."""
+    contacts_by_sender, last_sent_lookup, last_sent_by_email = await load_reply_check_context(conn, sender_email)
+    contacts_to_check = contacts_by_sender.get(sender_email.lower(), [])
+    if not contacts_to_check:
+        return 0
+    return await process_inbox_messages(conn, sender_email.lower(), messages, contacts_to_check,
+                                        last_sent_lookup, last_sent_by_email)
+
 async def reply_checker_worker():
     """
     Checks for email replies by matching inbox messages against the last sent email for each contact.
     This version correctly fetches threading info from the email_queue table.
     """
     import asyncio
-    from collections import defaultdict
-    from dateutil.parser import parse as parse_dt
     
     ADVISORY_LOCK_KEY = 90001  # Unique key for reply_checker_worker
+    # Mailboxes matched against the DB at the same time (each holds a pool connection)
+    PROCESS_CONCURRENCY = int(os.getenv('REPLY_CHECKER_DB_CONCURRENCY', '4'))
 
     while True:
         lock_acquired = False
@@ -8253,335 +8307,54 @@ async def reply_checker_worker():
                 async with db_pool.acquire() as fetch_conn:
                     logger.info("[REPLY CHECKER] Starting reply check cycle...")
 
-                    # 1. Get all active contacts that are expecting replies.
-                    active_contacts = await fetch_conn.fetch('''
-                        SELECT id, email, status, stage, event_id
-                        FROM campaign_contacts
-                        WHERE campaign_paused = FALSE AND status NOT IN ('completed', 'cancelled', 'Replied')
-                    ''')
+                    contacts_by_sender, last_sent_lookup, last_sent_by_email = await load_reply_check_context(fetch_conn)
 
-                    if not active_contacts:
+                    if not contacts_by_sender:
                         logger.info("[REPLY CHECKER] No active contacts to check. Sleeping.")
                         await asyncio.sleep(300) # Sleep for 5 minutes
                         continue
 
-                    contact_ids = [c['id'] for c in active_contacts]
-                    contacts_by_id = {c['id']: dict(c) for c in active_contacts}
-
-                    # 2. NEW: Create a lookup dictionary with the correct threading info for each contact.
-                    # Primary source: last sent entry from email_queue (one row per contact_id).
-                    # Fallback source: messages table (checks recipient_email and cc_recipients) so
-                    # contacts who were only CC'd are also tracked for reply detection.
-                    last_sent_lookup = {}
-                    if contact_ids:
-                        last_sent_emails = await fetch_conn.fetch('''
-                            WITH ranked_emails AS (
-                                SELECT
-                                    contact_id, subject, sent_at, message_id, conversation_id,
-                                    ROW_NUMBER() OVER(PARTITION BY contact_id ORDER BY sent_at DESC) as rn
-                                FROM email_queue
-                                WHERE status = 'sent' AND contact_id = ANY($1::int[]) AND message_id IS NOT NULL
-                            )
-                            SELECT contact_id, subject, sent_at, message_id, conversation_id
-                            FROM ranked_emails
-                            WHERE rn = 1
-                        ''', contact_ids)
-
-                        for row in last_sent_emails:
-                            last_sent_lookup[row['contact_id']] = dict(row)
-
-                    # Build a fallback mapping from normalized recipient email -> last sent message info
-                    # This lets us detect replies when the contact was included as CC (stored in cc_recipients)
-                    last_sent_by_email = {}
-                    contact_emails = [normalize_email(c['email']) for c in active_contacts if c.get('email')]
-                    if contact_emails:
-                        # Fetch recent sent messages that might contain our contacts as main recipient or in CC
-                        messages_sent = await fetch_conn.fetch('''
-                            SELECT recipient_email, cc_recipients, sent_at, message_id, conversation_id
-                            FROM messages
-                            WHERE direction = 'sent' AND message_id IS NOT NULL
-                            ORDER BY sent_at DESC
-                            LIMIT 100000
-                        ''')
-
-                        # Iterate recent sent messages (most recent first) and assign the first matching message
-                        # as the last_sent info for any contact email found in recipient or cc_recipients.
-                        for m in messages_sent:
-                            rec = (m.get('recipient_email') or '').strip()
-                            cc_raw = (m.get('cc_recipients') or '')
-                            cc_list = [normalize_email(x) for x in re.split(r'[;,\s]+', cc_raw) if x.strip()] if cc_raw else []
-
-                            # normalize recipient and check
-                            if rec:
-                                nrec = normalize_email(rec)
-                                if nrec in contact_emails and nrec not in last_sent_by_email:
-                                    last_sent_by_email[nrec] = {
-                                        'message_id': m.get('message_id'),
-                                        'conversation_id': m.get('conversation_id'),
-                                        'sent_at': m.get('sent_at'),
-                                        'recipient_email': rec,
-                                    }
-
-                            # check cc list
-                            for cc in cc_list:
-                                if cc in contact_emails and cc not in last_sent_by_email:
-                                    last_sent_by_email[cc] = {
-                                        'message_id': m.get('message_id'),
-                                        'conversation_id': m.get('conversation_id'),
-                                        'sent_at': m.get('sent_at'),
-                                        'recipient_email': rec,
-                                    }
-
-                    # 3. Group contacts by the sender email account we need to check.
-                    event_ids = [c['event_id'] for c in active_contacts]
-                    sender_map_rows = await fetch_conn.fetch('SELECT id, sender_email FROM event WHERE id = ANY($1::int[])', event_ids)
-                    sender_map = {row['id']: row['sender_email'] for row in sender_map_rows}
-
-                    contacts_by_sender = defaultdict(list)
-                    for contact_id in contact_ids:
-                        contact = contacts_by_id[contact_id]
-                        event_id = contact['event_id']
-                        sender_email = sender_map.get(event_id)
-                        if sender_email:
-                            contacts_by_sender[sender_email.lower()].append(contact)
-
-                # 4. Loop through each sender account and check its inbox.
-                for sender_email, contacts_to_check in contacts_by_sender.items():
+                # 4. Check every sender's inbox concurrently; each mailbox is matched
+                # as soon as its own fetch completes.
+                async def check_sender_inbox(sender_email, contacts_to_check):
                     logger.info(f"[REPLY CHECKER] Checking inbox of {sender_email} for {len(contacts_to_check)} contacts.")
                     try:
-                        inbox_messages = await asyncio.to_thread(
-                            graph_email.fetch_all_inbox_messages, sender_email, max_messages=100
+                        async with db_pool.acquire() as sync_conn:
+                            sync_state = await get_sync_state(sync_conn, sender_email)
+                        # Only messages new/changed since the stored delta link
+                        inbox_messages, sync_link, sync_complete = await fetch_mailbox_changes(
+                            sender_email, sync_state.get('delta_link') if sync_state else None
                         )
+                        logger.info(f"[REPLY CHECKER] {len(inbox_messages)} new/changed inbox message(s) for {sender_email}")
                     except Exception as e:
                         logger.error(f"[REPLY CHECKER] Failed to fetch inbox for {sender_email}: {e}")
-                        continue
+                        try:
+                            async with db_pool.acquire() as sync_conn:
+                                await record_sync_error(sync_conn, sender_email, str(e))
+                        except Exception:
+                            pass
+                        return
 
                     # Acquire a fresh DB connection for processing this sender's inbox messages.
-                    async with db_pool.acquire() as conn:
-                        for msg in inbox_messages:
-                            graph_message_id = msg.get('id')
-                            if not graph_message_id:
-                                continue
+                    async with process_slots, db_pool.acquire() as conn:
+                        await process_inbox_messages(conn, sender_email, inbox_messages, contacts_to_check,
+                                                     last_sent_lookup, last_sent_by_email)
 
-                            # Check if we have already processed this email to avoid redundant work
-                            if await conn.fetchval("SELECT 1 FROM messages WHERE message_id = $1", graph_message_id):
-                                continue
-
-                            # For this inbox message, see if it matches any of our contacts
-                            for contact in contacts_to_check:
-                                last_sent_info = last_sent_lookup.get(contact['id'])
-                                # If we don't have a last_sent entry by contact_id, try fallback by email
-                                if not last_sent_info:
-                                    try:
-                                        pending_exists = await conn.fetchval(
-                                            "SELECT 1 FROM email_queue WHERE contact_id = $1 AND status = 'pending' LIMIT 1",
-                                            contact['id']
-                                        )
-                                        if pending_exists:
-                                            logger.debug(f"[REPLY CHECKER] Skipping reply check for contact {contact['id']}: pending message exists")
-                                            continue
-
-                                        contact_email_norm = normalize_email(contact.get('email') or '')
-                                        fallback = last_sent_by_email.get(contact_email_norm)
-
-                                    
-                                        if fallback:
-                                            fallback_time = fallback.get('sent_at')
-                                            if fallback_time and fallback_time.tzinfo:
-                                                fallback_time = fallback_time.replace(tzinfo=None)
-
-                                            now_native = datetime.now(UTC).replace(tzinfo=None)
-                                            time_diff = (now_native - fallback_time).total_seconds() if fallback_time else float('inf')
-                                            is_recent =time_diff < (30 * 86400)
-
-                                            status_updated_at = contact.get('status_updated_at')
-                                            if status_updated_at and status_updated_at.tzinfo:
-                                                status_updated_at = status_updated_at.replace(tzinfo=None)
-
-                                            if is_recent and (not status_updated_at or fallback_time >= status_updated_at):
-                                               last_sent_info = {
-                                                   'contact_id': contact['id'],
-                                                   'subject': None,
-                                                   'sent_at': fallback.get('sent_at'),
-                                                   'message_id': fallback.get('message_id'),
-                                                   'conversation_id': fallback.get('conversation_id')
-                                               }
-                                               logger.debug(f"[REPLY CHECKER] valid fallback for contact {contact['id']}")
-                                            else:
-                                                logger.debug(f"[REPLY CHECKER] invalid fallback for contact {contact['id']}")
-                                                continue # This contact hasn't had an email sent we can match to.
-                                        else:
-                                            continue 
-                                    except Exception as e:
-                                        logger.error(f"[REPLY CHECKER] Error processing fallback for contact {contact['id']}: {e}")
-                                        continue    
-                                # --- THE CRITICAL MATCHING LOGIC ---
-                                is_match = False
-
-
-                                # Normalize IDs for reliable comparison (removes < > brackets)
-                                in_reply_to_id = (msg.get('inReplyTo') or '').strip(' <>')
-                                last_message_id = (last_sent_info.get('message_id') or '').strip(' <>')
-
-                                # Quick deterministic match: if inReplyTo maps to contact(s) in message_contact_map, use that
-                                if in_reply_to_id:
-                                    try:
-                                        mapped = await conn.fetch('SELECT contact_id FROM message_contact_map WHERE message_id = $1', in_reply_to_id)
-                                        if mapped and len(mapped) > 0:
-                                            # If the mapping includes our contact, mark as match
-                                            mapped_ids = [m['contact_id'] for m in mapped]
-                                            if contact['id'] in mapped_ids:
-                                                is_match = True
-                                                logger.info(f"[REPLY CHECKER] Matched via message_contact_map for contact {contact['id']} message {in_reply_to_id}")
-                                            else:
-                                                # if mapping exists but for other contacts, skip this contact
-                                                continue
-                                    except Exception:
-                                        pass
-
-                                # Match 1: Direct reply (most reliable)
-                                if in_reply_to_id and last_message_id and in_reply_to_id == last_message_id:
-                                    is_match = True
-
-                                # Match 2: Conversation threading (good fallback)
-                                elif msg.get('conversationId') and last_sent_info.get('conversation_id') and \
-                                     msg.get('conversationId') == last_sent_info.get('conversation_id'):
-                                    is_match = True
-
-                                # Match 3: Subject + recipient heuristic - helps catch replies where contact was CC'd
-                                if not is_match:
-                                    try:
-                                        # Build normalized subject comparisons (strip common reply prefixes)
-                                        def norm_sub(s):
-                                            if not s: return ''
-                                            s2 = re.sub(r'^(re|fwd)[:\s]+', '', s.lower()).strip()
-                                            s2 = re.sub(r'\s+', ' ', s2)
-                                            return s2
-
-                                        msg_subject_raw = msg.get('subject', '') or ''
-                                        last_subject_raw = last_sent_info.get('subject') or ''
-                                        msg_sub_norm = norm_sub(msg_subject_raw)
-                                        last_sub_norm = norm_sub(last_subject_raw)
-
-                                        # Extract recipients (To + Cc)
-                                        to_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('toRecipients') or [])]
-                                        cc_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('ccRecipients') or [])]
-                                        all_recipients = set([r for r in to_list + cc_list if r])
-
-                                        contact_email_norm = normalize_email(contact.get('email') or '')
-
-                                        # If subject matches (loose) and contact is present in recipients, treat as match
-                                        if last_sub_norm and msg_sub_norm and last_sub_norm in msg_sub_norm and contact_email_norm in all_recipients:
-                                            is_match = True
-                                    except Exception:
-                                        pass
-
-                                # Heuristic fallback: if sender of the inbox message is the contact email and the
-                                # message subject loosely contains the last sent subject, treat as a reply.
-                                if not is_match:
-                                    try:
-                                        sender_addr = (msg.get('from') or {}).get('emailAddress', {}).get('address', '')
-                                        sender_norm = normalize_email(sender_addr)
-                                        contact_email_norm = normalize_email(contact.get('email') or '')
-                                        msg_subject_raw = msg.get('subject', '') or ''
-                                        def norm_sub_simple(s):
-                                            return re.sub(r'^(re|fwd)[:\s]+', '', (s or '').lower()).strip()
-
-                                        if sender_norm and contact_email_norm and sender_norm == contact_email_norm:
-                                            last_sub = (last_sent_info.get('subject') or '')
-                                            if last_sub:
-                                                if norm_sub_simple(last_sub) in norm_sub_simple(msg_subject_raw):
-                                                    is_match = True
-                                                    logger.info(f"[REPLY CHECKER] Fallback sender+subject match for contact {contact['id']} sender={sender_norm} msg_id={graph_message_id}")
-                                    except Exception:
-                                        pass
+                        # All fetched messages were processed; advance the stored link
+                        await commit_mailbox_sync(conn, sender_email, sync_link, sync_complete, len(inbox_messages))
 
-                                if is_match:
-                                    # Before treating as a reply, check if this inbox message is a bounce
-                                    logger.debug(f"[REPLY CHECKER] Candidate match: msg_id={graph_message_id} contact={contact['id']} is_match={is_match} inReplyTo={in_reply_to_id} conv={msg.get('conversationId')} sender={msg.get('from')} to={[(r.get('emailAddress',{}).get('address')) for r in (msg.get('toRecipients') or [])]} cc={[(r.get('emailAddress',{}).get('address')) for r in (msg.get('ccRecipients') or [])]} subject='{msg.get('subject','')}' last_msg_id='{last_message_id}' last_subj='{last_sent_info.get('subject')}'")
-                                    sender_address_raw = ''
-                                    try:
-                                        sender_address_raw = msg.get('from', {}).get('emailAddress', {}).get('address', '')
-                                    except Exception:
-                                        sender_address_raw = ''
-
-                                    if is_bounce_email(msg.get('subject', ''), msg.get('processed_body', ''), sender_address_raw):
-                                        logger.info(f"[BOUNCE DETECTED IN INBOX] Message {graph_message_id} looks like a bounce; handling.")
-                                        try:
-                                            await handle_bounce_email(conn, msg.get('subject', ''), msg.get('processed_body', ''), sender_address_raw)
-                                        except Exception as e:
-                                            logger.error(f"[BOUNCE] Error handling bounce from inbox message {graph_message_id}: {e}")
-                                        # Skip treating this message as a contact reply
-                                        continue
-
-                                    # Final verification: Did the reply come from the correct person OR include contact as recipient?
-                                    sender_of_reply = normalize_email(sender_address_raw)
-                                    
-                                    # Parse contact email field (may contain comma-separated multiple emails)
-                                    contact_email_raw = (contact.get('email') or '')
-                                    contact_emails = [normalize_email(e.strip()) for e in contact_email_raw.split(',') if e.strip()]
-                                    
-                                    # Check if contact is in To or CC recipients (for CC'd reply detection)
-                                    to_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('toRecipients') or [])]
-                                    cc_list = [normalize_email(r.get('emailAddress', {}).get('address', '')) for r in (msg.get('ccRecipients') or [])]
-                                    all_recipients = set([r for r in to_list + cc_list if r])
-                                    
-                                    # Check if sender is any of the contact emails OR contact is in recipients
-                                    is_direct_sender = sender_of_reply in contact_emails
-                                    is_cc_recipient = any(email in all_recipients for email in contact_emails)
-                                    
-                                    if not is_direct_sender and not is_cc_recipient:
-                                        logger.debug(f"[REPLY CHECKER] Rejected: sender={sender_of_reply} not in contact_emails={contact_emails} and contact not in recipients. to={to_list} cc={cc_list}")
-                                        continue # Not a reply from our target contact or their thread
-
-                                    logger.info(f"[REPLY DETECTED] New reply for contact {contact['id']} (Message ID: {graph_message_id}) sender={sender_of_reply} contact_emails={contact_emails} is_direct={is_direct_sender} is_cc={is_cc_recipient}")
-
-                                    # Use a transaction to safely update the database
-                                    async with conn.transaction():
-                                        msg_time = parse_dt(msg['receivedDateTime']).astimezone(UTC).replace(tzinfo=None)
-
-                                        # Update contact status to 'Replied' and pause the campaign
-                                        await conn.execute("""
-                                            UPDATE campaign_contacts
-                                            SET status = 'Replied', campaign_paused = TRUE, last_triggered_at = $2,
-                                                trigger = COALESCE(trigger || E'\n', '') || $3
-                                            WHERE id = $1
-                                        """, contact['id'], msg_time, f"Reply detected at {msg_time}")
-
-                                        # Insert the new, unique reply into our messages table for history
-                                        # Extract cc recipients from the incoming message headers if present
-                                        cc_field = ''
-                                        try:
-                                            # msg may include an 'ccRecipients' or internetMessageHeaders with Cc
-                                            cc_field = msg.get('ccRecipients') or ''
-                                            if not cc_field:
-                                                # Try headers
-                                                headers = msg.get('internetMessageHeaders') or []
-                                                for h in headers:
-                                                    if h.get('name', '').lower() == 'cc':
-                                                        cc_field = h.get('value') or ''
-                                                        break
-                                        except Exception:
-                                            cc_field = ''
-
-                                        await conn.execute('''
-                                            INSERT INTO messages (
-                                                contact_id, direction, sender_email, recipient_email, cc_recipients, subject, body,
-                                                received_at, stage, message_id, in_reply_to
-                                            ) VALUES ($1, 'received', $2, $3, $4, $5, $6, $7, $8, $9, $10)
-                                        ''',
-                                        contact['id'],
-                                        sender_of_reply,
-                                        sender_email,
-                                        cc_field,
-                                        msg.get('subject', ''),
-                                        msg.get('processed_body', ''),
-                                        msg_time,
-                                        contact['stage'],
-                                        graph_message_id,
-                                        msg.get('inReplyTo'))
-
-                                    break # Match found, move to the next inbox message
+                process_slots = asyncio.Semaphore(PROCESS_CONCURRENCY)
+                sender_tasks = [
+                    asyncio.create_task(check_sender_inbox(sender_email, contacts_to_check))
+                    for sender_email, contacts_to_check in contacts_by_sender.items()
+                ]
+                cycle_started = time.monotonic()
+                for finished in asyncio.as_completed(sender_tasks):
+                    try:
+                        await finished
+                    except Exception as e:
+                        logger.error(f"[REPLY CHECKER] Error processing a mailbox: {e}", exc_info=True)
+                logger.info(f"[REPLY CHECKER] Checked {len(sender_tasks)} mailbox(es) in {time.monotonic() - cycle_started:.1f}s")
                                 
             except Exception as e:
                 logger.error(f'[REPLY CHECKER] Worker encountered a critical error: {e}', exc_info=True)
@@ -8601,63 +8374,25 @@ async def reply_checker_worker():
         except Exception as outer_e:
             logger.error(f"[REPLY CHECKER] Unexpected outer error: {outer_e}")
 
-        await asyncio.sleep(300) # Check for replies every 5 minutes
+        # Check for replies every 5 minutes (less often while Graph webhooks are healthy)
+        await wait_for_next_poll()
 # Utility to generate quoted email thread block
 
 # Second implementation of generate_quoted_block removed - using version defined above
 
 # --- Store reply in messages table only if not already present ---
-async def cleanup_duplicate_messages():
-    """Clean up duplicate messages from the messages table"""
+async def cleanup_duplicate_messages(max_batches: Optional[int] = None) -> int:
+    """Remove duplicate messages stored since the last cleanup run"""
     async with db_pool.acquire() as conn:
-        # Create a temporary table to store messages we want to keep
-        await conn.execute(r"""
-            CREATE TEMP TABLE messages_to_keep AS
-            WITH RankedMessages AS (
-                SELECT
-                    id,
-                    contact_id,
-                    direction,
-                    sender_email,
-                    recipient_email,
-                    subject,
-                    body,
-                    message_id,
-                    sent_at,
-                    received_at,
-                    ROW_NUMBER() OVER (
-                        PARTITION BY
-                            LOWER(sender_email),
-                            LOWER(recipient_email),
-                            LOWER(subject),
-                            LOWER(regexp_replace(body, '\s+', ' ', 'g'))
-                        ORDER BY
-                            COALESCE(sent_at, received_at) DESC,
-                            id DESC
-                    ) as rn
-                FROM messages
-            )
-            SELECT id FROM RankedMessages WHERE rn = 1
-        """)
-
-        # Delete duplicates
-        deleted = await conn.execute("""
-            WITH deleted AS (
-                DELETE FROM messages
-                WHERE id NOT IN (SELECT id FROM messages_to_keep)
-                RETURNING id
-            )
-            SELECT COUNT(*) FROM deleted
-        """)
-
-        # Drop temporary table
-        await conn.execute("DROP TABLE messages_to_keep")
-
-        return deleted
+        return await message_store.cleanup_duplicate_messages(conn, max_batches=max_batches)
 
 async def is_duplicate_message(conn, message: dict) -> bool:
     """
-    Check if a message is a duplicate using multiple criteria.
+    Check if a message is a duplicate.
+
+    Messages with a message_id are checked through the unique index on
+    messages.message_id. Messages without one are looked up by content
+    fingerprint (sender, recipient, subject, body) within a 5 minute window.
 
     Args:
         conn: Database connection
@@ -8666,43 +8401,19 @@ async def is_duplicate_message(conn, message: dict) -> bool:
     Returns:
         bool: True if message is a duplicate, False otherwise
     """
-    # Normalize the message content
-    sender = normalize_email(message.get('sender_email', ''))
-    subject = re.sub(r'^re:\s*', '', message.get('subject', '').lower()).strip()
-    body = ' '.join(message.get('body', '').lower().split())
-    timestamp = message.get('sent_at') or message.get('received_at')
     message_id = message.get('message_id')
-
-    # Check for duplicates using multiple criteria
-    duplicate = await conn.fetchval(r"""
-        SELECT 1 FROM messages
-        WHERE
-            -- Check by message_id if available
-            (message_id = $1 AND message_id IS NOT NULL)
-            OR
-            -- Check by content similarity within a time window
-            (
-                LOWER(sender_email) = LOWER($2)
-                AND (
-                    -- Exact subject match after removing 're:'
-                    regexp_replace(LOWER(subject), '^re:\s*', '') = $3
-                    OR
-                    -- High similarity subject
-                    similarity(LOWER(subject), $3) > 0.9
-                )
-                AND (
-                    -- Exact body match after normalization
-                    regexp_replace(LOWER(body), '\s+', ' ') = $4
-                    OR
-                    -- High similarity body
-                    similarity(LOWER(body), $4) > 0.9
-                )
-                -- Within 5 minute window
-                AND ABS(EXTRACT(EPOCH FROM (COALESCE(sent_at, received_at) - $5))) < 300
-            )
-    """, message_id, sender, subject, body, timestamp)
-
-    return bool(duplicate)
+    if message_id:
+        return not await filter_unseen_message_ids(conn, [message_id])
+
+    duplicate = await find_content_duplicate(
+        conn,
+        message.get('sender_email'),
+        message.get('recipient_email'),
+        message.get('subject'),
+        message.get('body'),
+        message.get('sent_at') or message.get('received_at'),
+    )
+    return duplicate is not None
 
 async def store_reply_in_messages_table(reply):
     """
@@ -8717,22 +8428,19 @@ async def store_reply_in_messages_table(reply):
         body = reply.get('body', '')
         from_email = reply.get('sender_email', '')
 
-        if is_bounce_email(subject, body, from_email):
+        bounce = classify_bounce(subject, body, from_email, exclude=[reply.get('recipient_email') or ''])
+        if bounce.is_bounce:
             logger.info(f"[BOUNCE] Detected bounce email from {from_email}")
-            await handle_bounce_email(conn, subject, body, from_email)
+            await handle_bounce_email(conn, subject, body, from_email, bounce=bounce)
             # Don't store bounce emails in regular messages table
             return
 
-        # Use our new duplicate detection function
         if await is_duplicate_message(conn, reply):
             logger.info(f"Skipping duplicate message from {reply.get('sender_email')} with subject: {reply.get('subject')}")
             return
 
-        if existing_message:
-            # Reply already exists, skip storing
-            return
-
-        # Insert the reply into the messages table
+        # Insert the reply into the messages table; a concurrent insert of the
+        # same message_id is dropped by the unique index
         await conn.execute(
             """
             INSERT INTO messages (
@@ -8742,6 +8450,7 @@ async def store_reply_in_messages_table(reply):
                 $1, $2, $3, $4, $5, $6,
                 $7, $8, $9, $10, $11, $12, $13
             )
+            ON CONFLICT DO NOTHING
             """,
             reply.get('contact_id'),
             'received',
@@ -8797,19 +8506,24 @@ async def queue_stage_message(conn, contact_id: int, stage: str, contact_row):
         """, message_body, contact_id)
         
         # Queue the email (include created_at and due_at)
-        await conn.execute("""
-            INSERT INTO email_queue (
-                sender_email, recipient_email, cc_recipients,
-                subject, message, contact_id, type,
-                status, campaign_stage, forms_link, payment_link,
-                attachment, attachment_filename, attachment_mimetype,
-                created_at, due_at
-            ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14, NOW(), NOW())
-        """, DEFAULT_SENDER_EMAIL, contact_row['email'], 
-            cc_recipients, subject, message_body,
-            contact_id, 'campaign', 'pending', stage,
-            contact_row.get('forms_link'), contact_row.get('payment_link'),
-            contact_row.get('attachment'), contact_row.get('attachment_filename'), contact_row.get('attachment_mimetype'))
+        now = datetime.now(UTC).replace(tzinfo=None)
+        await enqueue_with_snapshot(conn, [{
+            'sender_email': DEFAULT_SENDER_EMAIL,
+            'recipient_email': contact_row['email'],
+            'cc_recipients': ';'.join(cc_recipients) if cc_recipients else None,
+            'subject': subject,
+            'message': message_body,
+            'contact_id': contact_id,
+            'type': 'campaign',
+            'campaign_stage': stage,
+            'forms_link': contact_row.get('forms_link'),
+            'payment_link': contact_row.get('payment_link'),
+            'attachment': contact_row.get('attachment'),
+            'attachment_filename': contact_row.get('attachment_filename'),
+            'attachment_mimetype': contact_row.get('attachment_mimetype'),
+            'created_at': now,
+            'due_at': now,
+        }])
             
         logger.info(f"[QUEUE] Stage message queued for contact {contact_id}: {stage}")
         return True
@@ -9444,6 +9158,8 @@ async def create_campaign_contact(contact: dict = Body(...), current_user: dict
             contact.get("status", "pending"), contact.get("stage", "initial"),
             contact.get("forms_link"), contact.get("payment_link"), contact.get("campaign_paused", False), contact.get("invoice_number")
         )
+        if row:
+            await refresh_render_contexts(conn, [row['id']])
 
         # Log contact creation activity
         await log_user_activity(
@@ -9508,6 +9224,7 @@ async def update_contact_links(
                 invoice_number = COALESCE($6, invoice_number)
             WHERE id = $7
         """, forms_link, payment_link, attachment_bytes, attachment_filename, attachment_mimetype, invoice_number, contact_id)
+        await refresh_render_contexts(conn, [contact_id])
 
         # If we stored an attachment, propagate it to any pending queued messages for this contact
         if attachment_bytes:
@@ -9770,6 +9487,8 @@ async def update_campaign_contact(contact_id: int, contact: dict = Body(...), cu
         sql = f"UPDATE campaign_contacts SET {', '.join(fields)} WHERE id = ${len(values)} RETURNING *"
 
         row = await conn.fetchrow(sql, *values)
+        if row and any(k in contact for k in ('name', 'prefix', 'forms_link', 'payment_link')):
+            await refresh_render_contexts(conn, [contact_id])
           # If stage changed, remove any pending queued messages for this contact so
         # the old reminder does not get sent.
         if stage_changing:
@@ -10062,6 +9781,7 @@ async def upload_excel_campaign_contacts(
 ):
     import pandas as pd
     added, updated, skipped = [], [], []
+    inserted_contact_ids = []
 
     try:
         # Read Excel file
@@ -10091,6 +9811,14 @@ async def upload_excel_campaign_contacts(
                     if nl and nl not in names:
                         names.append(nl)
 
+            # Validate the sheet's primary addresses grouped by domain up front;
+            # the per-row call_validator() calls below are then cache hits
+            try:
+                primaries = [p[0] for p in (process_emails(e, validate=True) for e in emails) if p]
+                await validate_addresses(db_pool, primaries, email_validator.validate)
+            except Exception as e:
+                logger.warning(f"[EXCEL UPLOAD] Batch pre-validation failed, validating per row: {e}")
+
             email_eq_array = emails if emails else ['']
             email_like_array = [f'%{e}%' for e in emails] if emails else ['']
             name_eq_array = names if names else ['']
@@ -10294,6 +10022,8 @@ async def upload_excel_campaign_contacts(
                         validation_result_text = v.get('reason') or v.get('validation_result') or ("Valid" if v.get('valid') else "Invalid")
                         if isinstance(v.get('raw'), dict):
                             validator_code = v['raw'].get('smtp_code') or v['raw'].get('code') or v.get('code')
+                    except ValidationDeferred as e:
+                        validation_result_text = str(e)
                     except Exception as e:
                         logger.warning(f"Validator call failed for {primary_email}: {e}")
                         validation_result_text = f"Validator error: {str(e)}"
@@ -10388,6 +10118,8 @@ async def upload_excel_campaign_contacts(
                         """
 
                         new_contact = await conn.fetchrow(insert_sql, *dynamic_values)
+                        if new_contact:
+                            inserted_contact_ids.append(new_contact['id'])
 
                         added.append({
                             'email': primary_email,
@@ -10421,6 +10153,13 @@ async def upload_excel_campaign_contacts(
                     })
                     continue
 
+            # Materialize render contexts for the imported contacts in one batch
+            if inserted_contact_ids:
+                try:
+                    await refresh_render_contexts(conn, inserted_contact_ids)
+                except Exception as e:
+                    logger.warning(f"[UPLOAD] Could not refresh render contexts: {e}")
+
             # Log Excel upload activity
             # Count total matches
             total_matches = sum(1 for row in result_rows if row.get('matches'))
@@ -10637,6 +10376,7 @@ async def start_campaign_for_contact(
                 f.write(subject)
             with open(template_dir / "campaign_default_body.txt", "w") as f:
                 f.write(body)
+            template_registry.invalidate()
 
             # Read attachment bytes (if provided) and store on contact so future reminders include it
             attachment_bytes = None
@@ -10728,7 +10468,22 @@ async def bulk_start_campaign(
             new_values={"contact_count": len(payload), "contact_ids": contact_ids}
         )
 
-        queued = []
+        # Fetch all contacts with joined event data in one query
+        wanted_ids = [int(cid) for cid in contact_ids if cid]
+        contact_rows = await conn.fetch('''
+            SELECT
+                cc.*,
+                e.sender_email, e.org_name, e.city, e.month, e.venue, e.date2
+                FROM campaign_contacts cc
+                JOIN event e ON cc.event_id = e.id
+            WHERE cc.id = ANY($1::int[])
+        ''', wanted_ids)
+        contacts_by_id = {row['id']: row for row in contact_rows}
+        # Stored render contexts; any missing ones are computed in one batch
+        render_contexts = await load_render_contexts(conn, contact_rows)
+
+        pending_messages = []
+        prepared = {}
 
         for item in payload:
             contact_id = item.get("contact_id")
@@ -10736,17 +10491,7 @@ async def bulk_start_campaign(
                 logger.warning("Skipping item without contact_id")
                 continue
 
-            logger.info(f"Starting bulk campaign for contact_id={contact_id}")
-
-            # Fetch contact with joined event data
-            contact = await conn.fetchrow('''
-                SELECT
-                    cc.*,
-                    e.sender_email, e.org_name, e.city, e.month, e.venue, e.date2
-                    FROM campaign_contacts cc
-                    JOIN event e ON cc.event_id = e.id
-                WHERE cc.id = $1
-            ''', contact_id)
+            contact = contacts_by_id.get(int(contact_id))
             if not contact:
                 logger.warning(f"Contact not found for ID {contact_id}")
                 continue
@@ -10759,63 +10504,8 @@ async def bulk_start_campaign(
             # 1. Create Base Context
             context = dict(contact)
 
-            # =========================================================
-            # START: NAME PROCESSING BLOCK (THE FIX)
-            # =========================================================
-            raw_name = context.get('name', '').strip()
-            # Handle case where prefix might be None in DB
-            db_prefix = context.get('prefix', '').strip() if context.get('prefix') else ""
-            
-            # Default fallbacks to prevent crashes
-            final_prefix = ""
-            final_last_name = raw_name
-
-            if db_prefix:
-                # CASE A: Database has a prefix (e.g. "prof")
-                # Use DB prefix + Split the name to remove junk (e.g. "test4, kim" -> "kim")
-                final_prefix = db_prefix
-                
-                # Polish punctuation (Add dot if missing, skip "Sir")
-                if len(final_prefix) <= 3 and not final_prefix.endswith('.') and final_prefix.lower() not in ["sir", "madam"]:
-                    final_prefix += "."
-
-                if ',' in raw_name:
-                    # "test4, kim" -> "kim"
-                    final_last_name = raw_name.split(',')[-1].strip()
-                else:
-                    # "test4 kim" -> "kim"
-                    parts = raw_name.split()
-                    final_last_name = parts[-1].strip() if parts else raw_name
-            else:
-                # CASE B: No Database Prefix
-                # Use helper function to extract everything
-                try:
-                    final_prefix, final_last_name = extract_name_parts_with_prefix(raw_name)
-                except Exception as e:
-                    logger.error(f"Name extraction failed for {contact_id}: {e}")
-                    final_prefix = ""
-                    final_last_name = raw_name
-
-            # Capitalize
-            final_prefix = final_prefix.title() if final_prefix else ""
-            final_last_name = final_last_name.title()
-
-            # Construct Greeting Name
-            if final_prefix:
-                greeting_name = f"{final_prefix} {final_last_name}"
-            else:
-                greeting_name = final_last_name
-
-            # Assign Critical Variables to Context
-            context['prefix'] = final_prefix
-            context['last_name'] = final_last_name
-            context['greeting_name'] = greeting_name
-            context['name'] = greeting_name  # Ensure {{name}} uses the formatted version
-
-            logger.info(f"Contact {contact_id}: Name Processed -> greeting_name='{greeting_name}'")
-            # =========================================================
-            # END: NAME PROCESSING BLOCK
-            # =========================================================
+            # Name parts and link aliases come from the stored render context
+            context.update(render_contexts.get(contact['id']) or {})
 
             # Validate required vars (Now safe because we set them above)
             required_vars = ['name', 'city', 'date2', 'venue', 'month', 'greeting_name']
@@ -10826,7 +10516,7 @@ async def bulk_start_campaign(
 
             # Get values
             sender_email = item.get("sender_email") or contact.get("sender_email")
-            if sender_email not in ALLOWED_SENDERS:
+            if not sender_registry.is_assignable(sender_email):
                 logger.warning(f"Invalid sender_email={sender_email}, skipping contact_id={contact_id}")
                 continue
 
@@ -10849,124 +10539,124 @@ async def bulk_start_campaign(
                 subject_rendered = render_template_strict(subject, context)
                 body_rendered = render_template_strict(body, context)
                 body_plain = body_rendered
-                logger.info(f"Rendered templates for contact_id={contact_id}")
-                
-                # --- (Assuming your queueing/sending logic continues here) ---
-                
             except Exception as e:
                 logger.error(f"Template rendering failed for contact_id={contact_id}: {e}")
                 continue
 
-            # Prevent duplicate (same subject already sent or pending)
-            existing = await conn.fetchval('''
-                SELECT 1 FROM email_queue
-                WHERE contact_id = $1 AND subject = $2 AND status IN ('pending', 'sent')
-            ''', contact_id, subject_rendered)
-            if existing:
-                logger.warning(f"Duplicate prevention: Skipping contact_id={contact_id}")
-                continue
-
-            # --- Queue only (bulk) ---
-            sender_stats = await conn.fetchrow('SELECT last_sent, cooldown FROM sender_stats WHERE sender_email = $1', sender_email)
-            cooldown = sender_stats['cooldown'] if sender_stats else 120
-            last_sent = sender_stats['last_sent'] if sender_stats else None
-            # We intentionally ignore sender cooldown here; worker enforces it
-
-            # Worker will send later; just prepare queue metadata
-            conversation_id = None
-            message_id = None
-            logger.info(f"Prepared pending email for contact_id={contact_id}")
-
-            # --- Insert into email_queue ---
+            # Determine cc_recipients for the queued row: prefer explicit cc_store, fallback to extras in email field
+            cc_recipients = None
             try:
-                # Determine cc_recipients for the queued row: prefer explicit cc_store, fallback to extras in email field
+                if contact.get('cc_store'):
+                    parts = [p.strip() for p in re.split(r'[;,\s]+', contact.get('cc_store') or '') if p.strip()]
+                    cc_recipients = ';'.join(parts) if parts else None
+                else:
+                    parsed = process_emails(contact.get('email') or '', validate=True)
+                    if parsed and len(parsed) > 1:
+                        cc_recipients = ';'.join([p for p in parsed[1:]])
+            except Exception:
                 cc_recipients = None
-                try:
-                    if contact.get('cc_store'):
-                        parts = [p.strip() for p in re.split(r'[;,\s]+', contact.get('cc_store') or '') if p.strip()]
-                        cc_recipients = ';'.join(parts) if parts else None
-                    else:
-                        parsed = process_emails(contact.get('email') or '', validate=True)
-                        if parsed and len(parsed) > 1:
-                            cc_recipients = ';'.join([p for p in parsed[1:]])
-                except Exception:
-                    cc_recipients = None
 
-                # Only include attachment for payments or reminders related to payments
+            # Only include attachment for payments or reminders related to payments
+            attach_bytes = None
+            attach_filename = None
+            attach_mimetype = None
+            try:
+                # Infer message type: if the campaign item explicitly targets payments
+                if (item.get('type') == 'payments') or (item.get('stage') == 'payments'):
+                    attach_bytes = attachment_bytes
+                    # Bulk items may also provide filename/mimetype
+                    attach_filename = item.get('attachment_filename') or None
+                    attach_mimetype = item.get('attachment_mimetype') or None
+            except Exception:
                 attach_bytes = None
-                attach_filename = None
-                attach_mimetype = None
-                try:
-                    # Infer message type: if the campaign item explicitly targets payments
-                    if (item.get('type') == 'payments') or (item.get('stage') == 'payments'):
-                        attach_bytes = attachment_bytes
-                        # Bulk items may also provide filename/mimetype
-                        attach_filename = item.get('attachment_filename') or None
-                        attach_mimetype = item.get('attachment_mimetype') or None
-                except Exception:
-                    attach_bytes = None
 
-                row = await conn.fetchrow('''
-                    INSERT INTO email_queue (
-                        contact_id, sender_email, recipient_email, subject, message,
-                        created_at, due_at, type, status,
-                        message_type, cc_recipients, event_id, last_message_type,
-                        campaign_stage, forms_link, payment_link, attachment, attachment_filename, attachment_mimetype,
-                        conversation_id, message_id
-                    )
-                    VALUES ($1, $2, $3, $4, $5, $6, $7, 'campaign', 'pending', $8, $9, $10, $11, $12, $13, $14, $15, $16, $17, $18, $19)
-                    RETURNING *
-                ''',
-                contact_id, sender_email, contact['email'], subject_rendered, body_plain, now, now,
-                'campaign_main', cc_recipients, contact.get('event_id'), 'campaign_main', 'initial', forms_link, payment_link,
-                attach_bytes, attach_filename, attach_mimetype, conversation_id, message_id
-                )
+            # Worker will send later; duplicates (campaign_main already pending
+            # or sent) are dropped by the email_queue unique index.
+            pending_messages.append({
+                'contact_id': contact_id,
+                'sender_email': sender_email,
+                'recipient_email': contact['email'],
+                'subject': subject_rendered,
+                'message': body_plain,
+                'created_at': now,
+                'due_at': now,
+                'type': 'campaign',
+                'status': 'pending',
+                'message_type': 'campaign_main',
+                'cc_recipients': cc_recipients,
+                'event_id': contact.get('event_id'),
+                'last_message_type': 'campaign_main',
+                'campaign_stage': 'initial',
+                'forms_link': forms_link,
+                'payment_link': payment_link,
+                'attachment': attach_bytes,
+                'attachment_filename': attach_filename,
+                'attachment_mimetype': attach_mimetype,
+            })
+            prepared[int(contact_id)] = (contact, subject_rendered, sender_email)
 
-                # Log individual contact campaign start
-                await log_user_activity(
-                    conn,
-                    current_user,
-                    "START_INDIVIDUAL_CAMPAIGN",
-                    f"Started campaign for contact: {contact['name']} ({contact['email']}) - Subject: {subject_rendered[:50]}...",
-                    target_type="contact",
-                    target_id=contact_id,
-                    target_name=contact['name'],
-                    new_values={
+        # --- Insert all rows into email_queue in one round trip ---
+        try:
+            inserted = await enqueue_with_snapshot(conn, pending_messages)
+        except Exception as e:
+            logger.error(f"Bulk DB insert failed: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to queue campaign emails: {e}")
+
+        # Full queue rows, as the per-contact INSERT ... RETURNING * used to return
+        queued = []
+        if inserted:
+            queue_rows = await conn.fetch(
+                'SELECT * FROM email_queue WHERE id = ANY($1::int[]) ORDER BY id',
+                [row['id'] for row in inserted]
+            )
+            queued = [dict(row) for row in queue_rows]
+
+        skipped = len(pending_messages) - len(inserted)
+        if skipped:
+            logger.warning(f"Duplicate prevention: Skipped {skipped} contact(s) already queued or sent")
+
+        if queued:
+            # Log individual contact campaign starts (one audit row per contact)
+            activity_entries = []
+            for q in queued:
+                contact, subject_rendered, _ = prepared[q['contact_id']]
+                activity_entries.append({
+                    'action_description': f"Started campaign for contact: {contact['name']} ({contact['email']}) - Subject: {subject_rendered[:50]}...",
+                    'target_type': "contact",
+                    'target_id': q['contact_id'],
+                    'target_name': contact['name'],
+                    'new_values': {
                         "subject": subject_rendered,
-                        "queue_id": row["id"],
+                        "queue_id": q["id"],
                         "event_name": contact.get('event_name')
-                    }
-                )
-
-                queued.append(dict(row))
-                logger.info(f"Queued email for contact_id={contact_id}, email_queue_id={row['id']}")
-            except Exception as e:
-                logger.error(f"DB insert failed for contact_id={contact_id}: {e}")
-                continue
+                    },
+                })
+            await log_user_activities(conn, current_user, "START_INDIVIDUAL_CAMPAIGN", activity_entries)
 
-            # --- Update sender cooldown ---
+            # --- Update sender cooldown (once per sender/domain) ---
             # Randomize domain cooldown on bulk queue as well
-            try:
-                if sender_email and '@' in sender_email:
-                    domain = sender_email.split('@', 1)[1].lower()
-                    domain_key = f"domain:{domain}"
-                    domain_cd = random.randint(60, 180)
-                    await conn.execute('''
-                        INSERT INTO sender_stats (sender_email, last_sent, cooldown)
-                        VALUES ($1, $2, $3)
-                        ON CONFLICT (sender_email) DO UPDATE SET last_sent = $2, cooldown = $3
-                    ''', domain_key, now, domain_cd)
-            except Exception:
-                pass
+            for sender_email in {q['sender_email'] for q in queued}:
+                try:
+                    if sender_email and '@' in sender_email:
+                        domain = sender_email.split('@', 1)[1].lower()
+                        domain_key = f"domain:{domain}"
+                        domain_cd = random.randint(60, 180)
+                        await conn.execute('''
+                            INSERT INTO sender_stats (sender_email, last_sent, cooldown)
+                            VALUES ($1, $2, $3)
+                            ON CONFLICT (sender_email) DO UPDATE SET last_sent = $2, cooldown = $3
+                        ''', domain_key, now, domain_cd)
+                except Exception:
+                    pass
 
-            # Also update per-sender last_sent without forcing cooldown change
-            await conn.execute('''
-                INSERT INTO sender_stats (sender_email, last_sent, cooldown)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (sender_email) DO UPDATE SET last_sent = $2
-            ''', sender_email, now, cooldown)
+                # Also update per-sender last_sent without forcing cooldown change
+                await conn.execute('''
+                    INSERT INTO sender_stats (sender_email, last_sent, cooldown)
+                    VALUES ($1, $2, 120)
+                    ON CONFLICT (sender_email) DO UPDATE SET last_sent = $2
+                ''', sender_email, now)
 
-            # --- Update contact's trigger time and unpause the campaign ---
+            # --- Update contacts' trigger time and unpause the campaign ---
             trigger_text = f"{now.strftime('%Y-%m-%d %H:%M:%S')} - CAMPAIGN_STARTED: Campaign automatically resumed for bulk start"
             await conn.execute('''
                 UPDATE campaign_contacts
@@ -10976,10 +10666,10 @@ async def bulk_start_campaign(
                     campaign_paused = FALSE,
                     status = 'initial',
                     stage = 'initial'
-                WHERE id = $4
-            ''', trigger_text, now, 'first_message', contact_id)
+                WHERE id = ANY($4::int[])
+            ''', trigger_text, now, 'first_message', [q['contact_id'] for q in queued])
 
-        logger.info(f"Bulk campaign finished. Total sent: {len(queued)}")
+        logger.info(f"Bulk campaign finished. Total queued: {len(queued)}")
         return {"queued_emails": queued}
 
 @app.delete("/events/{event_id}")
@@ -11705,6 +11395,14 @@ async def get_detailed_email_stats(current_user: dict = Depends(get_current_user
         logger.error(f"Error getting detailed email stats: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/admin/templates/reload")
+async def reload_email_templates(current_user: dict = Depends(require_admin)):
+    """Re-read and recompile all email template files into the template registry"""
+    result = await asyncio.to_thread(template_registry.reload)
+    result["stats"] = template_registry.stats()
+    logger.info(f"[TEMPLATE] Templates reloaded by {current_user.get('username')}")
+    return result
+
 @app.get("/debug/templates")
 async def debug_templates(current_user: dict = Depends(get_current_user)):
     """Debug endpoint to check template files"""
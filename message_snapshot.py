@@ -0,0 +1,162 @@
+"""
+Queued Message Snapshot Module
+
+Each email_queue row carries the final payload that will be handed to Graph:
+cleaned subject, plain-text body with the quoted history already appended,
+the resolved To recipient, the CC list and the content type, plus a SHA-256
+hash of that payload. The snapshot is built once when the row is queued, so
+the send worker only reads and sends it.
+
+A BEFORE UPDATE trigger on email_queue drops the snapshot whenever subject,
+message, recipient_email or cc_recipients are edited on the row, in which
+case the send worker falls back to assembling the message itself.
+
+This module is imported and used by main.py for message queueing/sending.
+"""
+
+import json
+import hashlib
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PAYLOAD_SOURCE_FIELDS = ('subject', 'message', 'recipient_email', 'cc_recipients')
+
+# Latest reply (campaign_contact_replies, then received messages, then the
+# contact's own last_reply fields) and last sent body for a batch of contacts.
+HISTORY_QUERY = """
+    SELECT c.id, c.name, c.email, c.last_sent_body, c.last_sent_at,
+           e.event_name,
+           COALESCE(cr.body, m.body, c.last_reply_body) AS reply_body,
+           COALESCE(cr.received_at, m.received_at, c.last_reply_at) AS reply_at,
+           COALESCE(cr.message_id, m.message_id) AS reply_message_id
+    FROM campaign_contacts c
+    LEFT JOIN event e ON e.id = c.event_id
+    LEFT JOIN LATERAL (
+        SELECT body, received_at, message_id
+        FROM campaign_contact_replies
+        WHERE contact_id = c.id
+        ORDER BY received_at DESC
+        LIMIT 1
+    ) cr ON true
+    LEFT JOIN LATERAL (
+        SELECT body, received_at, message_id
+        FROM messages
+        WHERE contact_id = c.id AND direction = 'received'
+        ORDER BY received_at DESC
+        LIMIT 1
+    ) m ON true
+    WHERE c.id = ANY($1::int[])
+"""
+
+
+async def ensure_queue_payload_columns(conn):
+    """Add the snapshot columns to email_queue and the trigger that invalidates them."""
+    await conn.execute("""
+        ALTER TABLE email_queue
+            ADD COLUMN IF NOT EXISTS payload JSONB,
+            ADD COLUMN IF NOT EXISTS payload_hash TEXT,
+            ADD COLUMN IF NOT EXISTS payload_rendered_at TIMESTAMP
+    """)
+    source_new = ', '.join(f"NEW.{f}" for f in PAYLOAD_SOURCE_FIELDS)
+    source_old = ', '.join(f"OLD.{f}" for f in PAYLOAD_SOURCE_FIELDS)
+    await conn.execute(f"""
+        CREATE OR REPLACE FUNCTION email_queue_invalidate_payload()
+        RETURNS trigger AS $$
+        BEGIN
+            IF NEW.payload IS NOT NULL
+               AND NEW.payload IS NOT DISTINCT FROM OLD.payload
+               AND ROW({source_new}) IS DISTINCT FROM ROW({source_old}) THEN
+                NEW.payload := NULL;
+                NEW.payload_hash := NULL;
+                NEW.payload_rendered_at := NULL;
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_email_queue_payload ON email_queue")
+    await conn.execute("""
+        CREATE TRIGGER trg_email_queue_payload
+        BEFORE UPDATE ON email_queue
+        FOR EACH ROW EXECUTE FUNCTION email_queue_invalidate_payload()
+    """)
+    logger.info("[SNAPSHOT] Ensured email_queue payload columns and trigger")
+
+
+async def fetch_history(conn, contact_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Load quoting/subject sources for many contacts in one query."""
+    ids = sorted({int(i) for i in contact_ids if i is not None})
+    if not ids:
+        return {}
+    rows = await conn.fetch(HISTORY_QUERY, ids)
+    return {row['id']: dict(row) for row in rows}
+
+
+def append_quoted_history(message_body: str, history: Optional[Dict[str, Any]], sender_email: str) -> str:
+    """
+    Append the latest contact reply, or if there is none our last sent
+    message, as a quoted block under the new body.
+    """
+    if not history:
+        return message_body
+
+    if history.get('reply_body') and history.get('reply_at'):
+        reply_time = history['reply_at'].strftime("%a, %b %-d, %Y at %-I:%M %p")
+        quote_header = f"\n\nOn {reply_time} {history['name']} <{history['email']}> wrote:\n"
+        quote_text = "\n".join(history['reply_body'].splitlines())
+        return f"{message_body}\n{quote_header}{quote_text}"
+
+    if history.get('last_sent_body') and history.get('last_sent_at'):
+        sent_time = history['last_sent_at'].strftime("%a, %b %-d, %Y at %-I:%M %p")
+        quote_header = f"\n\nOn {sent_time} {sender_email} wrote:\n"
+        quote_text = "\n".join(history['last_sent_body'].splitlines())
+        return f"{message_body}\n{quote_header}{quote_text}"
+
+    return message_body
+
+
+def clean_subject(subject: Optional[str], event_name: Optional[str] = None) -> str:
+    """Collapse whitespace and never return an empty subject."""
+    if not subject or not str(subject).strip():
+        subject = f"Follow-up regarding {event_name or 'your reservation'}"
+    return ' '.join(str(subject).split())
+
+
+def payload_hash(payload: Dict[str, Any]) -> str:
+    """Stable SHA-256 over the payload fields."""
+    canonical = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def build_payload(subject: str, body: str, to: str, cc: Optional[List[str]], content_type: str = 'Text') -> Dict[str, Any]:
+    return {
+        'subject': subject,
+        'body': body,
+        'to': to,
+        'cc': list(cc) if cc else [],
+        'content_type': content_type,
+    }
+
+
+def read_payload(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Return the stored payload of a queue row if present and intact
+    (hash matches), otherwise None.
+    """
+    value = row.get('payload') if row else None
+    if not value:
+        return None
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return None
+    if not isinstance(value, dict) or not value.get('to') or not value.get('body'):
+        return None
+    stored_hash = row.get('payload_hash')
+    if stored_hash and stored_hash != payload_hash(value):
+        logger.warning(f"[SNAPSHOT] Payload hash mismatch for queue_id={row.get('id')}; rebuilding at send time")
+        return None
+    return value
@@ -0,0 +1,281 @@
+"""
+Message Store Module
+
+Batch helpers for recording inbound mail in the messages table.
+
+messages.message_id (the Graph message id for received mail) carries a
+unique partial index, so a whole inbox batch is checked for already
+processed messages with one = ANY($1) lookup and inserts rely on
+ON CONFLICT DO NOTHING instead of a SELECT before every INSERT.
+
+Every row also carries content_hash, an md5 fingerprint of the normalized
+sender, recipient, subject and body computed by a BEFORE INSERT/UPDATE
+trigger. Content duplicates of messages without an id are found with an
+index probe on content_hash, and duplicate cleanup walks the table
+incrementally from a stored id watermark instead of ranking every row.
+
+This module is imported and used by main.py for reply checking.
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from last_sent_by_address import NORMALIZE_FUNCTION_SQL
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_ID_INDEX = 'uniq_messages_message_id'
+MESSAGE_ID_FALLBACK_INDEX = 'idx_messages_message_id'
+CONTENT_HASH_INDEX = 'idx_messages_content_hash'
+
+# Messages with the same fingerprint this close together are duplicates
+DEDUPE_WINDOW_MINUTES = int(os.getenv('MESSAGE_DEDUPE_WINDOW_MINUTES', '5'))
+# Rows (by id) fingerprinted and checked per cleanup batch
+DEDUPE_BATCH_SIZE = int(os.getenv('MESSAGE_DEDUPE_BATCH_SIZE', '5000'))
+# Interval of the background cleanup job (hourly by default); 0 disables it
+DEDUPE_INTERVAL_SECONDS = int(os.getenv('MESSAGE_DEDUPE_INTERVAL_SECONDS', '3600'))
+DEDUPE_LOCK_KEY = 90005  # Advisory lock for the duplicate cleanup job
+
+CONTENT_HASH_FUNCTION_SQL = r"""
+    CREATE OR REPLACE FUNCTION message_content_hash(sender TEXT, recipient TEXT, subject TEXT, body TEXT)
+    RETURNS TEXT AS $$
+        SELECT md5(
+            COALESCE(normalize_email_address(sender), '') || chr(31) ||
+            COALESCE(normalize_email_address(recipient), '') || chr(31) ||
+            btrim(regexp_replace(lower(COALESCE(subject, '')), '^((re|fwd?)\s*:\s*)+', '')) || chr(31) ||
+            btrim(regexp_replace(lower(COALESCE(body, '')), '\s+', ' ', 'g'))
+        )
+    $$ LANGUAGE sql IMMUTABLE
+"""
+
+# (column, postgres type) of a received message row
+RECEIVED_COLUMNS = (
+    ('contact_id', 'int'),
+    ('direction', 'text'),
+    ('sender_email', 'text'),
+    ('recipient_email', 'text'),
+    ('cc_recipients', 'text'),
+    ('subject', 'text'),
+    ('body', 'text'),
+    ('received_at', 'timestamp'),
+    ('stage', 'text'),
+    ('message_id', 'text'),
+    ('in_reply_to', 'text'),
+)
+
+
+def _build_insert_sql() -> str:
+    names = [name for name, _ in RECEIVED_COLUMNS]
+    params = ', '.join(f'${i}::{pg_type}' for i, (_, pg_type) in enumerate(RECEIVED_COLUMNS, start=1))
+    mid = names.index('message_id') + 1
+    # NOT EXISTS covers databases where the unique index could not be built
+    return f"""
+        INSERT INTO messages ({', '.join(names)})
+        SELECT {params}
+        WHERE ${mid}::text IS NULL
+           OR NOT EXISTS (SELECT 1 FROM messages WHERE message_id = ${mid}::text)
+        ON CONFLICT DO NOTHING
+        RETURNING id
+    """
+
+
+INSERT_RECEIVED_SQL = _build_insert_sql()
+
+
+async def ensure_messages_message_id_index(conn) -> bool:
+    """
+    Create the unique index on messages.message_id.
+
+    Existing duplicate ids (rows stored before the index existed) block the
+    unique index; in that case a plain index is created so the batch lookup
+    stays indexed, and inserts are still guarded by NOT EXISTS.
+    """
+    try:
+        await conn.execute(f"""
+            CREATE UNIQUE INDEX IF NOT EXISTS {MESSAGE_ID_INDEX}
+            ON messages (message_id) WHERE message_id IS NOT NULL
+        """)
+        logger.info(f"[MESSAGES] Ensured unique index {MESSAGE_ID_INDEX}")
+        return True
+    except Exception as e:
+        logger.warning(f"[MESSAGES] Could not create unique index {MESSAGE_ID_INDEX} (duplicate message ids?): {e}")
+        await conn.execute(f"""
+            CREATE INDEX IF NOT EXISTS {MESSAGE_ID_FALLBACK_INDEX}
+            ON messages (message_id) WHERE message_id IS NOT NULL
+        """)
+        return False
+
+
+async def filter_unseen_message_ids(conn, message_ids: Iterable[Optional[str]]) -> List[str]:
+    """Return the ids (in input order, without duplicates) not yet stored in messages."""
+    ids = list(dict.fromkeys(i for i in message_ids if i))
+    if not ids:
+        return []
+    rows = await conn.fetch(
+        "SELECT message_id FROM messages WHERE message_id = ANY($1::text[])", ids
+    )
+    seen = {r['message_id'] for r in rows}
+    return [i for i in ids if i not in seen]
+
+
+async def insert_received_message(conn, message: Dict[str, Any]) -> bool:
+    """
+    Insert one received message; returns False if a row with the same
+    message_id already exists.
+    """
+    values = [message.get(name) for name, _ in RECEIVED_COLUMNS]
+    values[1] = message.get('direction') or 'received'
+    inserted = await conn.fetchval(INSERT_RECEIVED_SQL, *values)
+    return inserted is not None
+
+
+async def ensure_messages_content_hash(conn):
+    """Add messages.content_hash, its maintenance trigger and index."""
+    await conn.execute("ALTER TABLE messages ADD COLUMN IF NOT EXISTS content_hash TEXT")
+    await conn.execute(NORMALIZE_FUNCTION_SQL)
+    await conn.execute(CONTENT_HASH_FUNCTION_SQL)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION messages_set_content_hash()
+        RETURNS trigger AS $$
+        BEGIN
+            NEW.content_hash := message_content_hash(NEW.sender_email, NEW.recipient_email, NEW.subject, NEW.body);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_messages_content_hash ON messages")
+    await conn.execute("""
+        CREATE TRIGGER trg_messages_content_hash
+        BEFORE INSERT OR UPDATE OF sender_email, recipient_email, subject, body ON messages
+        FOR EACH ROW EXECUTE FUNCTION messages_set_content_hash()
+    """)
+    await conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS {CONTENT_HASH_INDEX}
+        ON messages (content_hash) WHERE content_hash IS NOT NULL
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS message_dedupe_state (
+            name TEXT PRIMARY KEY,
+            last_id BIGINT NOT NULL DEFAULT 0,
+            last_run_at TIMESTAMP,
+            last_deleted INTEGER DEFAULT 0
+        )
+    """)
+    logger.info(f"[MESSAGES] Ensured messages.content_hash trigger and index {CONTENT_HASH_INDEX}")
+
+
+async def find_content_duplicate(conn, sender: Optional[str], recipient: Optional[str], subject: Optional[str],
+                                 body: Optional[str], timestamp: Optional[datetime]) -> Optional[int]:
+    """
+    Id of a stored message with the same fingerprint within
+    DEDUPE_WINDOW_MINUTES of timestamp, or None.
+    """
+    if not timestamp:
+        return None
+    if timestamp.tzinfo:
+        timestamp = timestamp.replace(tzinfo=None)
+    return await conn.fetchval("""
+        SELECT id FROM messages
+        WHERE content_hash = message_content_hash($1, $2, $3, $4)
+          AND COALESCE(sent_at, received_at) BETWEEN $5::timestamp - make_interval(mins => $6)
+                                                 AND $5::timestamp + make_interval(mins => $6)
+        LIMIT 1
+    """, sender, recipient, subject, body, timestamp, DEDUPE_WINDOW_MINUTES)
+
+
+async def cleanup_duplicate_batch(conn, batch_size: int = DEDUPE_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Process the next batch of messages after the stored watermark.
+
+    Rows in the batch without a fingerprint (stored before the column
+    existed) are fingerprinted, then every row in the batch that repeats an
+    earlier row (lower id) with the same fingerprint within
+    DEDUPE_WINDOW_MINUTES is deleted. Earlier rows were fingerprinted by
+    previous batches, so each row is only ever looked at once.
+    """
+    async with conn.transaction():
+        await conn.execute("""
+            INSERT INTO message_dedupe_state (name) VALUES ('messages')
+            ON CONFLICT (name) DO NOTHING
+        """)
+        last_id = await conn.fetchval(
+            "SELECT last_id FROM message_dedupe_state WHERE name = 'messages' FOR UPDATE"
+        )
+        upper = await conn.fetchval(
+            "SELECT MAX(id) FROM (SELECT id FROM messages WHERE id > $1 ORDER BY id LIMIT $2) b",
+            last_id, batch_size
+        )
+        if upper is None:
+            return {'from_id': last_id, 'to_id': last_id, 'deleted': 0}
+
+        await conn.execute("""
+            UPDATE messages
+            SET content_hash = message_content_hash(sender_email, recipient_email, subject, body)
+            WHERE id > $1 AND id <= $2 AND content_hash IS NULL
+        """, last_id, upper)
+        deleted = await conn.fetchval("""
+            WITH deleted AS (
+                DELETE FROM messages r
+                WHERE r.id > $1 AND r.id <= $2
+                  AND r.content_hash IS NOT NULL
+                  AND COALESCE(r.sent_at, r.received_at) IS NOT NULL
+                  AND EXISTS (
+                      SELECT 1 FROM messages o
+                      WHERE o.content_hash = r.content_hash
+                        AND o.id < r.id
+                        AND COALESCE(o.sent_at, o.received_at)
+                            BETWEEN COALESCE(r.sent_at, r.received_at) - make_interval(mins => $3)
+                                AND COALESCE(r.sent_at, r.received_at) + make_interval(mins => $3)
+                  )
+                RETURNING r.id
+            )
+            SELECT COUNT(*) FROM deleted
+        """, last_id, upper, DEDUPE_WINDOW_MINUTES)
+        await conn.execute("""
+            UPDATE message_dedupe_state
+            SET last_id = $1, last_run_at = CURRENT_TIMESTAMP, last_deleted = $2
+            WHERE name = 'messages'
+        """, upper, deleted)
+    return {'from_id': last_id, 'to_id': upper, 'deleted': deleted}
+
+
+async def cleanup_duplicate_messages(conn, max_batches: Optional[int] = None) -> int:
+    """
+    Run cleanup batches until the watermark reaches the newest message
+    (or max_batches); returns the number of deleted rows. Skips the run if
+    another instance holds the cleanup lock.
+    """
+    if not await conn.fetchval(f"SELECT pg_try_advisory_lock({DEDUPE_LOCK_KEY})"):
+        logger.debug("[MESSAGES] Duplicate cleanup already running elsewhere")
+        return 0
+    total = 0
+    batches = 0
+    try:
+        while max_batches is None or batches < max_batches:
+            result = await cleanup_duplicate_batch(conn)
+            batches += 1
+            total += result['deleted']
+            if result['to_id'] == result['from_id']:
+                break
+            if result['deleted']:
+                logger.info(f"[MESSAGES] Removed {result['deleted']} duplicate message(s) in ids "
+                            f"{result['from_id'] + 1}..{result['to_id']}")
+    finally:
+        await conn.execute(f"SELECT pg_advisory_unlock({DEDUPE_LOCK_KEY})")
+    return total
+
+
+async def duplicate_cleanup_worker(pool):
+    """Periodically remove content duplicates among newly stored messages."""
+    while True:
+        try:
+            async with pool.acquire() as conn:
+                await cleanup_duplicate_messages(conn)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[MESSAGES] Duplicate cleanup error: {e}", exc_info=True)
+        await asyncio.sleep(DEDUPE_INTERVAL_SECONDS)
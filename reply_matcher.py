@@ -0,0 +1,286 @@
+"""
+Reply Matcher Module
+
+Matches inbound mailbox messages to campaign contacts through in-memory
+indexes instead of comparing every message with every contact.
+
+For one mailbox the matcher resolves each contact's last sent message once
+(email_queue first, then the messages-table fallback by address) and
+indexes the contacts by:
+
+- last sent Message-ID (In-Reply-To lookups)
+- last sent conversationId
+- normalized contact address (sender / To / Cc lookups)
+- normalized last sent subject
+
+Pending-queue state and message_contact_map rows (completed from the
+local mail archive) are prefetched in one query each, so resolving an inbound message only unions a few index
+buckets and evaluates the match rules for those candidates - no database
+access per message/contact pair.
+
+This module is imported and used by main.py for reply checking.
+"""
+
+import re
+import logging
+from collections import defaultdict
+from datetime import datetime, UTC
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Fallback matches by address only count if the message was sent recently
+FALLBACK_MAX_AGE_SECONDS = 30 * 86400
+
+_REPLY_PREFIX = re.compile(r'^(re|fwd)[:\s]+')
+
+
+def normalize_email(email: Optional[str]) -> str:
+    """Same normalization as main.normalize_email (lowercase, no brackets or display name)."""
+    if not email:
+        return ''
+    email = str(email).strip('<> \t\n\r')
+    if '<' in email and '>' in email:
+        email = email.split('<')[-1].split('>')[0].strip()
+    return email.lower()
+
+
+def normalize_subject(subject: Optional[str]) -> str:
+    """Lower-case, strip one leading Re:/Fwd: and collapse whitespace."""
+    if not subject:
+        return ''
+    s = _REPLY_PREFIX.sub('', subject.lower()).strip()
+    return re.sub(r'\s+', ' ', s)
+
+
+def normalize_subject_simple(subject: Optional[str]) -> str:
+    return _REPLY_PREFIX.sub('', (subject or '').lower()).strip()
+
+
+def strip_message_id(message_id: Optional[str]) -> str:
+    return (message_id or '').strip(' <>')
+
+
+def contact_addresses(contact: Dict[str, Any]) -> List[str]:
+    """All normalized addresses in a contact's (possibly comma-separated) email field."""
+    raw = contact.get('email') or ''
+    return [normalize_email(e) for e in raw.split(',') if e.strip()]
+
+
+def message_recipients(msg: Dict[str, Any]) -> Set[str]:
+    to_list = [normalize_email((r.get('emailAddress') or {}).get('address', '')) for r in (msg.get('toRecipients') or [])]
+    cc_list = [normalize_email((r.get('emailAddress') or {}).get('address', '')) for r in (msg.get('ccRecipients') or [])]
+    return set(r for r in to_list + cc_list if r)
+
+
+def message_sender(msg: Dict[str, Any]) -> str:
+    return normalize_email(((msg.get('from') or {}).get('emailAddress') or {}).get('address', ''))
+
+
+def _naive(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo:
+        return value.replace(tzinfo=None)
+    return value
+
+
+class ReplyMatcher:
+    """Index of one mailbox's active contacts for reply matching."""
+
+    def __init__(self, contacts: Iterable[Dict[str, Any]], last_sent_lookup: Dict[int, Dict[str, Any]],
+                 last_sent_by_email: Dict[str, Dict[str, Any]], pending_contact_ids: Iterable[int] = (),
+                 now: Optional[datetime] = None):
+        self.contacts: List[Dict[str, Any]] = list(contacts)
+        self.order: Dict[int, int] = {c['id']: i for i, c in enumerate(self.contacts)}
+        self.by_id: Dict[int, Dict[str, Any]] = {c['id']: c for c in self.contacts}
+        self.last_sent: Dict[int, Dict[str, Any]] = {}
+        self.message_map: Dict[str, Set[int]] = {}
+
+        self.by_message_id: Dict[str, List[int]] = defaultdict(list)
+        self.by_conversation: Dict[str, List[int]] = defaultdict(list)
+        self.by_address: Dict[str, List[int]] = defaultdict(list)
+        self.by_subject: Dict[str, List[int]] = defaultdict(list)
+
+        pending = set(pending_contact_ids)
+        now_naive = _naive(now or datetime.now(UTC))
+
+        for contact in self.contacts:
+            info = self._resolve_last_sent(contact, last_sent_lookup, last_sent_by_email, pending, now_naive)
+            if not info:
+                continue
+            cid = contact['id']
+            self.last_sent[cid] = info
+
+            message_id = strip_message_id(info.get('message_id'))
+            if message_id:
+                self.by_message_id[message_id].append(cid)
+            if info.get('conversation_id'):
+                self.by_conversation[info['conversation_id']].append(cid)
+            subject = normalize_subject(info.get('subject'))
+            if subject:
+                self.by_subject[subject].append(cid)
+
+            addresses = set(contact_addresses(contact))
+            addresses.add(normalize_email(contact.get('email')))
+            for address in addresses:
+                if address:
+                    self.by_address[address].append(cid)
+
+    @staticmethod
+    def _resolve_last_sent(contact, last_sent_lookup, last_sent_by_email, pending, now_naive):
+        info = last_sent_lookup.get(contact['id'])
+        if info:
+            return info
+
+        # No sent queue row for this contact: fall back to the last sent
+        # message addressed to it, unless a message is still pending.
+        if contact['id'] in pending:
+            logger.debug(f"[REPLY MATCHER] Skipping reply check for contact {contact['id']}: pending message exists")
+            return None
+
+        fallback = last_sent_by_email.get(normalize_email(contact.get('email')))
+        if not fallback:
+            return None
+
+        fallback_time = _naive(fallback.get('sent_at'))
+        time_diff = (now_naive - fallback_time).total_seconds() if fallback_time else float('inf')
+        is_recent = time_diff < FALLBACK_MAX_AGE_SECONDS
+        status_updated_at = _naive(contact.get('status_updated_at'))
+
+        if is_recent and (not status_updated_at or fallback_time >= status_updated_at):
+            logger.debug(f"[REPLY MATCHER] valid fallback for contact {contact['id']}")
+            return {
+                'contact_id': contact['id'],
+                'subject': None,
+                'sent_at': fallback.get('sent_at'),
+                'message_id': fallback.get('message_id'),
+                'conversation_id': fallback.get('conversation_id')
+            }
+        logger.debug(f"[REPLY MATCHER] invalid fallback for contact {contact['id']}")
+        return None
+
+    @classmethod
+    async def build(cls, conn, contacts: Iterable[Dict[str, Any]], last_sent_lookup: Dict[int, Dict[str, Any]],
+                    last_sent_by_email: Dict[str, Dict[str, Any]]) -> 'ReplyMatcher':
+        """Create a matcher, loading pending-queue state for the contacts in one query."""
+        contacts = list(contacts)
+        without_sent = [c['id'] for c in contacts if c['id'] not in last_sent_lookup]
+        pending: List[int] = []
+        if without_sent:
+            rows = await conn.fetch(
+                "SELECT DISTINCT contact_id FROM email_queue WHERE contact_id = ANY($1::int[]) AND status = 'pending'",
+                without_sent
+            )
+            pending = [r['contact_id'] for r in rows]
+        return cls(contacts, last_sent_lookup, last_sent_by_email, pending)
+
+    async def prefetch_message_map(self, conn, messages: Iterable[Dict[str, Any]]):
+        """Load message_contact_map rows for every In-Reply-To of a message batch."""
+        ids = sorted({strip_message_id(m.get('inReplyTo')) for m in messages} - {''})
+        self.message_map = {}
+        if not ids:
+            return
+        try:
+            rows = await conn.fetch(
+                'SELECT message_id, contact_id FROM message_contact_map WHERE message_id = ANY($1::text[])', ids
+            )
+        except Exception as e:
+            logger.warning(f"[REPLY MATCHER] Could not load message_contact_map: {e}")
+            return
+        for row in rows:
+            self.message_map.setdefault(row['message_id'], set()).add(row['contact_id'])
+
+    def add_reply_recipients(self, recipients: Dict[str, Set[str]]):
+        """
+        Extend message_map from archived sent messages: an In-Reply-To id
+        without a message_contact_map row maps to the indexed contacts among
+        the To/Cc recipients of the sent message it answers.
+        """
+        for message_id, addresses in recipients.items():
+            if message_id in self.message_map:
+                continue
+            ids = {cid for address in addresses for cid in self.by_address.get(address, ())}
+            if ids:
+                self.message_map[message_id] = ids
+
+    def _candidates(self, msg: Dict[str, Any], in_reply_to: str, sender: str, recipients: Set[str]) -> List[int]:
+        ids: Set[int] = set()
+        if in_reply_to:
+            ids.update(self.by_message_id.get(in_reply_to, ()))
+            ids.update(c for c in self.message_map.get(in_reply_to, ()) if c in self.by_id)
+        if msg.get('conversationId'):
+            ids.update(self.by_conversation.get(msg['conversationId'], ()))
+        if sender:
+            ids.update(self.by_address.get(sender, ()))
+        for address in recipients:
+            ids.update(self.by_address.get(address, ()))
+        subject = normalize_subject(msg.get('subject'))
+        if subject:
+            ids.update(self.by_subject.get(subject, ()))
+        # Keep the original contact order so the first matching contact wins
+        return sorted((i for i in ids if i in self.last_sent), key=self.order.__getitem__)
+
+    def match(self, msg: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Contacts the message is a reply candidate for, in priority order.
+
+        Rules, per candidate contact:
+        1. If In-Reply-To is in message_contact_map, only the mapped
+           contacts can match.
+        2. In-Reply-To equals the last sent Message-ID, or the
+           conversationId equals the last sent conversation.
+        3. The last sent subject is contained in the message subject and
+           the contact is a To/Cc recipient.
+        4. The contact is the sender and the last sent subject is
+           contained in the message subject.
+        """
+        in_reply_to = strip_message_id(msg.get('inReplyTo'))
+        sender = message_sender(msg)
+        recipients = message_recipients(msg)
+        msg_subject_raw = msg.get('subject', '') or ''
+        msg_sub_norm = normalize_subject(msg_subject_raw)
+        mapped = self.message_map.get(in_reply_to) if in_reply_to else None
+
+        matches = []
+        for cid in self._candidates(msg, in_reply_to, sender, recipients):
+            contact = self.by_id[cid]
+            info = self.last_sent[cid]
+            contact_email_norm = normalize_email(contact.get('email'))
+            is_match = False
+
+            if mapped:
+                if cid not in mapped:
+                    continue
+                is_match = True
+                logger.info(f"[REPLY CHECKER] Matched via message_contact_map for contact {cid} message {in_reply_to}")
+
+            last_message_id = strip_message_id(info.get('message_id'))
+            if in_reply_to and last_message_id and in_reply_to == last_message_id:
+                is_match = True
+            elif msg.get('conversationId') and info.get('conversation_id') and \
+                    msg.get('conversationId') == info.get('conversation_id'):
+                is_match = True
+
+            if not is_match:
+                last_sub_norm = normalize_subject(info.get('subject'))
+                if last_sub_norm and msg_sub_norm and last_sub_norm in msg_sub_norm and contact_email_norm in recipients:
+                    is_match = True
+
+            if not is_match and sender and contact_email_norm and sender == contact_email_norm:
+                last_sub = info.get('subject') or ''
+                if last_sub and normalize_subject_simple(last_sub) in normalize_subject_simple(msg_subject_raw):
+                    is_match = True
+                    logger.info(f"[REPLY CHECKER] Fallback sender+subject match for contact {cid} sender={sender} msg_id={msg.get('id')}")
+
+            if is_match:
+                matches.append(contact)
+        return matches
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'contacts': len(self.contacts),
+            'indexed': len(self.last_sent),
+            'message_ids': len(self.by_message_id),
+            'conversations': len(self.by_conversation),
+            'addresses': len(self.by_address),
+            'subjects': len(self.by_subject),
+        }
@@ -0,0 +1,408 @@
+"""
+Send Volume Forecast Module
+
+Projects how many emails each sender mailbox will have to send per hour over
+the coming days so operators can see when a sender is about to fall behind.
+
+The forecast is built from the current campaign state only (nothing is queued
+or sent):
+
+- Active contacts are aggregated in SQL into cohorts sharing the same sender,
+  stage, last message type and anchor hour, so the projection cost depends on
+  the number of cohorts rather than the number of contacts.
+- Each cohort is walked through the stage cadence (the same day gaps used by
+  send_campaign_message / send_email_worker) to get the hours its future
+  messages become due.
+- Due messages are shifted into UK business hours and drained per sending
+  domain at the rate allowed by the domain cooldown enforced by the send
+  worker. Messages that cannot be drained in a business hour carry over and
+  are reported as backlog windows.
+
+Reminder due times are anchored on the projected due hour of the previous
+message, not its drained hour, so backlog delays are not compounded.
+"""
+
+import os
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta, UTC
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+import inspect
+
+from business_hours import next_allowed_uk_business_time
+
+logger = logging.getLogger(__name__)
+
+FORECAST_DEFAULT_DAYS = int(os.getenv('FORECAST_DEFAULT_DAYS', '14'))
+FORECAST_MAX_DAYS = int(os.getenv('FORECAST_MAX_DAYS', '31'))
+# The send worker sets a random 60-180s cooldown per sending domain after each
+# send, so on average one message leaves a domain every 120 seconds.
+FORECAST_MEAN_COOLDOWN_SECONDS = float(os.getenv('FORECAST_MEAN_COOLDOWN_SECONDS', '120'))
+
+# Cadence per canonical stage: (message_type, days after the previous message).
+# Mirrors the delay maps used when queueing and sending reminders.
+STAGE_CADENCES: Dict[str, List[Tuple[str, int]]] = {
+    'initial': [
+        ('campaign_main', 0),
+        ('reminder1', 3),
+        ('reminder2', 4),
+    ],
+    'forms': [
+        ('forms_initial', 0),
+        ('forms_reminder1', 2),
+        ('forms_reminder2', 2),
+        ('forms_reminder3', 3),
+    ],
+    'payments': [
+        ('payments_initial', 0),
+        ('payments_reminder1', 2),
+        ('payments_reminder2', 2),
+        ('payments_reminder3', 3),
+        ('payments_reminder4', 7),
+        ('payments_reminder5', 7),
+        ('payments_reminder6', 7),
+    ],
+    'sepa': [
+        ('sepa_initial', 0),
+        ('sepa_reminder1', 2),
+        ('sepa_reminder2', 2),
+        ('sepa_reminder3', 2),
+        ('payments_reminder4', 7),
+        ('payments_reminder5', 7),
+        ('payments_reminder6', 7),
+    ],
+    'rh': [
+        ('rh_initial', 0),
+        ('rh_reminder1', 2),
+        ('rh_reminder2', 2),
+        ('rh_reminder3', 2),
+        ('payments_reminder4', 7),
+        ('payments_reminder5', 7),
+        ('payments_reminder6', 7),
+    ],
+}
+
+# Legacy message type names still present in historical rows
+MESSAGE_TYPE_ALIASES = {
+    'forms_main': 'forms_initial',
+    'payment_main': 'payments_initial',
+    'first_message': 'campaign_main',
+}
+
+COHORT_QUERY = """
+    SELECT
+        LOWER(TRIM(COALESCE(NULLIF(TRIM(e.sender_email), ''), $1))) AS sender_email,
+        LOWER(COALESCE(cc.stage, '')) AS stage,
+        cc.last_message_type,
+        date_trunc('hour', pq.next_at) AS pending_hour,
+        date_trunc('hour', COALESCE(ls.sent_at, cc.last_triggered_at)) AS last_sent_hour,
+        COUNT(*) AS contacts
+    FROM campaign_contacts cc
+    JOIN event e ON e.id = cc.event_id
+    LEFT JOIN (
+        SELECT contact_id, MIN(COALESCE(scheduled_at, due_at, created_at)) AS next_at
+        FROM email_queue
+        WHERE status = 'pending'
+        GROUP BY contact_id
+    ) pq ON pq.contact_id = cc.id
+    LEFT JOIN (
+        SELECT contact_id, MAX(sent_at) AS sent_at
+        FROM email_queue
+        WHERE status = 'sent' AND sent_at IS NOT NULL
+        GROUP BY contact_id
+    ) ls ON ls.contact_id = cc.id
+    WHERE COALESCE(cc.campaign_paused, FALSE) = FALSE
+      AND LOWER(COALESCE(cc.status, '')) NOT IN ('completed', 'cancelled', 'replied', 'bounced')
+      AND LOWER(COALESCE(cc.stage, '')) NOT IN ('completed', 'cancelled')
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+
+def canonical_stage(raw_stage: Optional[str]) -> Optional[str]:
+    """Map a stored stage string to a cadence key (same rules as the campaign worker)."""
+    raw_stage = (raw_stage or '').lower()
+    if not raw_stage:
+        return 'initial'
+    if 'custom' in raw_stage:
+        # Custom flows carry their own per-step delays; not projected
+        return None
+    if 'rh' in raw_stage:
+        return 'rh'
+    if 'payment' in raw_stage:
+        return 'payments'
+    if 'sepa' in raw_stage:
+        return 'sepa'
+    if 'forms' in raw_stage:
+        return 'forms'
+    return 'initial'
+
+
+def project_cohort(stage: str, last_message_type: Optional[str], pending_at: Optional[datetime],
+                   last_sent_at: Optional[datetime], now: datetime, horizon_end: datetime) -> List[Tuple[str, datetime]]:
+    """Return (message_type, due_at) for the messages a cohort will need before horizon_end."""
+    cadence = STAGE_CADENCES.get(stage)
+    if not cadence:
+        return []
+
+    message_type = MESSAGE_TYPE_ALIASES.get(last_message_type, last_message_type)
+    types = [t for t, _ in cadence]
+    projected: List[Tuple[str, datetime]] = []
+
+    if message_type in types:
+        position = types.index(message_type)
+        if pending_at is not None:
+            # The pending row is the message of the current position
+            anchor = max(pending_at, now)
+            projected.append((message_type, anchor))
+        else:
+            anchor = last_sent_at or now
+        next_position = position + 1
+    elif pending_at is not None:
+        # Pending row for a type outside the cadence (manual / stage change)
+        anchor = max(pending_at, now)
+        projected.append((message_type or types[0], anchor))
+        next_position = 1 if message_type is None else len(types)
+    elif message_type is None or stage != 'initial':
+        # Nothing sent in this stage yet: its initial message is due now
+        anchor = now
+        projected.append((types[0], anchor))
+        next_position = 1
+    else:
+        return []
+
+    for msg_type, gap_days in cadence[next_position:]:
+        anchor = anchor + timedelta(days=gap_days)
+        if anchor >= horizon_end:
+            break
+        projected.append((msg_type, max(anchor, now)))
+    return projected
+
+
+def _sender_domain(sender_email: str) -> str:
+    return sender_email.split('@', 1)[1] if '@' in sender_email else sender_email
+
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(UTC).replace(tzinfo=None)
+    return value
+
+
+def build_forecast(cohorts: List[Any], now: Optional[datetime] = None, days: int = FORECAST_DEFAULT_DAYS,
+                   default_sender: str = '', senders: Optional[List[str]] = None,
+                   mean_cooldown_seconds: float = FORECAST_MEAN_COOLDOWN_SECONDS) -> Dict[str, Any]:
+    """
+    Build the per-sender per-hour forecast from cohort rows.
+
+    Each cohort row provides sender_email, stage, last_message_type,
+    pending_hour, last_sent_hour and contacts (see COHORT_QUERY).
+    """
+    now = _naive_utc(now) or datetime.now(UTC).replace(tzinfo=None)
+    start = now.replace(minute=0, second=0, microsecond=0)
+    hours = max(1, int(days) * 24)
+    horizon_end = start + timedelta(hours=hours)
+    hour_starts = [start + timedelta(hours=h) for h in range(hours)]
+
+    # Business-hour mask, and where a message due in hour h is actually released
+    sendable = [next_allowed_uk_business_time(hs) <= hs for hs in hour_starts]
+    release_index: List[int] = [hours] * hours
+    next_open = hours
+    for h in range(hours - 1, -1, -1):
+        if sendable[h]:
+            next_open = h
+        release_index[h] = next_open
+
+    demand: Dict[str, List[int]] = defaultdict(lambda: [0] * hours)
+    by_type: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+    skipped_contacts = 0
+
+    for row in cohorts:
+        sender = (row['sender_email'] or default_sender or '').lower()
+        count = int(row['contacts'] or 0)
+        stage = canonical_stage(row['stage'])
+        if not sender or not count or stage is None:
+            skipped_contacts += count
+            continue
+        emissions = project_cohort(
+            stage,
+            row['last_message_type'],
+            _naive_utc(row['pending_hour']),
+            _naive_utc(row['last_sent_hour']),
+            now,
+            horizon_end,
+        )
+        sender_demand = demand[sender]
+        for msg_type, due_at in emissions:
+            h = int((due_at - start).total_seconds() // 3600)
+            if h < 0:
+                h = 0
+            if h >= hours:
+                continue
+            released = release_index[h]
+            if released >= hours:
+                continue
+            sender_demand[released] += count
+            by_type[sender][msg_type] += count
+
+    for sender in senders or []:
+        demand[sender.lower()]
+
+    # Drain the queue per sending domain: senders on the same domain share the
+    # domain cooldown enforced by the send worker.
+    capacity_per_hour = int(3600 // max(1.0, float(mean_cooldown_seconds)))
+    domains: Dict[str, List[str]] = defaultdict(list)
+    for sender in demand:
+        domains[_sender_domain(sender)].append(sender)
+
+    projected: Dict[str, List[int]] = {s: [0] * hours for s in demand}
+    backlog: Dict[str, List[int]] = {s: [0] * hours for s in demand}
+    backlog_windows: List[Dict[str, Any]] = []
+
+    for domain, domain_senders in domains.items():
+        waiting = {s: 0 for s in domain_senders}
+        window = None
+        for h in range(hours):
+            for s in domain_senders:
+                waiting[s] += demand[s][h]
+            total = sum(waiting.values())
+            if sendable[h] and total:
+                budget = min(total, capacity_per_hour)
+                # Share the hour's budget proportionally to what each sender has waiting
+                shares = {s: (waiting[s] * budget) // total for s in domain_senders}
+                leftover = budget - sum(shares.values())
+                for s in sorted(domain_senders, key=lambda x: waiting[x] - shares[x], reverse=True):
+                    if leftover <= 0:
+                        break
+                    if waiting[s] > shares[s]:
+                        shares[s] += 1
+                        leftover -= 1
+                for s in domain_senders:
+                    projected[s][h] = shares[s]
+                    waiting[s] -= shares[s]
+            remaining = sum(waiting.values())
+            for s in domain_senders:
+                backlog[s][h] = waiting[s]
+
+            # A backlog window is a run of business hours that end with mail still waiting
+            if sendable[h] and remaining:
+                if window is None:
+                    window = {
+                        'domain': domain,
+                        'start': hour_starts[h].isoformat(),
+                        'end': (hour_starts[h] + timedelta(hours=1)).isoformat(),
+                        'peak_backlog': remaining,
+                        'senders': sorted(s for s in domain_senders if waiting[s]),
+                    }
+                else:
+                    window['end'] = (hour_starts[h] + timedelta(hours=1)).isoformat()
+                    window['peak_backlog'] = max(window['peak_backlog'], remaining)
+                    window['senders'] = sorted(set(window['senders']) | {s for s in domain_senders if waiting[s]})
+            elif sendable[h] and window is not None:
+                backlog_windows.append(window)
+                window = None
+        if window is not None:
+            backlog_windows.append(window)
+
+    senders_out = {}
+    for sender in sorted(demand):
+        senders_out[sender] = {
+            'domain': _sender_domain(sender),
+            'total_due': sum(demand[sender]),
+            'total_projected': sum(projected[sender]),
+            'backlog_at_horizon': backlog[sender][-1],
+            'by_message_type': dict(by_type.get(sender, {})),
+            'hours': [
+                {
+                    'hour': hour_starts[h].isoformat(),
+                    'due': demand[sender][h],
+                    'projected': projected[sender][h],
+                    'backlog': backlog[sender][h],
+                }
+                for h in range(hours)
+            ],
+        }
+
+    backlog_windows.sort(key=lambda w: w['start'])
+    return {
+        'generated_at': now.isoformat(),
+        'horizon_start': start.isoformat(),
+        'horizon_hours': hours,
+        'domain_capacity_per_hour': capacity_per_hour,
+        'cohorts': len(cohorts),
+        'skipped_contacts': skipped_contacts,
+        'senders': senders_out,
+        'backlog_windows': backlog_windows,
+    }
+
+
+async def compute_send_forecast(conn, days: int = FORECAST_DEFAULT_DAYS, default_sender: str = '',
+                                senders: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Load the cohort aggregate and build the forecast."""
+    cohorts = await conn.fetch(COHORT_QUERY, default_sender or '')
+    forecast = build_forecast(cohorts, days=days, default_sender=default_sender, senders=senders)
+    logger.info(
+        f"[FORECAST] Built {forecast['horizon_hours']}h forecast from {forecast['cohorts']} cohorts, "
+        f"{len(forecast['backlog_windows'])} backlog windows"
+    )
+    return forecast
+
+
+def create_send_forecast_router():
+    """Factory function to create the send forecast router"""
+    router = APIRouter()
+
+    def get_db_pool():
+        """Get the DB pool from main module"""
+        import main
+        return main.get_db_pool()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    @router.get("/admin/send-forecast")
+    async def get_send_forecast(
+        days: int = Query(FORECAST_DEFAULT_DAYS, ge=1),
+        sender_email: Optional[str] = None,
+        current_user: dict = Depends(get_current_user)
+    ):
+        """
+        Projected per-sender hourly send volume and backlog windows.
+        """
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+
+        pool = get_db_pool()
+        if not pool:
+            raise HTTPException(status_code=503, detail="Database pool not available")
+
+        import main
+        try:
+            async with pool.acquire() as conn:
+                forecast = await compute_send_forecast(
+                    conn,
+                    days=min(days, FORECAST_MAX_DAYS),
+                    default_sender=main.DEFAULT_SENDER_EMAIL or '',
+                    senders=main.assignable_senders(),
+                )
+        except Exception as e:
+            logger.error(f"[FORECAST] Failed to build send forecast: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to build send forecast: {e}")
+
+        if sender_email:
+            wanted = sender_email.strip().lower()
+            forecast['senders'] = {k: v for k, v in forecast['senders'].items() if k == wanted}
+            forecast['backlog_windows'] = [w for w in forecast['backlog_windows'] if wanted in w['senders']]
+        return forecast
+
+    return router
+
+
+router = create_send_forecast_router()
@@ -0,0 +1,355 @@
+"""
+Sender Registry Module
+
+Registry of the Graph sender mailboxes: tenant and app credentials,
+rate limits, per-event capacity and whether the mailbox may send or be
+auto-assigned to new events.
+
+Rows live in the sender_registry table and are held in memory as a dict
+keyed by lowercased mailbox, so get_sender_config() is a single lookup
+on the send path. Client secrets are never stored in the database: a row
+names the environment variable holding its secret (credential_ref).
+
+Senders configured through the AZURE_*_1..3 / GRAPH_SENDER_EMAIL_*
+environment variables are always known, which keeps scripts and workers
+working before the database is reached; on first start they and the
+built-in assignable senders are seeded into the table. Database rows
+take precedence over the environment once loaded.
+
+sender_registry_worker polls a cheap fingerprint of the table (row count
+and latest updated_at, kept current by a trigger) and reloads on change,
+so adding, disabling or re-limiting a sender needs no restart.
+
+This module is imported and used by graph_email.py, main.py and
+graph_webhooks.py.
+"""
+
+import os
+import asyncio
+import inspect
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+
+logger = logging.getLogger(__name__)
+
+# Events per sender before rotation moves on to the next sender
+DEFAULT_CAPACITY_PER_EVENT = int(os.getenv('SENDER_CAPACITY_PER_EVENT', '50'))
+# Interval of the change check; 0 disables hot reload
+RELOAD_SECONDS = int(os.getenv('SENDER_REGISTRY_RELOAD_SECONDS', '30'))
+
+# Editable columns accepted by upsert_sender
+SENDER_FIELDS = (
+    'tenant_id', 'client_id', 'credential_ref', 'hourly_limit', 'daily_limit',
+    'max_concurrency', 'capacity_per_event', 'enabled', 'assignable', 'sort_order',
+)
+
+
+def _env_senders() -> List[Dict[str, Any]]:
+    """Senders configured in the environment (numbered sets, then the default)."""
+    senders = []
+    for suffix in ('_1', '_2', '_3', ''):
+        sender_email = os.getenv(f'GRAPH_SENDER_EMAIL{suffix}')
+        if not sender_email:
+            continue
+        senders.append({
+            'mailbox': sender_email.strip().lower(),
+            'tenant_id': os.getenv(f'AZURE_TENANT_ID{suffix}'),
+            'client_id': os.getenv(f'AZURE_CLIENT_ID{suffix}'),
+            'credential_ref': f'AZURE_CLIENT_SECRET{suffix}',
+        })
+    return senders
+
+
+def _sender_config(row: Dict[str, Any], fallback: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """The sender dict handed to graph_email (same shape as before plus limits)."""
+    fallback = fallback or {}
+    tenant_id = row.get('tenant_id') or fallback.get('tenant_id')
+    client_id = row.get('client_id') or fallback.get('client_id')
+    credential_ref = row.get('credential_ref')
+    client_secret = os.getenv(credential_ref) if credential_ref else None
+    if not client_secret and client_id and fallback.get('client_id') == client_id:
+        client_secret = fallback.get('client_secret')
+    capacity = row.get('capacity_per_event')
+    return {
+        'sender_email': row['mailbox'],
+        'tenant_id': tenant_id,
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'credential_ref': credential_ref,
+        'msal_app': None,
+        'hourly_limit': row.get('hourly_limit'),
+        'daily_limit': row.get('daily_limit'),
+        'max_concurrency': row.get('max_concurrency'),
+        'capacity_per_event': capacity if capacity and capacity > 0 else DEFAULT_CAPACITY_PER_EVENT,
+        'enabled': row.get('enabled', True),
+        'assignable': row.get('assignable', False),
+        'sort_order': row.get('sort_order') or 0,
+    }
+
+
+class SenderRegistry:
+    """In-memory sender map; reload() swaps the whole map at once."""
+
+    def __init__(self):
+        self._env: Dict[str, Dict[str, Any]] = {}
+        for row in _env_senders():
+            self._env.setdefault(row['mailbox'], _sender_config(row))
+        self._senders: Dict[str, Dict[str, Any]] = dict(self._env)
+        self._assignable: Tuple[str, ...] = ()
+        self._default_assignable: Tuple[str, ...] = ()
+        self._fingerprint: Optional[Tuple[Any, Any]] = None
+        self.loaded_from_db = False
+
+    def set_default_assignable(self, mailboxes: Iterable[str]):
+        """Rotation order used until the table has been loaded."""
+        self._default_assignable = tuple(m.strip().lower() for m in mailboxes)
+        if not self.loaded_from_db:
+            self._assignable = self._default_assignable
+
+    def get(self, mailbox: Optional[str]) -> Optional[Dict[str, Any]]:
+        if not mailbox:
+            return None
+        return self._senders.get(mailbox.strip().lower())
+
+    def get_sender_config(self, sender_email: Optional[str]) -> Dict[str, Any]:
+        """Credentials of an enabled sender; raises like the old graph_email lookup."""
+        if not sender_email:
+            raise Exception("No sender_email provided to get_sender_config")
+        sender = self._senders.get(sender_email.strip().lower())
+        if sender is None or not sender['client_id'] or not sender['client_secret']:
+            raise Exception(f"No Azure config found for sender {sender_email}")
+        if not sender['enabled']:
+            raise Exception(f"Sender {sender_email} is disabled in the sender registry")
+        if not sender['tenant_id'] or sender['tenant_id'].lower() == 'none':
+            raise Exception(f"Missing or invalid tenant_id for sender {sender_email}")
+        return sender
+
+    def assignable_senders(self) -> List[str]:
+        """Enabled senders used for event auto-assignment, in rotation order."""
+        return list(self._assignable)
+
+    def is_assignable(self, mailbox: Optional[str]) -> bool:
+        return bool(mailbox) and mailbox.strip().lower() in self._assignable
+
+    def capacity_per_event(self, mailbox: str) -> int:
+        sender = self.get(mailbox)
+        return sender['capacity_per_event'] if sender else DEFAULT_CAPACITY_PER_EVENT
+
+    def credentials(self) -> List[Tuple[str, str, str]]:
+        """(tenant_id, client_id, client_secret) of every usable enabled sender."""
+        credentials = []
+        for sender in self._senders.values():
+            if sender['enabled'] and sender['tenant_id'] and sender['client_id'] and sender['client_secret']:
+                key = (sender['tenant_id'], sender['client_id'], sender['client_secret'])
+                if key not in credentials:
+                    credentials.append(key)
+        return credentials
+
+    def apply_rows(self, rows: Iterable[Any], fingerprint: Optional[Tuple[Any, Any]] = None):
+        senders = dict(self._env)
+        for row in rows:
+            row = dict(row)
+            row['mailbox'] = row['mailbox'].strip().lower()
+            senders[row['mailbox']] = _sender_config(row, self._env.get(row['mailbox']))
+        ordered = sorted(senders.values(), key=lambda s: (s['sort_order'], s['sender_email']))
+        self._senders = senders
+        self._assignable = tuple(s['sender_email'] for s in ordered if s['enabled'] and s['assignable'])
+        self._fingerprint = fingerprint
+        self.loaded_from_db = True
+
+    def status(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                'mailbox': s['sender_email'],
+                'tenant_id': s['tenant_id'],
+                'client_id': s['client_id'],
+                'credential_ref': s['credential_ref'],
+                'has_secret': bool(s['client_secret']),
+                'hourly_limit': s['hourly_limit'],
+                'daily_limit': s['daily_limit'],
+                'max_concurrency': s['max_concurrency'],
+                'capacity_per_event': s['capacity_per_event'],
+                'enabled': s['enabled'],
+                'assignable': s['assignable'],
+                'sort_order': s['sort_order'],
+            }
+            for s in sorted(self._senders.values(), key=lambda s: (s['sort_order'], s['sender_email']))
+        ]
+
+
+sender_registry = SenderRegistry()
+
+
+def get_sender_config(sender_email: Optional[str]) -> Dict[str, Any]:
+    return sender_registry.get_sender_config(sender_email)
+
+
+def assignable_senders() -> List[str]:
+    return sender_registry.assignable_senders()
+
+
+async def ensure_sender_registry_table(conn, default_assignable: Iterable[str] = ()):
+    """Create sender_registry and seed it once from the environment and default senders."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS sender_registry (
+            mailbox TEXT PRIMARY KEY,
+            tenant_id TEXT,
+            client_id TEXT,
+            credential_ref TEXT,
+            hourly_limit INTEGER,
+            daily_limit INTEGER,
+            max_concurrency INTEGER,
+            capacity_per_event INTEGER,
+            enabled BOOLEAN NOT NULL DEFAULT TRUE,
+            assignable BOOLEAN NOT NULL DEFAULT FALSE,
+            sort_order INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await conn.execute("""
+        CREATE OR REPLACE FUNCTION sender_registry_touch() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := CURRENT_TIMESTAMP;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    await conn.execute("DROP TRIGGER IF EXISTS trg_sender_registry_touch ON sender_registry")
+    await conn.execute("""
+        CREATE TRIGGER trg_sender_registry_touch
+        BEFORE UPDATE ON sender_registry
+        FOR EACH ROW EXECUTE FUNCTION sender_registry_touch()
+    """)
+
+    if await conn.fetchval("SELECT COUNT(*) FROM sender_registry") == 0:
+        assignable = [m.strip().lower() for m in default_assignable]
+        seeds: Dict[str, Tuple] = {}
+        for order, mailbox in enumerate(assignable):
+            seeds[mailbox] = (mailbox, None, None, None, True, order)
+        for row in _env_senders():
+            mailbox = row['mailbox']
+            order = assignable.index(mailbox) if mailbox in assignable else len(assignable)
+            seeds[mailbox] = (mailbox, row['tenant_id'], row['client_id'], row['credential_ref'],
+                              mailbox in assignable, order)
+        await conn.executemany("""
+            INSERT INTO sender_registry (mailbox, tenant_id, client_id, credential_ref, assignable, sort_order)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            ON CONFLICT (mailbox) DO NOTHING
+        """, list(seeds.values()))
+        logger.info(f"[SENDERS] Seeded sender_registry with {len(seeds)} sender(s)")
+    logger.info("[SENDERS] Ensured sender_registry table")
+
+
+async def _fingerprint(conn) -> Tuple[Any, Any]:
+    row = await conn.fetchrow("SELECT COUNT(*) AS n, MAX(updated_at) AS changed FROM sender_registry")
+    return (row['n'], row['changed'])
+
+
+async def load_sender_registry(conn) -> int:
+    """Replace the in-memory registry with the table contents."""
+    fingerprint = await _fingerprint(conn)
+    rows = await conn.fetch(f"SELECT mailbox, {', '.join(SENDER_FIELDS)} FROM sender_registry")
+    sender_registry.apply_rows(rows, fingerprint)
+    logger.info(f"[SENDERS] Loaded {len(rows)} sender(s), {len(sender_registry.assignable_senders())} assignable")
+    return len(rows)
+
+
+async def reload_if_changed(conn) -> bool:
+    if await _fingerprint(conn) == sender_registry._fingerprint:
+        return False
+    await load_sender_registry(conn)
+    return True
+
+
+async def upsert_sender(conn, mailbox: str, fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Insert or update one sender; only SENDER_FIELDS present in fields are written."""
+    mailbox = mailbox.strip().lower()
+    values = {k: fields[k] for k in SENDER_FIELDS if k in fields}
+    columns = ['mailbox'] + list(values)
+    placeholders = ', '.join(f'${i}' for i in range(1, len(columns) + 1))
+    updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in values) or 'mailbox = EXCLUDED.mailbox'
+    await conn.execute(
+        f"INSERT INTO sender_registry ({', '.join(columns)}) VALUES ({placeholders}) "
+        f"ON CONFLICT (mailbox) DO UPDATE SET {updates}",
+        mailbox, *values.values()
+    )
+    await load_sender_registry(conn)
+    return sender_registry.get(mailbox)
+
+
+async def sender_registry_worker(pool):
+    """Reload the registry whenever the table changes."""
+    while True:
+        await asyncio.sleep(RELOAD_SECONDS)
+        try:
+            async with pool.acquire() as conn:
+                if await reload_if_changed(conn):
+                    logger.info("[SENDERS] Sender registry reloaded after a table change")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[SENDERS] Sender registry reload failed: {e}")
+
+
+def create_sender_registry_router():
+    """Factory function to create the sender registry router"""
+    router = APIRouter()
+
+    async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())):
+        """Get current user from main module"""
+        import main
+        user = main.get_current_user(credentials)
+        if inspect.isawaitable(user):
+            user = await user
+        return user
+
+    def _pool():
+        import main
+        pool = main.get_db_pool()
+        if not pool:
+            raise HTTPException(status_code=503, detail="Database pool not available")
+        return pool
+
+    @router.get("/admin/senders")
+    async def list_senders(current_user: dict = Depends(get_current_user)):
+        """Registered senders as currently loaded (secrets are never returned)."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return {
+            'senders': sender_registry.status(),
+            'assignable': sender_registry.assignable_senders(),
+            'loaded_from_db': sender_registry.loaded_from_db,
+        }
+
+    @router.put("/admin/senders/{mailbox}")
+    async def put_sender(mailbox: str, fields: Dict[str, Any] = Body(...),
+                         current_user: dict = Depends(get_current_user)):
+        """Add or update a sender; takes effect immediately."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        unknown = sorted(set(fields) - set(SENDER_FIELDS))
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown sender fields: {', '.join(unknown)}")
+        if '@' not in mailbox:
+            raise HTTPException(status_code=400, detail="mailbox must be an email address")
+        async with _pool().acquire() as conn:
+            sender = await upsert_sender(conn, mailbox, fields)
+        return {'mailbox': sender['sender_email'], 'enabled': sender['enabled'], 'assignable': sender['assignable']}
+
+    @router.post("/admin/senders/reload")
+    async def reload_senders(current_user: dict = Depends(get_current_user)):
+        """Reload the registry from the table now."""
+        if not current_user.get('is_admin'):
+            raise HTTPException(status_code=403, detail="Admin access required")
+        async with _pool().acquire() as conn:
+            count = await load_sender_registry(conn)
+        return {'senders': count, 'assignable': sender_registry.assignable_senders()}
+
+    return router
+
+
+router = create_sender_registry_router()
@@ -0,0 +1,277 @@
+"""
+Validation Cache Module
+
+Persistent cache of external email validator results.
+
+Every result of call_validator is stored in email_validation_cache keyed
+by the normalized address, together with an outcome class and an expiry
+that depends on it: definite results (valid / invalid) are kept for days,
+inconclusive ones (unknown, catch-all, greylisted) and validator errors
+or timeouts only briefly, so they are retried soon.
+
+An in-process LRU sits in front of the table, concurrent validations of
+one address share a single validator call, and prefetch_validations()
+loads the cached results of a whole upload in one query - re-importing
+the same attendee list is served without calling the validator.
+
+This module is imported and used by main.py for email validation.
+"""
+
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta, UTC
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Time to live per outcome
+TTL_VALID = timedelta(days=float(os.getenv('EMAIL_VALIDATION_TTL_VALID_DAYS', '30')))
+TTL_INVALID = timedelta(days=float(os.getenv('EMAIL_VALIDATION_TTL_INVALID_DAYS', '7')))
+TTL_UNKNOWN = timedelta(hours=float(os.getenv('EMAIL_VALIDATION_TTL_UNKNOWN_HOURS', '6')))
+TTL_ERROR = timedelta(minutes=float(os.getenv('EMAIL_VALIDATION_TTL_ERROR_MINUTES', '15')))
+OUTCOME_TTLS = {
+    'valid': TTL_VALID,
+    'invalid': TTL_INVALID,
+    'unknown': TTL_UNKNOWN,
+    'error': TTL_ERROR,
+}
+LRU_SIZE = int(os.getenv('EMAIL_VALIDATION_LRU_SIZE', '50000'))
+
+# Validator reasons that do not settle whether the mailbox exists
+INCONCLUSIVE_MARKERS = (
+    'unknown', 'timeout', 'timed out', 'temporar', 'greylist', 'graylist', 'try again',
+    'catch-all', 'catch all', 'catchall', 'unverifiable', 'could not connect', 'rate limit',
+)
+
+Result = Dict[str, Any]
+
+
+class CachedValidationError(Exception):
+    """The validator failed for this address recently; raised until the entry expires."""
+
+
+def normalize_validation_email(email: Optional[str]) -> str:
+    return (email or '').strip().lower()
+
+
+def classify_outcome(result: Optional[Result], error: Optional[BaseException] = None) -> str:
+    """valid / invalid / unknown / error for a validator result or exception."""
+    if error is not None or not result:
+        return 'error'
+    code = result.get('code') or 0
+    if code == 0 or code >= 500 or code in (408, 429):
+        return 'error'
+    if result.get('valid'):
+        return 'valid'
+    reason = str(result.get('reason') or '').lower()
+    if any(marker in reason for marker in INCONCLUSIVE_MARKERS):
+        return 'unknown'
+    return 'invalid' if code < 300 else 'error'
+
+
+class _LRU:
+    """Address -> (result, outcome, expires_at), bounded and expiry-aware."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._items: 'OrderedDict[str, Tuple[Result, str, datetime]]' = OrderedDict()
+
+    def get(self, email: str) -> Optional[Tuple[Result, str, datetime]]:
+        entry = self._items.get(email)
+        if entry is None:
+            return None
+        if entry[2] <= datetime.now(UTC):
+            del self._items[email]
+            return None
+        self._items.move_to_end(email)
+        return entry
+
+    def put(self, email: str, result: Result, outcome: str, expires_at: datetime):
+        if self.size <= 0:
+            return
+        self._items[email] = (result, outcome, expires_at)
+        self._items.move_to_end(email)
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+_lru = _LRU(LRU_SIZE)
+_in_flight: Dict[str, asyncio.Future] = {}
+_stats = {'lru_hits': 0, 'db_hits': 0, 'misses': 0, 'stored': 0}
+
+
+async def ensure_email_validation_cache_table(conn):
+    """Create email_validation_cache and drop entries that expired long ago."""
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS email_validation_cache (
+            email TEXT PRIMARY KEY,
+            outcome TEXT NOT NULL,
+            valid BOOLEAN NOT NULL DEFAULT FALSE,
+            status_code INTEGER,
+            reason TEXT,
+            validation_result JSONB,
+            raw TEXT,
+            validated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL
+        )
+    """)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_email_validation_cache_expires ON email_validation_cache (expires_at)"
+    )
+    deleted = await conn.execute(
+        "DELETE FROM email_validation_cache "
+        "WHERE expires_at < (CURRENT_TIMESTAMP AT TIME ZONE 'UTC') - INTERVAL '7 days'"
+    )
+    logger.info(f"[VALIDATION CACHE] Ensured email_validation_cache table ({deleted})")
+
+
+def _row_entry(row) -> Tuple[Result, str, datetime]:
+    validation_result = row['validation_result']
+    if isinstance(validation_result, str):
+        try:
+            validation_result = json.loads(validation_result)
+        except ValueError:
+            pass
+    result = {
+        'code': row['status_code'],
+        'valid': row['valid'],
+        'validation_result': validation_result,
+        'reason': row['reason'],
+        'raw': row['raw'],
+        'cached': True,
+    }
+    return result, row['outcome'], row['expires_at'].replace(tzinfo=UTC)
+
+
+async def prefetch_validations(pool, emails: Iterable[str]) -> int:
+    """Load unexpired cached results for many addresses into the LRU in one query."""
+    wanted = sorted({normalize_validation_email(e) for e in emails if e} - {''})
+    missing = [e for e in wanted if _lru.get(e) is None]
+    if not missing or pool is None:
+        return 0
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT * FROM email_validation_cache
+            WHERE email = ANY($1::text[]) AND expires_at > (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        """, missing)
+    for row in rows:
+        _lru.put(row['email'], *_row_entry(row))
+    logger.info(f"[VALIDATION CACHE] Prefetched {len(rows)} of {len(missing)} uncached address(es)")
+    return len(rows)
+
+
+async def cached_validation(pool, email: str, check_db: bool = True) -> Optional[Tuple[Result, str]]:
+    """
+    (result, outcome) from the LRU or the table, or None if not cached.
+    check_db=False only looks at the LRU (after prefetch_validations).
+    """
+    email = normalize_validation_email(email)
+    entry = _lru.get(email)
+    if entry is not None:
+        _stats['lru_hits'] += 1
+        return entry[0], entry[1]
+    if pool is None or not check_db:
+        return None
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT * FROM email_validation_cache
+            WHERE email = $1 AND expires_at > (CURRENT_TIMESTAMP AT TIME ZONE 'UTC')
+        """, email)
+    if row is None:
+        return None
+    _stats['db_hits'] += 1
+    entry = _row_entry(row)
+    _lru.put(email, *entry)
+    return entry[0], entry[1]
+
+
+async def store_validation(pool, email: str, result: Optional[Result], error: Optional[BaseException] = None) -> str:
+    """Cache a validator result (or failure) with the TTL of its outcome; returns the outcome."""
+    email = normalize_validation_email(email)
+    outcome = classify_outcome(result, error)
+    now = datetime.now(UTC)
+    expires_at = now + OUTCOME_TTLS[outcome]
+    if error is not None:
+        result = {'code': 0, 'valid': False, 'validation_result': None,
+                  'reason': f"Validation error: {error}", 'raw': None}
+    _lru.put(email, dict(result, cached=True), outcome, expires_at)
+    _stats['stored'] += 1
+    if pool is None:
+        return outcome
+    validation_result = result.get('validation_result')
+    try:
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO email_validation_cache
+                    (email, outcome, valid, status_code, reason, validation_result, raw, validated_at, expires_at)
+                VALUES ($1, $2, $3, $4, $5, $6::jsonb, $7, $8, $9)
+                ON CONFLICT (email) DO UPDATE
+                SET outcome = EXCLUDED.outcome,
+                    valid = EXCLUDED.valid,
+                    status_code = EXCLUDED.status_code,
+                    reason = EXCLUDED.reason,
+                    validation_result = EXCLUDED.validation_result,
+                    raw = EXCLUDED.raw,
+                    validated_at = EXCLUDED.validated_at,
+                    expires_at = EXCLUDED.expires_at
+            """,
+                email, outcome, bool(result.get('valid')), result.get('code'),
+                str(result['reason']) if result.get('reason') is not None else None,
+                json.dumps(validation_result) if validation_result is not None else None,
+                result.get('raw'), now.replace(tzinfo=None), expires_at.replace(tzinfo=None)
+            )
+    except Exception as e:
+        logger.warning(f"[VALIDATION CACHE] Could not store result for {email}: {e}")
+    return outcome
+
+
+async def validate_with_cache(pool, email: str, validator: Callable[[str], Awaitable[Result]],
+                              check_db: bool = True) -> Result:
+    """
+    Cached result for the address, calling validator(email) on a miss.
+    Concurrent callers for one address share the call. A cached failure
+    raises CachedValidationError until its short TTL expires.
+    """
+    key = normalize_validation_email(email)
+    cached = await cached_validation(pool, key, check_db=check_db)
+    if cached is not None:
+        result, outcome = cached
+        if outcome == 'error':
+            raise CachedValidationError(result.get('reason') or 'Validator unavailable')
+        return result
+
+    pending = _in_flight.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending)
+
+    _stats['misses'] += 1
+    future = asyncio.get_running_loop().create_future()
+    _in_flight[key] = future
+    try:
+        try:
+            result = await validator(email)
+        except Exception as e:
+            # Deferred calls (validator unavailable) say nothing about the address
+            if not getattr(e, 'deferred', False):
+                await store_validation(pool, key, None, error=e)
+            future.set_exception(e)
+            raise
+        await store_validation(pool, key, result)
+        future.set_result(result)
+        return result
+    finally:
+        _in_flight.pop(key, None)
+        if future.done() and not future.cancelled():
+            future.exception()  # mark retrieved when nobody else was waiting
+        elif not future.done():
+            future.cancel()
+
+
+def cache_stats() -> Dict[str, Any]:
+    return dict(_stats, lru_entries=len(_lru), in_flight=len(_in_flight))